@@ -169,7 +169,7 @@ export default function App() {
       const res = await fetch('http://localhost:8000/api/analyze', { method: 'POST', body: formData });
       if (!res.ok) throw new Error(`Error del servidor: ${res.status}`);
       const data = await res.json();
-      if (data.status === 'success') {
+      if (data.status === 'success' || data.status === 'parcial') {  // parcial: SLO vencido, alertas con lo no verificado
         if (data.report) {
           setResult(data.report);
         }
@@ -0,0 +1,230 @@
+"""
+Control de admisión de análisis por worker: colas acotadas, cuotas por cliente y carriles.
+
+Cada worker ejecuta a lo sumo FRAUDE_WORKER_CONCURRENCY análisis a la vez. Las peticiones
+que llegan con los cupos ocupados esperan en la cola de su carril:
+
+- "interactiva" (por defecto; la mesa de ayuda de RR. HH.) y "lote" (`X-Lane: batch`,
+  auditorías masivas). Al liberarse un cupo se atiende primero la cola interactiva, y el
+  carril de lote nunca ocupa más de FRAUDE_ADMISION_CUPOS_LOTE cupos (por defecto todos
+  menos uno), así una auditoría no deja sin servicio a las cargas interactivas. Con un
+  solo cupo el lote no tiene ninguno y sus peticiones se rechazan: el cupo queda
+  reservado a la carga interactiva salvo que FRAUDE_ADMISION_CUPOS_LOTE=1 lo comparta.
+- La profundidad de cada cola está acotada (FRAUDE_ADMISION_COLA_INTERACTIVA, 16;
+  FRAUDE_ADMISION_COLA_LOTE, 64) y cada cliente (API key o IP) tiene una cuota de
+  peticiones en curso + en cola (FRAUDE_ADMISION_CUOTA_CLIENTE, 4;
+  FRAUDE_ADMISION_CUOTA_CLIENTE_LOTE, 32). Dentro de un carril los clientes se atienden
+  por turnos, no por orden de llegada.
+
+Lo que no cabe se rechaza de inmediato (`Overloaded` → 429) con un Retry-After estimado
+a partir de la tasa de servicio observada: promedio móvil de la duración de los análisis
+del carril (FRAUDE_ADMISION_SERVICIO_S, 40 s, hasta tener mediciones).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import math
+import time
+from collections import Counter, OrderedDict, deque
+from dataclasses import dataclass, field
+
+from ..settings import env_float, env_int
+
+INTERACTIVE = "interactiva"
+BATCH = "lote"
+EWMA_ALPHA = 0.2
+
+
+class Overloaded(Exception):
+    """Petición rechazada por la admisión; `retry_after` en segundos."""
+
+    def __init__(self, motivo: str, retry_after: int):
+        super().__init__(motivo)
+        self.motivo = motivo
+        self.retry_after = retry_after
+
+
+@dataclass
+class Lane:
+    nombre: str
+    max_activos: int
+    max_cola: int
+    cuota_cliente: int
+    servicio_s: float
+    activos: int = 0
+    # Cliente → futuros en espera; el orden de las claves es el turno de atención
+    esperando: OrderedDict[str, deque[asyncio.Future]] = field(default_factory=OrderedDict)
+    por_cliente: Counter = field(default_factory=Counter)
+    atendidas: int = 0
+    rechazadas: Counter = field(default_factory=Counter)
+
+    @property
+    def en_cola(self) -> int:
+        return sum(len(q) for q in self.esperando.values())
+
+    def observe(self, duracion_s: float) -> None:
+        self.servicio_s += EWMA_ALPHA * (duracion_s - self.servicio_s)
+        self.atendidas += 1
+
+    def pop_next(self) -> asyncio.Future | None:
+        """Siguiente espera, por turnos entre clientes."""
+        if not self.esperando:
+            return None
+        cliente, cola = next(iter(self.esperando.items()))
+        future = cola.popleft()
+        if cola:
+            self.esperando.move_to_end(cliente)
+        else:
+            del self.esperando[cliente]
+        return future
+
+    def remove(self, cliente: str, future: asyncio.Future) -> None:
+        cola = self.esperando.get(cliente)
+        if cola is not None and future in cola:
+            cola.remove(future)
+            if not cola:
+                del self.esperando[cliente]
+
+
+class Ticket:
+    """Lugar admitido en un carril; `async with ticket` espera el cupo y lo libera al salir."""
+
+    def __init__(self, controller: AdmissionController, lane: Lane, cliente: str):
+        self.controller, self.lane, self.cliente = controller, lane, cliente
+        self.future: asyncio.Future | None = None
+        self.espera_s = 0.0
+        self._inicio = 0.0
+        self._estado = "admitido"  # admitido → activo → liberado
+        self._retenido: asyncio.Future | None = None
+
+    async def __aenter__(self) -> Ticket:
+        llegada = time.perf_counter()
+        if self.future is not None:
+            try:
+                await self.future
+            except asyncio.CancelledError:
+                self.controller._abandon(self)
+                raise
+        self._estado = "activo"
+        self._inicio = time.perf_counter()
+        self.espera_s = self._inicio - llegada
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        if self._retenido is not None and not self._retenido.done():
+            return  # lo libera `hold_until` al terminar la tarea
+        self.controller._finish(self, time.perf_counter() - self._inicio)
+
+    def hold_until(self, task: asyncio.Future) -> None:
+        """Conserva el cupo hasta que termine `task` aunque se salga antes del `async with`
+        (un análisis que sigue en su hilo después de responder fuera de plazo)."""
+        self._retenido = task
+        task.add_done_callback(lambda _: self.controller._finish(self, time.perf_counter() - self._inicio))
+
+    def cancel(self) -> None:
+        """Devuelve el lugar sin ejecutar (p. ej. el resultado salió de la caché)."""
+        if self._estado == "admitido":
+            self.controller._abandon(self)
+
+
+class AdmissionController:
+    def __init__(self, cupos: int, lanes: dict[str, Lane]):
+        self.cupos = cupos
+        self.lanes = lanes
+
+    @classmethod
+    def from_env(cls) -> AdmissionController:
+        cupos = max(1, env_int("FRAUDE_WORKER_CONCURRENCY", 1))
+        servicio = env_float("FRAUDE_ADMISION_SERVICIO_S", 40.0)
+        return cls(cupos, {
+            INTERACTIVE: Lane(INTERACTIVE, cupos, max(0, env_int("FRAUDE_ADMISION_COLA_INTERACTIVA", 16)),
+                              max(1, env_int("FRAUDE_ADMISION_CUOTA_CLIENTE", 4)), servicio),
+            BATCH: Lane(BATCH, min(cupos, max(0, env_int("FRAUDE_ADMISION_CUPOS_LOTE", cupos - 1))),
+                        max(0, env_int("FRAUDE_ADMISION_COLA_LOTE", 64)),
+                        max(1, env_int("FRAUDE_ADMISION_CUOTA_CLIENTE_LOTE", 32)), servicio),
+        })
+
+    @property
+    def activos(self) -> int:
+        return sum(lane.activos for lane in self.lanes.values())
+
+    def _can_start(self, lane: Lane) -> bool:
+        return self.activos < self.cupos and lane.activos < lane.max_activos
+
+    def retry_after(self, lane: Lane, adelante: int | None = None) -> int:
+        """Segundos estimados hasta que haya lugar: trabajo por delante / tasa de servicio del carril."""
+        adelante = lane.en_cola + 1 if adelante is None else adelante
+        if lane.nombre == BATCH:  # la cola interactiva pasa antes
+            adelante += self.lanes[INTERACTIVE].en_cola
+        return max(1, min(3600, math.ceil(adelante * lane.servicio_s / max(1, lane.max_activos))))
+
+    def admit(self, lane_name: str, cliente: str) -> Ticket:
+        """Reserva un lugar o lanza `Overloaded` (sin esperar)."""
+        lane = self.lanes[lane_name]
+        if lane.max_activos == 0:  # carril sin cupos propios: encolar sería esperar para siempre
+            lane.rechazadas["sin_cupos"] += 1
+            raise Overloaded("sin_cupos", 3600)
+        if lane.por_cliente[cliente] >= lane.cuota_cliente:
+            lane.rechazadas["cuota_cliente"] += 1
+            raise Overloaded("cuota_cliente", self.retry_after(lane, lane.por_cliente[cliente]))
+        ticket = Ticket(self, lane, cliente)
+        if self._can_start(lane) and not lane.esperando and not (
+            lane.nombre == BATCH and self.lanes[INTERACTIVE].esperando
+        ):
+            lane.activos += 1
+        elif lane.en_cola >= lane.max_cola:
+            lane.rechazadas["cola_llena"] += 1
+            raise Overloaded("cola_llena", self.retry_after(lane))
+        else:
+            ticket.future = asyncio.get_running_loop().create_future()
+            lane.esperando.setdefault(cliente, deque()).append(ticket.future)
+        lane.por_cliente[cliente] += 1
+        return ticket
+
+    def _dispatch(self) -> None:
+        """Asigna los cupos libres: primero la cola interactiva, luego la de lote."""
+        for lane in (self.lanes[INTERACTIVE], self.lanes[BATCH]):
+            while lane.esperando and self._can_start(lane):
+                future = lane.pop_next()
+                if future.done():  # cancelada mientras esperaba: `_abandon` descuenta al cliente
+                    continue
+                lane.activos += 1
+                future.set_result(None)
+
+    def _abandon(self, ticket: Ticket) -> None:
+        lane = ticket.lane
+        if ticket.future is not None and (not ticket.future.done() or ticket.future.cancelled()):
+            lane.remove(ticket.cliente, ticket.future)  # seguía en cola
+            ticket.future.cancel()
+        else:
+            lane.activos -= 1  # ya tenía cupo asignado
+        lane.por_cliente[ticket.cliente] -= 1
+        ticket._estado = "liberado"
+        self._dispatch()
+
+    def _finish(self, ticket: Ticket, duracion_s: float) -> None:
+        if ticket._estado != "activo":
+            return
+        lane = ticket.lane
+        lane.activos -= 1
+        lane.por_cliente[ticket.cliente] -= 1
+        lane.observe(duracion_s)
+        ticket._estado = "liberado"
+        self._dispatch()
+
+    def stats(self) -> dict:
+        return {
+            "cupos": self.cupos,
+            "activos": self.activos,
+            "carriles": {
+                nombre: {
+                    "activos": lane.activos, "max_activos": lane.max_activos, "en_cola": lane.en_cola,
+                    "max_cola": lane.max_cola, "clientes": sum(1 for v in lane.por_cliente.values() if v > 0),
+                    "cuota_cliente": lane.cuota_cliente, "servicio_s": round(lane.servicio_s, 2),
+                    "atendidas": lane.atendidas, "rechazadas": dict(lane.rechazadas),
+                    "retry_after_s": self.retry_after(lane),
+                }
+                for nombre, lane in self.lanes.items()
+            },
+        }
@@ -1,14 +1,20 @@
 import os
 import sys
 import io
-import json
-import re
+import asyncio
+import hashlib
+import logging
+import time
+import uuid
+from contextlib import asynccontextmanager
+from datetime import date
 from pathlib import Path
 
 # Agregar src a sys.path para que no dependa de poetry para encontrar 'fraude_incapacidades'
 sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
 
-from fastapi import FastAPI, File, UploadFile
+from fastapi import FastAPI, File, Header, HTTPException, Query, Request, UploadFile
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
@@ -18,12 +24,6 @@ if sys.stdout.encoding and sys.stdout.encoding.lower() != 'utf-8':
 if sys.stderr.encoding and sys.stderr.encoding.lower() != 'utf-8':
     sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
 
-# Redirigir stdout/stderr para diagnosticar bloqueos de CrewAI
-log_file = Path(__file__).resolve().parents[3] / "src" / "crewai_debug.log"
-sys.stdout = open(log_file, "a", encoding="utf-8", buffering=1)
-sys.stderr = sys.stdout
-
-
 # Cargar variables de entorno desde .env
 _ENV_PATH = Path(__file__).resolve().parents[3] / ".env"
 
@@ -39,13 +39,88 @@ except ImportError:
                 key, val = line.split("=", 1)
                 os.environ[key.strip()] = val.strip()
 
-# Importamos el Crew para ejecutar la lógica de la IA
-from fraude_incapacidades.crew import crew
+# Importamos el Crew para ejecutar la lógica de la IA (se construye por hilo, no al importar)
+from fraude_incapacidades.api.admission import BATCH, INTERACTIVE, AdmissionController, Overloaded, Ticket
+from fraude_incapacidades.cascade import partial_report, run_analysis
+from fraude_incapacidades.deadline import Deadline, analysis_deadline, request_deadline, slo_margin
+from fraude_incapacidades.llm.clients import aclose_clients, close_clients
+from fraude_incapacidades.llm.scheduler import PRIORITY_BATCH, PRIORITY_INTERACTIVE, get_scheduler, llm_priority
+from fraude_incapacidades.llm.usage import token_ledger
+from fraude_incapacidades.forensics.templates import learn_from_analysis
+from fraude_incapacidades.report import StructuredReport, parse_crew_result, record_analysis
+from fraude_incapacidades.pipeline import locate_upload, reanalyze_document
+from fraude_incapacidades.logs import log_context, log_stage, setup_logging, shutdown_logging
+from fraude_incapacidades.profiling import (
+    Profile, collapsed, load_profile, new_profile, profile_run, save_profile, trace_events, wants_profile,
+)
+from fraude_incapacidades.settings import env_int, worker_count
+from fraude_incapacidades.storage.cache import cache_get, cache_set, get_cache, ttl_for
+from fraude_incapacidades.storage.history import get_history_store
+
+logger = logging.getLogger("fraude_incapacidades.api")
+
+# Ruta donde se guardarán temporalmente los archivos subidos
+UPLOAD_DIR = Path(__file__).resolve().parents[3] / "test" / "uploads"
+
+# Análisis simultáneos por worker (cada uno en un hilo con su propio Crew), con colas
+# acotadas por carril y cuotas por cliente (api/admission.py)
+_admission: AdmissionController | None = None
+
+
+def _admission_control() -> AdmissionController:
+    global _admission
+    if _admission is None:
+        _admission = AdmissionController.from_env()
+    return _admission
+
+
+def _admit(request: Request) -> Ticket:
+    """Reserva lugar para la petición o responde 429 con Retry-After.
+
+    El carril sale de `X-Lane` ("batch"/"lote" para auditorías masivas) y el cliente de
+    `X-API-Key` (solo se guarda su hash) o, sin ella, de la IP.
+    """
+    lane = BATCH if (request.headers.get("x-lane") or "").strip().lower() in ("batch", "lote") else INTERACTIVE
+    api_key = request.headers.get("x-api-key")
+    cliente = "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:12] if api_key else \
+        "ip:" + (request.client.host if request.client else "desconocido")
+    try:
+        return _admission_control().admit(lane, cliente)
+    except Overloaded as e:
+        logger.warning("petición rechazada por admisión",
+                       extra={"carril": lane, "motivo": e.motivo, "retry_after_s": e.retry_after})
+        raise HTTPException(status_code=429, detail=f"Servicio saturado ({e.motivo}); reintente más tarde",
+                            headers={"Retry-After": str(e.retry_after)})
+
+
+def worker_startup() -> None:
+    """Estado por proceso worker: logging, directorios, caché e índices compartidos."""
+    setup_logging()
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    purgadas = get_cache().purge_expired()
+    get_history_store()
+    _admission_control()
+    logger.info(
+        "worker iniciado", extra={"pid": os.getpid(), "workers": worker_count(),
+                                  "concurrencia": env_int("FRAUDE_WORKER_CONCURRENCY", 1),
+                                  "cache_purgadas": purgadas},
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    worker_startup()
+    yield
+    await aclose_clients()
+    close_clients()
+    shutdown_logging()
+
 
 app = FastAPI(
     title="Fraude Incapacidades API",
     description="API para procesar certificados médicos usando CrewAI",
-    version="2.0.0"
+    version="2.0.0",
+    lifespan=lifespan,
 )
 
 # Configurar CORS para permitir acceso desde nuestro frontend en Vite (puertos 5173, etc.)
@@ -57,18 +132,24 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Ruta donde se guardarán temporalmente los archivos subidos
-UPLOAD_DIR = Path(__file__).resolve().parents[3] / "test" / "uploads"
-UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
-
-class StructuredReport(BaseModel):
-    puntaje_veracidad: int = 0
-    hallazgos_medicos: str = ""
-    analisis_forense: str = ""
-    verificacion_entidades: str = ""
-    alertas: list[str] = []
-    veredicto: str = "Indeterminado"
+@app.middleware("http")
+async def request_logging(request: Request, call_next):
+    """Asigna un request_id (o respeta X-Request-ID) a todos los registros de la petición."""
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex[:16]
+    inicio = time.perf_counter()
+    with log_context(request_id=request_id):
+        try:
+            response = await call_next(request)
+        except Exception:
+            logger.exception("petición fallida", extra={"metodo": request.method, "ruta": request.url.path})
+            raise
+        logger.info(
+            "petición", extra={"metodo": request.method, "ruta": request.url.path, "status": response.status_code,
+                               "duracion_ms": round((time.perf_counter() - inicio) * 1000, 1)},
+        )
+    response.headers["X-Request-ID"] = request_id
+    return response
 
 
 class AnalysisResponse(BaseModel):
@@ -76,76 +157,305 @@ class AnalysisResponse(BaseModel):
     report: StructuredReport | None = None
     raw_report: str = ""
     error: str | None = None
+    analysis_id: str | None = None
+    cached: bool = False
+
 
+def _save_upload(filename: str | None, content: bytes) -> tuple[Path, str]:
+    """Guarda el archivo en test/uploads/<hash>/<nombre> de forma atómica.
 
-def _parse_crew_result(result) -> tuple[StructuredReport | None, str]:
-    """Parsea el resultado del crew intentando extraer JSON estructurado."""
-    raw_text = ""
-    if isinstance(result, str):
-        raw_text = result
-    elif hasattr(result, "raw"):
-        raw_text = str(result.raw)
-    elif hasattr(result, "output"):
-        raw_text = str(result.output)
-    else:
-        raw_text = str(result)
-
-    # Try to extract JSON from the text (it may be wrapped in markdown code blocks)
-    json_match = re.search(r'\{[\s\S]*\}', raw_text)
-    if json_match:
+    Varios workers pueden recibir a la vez archivos con el mismo nombre: el
+    subdirectorio por contenido evita que uno sobrescriba al otro a mitad de análisis.
+    """
+    doc_id = hashlib.sha256(content).hexdigest()  # igual a storage.extractions.document_id
+    target = UPLOAD_DIR / doc_id[:16] / (Path(filename or "documento").name or "documento")
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_name(f".{target.name}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp")
+    tmp.write_bytes(content)
+    os.replace(tmp, target)
+    return target, doc_id
+
+
+def _run_crew(file_path: Path, tiempos: dict, perfil: Profile | None = None, lane: str = INTERACTIVE,
+              plazo: Deadline | None = None):
+    # Prioridad ante OpenAI según el carril; corre en un hilo del pool con su propio Crew
+    # (o la cascada, FRAUDE_ANALYSIS_MODE=cascade). Los tokens por etapa quedan en
+    # tiempos["tokens"] y, si se pidió perfil, su resumen en tiempos["perfil"] (también
+    # si el análisis falla). Si falla por haber agotado el plazo se devuelve el informe
+    # parcial con lo verificado a tiempo.
+    prioridad = PRIORITY_BATCH if lane == BATCH else PRIORITY_INTERACTIVE
+    with llm_priority(prioridad), token_ledger() as ledger, analysis_deadline(plazo):
         try:
-            data = json.loads(json_match.group())
-            report = StructuredReport(
-                puntaje_veracidad=int(data.get("puntaje_veracidad", 0)),
-                hallazgos_medicos=str(data.get("hallazgos_medicos", "")),
-                analisis_forense=str(data.get("analisis_forense", "")),
-                verificacion_entidades=str(data.get("verificacion_entidades", "")),
-                alertas=data.get("alertas", []),
-                veredicto=str(data.get("veredicto", "Indeterminado")),
-            )
-            return report, raw_text
-        except (json.JSONDecodeError, ValueError, TypeError):
-            pass
-
-    # Fallback: return as raw text
-    return None, raw_text
+            with profile_run(perfil):
+                try:
+                    return run_analysis(str(file_path), tiempos)
+                except Exception as e:
+                    if plazo is None or not plazo.expired():
+                        raise
+                    logger.warning("plazo del análisis vencido: %s", e, extra={"archivo": file_path.name})
+                    return partial_report(str(file_path), plazo.snapshot())
+        finally:
+            tiempos["tokens"] = ledger.resumen()
+            if perfil is not None:
+                tiempos["perfil"] = perfil.resumen()
+
+
+async def _analyze(file_path: Path, tiempos: dict, perfil: Profile | None, ticket: Ticket, plazo: Deadline | None):
+    """Ejecuta el análisis en un hilo. Si no vuelve dentro del plazo (más medio margen)
+    responde con el informe parcial; el hilo termina por su cuenta, sin que sus consultas
+    ni llamadas a OpenAI pasen ya del plazo, y conserva el cupo de admisión hasta entonces.
+    Con el plazo ya vencido al salir de la cola ni siquiera se lanza."""
+    if plazo is not None and plazo.expired():
+        logger.warning("plazo agotado en la cola; se responde con el informe parcial",
+                       extra={"archivo": file_path.name, "cola_s": tiempos.get("cola_s")})
+        return await asyncio.to_thread(partial_report, str(file_path), plazo.snapshot())
+    lane = ticket.lane.nombre
+    task = asyncio.ensure_future(asyncio.to_thread(_run_crew, file_path, tiempos, perfil, lane, plazo))
+    if plazo is None:
+        return await task
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), timeout=plazo.remaining() + slo_margin() / 2)
+    except asyncio.TimeoutError:
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())  # sin "exception never retrieved"
+        ticket.hold_until(task)  # el hilo sigue ocupando el worker: el cupo se libera cuando termine
+        logger.warning("análisis fuera de plazo; se responde con el informe parcial", extra={"archivo": file_path.name})
+        return await asyncio.to_thread(partial_report, str(file_path), plazo.snapshot())
 
 
 @app.post("/api/analyze", response_model=AnalysisResponse)
-async def analyze_certificate(file: UploadFile = File(...)):
+async def analyze_certificate(request: Request, file: UploadFile = File(...),
+                              x_profile: str | None = Header(default=None)):
     """
     Endpoint para subir un certificado (PDF/Imagen) y ejecutar el pipeline de CrewAI.
     Retorna un informe estructurado con puntaje, hallazgos, análisis forense y veredicto.
+    Con `X-Profile: 1` el análisis se perfila (GET /api/history/{analysis_id}/profile).
+    Con el worker saturado responde 429 con Retry-After (ver `_admit`). Si el análisis no
+    termina dentro del SLO (FRAUDE_SLO_S) responde `status="parcial"` con las verificaciones
+    pendientes en `report.no_verificados`.
     """
+    inicio = time.perf_counter()
+    ticket = _admit(request)
+    tiempos: dict = {}
+    perfil = new_profile(wants_profile(x_profile))
+    file_path = UPLOAD_DIR / Path(file.filename or "documento").name
+    doc_id = None
+    result = None
     try:
         # Guardar archivo temporal en test/uploads/
-        file_path = UPLOAD_DIR / file.filename
-        with open(file_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
+        file_path, doc_id = await asyncio.to_thread(_save_upload, file.filename, await file.read())
+        tiempos["carga_s"] = round(time.perf_counter() - inicio, 3)
+
+        # El mismo documento ya dictaminado (por cualquier worker) se responde desde la caché,
+        # salvo que se pida perfil: ese análisis se ejecuta de nuevo
+        cached = await asyncio.to_thread(cache_get, "resultados", doc_id) if perfil is None else None
+        if cached is not None:
+            logger.info("resultado desde caché", extra={"archivo": file_path.name, "doc_id": doc_id})
+            return AnalysisResponse(**cached, cached=True)
         
         # Ejecutar el CrewAI con la ruta del archivo
-        result = crew.kickoff(inputs={
-            "file_path": str(file_path)
-        })
+        t_crew = time.perf_counter()
+        async with ticket:
+            tiempos["cola_s"] = round(ticket.espera_s, 3)
+            # El SLO cuenta desde que llegó la petición: la carga y la cola consumen plazo
+            plazo = request_deadline(time.perf_counter() - inicio, lote=ticket.lane.nombre == BATCH)
+            with log_stage(logger, "crew", archivo=file_path.name, doc_id=doc_id, carril=ticket.lane.nombre):
+                result = await _analyze(file_path, tiempos, perfil, ticket, plazo)
+        tiempos["crew_s"] = round(time.perf_counter() - t_crew, 3)
         
         # Parse structured report
-        report, raw_text = _parse_crew_result(result)
+        report, raw_text = parse_crew_result(result)
+        status = "parcial" if getattr(result, "parcial", False) else "success"
+        if plazo is not None:
+            tiempos["plazo"] = {"s": round(plazo.segundos, 3), "vencido": plazo.expired()}
+
+        # Los documentos dictaminados como válidos alimentan la biblioteca de plantillas
+        if status == "success" and report is not None:
+            try:
+                learn_from_analysis(file_path, doc_id, report.veredicto, report.puntaje_veracidad)
+            except Exception as e:
+                logger.warning("No se pudo aprender la plantilla de %s: %s", file_path.name, e)
+
+        tiempos["total_s"] = round(time.perf_counter() - inicio, 3)
+        analysis_id = record_analysis(file_path, doc_id, status, report, raw_text, result, tiempos, None)
+        _save_profile(analysis_id, perfil)
+        logger.info(
+            "análisis completado", extra={"archivo": file_path.name, "doc_id": doc_id, "analysis_id": analysis_id,
+                                          "veredicto": report.veredicto if report else None, "status": status,
+                                          "tiempos": tiempos},
+        )
         
-        return AnalysisResponse(
-            status="success",
+        response = AnalysisResponse(
+            status=status,
             report=report,
             raw_report=raw_text,
-            error=None
+            error=None,
+            analysis_id=analysis_id,
         )
+        if status == "success" and report is not None:  # un informe parcial no se reutiliza
+            cache_set("resultados", doc_id, response.model_dump(exclude={"cached"}), ttl_for("resultados", 86400))
+        return response
         
     except Exception as e:
+        tiempos["total_s"] = round(time.perf_counter() - inicio, 3)
+        analysis_id = record_analysis(file_path, doc_id, "error", None, "", result, tiempos, str(e))
+        _save_profile(analysis_id, perfil)
+        logger.exception(
+            "análisis fallido", extra={"archivo": file_path.name, "doc_id": doc_id, "analysis_id": analysis_id,
+                                       "tiempos": tiempos},
+        )
         return AnalysisResponse(
             status="error",
             report=None,
             raw_report="",
-            error=str(e)
+            error=str(e),
+            analysis_id=analysis_id,
         )
+    finally:
+        ticket.cancel()  # lugar sin usar (resultado en caché o fallo antes del análisis)
+
+
+def _save_profile(analysis_id: str | None, perfil: Profile | None) -> None:
+    try:
+        save_profile(analysis_id, perfil)
+    except Exception as e:
+        logger.warning("No se pudo guardar el perfil del análisis %s: %s", analysis_id, e)
+
+
+def _history_filters(desde, hasta, eps, medico_documento, paciente_documento, cie10, veredicto, status) -> dict:
+    return {
+        "desde": desde.isoformat() if desde else None,
+        "hasta": hasta.isoformat() if hasta else None,
+        "eps": eps.upper() if eps else None,
+        "medico_documento": medico_documento,
+        "paciente_documento": paciente_documento,
+        "cie10": cie10,
+        "veredicto": veredicto,
+        "status": status,
+    }
+
+
+@app.get("/api/history")
+def list_history(
+    desde: date | None = None,
+    hasta: date | None = None,
+    eps: str | None = None,
+    medico_documento: str | None = None,
+    paciente_documento: str | None = None,
+    cie10: str | None = None,
+    veredicto: str | None = None,
+    status: str | None = None,
+    page: int = Query(1, ge=1),
+    page_size: int = Query(50, ge=1, le=500),
+):
+    """Consulta paginada del historial de análisis."""
+    filters = _history_filters(desde, hasta, eps, medico_documento, paciente_documento, cie10, veredicto, status)
+    return get_history_store().query(filters, page=page, page_size=page_size)
+
+
+@app.get("/api/history/export")
+def export_history(
+    formato: str = Query("csv", pattern="^(csv|parquet)$"),
+    desde: date | None = None,
+    hasta: date | None = None,
+    eps: str | None = None,
+    medico_documento: str | None = None,
+    paciente_documento: str | None = None,
+    cie10: str | None = None,
+    veredicto: str | None = None,
+    status: str | None = None,
+):
+    """Exportación en streaming (CSV o Parquet) del historial filtrado."""
+    filters = _history_filters(desde, hasta, eps, medico_documento, paciente_documento, cie10, veredicto, status)
+    store = get_history_store()
+    if formato == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise HTTPException(status_code=501, detail="Exportación Parquet requiere: pip install pyarrow")
+        return StreamingResponse(
+            store.export_parquet(filters),
+            media_type="application/vnd.apache.parquet",
+            headers={"Content-Disposition": 'attachment; filename="historial.parquet"'},
+        )
+    return StreamingResponse(
+        store.export_csv(filters),
+        media_type="text/csv; charset=utf-8",
+        headers={"Content-Disposition": 'attachment; filename="historial.csv"'},
+    )
+
+
+@app.get("/api/history/{analysis_id}")
+def get_history_item(analysis_id: str):
+    """Detalle completo de un análisis (dictamen, extracción, salidas de tareas, tiempos)."""
+    item = get_history_store().get(analysis_id)
+    if item is None:
+        raise HTTPException(status_code=404, detail="Análisis no encontrado")
+    return item
+
+
+@app.get("/api/history/{analysis_id}/profile")
+def get_history_profile(analysis_id: str, formato: str = Query("json", pattern="^(json|collapsed|trace)$")):
+    """Perfil de un análisis pedido con `X-Profile: 1`: línea de tiempo y pilas muestreadas
+    (json), pilas colapsadas para flamegraph.pl/speedscope (collapsed) o Trace Event (trace)."""
+    perfil = load_profile(analysis_id)
+    if perfil is None:
+        raise HTTPException(status_code=404, detail="El análisis no tiene perfil")
+    if formato == "collapsed":
+        return PlainTextResponse(collapsed(perfil))
+    if formato == "trace":
+        return trace_events(perfil)
+    return perfil
+
+
+class ReanalysisResponse(AnalysisResponse):
+    etapas: dict[str, str] = {}
+
+
+@app.post("/api/history/{analysis_id}/reanalyze", response_model=ReanalysisResponse)
+async def reanalyze_history_item(analysis_id: str, request: Request):
+    """Re-analiza el documento de un análisis por el DAG de etapas memoizadas; solo se
+    recalculan las etapas invalidadas (`etapas`: hit/miss por etapa)."""
+    item = await asyncio.to_thread(get_history_store().get, analysis_id)
+    if item is None:
+        raise HTTPException(status_code=404, detail="Análisis no encontrado")
+    if not item.get("doc_id"):
+        raise HTTPException(status_code=409, detail="El análisis no tiene documento asociado")
+    doc_id, archivo = item["doc_id"], item.get("archivo") or "documento"
+    async with _admit(request) as ticket:
+        with log_stage(logger, "reanalisis", archivo=archivo, doc_id=doc_id, carril=ticket.lane.nombre):
+            fila = await asyncio.to_thread(_reanalyze, doc_id, archivo, ticket.lane.nombre)
+    if fila["status"] == "success" and fila.get("reporte"):
+        cache_set("resultados", doc_id,
+                  AnalysisResponse(status="success", report=fila["reporte"], raw_report=fila["raw_report"],
+                                   analysis_id=fila["analysis_id"]).model_dump(exclude={"cached"}),
+                  ttl_for("resultados", 86400))
+    return ReanalysisResponse(status=fila["status"], report=fila.get("reporte"), raw_report=fila.get("raw_report", ""),
+                              error=fila.get("error"), analysis_id=fila.get("analysis_id"),
+                              etapas=fila.get("etapas") or {})
+
+
+def _reanalyze(doc_id: str, archivo: str, lane: str = INTERACTIVE) -> dict:
+    with llm_priority(PRIORITY_BATCH if lane == BATCH else PRIORITY_INTERACTIVE):
+        return reanalyze_document(doc_id, locate_upload(doc_id, archivo, UPLOAD_DIR), archivo)
+
+
+@app.get("/api/llm/stats")
+def llm_stats():
+    """Estado de la cola y del throttling del planificador global de OpenAI."""
+    return get_scheduler().stats()
+
+
+@app.get("/api/admission/stats")
+def admission_stats():
+    """Cupos, colas, rechazos y tasa de servicio por carril de este worker."""
+    return dict(_admission_control().stats(), pid=os.getpid())
+
+
+@app.get("/api/cache/stats")
+def cache_stats():
+    """Entradas vigentes por espacio (compartidas) y aciertos/fallos de este worker."""
+    return dict(get_cache().stats(), pid=os.getpid())
+
 
 @app.get("/")
 def read_root():
@@ -0,0 +1,313 @@
+"""
+Auditoría en lote de un árbol de directorios (`fraude-incapacidades audit <dir>`).
+
+Los análisis corren en un pool de procesos (cada uno con su propio Crew, logs por
+pid y su parte del presupuesto de OpenAI) y el proceso principal:
+
+- recorre el árbol y calcula el SHA-256 de cada archivo antes de enviarlo, para
+  omitir duplicados y documentos que ya tienen un análisis exitoso en el historial;
+- escribe cada resultado como una línea JSONL apenas termina y lo registra en un
+  checkpoint SQLite (`<salida>.checkpoint.sqlite`), de modo que una corrida
+  interrumpida se retoma donde quedó sin volver a leer los archivos ya hechos;
+- imprime avance, throughput y ETA en stderr.
+
+Los archivos con error se consideran terminados al retomar, salvo `--retry-errors`.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterator, TextIO
+
+from .storage.extractions import document_id
+from .storage.history import get_history_store
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_EXTENSIONS = (".pdf", ".png", ".jpg", ".jpeg")
+
+
+def iter_documents(root: Path) -> Iterator[Path]:
+    """Certificados bajo `root` en orden estable (el mismo en cada corrida)."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.lower().endswith(SUPPORTED_EXTENSIONS) and not name.startswith("."):
+                yield Path(dirpath) / name
+
+
+class Checkpoint:
+    """Estado por archivo de una auditoría (ruta, tamaño, mtime, hash y resultado)."""
+
+    def __init__(self, path: Path | str):
+        self.path = str(path)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS archivos ("
+            " ruta TEXT PRIMARY KEY, tamano INTEGER, mtime_ns INTEGER, doc_id TEXT,"
+            " estado TEXT NOT NULL, analysis_id TEXT, actualizado REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ix_archivos_doc ON archivos (doc_id)")
+        self.conn.commit()
+
+    def is_done(self, path: Path, stat: os.stat_result, retry_errors: bool = False) -> bool:
+        row = self.conn.execute(
+            "SELECT tamano, mtime_ns, estado FROM archivos WHERE ruta = ?", (str(path),)
+        ).fetchone()
+        if row is None or (row[0], row[1]) != (stat.st_size, stat.st_mtime_ns):
+            return False
+        return not (retry_errors and row[2] == "error")
+
+    def analyzed(self, doc_id: str) -> str | None:
+        """Id del análisis exitoso de este contenido en la corrida (si lo hay)."""
+        row = self.conn.execute(
+            "SELECT analysis_id FROM archivos WHERE doc_id = ? AND estado = 'success' LIMIT 1", (doc_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def mark(self, path: Path, stat: os.stat_result, doc_id: str | None, estado: str,
+             analysis_id: str | None) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO archivos VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (str(path), stat.st_size, stat.st_mtime_ns, doc_id, estado, analysis_id, time.time()),
+        )
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def _repair_tail(path: Path) -> None:
+    """Recorta una última línea a medio escribir (corrida interrumpida en plena escritura)."""
+    if not path.exists() or path.stat().st_size == 0:
+        return
+    with open(path, "rb+") as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) == b"\n":
+            return
+        size = f.seek(0, os.SEEK_END)
+        block = min(size, 1 << 20)
+        f.seek(size - block)
+        tail = f.read(block)
+        cut = tail.rfind(b"\n")
+        f.truncate(size - block + cut + 1 if cut >= 0 else 0)
+
+
+@dataclass
+class Progress:
+    total: int
+    inicio: float = field(default_factory=time.monotonic)
+    analizados: int = 0
+    errores: int = 0
+    omitidos: int = 0
+    ya_hechos: int = 0
+    _ultimo: float = 0.0
+
+    @property
+    def pendientes(self) -> int:
+        return self.total - self.analizados - self.errores - self.omitidos - self.ya_hechos
+
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.inicio
+        return (self.analizados + self.errores) / elapsed if elapsed > 0 else 0.0
+
+    def line(self) -> str:
+        rate = self.rate()
+        hechos = self.total - self.pendientes
+        eta = _format_eta(self.pendientes / rate) if rate > 0 else "--"
+        return (
+            f"[audit] {hechos}/{self.total} · {rate:.2f} docs/s · ETA {eta} · "
+            f"ok {self.analizados} · errores {self.errores} · omitidos {self.omitidos} · "
+            f"checkpoint {self.ya_hechos}"
+        )
+
+    def report(self, out: TextIO, every_s: float, force: bool = False) -> None:
+        now = time.monotonic()
+        if force or now - self._ultimo >= every_s:
+            self._ultimo = now
+            print(self.line(), file=out, flush=True)
+
+
+def _format_eta(seconds: float) -> str:
+    seconds = int(seconds)
+    h, rem = divmod(seconds, 3600)
+    m, s = divmod(rem, 60)
+    return f"{h}h {m:02d}m" if h else f"{m}m {s:02d}s"
+
+
+def _init_worker(workers: int) -> None:
+    # Cada proceso del pool cuenta como un worker: reparte RPM/TPM y escribe su propio log
+    os.environ["FRAUDE_WORKERS"] = str(workers)
+    from .logs import setup_logging
+
+    setup_logging()
+
+
+def analyze_file(path: str, doc_id: str, profile: bool = False) -> dict:
+    """Analiza un documento con el Crew del proceso (se ejecuta en el pool); con `profile`
+    guarda el perfil del análisis (profiling.py) junto a su entrada del historial."""
+    from .cascade import run_analysis
+    from .forensics.templates import learn_from_analysis
+    from .llm.scheduler import PRIORITY_BATCH, llm_priority
+    from .llm.usage import token_ledger
+    from .logs import log_context
+    from .profiling import new_profile, profile_run, save_profile
+    from .report import parse_crew_result, record_analysis
+
+    file_path = Path(path)
+    inicio = time.perf_counter()
+    result = None
+    tiempos: dict = {}
+    perfil = new_profile(profile)
+    with log_context(job_id=doc_id[:16]), llm_priority(PRIORITY_BATCH), token_ledger() as ledger:
+        try:
+            with profile_run(perfil):
+                result = run_analysis(path, tiempos)
+            report, raw_text = parse_crew_result(result)
+            if report is not None:
+                try:
+                    learn_from_analysis(file_path, doc_id, report.veredicto, report.puntaje_veracidad)
+                except Exception as e:
+                    logger.warning("No se pudo aprender la plantilla de %s: %s", file_path.name, e)
+            tiempos.update(total_s=round(time.perf_counter() - inicio, 3), tokens=ledger.resumen())
+            if perfil is not None:
+                tiempos["perfil"] = perfil.resumen()
+            analysis_id = record_analysis(file_path, doc_id, "success", report, raw_text, result, tiempos, None)
+            save_profile(analysis_id, perfil)
+            return {
+                "status": "success",
+                "analysis_id": analysis_id,
+                "reporte": report.model_dump() if report is not None else None,
+                "raw_report": "" if report is not None else raw_text,
+                "tiempos": tiempos,
+            }
+        except Exception as e:
+            tiempos.update(total_s=round(time.perf_counter() - inicio, 3), tokens=ledger.resumen())
+            if perfil is not None:
+                tiempos["perfil"] = perfil.resumen()
+            analysis_id = record_analysis(file_path, doc_id, "error", None, "", result, tiempos, str(e))
+            save_profile(analysis_id, perfil)
+            return {"status": "error", "analysis_id": analysis_id, "error": str(e), "tiempos": tiempos}
+
+
+def run_audit(
+    root: Path | str,
+    output: Path | str,
+    workers: int = 2,
+    checkpoint: Path | str | None = None,
+    retry_errors: bool = False,
+    skip_history: bool = True,
+    limit: int | None = None,
+    progress_every_s: float = 5.0,
+    profile: bool = False,
+    out: TextIO = sys.stderr,
+) -> dict:
+    """Audita todos los certificados bajo `root` y devuelve el resumen de la corrida."""
+    root, output = Path(root).resolve(), Path(output)
+    workers = max(1, workers)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    ckpt = Checkpoint(checkpoint or output.with_name(output.name + ".checkpoint.sqlite"))
+    history = get_history_store() if skip_history else None
+    _repair_tail(output)
+
+    files = list(iter_documents(root))
+    if limit:
+        files = files[:limit]
+    progress = Progress(total=len(files))
+    print(f"[audit] {len(files)} documentos en {root} · {workers} procesos", file=out, flush=True)
+
+    pending: dict = {}
+    in_flight: set[str] = set()
+    queue = iter(files)
+
+    with open(output, "a", encoding="utf-8") as sink:
+
+        def emit(path: Path, stat: os.stat_result | None, doc_id: str | None, entry: dict) -> None:
+            line = {"archivo": str(path.relative_to(root)), "doc_id": doc_id, **entry}
+            sink.write(json.dumps(line, ensure_ascii=False) + "\n")
+            sink.flush()
+            if stat is not None:  # sin stat (archivo ilegible) se reintenta al retomar
+                ckpt.mark(path, stat, doc_id, entry["status"], entry.get("analysis_id"))
+
+        def fill(pool: ProcessPoolExecutor) -> None:
+            while len(pending) < workers * 2:
+                path = next(queue, None)
+                if path is None:
+                    return
+                try:
+                    stat = path.stat()
+                    if ckpt.is_done(path, stat, retry_errors):
+                        progress.ya_hechos += 1
+                        continue
+                    doc_id = document_id(path)
+                except OSError as e:
+                    progress.errores += 1
+                    emit(path, None, None, {"status": "error", "error": str(e)})
+                    continue
+                previo = ckpt.analyzed(doc_id) or (history.latest_success(doc_id) if history else None)
+                if previo or doc_id in in_flight:
+                    progress.omitidos += 1
+                    emit(path, stat, doc_id, {"status": "omitido", "motivo": "ya_analizado" if previo else "duplicado",
+                                              "analysis_id": previo})
+                    continue
+                in_flight.add(doc_id)
+                pending[pool.submit(analyze_file, str(path), doc_id, profile)] = (path, stat, doc_id)
+
+        pool = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker, initargs=(workers,),
+        )
+        try:
+            fill(pool)
+            while pending:
+                done, _ = wait(pending, timeout=progress_every_s, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, stat, doc_id = pending.pop(future)
+                    try:
+                        entry = future.result()
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as e:
+                        entry = {"status": "error", "error": f"{type(e).__name__}: {e}"}
+                    if entry["status"] == "success":
+                        progress.analizados += 1
+                    else:
+                        progress.errores += 1
+                    emit(path, stat, doc_id, entry)
+                    in_flight.discard(doc_id)
+                fill(pool)
+                progress.report(out, progress_every_s)
+        except (KeyboardInterrupt, BrokenProcessPool) as e:
+            # Lo terminado ya está en la salida y el checkpoint; lo que estaba en curso se repite
+            print(f"[audit] interrumpido ({type(e).__name__}); vuelva a ejecutar el mismo comando para "
+                  f"retomar", file=out, flush=True)
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        else:
+            pool.shutdown(wait=True)
+        finally:
+            ckpt.close()
+
+    progress.report(out, progress_every_s, force=True)
+    return {
+        "raiz": str(root),
+        "salida": str(output),
+        "documentos": progress.total,
+        "analizados": progress.analizados,
+        "errores": progress.errores,
+        "omitidos": progress.omitidos,
+        "ya_en_checkpoint": progress.ya_hechos,
+        "duracion_s": round(time.monotonic() - progress.inicio, 1),
+        "docs_por_s": round(progress.rate(), 3),
+    }
@@ -0,0 +1,831 @@
+"""
+Modo cascada: verificaciones locales baratas primero y agentes solo cuando hace falta.
+
+Con FRAUDE_ANALYSIS_MODE=cascade (por defecto "crew", el Crew completo) cada documento
+avanza por etapas y se detiene en cuanto la confianza calibrada de que es válido alcanza
+el umbral de la etapa:
+
+0. local: software creador, tipografías, imágenes, duplicados perceptuales, plantilla
+   conocida, firma/sello del detector local y, si el PDF tiene capa de texto, CIE-10/días
+   y EPS leídos de ella;
+1. vision: extracción estructurada con GPT-4o Vision (la misma de la herramienta forense);
+2. registros: EPS, RETHUS, ADRES y OSINT consultados directamente, sin agente;
+3. dictamen: el agente redactor sobre la evidencia reunida, con el modelo
+   `llm_bajo_riesgo` de agents.yaml si la confianza supera FRAUDE_CASCADE_BAJO_RIESGO.
+
+Si una etapa alcanza su umbral el dictamen se arma sin LLM a partir de las señales. La
+confianza es una logística sobre señales con pesos fijos (`WEIGHTS`), recalibrada por
+etapa (Platt) con los veredictos del Crew completo guardados en el historial
+(`fraude-incapacidades cascade-calibrate`). Sin esa calibración los pesos fijos dan
+confianzas de 0.99 a cualquier documento de plantilla conocida, así que las etapas
+anteriores a registros solo cortan si están calibradas: un "Válida" sin calibrar
+siempre pasa por RETHUS, ADRES y la conciliación de nombres. `fraude-incapacidades cascade-eval` compara
+ambos modos sobre un directorio: acuerdo de veredictos, tokens, costo y latencia.
+"""
+
+from __future__ import annotations
+
+import contextvars
+import json
+import logging
+import math
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Iterable, TextIO
+
+from .diagnosis import check_diagnosis
+from .forensics.marks import marks_threshold
+from .llm.payloads import minify
+from .profiling import record_span
+from .settings import data_path, env_float, env_override, env_str
+from .storage import intervals
+from .storage.durations import assess_days
+from .storage.extractions import document_id, load_extraction, save_extraction
+from .tools.cie10_tool import CIE10_DATABASE
+from .tools.eps_tool import EPS_COLOMBIA
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("local", "vision", "registros")
+
+# Peso de cada señal en la escala logit de "documento válido"
+WEIGHTS = {
+    "sesgo": 1.0,
+    "software_diseno": -3.0,
+    "exceso_fuentes": -1.0,
+    "sin_imagenes": -1.0,
+    "duplicado_perceptual": -2.0,
+    "plantilla_conocida": 2.0,
+    "desviacion_plantilla": -1.5,
+    "historial_superpuesto": -1.5,
+    "exif_editado": -2.0,
+    "cie10_coherente": 1.0,
+    "cie10_fuera_de_rango": -1.0,
+    "cie10_desconocido": -1.5,
+    "cie10_texto_discrepante": -1.0,
+    "eps_reconocida": 0.5,
+    "datos_completos": 0.5,
+    "datos_incompletos": -1.0,
+    "firma_y_sello": 0.5,
+    "marcas_confirmadas": 0.5,
+    "manipulacion_visual": -2.5,
+    "rethus_verificado": 1.0,
+    "rethus_no_encontrado": -3.0,
+    "adres_afiliado": 0.5,
+    "adres_no_afiliado": -1.5,
+    "osint_fraude": -2.0,
+    "nombre_discrepante": -3.0,
+    "nombre_parcial": -0.5,
+}
+
+# Umbral de confianza para detenerse en cada etapa (FRAUDE_CASCADE_UMBRAL_<ETAPA>)
+DEFAULT_THRESHOLDS = {"local": 0.97, "vision": 0.93, "registros": 0.90}
+
+# Alertas que agrega el índice de periodos (storage/intervals.py) al final de la extracción
+_HISTORY_ALERTS = ("SUPERPUESTA", "Cadena ininterrumpida", "Índice de periodos de incapacidad")
+_VISUAL_RED_FLAGS = ("manipul", "editad", "alterad", "falsific", "adulter", "superpuest")
+_CIE10_LABEL = re.compile(r"CIE[\s-]*10\W{0,20}([A-Z]\d{2}(?:\.?\d)?)", re.IGNORECASE)
+_CIE10_ANY = re.compile(r"\b([A-TV-Z]\d{2})(?:\.?\d)?\b")
+_DOC_TIPO = r"\b(?:C\.?C|T\.?I|C\.?E|R\.?C|c[ée]dula(?:\s+de\s+ciudadan[íi]a)?|documento(?:\s+de\s+identidad)?|identificaci[óo]n)\.?\W{0,10}(\d[\d.]{4,13}\d)"
+_PACIENTE_DOC = re.compile(r"\b(?:afiliado|paciente|usuario)\b[^\d]{0,60}?" + _DOC_TIPO, re.IGNORECASE)
+_MEDICO_DOC = re.compile(r"\b(?:m[ée]dico|profesional)\b[^\d]{0,60}?" + _DOC_TIPO, re.IGNORECASE)
+# Hasta 40 caracteres tras la etiqueta (la fecha puede partirse en dos líneas), sin entrar en la siguiente
+_FECHA_VALOR = r"\W{0,5}((?:(?!fecha|hasta).){0,40})"
+_FECHA_INICIO = re.compile(r"(?:fecha\s+(?:de\s+)?inicio|\bdesde)" + _FECHA_VALOR, re.IGNORECASE | re.DOTALL)
+_FECHA_FIN = re.compile(r"(?:fecha\s+(?:de\s+)?(?:fin(?:alizaci[óo]n)?|terminaci[óo]n)|\bhasta)" + _FECHA_VALOR,
+                        re.IGNORECASE | re.DOTALL)
+_DIAS = re.compile(r"(?:d[ií]as(?:\s+de\s+incapacidad)?\W{0,5}(\d{1,3})\b|\b(\d{1,3})\s*\(?\s*d[ií]as\b)",
+                   re.IGNORECASE)
+
+
+def analysis_mode() -> str:
+    mode = env_str("FRAUDE_ANALYSIS_MODE", "crew").lower()
+    return mode if mode in ("cascade", "dag") else "crew"
+
+
+def stage_threshold(etapa: str) -> float:
+    return env_float(f"FRAUDE_CASCADE_UMBRAL_{etapa.upper()}", DEFAULT_THRESHOLDS[etapa])
+
+
+# ── Señales y confianza ──────────────────────────────────────────────────────
+
+@dataclass
+class Signal:
+    clave: str
+    grupo: str  # medico | forense | entidades
+    detalle: str
+    factor: float = 1.0  # escala del peso (p. ej. varias desviaciones de plantilla en una señal)
+
+    @property
+    def peso(self) -> float:
+        return WEIGHTS[self.clave] * self.factor
+
+
+def _filled(value: Any) -> bool:
+    text = str(value or "").strip().lower()
+    return bool(text) and text not in ("null", "none", "no legible", "ilegible", "no especificado", "n/a")
+
+
+def _cie10_signals(datos: dict) -> list[Signal]:
+    codigo = str(datos.get("codigo_cie10") or "").upper().strip()
+    if not codigo:
+        return []
+    entry = CIE10_DATABASE.get(codigo) or CIE10_DATABASE.get(codigo.split(".")[0][:3])
+    if entry is None:
+        return [Signal("cie10_desconocido", "medico", f"Código CIE-10 '{codigo}' no encontrado en la base.")]
+    out = []
+    texto = datos.get("diagnostico_texto")
+    alerta = check_diagnosis(texto, codigo).alerta() if _filled(texto) else None
+    if alerta:
+        out.append(Signal("cie10_texto_discrepante", "medico", alerta["detalle"]))
+    try:
+        dias = int(float(str(datos.get("dias_incapacidad") or 0)))
+    except ValueError:
+        dias = 0
+    duracion = assess_days(codigo, dias, entry)
+    if duracion is None:
+        return out
+    if duracion.fuente == "historial":
+        referencia = f"percentil {duracion.percentil:.0f} del historial, mediana {duracion.cuantiles['p50']} días"
+    else:
+        referencia = f"rango {entry['dias_min']}-{entry['dias_max']}"
+    if duracion.nivel == "exceso":
+        return out + [Signal("cie10_fuera_de_rango", "medico",
+                             f"{dias} días exceden lo esperado ({referencia}) para {codigo} ({entry['desc']}).")]
+    return out + [Signal("cie10_coherente", "medico",
+                         f"CIE-10 {codigo} ({entry['desc']}) coherente con {dias} días ({referencia}).")]
+
+
+def eps_official(nombre: str) -> str | None:
+    """EPS real mencionada en `nombre` (texto libre); variantes de menos de 4 letras no cuentan."""
+    text = f" {nombre.lower()} "
+    for oficial, variaciones in EPS_COLOMBIA.items():
+        if any(len(var) >= 4 and re.search(rf"\b{re.escape(var)}\b", text) for var in variaciones):
+            return oficial
+    return None
+
+
+def signals(evidencia: dict, etapa: str) -> list[Signal]:
+    """Señales de una evidencia con la forma de la extracción forense guardada
+    (`datos_estructurados`, `hallazgos_forenses`, `plantilla_conocida`) más `registros`."""
+    hallazgos = evidencia.get("hallazgos_forenses") or {}
+    datos = evidencia.get("datos_estructurados") or {}
+    out: list[Signal] = []
+    desviaciones: list[str] = []
+
+    for alerta in hallazgos.get("alertas_forenses_automaticas") or []:
+        if "DISEÑO GRÁFICO" in alerta:
+            out.append(Signal("software_diseno", "forense", alerta))
+        elif "Exceso de tipografías" in alerta:
+            out.append(Signal("exceso_fuentes", "forense", alerta))
+        elif "Sin logo ni imagen" in alerta:
+            out.append(Signal("sin_imagenes", "forense", alerta))
+        elif "casi idéntica" in alerta:
+            out.append(Signal("duplicado_perceptual", "forense", alerta))
+        elif "Desviación de plantilla" in alerta:
+            desviaciones.append(alerta)
+        elif "SUPERPUESTA" in alerta or "Cadena ininterrumpida" in alerta:
+            out.append(Signal("historial_superpuesto", "medico", alerta))
+        elif "EXIF" in alerta:
+            out.append(Signal("exif_editado", "forense", alerta))
+    if desviaciones:
+        # Una sola señal: cada desviación extra suma medio peso, hasta el doble con tres o más
+        out.append(Signal("desviacion_plantilla", "forense", " ".join(desviaciones),
+                          factor=1.0 + 0.5 * (min(len(desviaciones), 3) - 1)))
+    plantilla = evidencia.get("plantilla_conocida") or {}
+    if plantilla and not desviaciones:
+        out.append(Signal("plantilla_conocida", "forense",
+                          f"Coincide con la plantilla conocida '{plantilla.get('nombre')}'."))
+
+    out.extend(_cie10_signals(datos))
+    eps = eps_official(str(datos.get("eps_o_ips") or "")) or eps_official(str(datos.get("logo_detectado") or ""))
+    if eps:
+        out.append(Signal("eps_reconocida", "entidades", f"EPS reconocida: {eps}."))
+
+    # Detector local de firma/sello (forensics/marks.py): decide sin visión o confirma lo que ve
+    local, umbral_marcas = _local_marks(hallazgos), marks_threshold()
+    if etapa == "local" and min(local["firma"], local["sello"]) >= umbral_marcas:
+        out.append(Signal("firma_y_sello", "forense",
+                          f"Firma y sello detectados localmente (confianza {local['firma']} y {local['sello']})."))
+
+    if etapa != "local" and "error_extraccion_vision" not in datos:
+        faltantes = [k for k in ("paciente_nombre", "paciente_cedula", "medico_nombre") if not _filled(datos.get(k))]
+        if faltantes:
+            out.append(Signal("datos_incompletos", "medico", f"Datos ausentes o ilegibles: {', '.join(faltantes)}."))
+        else:
+            out.append(Signal("datos_completos", "medico", "Datos del paciente y del médico completos."))
+        if datos.get("tiene_firma") is True and datos.get("tiene_sello") is True:
+            out.append(Signal("firma_y_sello", "forense", "Firma y sello visibles."))
+            if min(local["firma"], local["sello"]) >= umbral_marcas:
+                out.append(Signal("marcas_confirmadas", "forense",
+                                  "El detector local confirma la firma y el sello que vio el modelo de visión."))
+        visual = str(datos.get("evaluacion_visual") or "")
+        if any(flag in visual.lower() for flag in _VISUAL_RED_FLAGS) and not visual.startswith("No evaluado"):
+            out.append(Signal("manipulacion_visual", "forense", f"Evaluación visual: {visual[:200]}"))
+
+    registros = evidencia.get("registros") or {}
+    rethus = registros.get("rethus") or {}
+    if rethus.get("verificado") is True:
+        out.append(Signal("rethus_verificado", "entidades", "Médico registrado en RETHUS."))
+    elif rethus.get("verificado") is False:
+        out.append(Signal("rethus_no_encontrado", "entidades", "Médico NO encontrado en RETHUS."))
+    adres = registros.get("adres") or {}
+    if adres.get("verificado") is True:
+        out.append(Signal("adres_afiliado", "entidades", "Paciente afiliado según ADRES."))
+    elif adres.get("verificado") is False:
+        out.append(Signal("adres_no_afiliado", "entidades", "Paciente NO afiliado según ADRES."))
+    if (registros.get("osint") or {}).get("fraude_especifico"):
+        out.append(Signal("osint_fraude", "entidades", "Reportes web de fraude que mencionan a la entidad."))
+    for alerta in name_alerts(registros):
+        out.append(Signal(alerta["tipo"], "entidades", alerta["detalle"]))
+    return out
+
+
+def name_alerts(registros: dict | None) -> list[dict]:
+    """Alertas estructuradas de nombres que no coinciden con los registrados (RETHUS, ADRES)."""
+    alertas = []
+    for name in ("rethus", "adres"):
+        alerta = ((((registros or {}).get(name) or {}).get("coincidencia_nombre")) or {}).get("alerta")
+        if alerta:
+            alertas.append(alerta)
+    return alertas
+
+
+def raw_score(señales: Iterable[Signal]) -> float:
+    return WEIGHTS["sesgo"] + sum(s.peso for s in señales)
+
+
+def _calibration_path() -> Path:
+    return data_path("cascada_calibracion.json")
+
+
+def _stored_calibration() -> dict[str, dict]:
+    try:
+        with open(_calibration_path(), "r", encoding="utf-8") as f:
+            stored = json.load(f).get("etapas", {})
+    except (OSError, ValueError, AttributeError):
+        return {}
+    return stored if isinstance(stored, dict) else {}
+
+
+def load_calibration() -> dict[str, tuple[float, float]]:
+    """(a, b) por etapa: confianza = sigmoide(a * puntaje + b). Sin calibrar: (1, 0)."""
+    calibration = {etapa: (1.0, 0.0) for etapa in STAGES}
+    for etapa, params in _stored_calibration().items():
+        try:
+            if etapa in calibration:
+                calibration[etapa] = (float(params["a"]), float(params["b"]))
+        except (ValueError, KeyError, TypeError):
+            pass
+    return calibration
+
+
+def calibrated_stages() -> set[str]:
+    """Etapas que `cascade-calibrate` ajustó con el historial; solo ellas pueden cortar la
+    cascada antes de consultar los registros."""
+    etapas = set()
+    for etapa, params in _stored_calibration().items():
+        if not isinstance(params, dict):
+            continue
+        # Archivos anteriores sin la marca: calibrada si no quedó en (1, 0)
+        ajustada = params.get("calibrada", (params.get("a"), params.get("b")) not in ((1, 0), (1.0, 0.0)))
+        if ajustada:
+            etapas.add(etapa)
+    return etapas
+
+
+def confidence(score: float, etapa: str, calibration: dict[str, tuple[float, float]] | None = None) -> float:
+    a, b = (calibration or load_calibration())[etapa]
+    return 1.0 / (1.0 + math.exp(-(a * score + b)))
+
+
+def _fit_platt(scores: list[float], labels: list[int], iterations: int = 50) -> tuple[float, float]:
+    """Regresión logística de un parámetro (Newton) con las etiquetas suavizadas de Platt."""
+    import numpy as np
+
+    x = np.asarray(scores, dtype=float)
+    positives = sum(labels)
+    negatives = len(labels) - positives
+    y = np.where(np.asarray(labels) == 1, (positives + 1) / (positives + 2), 1 / (negatives + 2))
+    params = np.array([1.0, 0.0])
+    design = np.column_stack([x, np.ones_like(x)])
+    for _ in range(iterations):
+        p = 1 / (1 + np.exp(-(design @ params)))
+        grad = design.T @ (p - y)
+        hess = design.T @ (design * (p * (1 - p))[:, None]) + 1e-6 * np.eye(2)
+        step = np.linalg.solve(hess, grad)
+        params -= step
+        if np.abs(step).max() < 1e-8:
+            break
+    return float(params[0]), float(params[1])
+
+
+def _local_evidence(extraccion: dict) -> dict | None:
+    """Evidencia de la etapa local reconstruida de una extracción guardada, como la arma
+    `run_cascade`: datos de la capa de texto (no los de visión) y sin el historial del
+    paciente, que se registra después. None si la etapa local no llegó a correr (plantilla
+    conocida) o la extracción es anterior a guardar la capa de texto."""
+    texto = extraccion.get("texto_capa")
+    if texto is None or (extraccion.get("plantilla_conocida") and not extraccion.get("paginas_analizadas_por_vision")):
+        return None
+    hallazgos = dict(extraccion.get("hallazgos_forenses") or {}, historial_paciente=None)
+    hallazgos["alertas_forenses_automaticas"] = [
+        a for a in hallazgos.get("alertas_forenses_automaticas") or []
+        if not any(k in a for k in _HISTORY_ALERTS)
+    ]
+    return dict(extraccion, hallazgos_forenses=hallazgos, datos_estructurados=_text_layer_data(texto, hallazgos))
+
+
+def calibrate(min_samples: int = 20) -> dict:
+    """Recalibra las etapas local y visión con los dictámenes del Crew completo en el historial.
+
+    La etapa local se ajusta sobre la evidencia que produce en ejecución (capa de texto y
+    detector local, `_local_evidence`), no sobre los datos que después extrajo la visión.
+    Las etapas sin suficientes ejemplos de ambas clases conservan su calibración actual.
+    """
+    from .storage.history import get_history_store
+
+    samples: dict[str, tuple[list[float], list[int]]] = {"local": ([], []), "vision": ([], [])}
+    for extraccion, veredicto, tiempos in get_history_store().iter_labeled():
+        if (tiempos or {}).get("cascada", {}).get("etapa_final") not in (None, "crew"):
+            continue  # dictámenes de la propia cascada: no son etiquetas independientes
+        etiqueta = int(veredicto == "Válida")
+        for etapa, evidencia in (("local", _local_evidence(extraccion)), ("vision", extraccion)):
+            if evidencia is not None:
+                samples[etapa][0].append(raw_score(signals(evidencia, etapa)))
+                samples[etapa][1].append(etiqueta)
+
+    current, calibradas = load_calibration(), calibrated_stages()
+    resumen: dict[str, Any] = {"etapas": {}, "muestras": {etapa: len(scores) for etapa, (scores, _) in samples.items()}}
+    for etapa in STAGES:
+        a, b = current[etapa]
+        scores, labels = samples.get(etapa, ([], []))
+        ajustada = etapa in calibradas
+        if len(scores) >= min_samples and 0 < sum(labels) < len(labels):
+            a, b = _fit_platt(scores, labels)
+            ajustada = True
+        resumen["etapas"][etapa] = {"a": round(a, 4), "b": round(b, 4), "calibrada": ajustada}
+    path = _calibration_path()
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(resumen, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+    return resumen
+
+
+# ── Cascada ──────────────────────────────────────────────────────────────────
+
+@dataclass
+class CascadeResult:
+    """Resultado con la interfaz que usan `parse_crew_result` y `record_analysis`."""
+
+    raw: str
+    etapas: list[dict] = field(default_factory=list)
+    etapa_final: str = ""
+    confianza: float | None = None
+    modelo_dictamen: str | None = None
+    tasks_output: list[str] = field(default_factory=list)
+
+    def resumen(self) -> dict:
+        return {
+            "etapa_final": self.etapa_final,
+            "confianza": self.confianza,
+            "modelo_dictamen": self.modelo_dictamen,
+            "etapas": self.etapas,
+        }
+
+
+def _local_marks(hallazgos: dict) -> dict[str, float]:
+    marcas = hallazgos.get("marcas_locales") or {}
+    return {tipo: float((marcas.get(tipo) or {}).get("confianza") or 0.0) for tipo in ("firma", "sello", "logo")}
+
+
+def _text_layer_data(full_text: str, hallazgos: dict | None = None) -> dict:
+    """CIE-10, días, EPS, documentos del paciente y del médico y fechas leídos de la capa de
+    texto del PDF, y firma/sello/logo del detector local (sin visión)."""
+    datos: dict[str, Any] = {}
+    if hallazgos and hallazgos.get("marcas_locales"):
+        umbral = marks_threshold()
+        conf = _local_marks(hallazgos)
+        datos.update(tiene_firma=conf["firma"] >= umbral, tiene_sello=conf["sello"] >= umbral)
+        if conf["logo"] >= umbral:
+            datos["logo_detectado"] = f"Logo detectado localmente (confianza {conf['logo']})"
+    match = _CIE10_LABEL.search(full_text)
+    if match:
+        datos["codigo_cie10"] = match.group(1).upper()
+    else:
+        codigo = next((m.group(1) for m in _CIE10_ANY.finditer(full_text) if m.group(1) in CIE10_DATABASE), None)
+        if codigo:
+            datos["codigo_cie10"] = codigo
+    match = _DIAS.search(full_text)
+    if match:
+        datos["dias_incapacidad"] = int(match.group(1) or match.group(2))
+    eps = eps_official(full_text)
+    if eps:
+        datos["eps_o_ips"] = eps
+    for clave, patron in (("paciente_cedula", _PACIENTE_DOC), ("medico_cedula", _MEDICO_DOC)):
+        match = patron.search(full_text)
+        if match:
+            datos[clave] = intervals.normalizar_documento(match.group(1))
+    for clave, patron in (("fecha_inicio", _FECHA_INICIO), ("fecha_fin", _FECHA_FIN)):
+        match = patron.search(full_text)
+        fecha = intervals.parse_fecha(match.group(1)) if match else None
+        if fecha:
+            datos[clave] = fecha.isoformat()
+    return datos
+
+
+def _register_period(doc_id: str, archivo: str, evidencia: dict) -> tuple[dict, bool]:
+    """Registra el periodo de un documento dictaminado en la etapa local (la extracción no
+    llega al final del generador, donde se registra tras la visión o la plantilla).
+
+    Devuelve la evidencia con el historial del paciente y sus alertas, y si hubo alertas.
+    """
+    hallazgos = dict(evidencia.get("hallazgos_forenses") or {})
+    alertas = list(hallazgos.get("alertas_forenses_automaticas") or [])
+    try:
+        historial, alertas_hist = intervals.check_and_register(doc_id, archivo, evidencia.get("datos_estructurados") or {})
+    except Exception as e:
+        historial, alertas_hist = None, []
+        alertas.append(f"Índice de periodos de incapacidad no disponible: {e}")
+    hallazgos.update(historial_paciente=historial, alertas_forenses_automaticas=alertas + alertas_hist)
+    return dict(evidencia, hallazgos_forenses=hallazgos), bool(alertas_hist)
+
+
+def _report(señales: list[Signal], p: float, etapa: str, alertas_estructuradas: list[dict] | None = None) -> dict:
+    """Dictamen sin LLM (misma estructura que el agente redactor)."""
+    puntaje = round(100 * p)
+    veredicto = "Válida" if puntaje >= 75 else "Sospechosa" if puntaje >= 45 else "Fraudulenta"
+    grupos = {grupo: [s.detalle for s in señales if s.grupo == grupo] for grupo in ("medico", "forense", "entidades")}
+    no_consultado = f"no consultados: riesgo bajo tras la etapa '{etapa}'"
+    return {
+        "puntaje_veracidad": puntaje,
+        "hallazgos_medicos": " ".join(grupos["medico"]) or "Sin hallazgos médicos relevantes.",
+        "analisis_forense": " ".join(grupos["forense"]) or "Sin alertas forenses.",
+        "verificacion_entidades": (
+            " ".join(grupos["entidades"]) + ("" if etapa == "registros" else f" RETHUS/ADRES/OSINT {no_consultado}.")
+        ).strip(),
+        "alertas": [s.detalle for s in señales if s.peso < 0],
+        "alertas_estructuradas": alertas_estructuradas or [],
+        "veredicto": veredicto,
+    }
+
+
+def _registry_entry(raw: str) -> dict:
+    """Resumen de la salida de RETHUS/ADRES para las señales (`registros`)."""
+    try:
+        data = json.loads(raw)
+    except (json.JSONDecodeError, TypeError):
+        return {"detalle": str(raw)[:300]}
+    coincidencia = data.get("coincidencia_nombre", data.get("nom")) or {}
+    if "al" in coincidencia:
+        coincidencia = dict(coincidencia, alerta=coincidencia.pop("al"))
+    return {"verificado": data.get("verificado", data.get("ver")), "aviso": data.get("aviso"),
+            "coincidencia_nombre": coincidencia or None}
+
+
+def _osint_entry(raw: str) -> dict:
+    try:
+        results = json.loads(raw).get("res", [])
+        fraude = any(r.get("c") == "fraude" for r in results)
+    except (json.JSONDecodeError, AttributeError):
+        fraude = "[Fraude Específico]" in raw
+    return {"fraude_especifico": fraude}
+
+
+def registry_lookups(datos: dict) -> dict:
+    """Consulta directa (en paralelo) de las herramientas de verificación."""
+    from .tools.adres_tool import ADRESVerificationTool
+    from .tools.rethus_tool import RETHUSVerificationTool
+    from .tools.search_tool import OSINTSearchTool
+
+    def documento(key: str) -> str:
+        return "".join(ch for ch in str(datos.get(key) or "") if ch.isalnum())
+
+    def submit(pool: ThreadPoolExecutor, fn, *args):
+        # Cada consulta corre con el contexto del análisis (perfil, ledger y plazo activos)
+        return pool.submit(contextvars.copy_context().run, fn, *args)
+
+    jobs = {}
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        if documento("medico_cedula"):
+            jobs["rethus"] = (_registry_entry, submit(pool, RETHUSVerificationTool()._run, json.dumps(
+                {"tipo_documento": "CC", "numero_documento": documento("medico_cedula"),
+                 "nombre": datos.get("medico_nombre")}, ensure_ascii=False)))
+        if documento("paciente_cedula"):
+            jobs["adres"] = (_registry_entry, submit(pool, ADRESVerificationTool()._run, json.dumps(
+                {"tipo_documento": "CC", "numero_documento": documento("paciente_cedula"),
+                 "nombre": datos.get("paciente_nombre")}, ensure_ascii=False)))
+        if _filled(datos.get("eps_o_ips")):
+            jobs["osint"] = (_osint_entry, submit(pool, OSINTSearchTool()._run, str(datos["eps_o_ips"])))
+        registros = {}
+        for name, (interpret, future) in jobs.items():
+            try:
+                registros[name] = interpret(future.result())
+            except Exception as e:
+                registros[name] = {"detalle": f"error: {e}"}
+    return registros
+
+
+def _agent_evidence(evidencia: dict, señales: list[Signal], p: float) -> str:
+    hallazgos = dict(evidencia.get("hallazgos_forenses") or {})
+    hallazgos.pop("exif_imagen", None)
+    return minify({
+        "datos_estructurados": evidencia.get("datos_estructurados"),
+        "hallazgos_forenses": hallazgos,
+        "plantilla_conocida": evidencia.get("plantilla_conocida"),
+        "registros": evidencia.get("registros"),
+        "senales_automaticas": [{"senal": s.clave, "detalle": s.detalle} for s in señales],
+        "confianza_validez_automatica": round(p, 3),
+    })
+
+
+def run_cascade(file_path: str) -> Any:
+    """Analiza un documento por etapas; devuelve un CascadeResult (o el resultado del Crew
+    completo si la extracción local falla)."""
+    from .tools.ocr_tool import PDFForensicExtractTool
+
+    calibration, calibradas = load_calibration(), calibrated_stages()
+    trace: list[dict] = []
+    tool = PDFForensicExtractTool()
+    path = Path(file_path.strip().strip("'\""))
+
+    def decide(evidencia: dict, etapa: str) -> tuple[list[Signal], float, bool]:
+        señales = signals(evidencia, etapa)
+        p = confidence(raw_score(señales), etapa, calibration)
+        umbral = stage_threshold(etapa)
+        # Sin calibrar, solo se corta después de consultar los registros
+        stop = p >= umbral and (etapa == "registros" or etapa in calibradas)
+        trace.append({"etapa": etapa, "confianza": round(p, 4), "umbral": umbral,
+                      "senales": [s.clave for s in señales], "calibrada": etapa in calibradas, "detener": stop})
+        return señales, p, stop
+
+    def finish(señales: list[Signal], p: float, etapa: str, evidencia: dict | None = None) -> CascadeResult:
+        reporte = _report(señales, p, etapa, name_alerts((evidencia or {}).get("registros")))
+        return CascadeResult(raw=json.dumps(reporte, ensure_ascii=False), etapas=trace, etapa_final=etapa,
+                             confianza=round(p, 4), tasks_output=[json.dumps(trace, ensure_ascii=False)])
+
+    def full_crew(motivo: str):
+        from .crew import get_crew
+
+        logger.warning("cascada: %s; se usa el Crew completo", motivo, extra={"archivo": path.name})
+        return get_crew().kickoff(inputs={"file_path": file_path})
+
+    # Etapa 0: hallazgos locales (el generador se detiene justo antes de la visión)
+    t0 = time.perf_counter()
+    steps = tool._pipeline(file_path)
+    done, value = tool._advance(lambda: next(steps))
+    doc_id = document_id(path) if path.exists() else None
+    if done:
+        evidencia = load_extraction(doc_id) if doc_id else None
+        if not evidencia:  # error de extracción: el Crew lo reporta como siempre
+            return full_crew(f"extracción local fallida: {str(value)[:200]}")
+        señales, p, stop = decide(evidencia, "vision")  # plantilla conocida: datos sin visión
+        etapa = trace[-1]["etapa"] = "plantilla"
+        record_span("etapa", etapa, t0)
+    else:
+        page_images, full_text, preliminar = value
+        evidencia = dict(preliminar, datos_estructurados=_text_layer_data(full_text, preliminar["hallazgos_forenses"]))
+        señales, p, stop = decide(evidencia, "local")
+        if stop and doc_id:
+            # Los datos de la capa de texto son los definitivos: el periodo se registra aquí, y
+            # si choca con el historial del paciente la etapa vuelve a decidir con esas alertas
+            evidencia, con_alertas = _register_period(doc_id, path.name, evidencia)
+            if con_alertas:
+                señales, p, stop = decide(evidencia, "local")
+        trace[-1]["duracion_s"] = round(time.perf_counter() - t0, 3)
+        record_span("etapa", "local", t0)
+        if stop:
+            steps.close()
+            if doc_id:
+                save_extraction(doc_id, dict(evidencia, paginas_analizadas_por_vision=0, archivo=path.name,
+                                             fuente_datos="capa_texto", texto_capa=full_text))
+            return finish(señales, p, "local")
+
+        # Etapa 1: visión
+        t1 = time.perf_counter()
+        try:
+            structured = tool._vision_extract(page_images, full_text)
+        except Exception as e:
+            done, value = tool._advance(lambda: steps.throw(e))
+        else:
+            done, value = tool._advance(lambda: steps.send(structured))
+        evidencia = load_extraction(doc_id) if doc_id else None
+        if not evidencia:
+            return full_crew(f"extracción por visión fallida: {str(value)[:200]}")
+        señales, p, stop = decide(evidencia, "vision")
+        trace[-1]["duracion_s"] = round(time.perf_counter() - t1, 3)
+        record_span("etapa", "vision", t1)
+        etapa = "vision"
+    if stop:
+        return finish(señales, p, etapa)
+
+    # Etapa 2: registros
+    t2 = time.perf_counter()
+    evidencia = dict(evidencia, registros=registry_lookups(evidencia.get("datos_estructurados") or {}))
+    señales, p, stop = decide(evidencia, "registros")
+    trace[-1]["duracion_s"] = round(time.perf_counter() - t2, 3)
+    record_span("etapa", "registros", t2)
+    if stop:
+        return finish(señales, p, "registros", evidencia)
+
+    # Etapa 3: agente redactor sobre la evidencia reunida
+    from .crew import _agent_model, agents_cfg, build_report_crew
+
+    low_risk = p >= env_float("FRAUDE_CASCADE_BAJO_RIESGO", 0.6)
+    t3 = time.perf_counter()
+    result = build_report_crew(_agent_evidence(evidencia, señales, p), low_risk=low_risk).kickoff()
+    modelo = _agent_model(agents_cfg["redactor_dictamen"], low_risk)
+    trace.append({"etapa": "dictamen", "modelo": modelo, "bajo_riesgo": low_risk,
+                  "duracion_s": round(time.perf_counter() - t3, 3)})
+    record_span("etapa", "dictamen", t3, modelo=modelo)
+    return CascadeResult(raw=str(getattr(result, "raw", result)), etapas=trace, etapa_final="dictamen",
+                         confianza=round(p, 4), modelo_dictamen=modelo,
+                         tasks_output=[json.dumps(trace, ensure_ascii=False), str(getattr(result, "raw", result))])
+
+
+def run_analysis(file_path: str, tiempos: dict | None = None) -> Any:
+    """Punto de entrada de la API y la auditoría en lote: Crew completo, cascada o DAG de
+    etapas memoizadas (pipeline.py)."""
+    mode = analysis_mode()
+    if mode == "dag":
+        from .pipeline import run_pipeline
+
+        result = run_pipeline(document_id(file_path), file_path)
+        if tiempos is not None:
+            tiempos["etapas"] = result.etapas
+        return result
+    if mode == "cascade":
+        result = run_cascade(file_path)
+        if tiempos is not None:
+            tiempos["cascada"] = result.resumen() if isinstance(result, CascadeResult) else {"etapa_final": "crew"}
+        return result
+    from .crew import get_crew
+
+    return get_crew().kickoff(inputs={"file_path": file_path})
+
+
+# Verificaciones del informe parcial (las de CIE-10 y EPS salen de la propia extracción)
+PARTIAL_CHECKS = {
+    "extraccion": "Extracción del documento",
+    "rethus": "RETHUS (médico)",
+    "adres": "ADRES (paciente)",
+    "osint": "OSINT (entidad)",
+}
+
+
+@dataclass
+class PartialResult:
+    """Informe parcial por plazo vencido, con la interfaz de resultado de `parse_crew_result`.
+
+    `parcial` lo marca aunque no quede nada en `no_verificados` (todo verificado a tiempo o
+    sin datos que verificar): la API no lo cachea ni aprende de él.
+    """
+
+    raw: str
+    no_verificados: list[str] = field(default_factory=list)
+    parcial: bool = True
+
+
+def partial_report(file_path: str, completadas: dict[str, str]) -> PartialResult:
+    """Dictamen sin LLM con lo que se alcanzó a verificar antes del plazo del análisis.
+
+    `completadas` son las salidas de herramientas terminadas a tiempo (`Deadline.completadas`);
+    la extracción se toma de la guardada. Lo que falta queda en `no_verificados` y en las
+    alertas como "no verificado por tiempo"; sin extracción el veredicto es "Indeterminado".
+    """
+    path = Path(file_path.strip().strip("'\""))
+    evidencia = load_extraction(document_id(path)) if path.exists() else None
+    datos = (evidencia or {}).get("datos_estructurados") or {}
+    extraida = bool(evidencia) and "error_extraccion_vision" not in datos
+
+    registros: dict[str, dict] = {}
+    pendientes = [] if extraida else ["extraccion"]
+    for name, clave in (("rethus", "medico_cedula"), ("adres", "paciente_cedula"), ("osint", "eps_o_ips")):
+        if name in completadas:
+            registros[name] = (_osint_entry if name == "osint" else _registry_entry)(completadas[name])
+        elif not extraida or _filled(datos.get(clave)):
+            pendientes.append(name)
+
+    if evidencia:
+        evidencia = dict(evidencia, registros=registros)
+        etapa = "registros" if extraida else "local"
+        señales = signals(evidencia, etapa)
+        reporte = _report(señales, confidence(raw_score(señales), etapa, load_calibration()), "registros",
+                          name_alerts(registros))
+    else:
+        reporte = _report([], 0.0, "registros")
+        reporte["hallazgos_medicos"] = reporte["analisis_forense"] = "No verificado por tiempo."
+    if not extraida:
+        reporte["veredicto"] = "Indeterminado"
+    if pendientes:
+        etiquetas = [PARTIAL_CHECKS[name] for name in pendientes]
+        reporte["verificacion_entidades"] = (
+            f"{reporte['verificacion_entidades']} No verificado por tiempo: {', '.join(etiquetas)}."
+        ).strip()
+        reporte["alertas"] = reporte["alertas"] + [f"{etiqueta}: no verificado por tiempo" for etiqueta in etiquetas]
+    reporte["no_verificados"] = pendientes
+    return PartialResult(json.dumps(reporte, ensure_ascii=False), pendientes)
+
+
+# ── Evaluación ───────────────────────────────────────────────────────────────
+
+# USD por millón de tokens (entrada, salida); FRAUDE_PRECIOS_MODELOS='{"gpt-4o": [2.5, 10]}'
+DEFAULT_PRICES = {"gpt-4o-mini": (0.15, 0.60), "gpt-4o": (2.50, 10.00)}
+
+
+def _prices() -> dict[str, tuple[float, float]]:
+    prices = dict(DEFAULT_PRICES)
+    try:
+        prices.update({k: tuple(v) for k, v in json.loads(env_str("FRAUDE_PRECIOS_MODELOS") or "{}").items()})
+    except (ValueError, TypeError):
+        pass
+    return prices
+
+
+def cost_usd(modelos: dict[str, dict]) -> float:
+    prices = sorted(_prices().items(), key=lambda kv: -len(kv[0]))  # "gpt-4o-mini" antes que "gpt-4o"
+    total = 0.0
+    for modelo, usage in modelos.items():
+        entrada, salida = next((v for k, v in prices if modelo.startswith(k)), prices[-1][1])
+        total += (usage["prompt_tokens"] * entrada + usage["completion_tokens"] * salida) / 1e6
+    return total
+
+
+def _measure(fn) -> tuple[Any, dict, float]:
+    from .llm.usage import token_ledger
+
+    with token_ledger() as ledger:
+        inicio = time.perf_counter()
+        result = fn()
+        return result, ledger.resumen(), time.perf_counter() - inicio
+
+
+def evaluate(paths: list[Path], out: TextIO | None = None) -> dict:
+    """Corre Crew completo y cascada sobre los mismos documentos (sin cachés de visión ni
+    de registros) y compara veredicto, tokens, costo estimado y latencia."""
+    from .crew import get_crew
+    from .report import parse_crew_result
+
+    filas = []
+    sin_cache = {f"FRAUDE_CACHE_TTL_{namespace}": "0" for namespace in ("VISION", "RETHUS", "ADRES", "OSINT")}
+    with env_override(**sin_cache):  # solo durante la comparación; el proceso conserva sus TTL
+        for path in paths:
+            crew_result, crew_usage, crew_s = _measure(lambda: get_crew().kickoff(inputs={"file_path": str(path)}))
+            cascade_result, cascade_usage, cascade_s = _measure(lambda: run_cascade(str(path)))
+            crew_report, _ = parse_crew_result(crew_result)
+            cascade_report, _ = parse_crew_result(cascade_result)
+            fila = {
+                "archivo": path.name,
+                "veredicto_crew": crew_report.veredicto if crew_report else None,
+                "veredicto_cascada": cascade_report.veredicto if cascade_report else None,
+                "etapa_final": getattr(cascade_result, "etapa_final", "crew"),
+                "tokens_crew": crew_usage["total"]["prompt_tokens"] + crew_usage["total"]["completion_tokens"],
+                "tokens_cascada": cascade_usage["total"]["prompt_tokens"] + cascade_usage["total"]["completion_tokens"],
+                "costo_crew_usd": round(cost_usd(crew_usage["modelos"]), 5),
+                "costo_cascada_usd": round(cost_usd(cascade_usage["modelos"]), 5),
+                "latencia_crew_s": round(crew_s, 3),
+                "latencia_cascada_s": round(cascade_s, 3),
+            }
+            filas.append(fila)
+            if out is not None:
+                print(json.dumps(fila, ensure_ascii=False), file=out, flush=True)
+    return summarize(filas)
+
+
+def summarize(filas: list[dict]) -> dict:
+    n = len(filas)
+
+    def total(key: str) -> float:
+        return sum(f[key] for f in filas)
+
+    def ahorro(crew_key: str, cascade_key: str) -> float | None:
+        base = total(crew_key)
+        return round(100 * (1 - total(cascade_key) / base), 1) if base else None
+
+    matriz: dict[str, dict[str, int]] = {}
+    etapas: dict[str, int] = {}
+    for f in filas:
+        fila = matriz.setdefault(str(f["veredicto_crew"]), {})
+        fila[str(f["veredicto_cascada"])] = fila.get(str(f["veredicto_cascada"]), 0) + 1
+        etapas[f["etapa_final"]] = etapas.get(f["etapa_final"], 0) + 1
+    acuerdos = sum(f["veredicto_crew"] == f["veredicto_cascada"] for f in filas)
+    return {
+        "documentos": n,
+        "acuerdo_veredicto_pct": round(100 * acuerdos / n, 1) if n else None,
+        "matriz_veredictos": matriz,  # veredicto del Crew -> veredicto de la cascada
+        "etapa_final": etapas,
+        "tokens": {"crew": total("tokens_crew"), "cascada": total("tokens_cascada"),
+                   "ahorro_pct": ahorro("tokens_crew", "tokens_cascada")},
+        "costo_usd": {"crew": round(total("costo_crew_usd"), 4), "cascada": round(total("costo_cascada_usd"), 4),
+                      "ahorro_pct": ahorro("costo_crew_usd", "costo_cascada_usd")},
+        "latencia_media_s": {"crew": round(total("latencia_crew_s") / n, 2) if n else None,
+                             "cascada": round(total("latencia_cascada_s") / n, 2) if n else None,
+                             "ahorro_pct": ahorro("latencia_crew_s", "latencia_cascada_s")},
+        "umbrales": {etapa: stage_threshold(etapa) for etapa in STAGES},
+        "etapas_calibradas": sorted(calibrated_stages()),
+        "bajo_riesgo": env_float("FRAUDE_CASCADE_BAJO_RIESGO", 0.6),
+    }
@@ -0,0 +1,215 @@
+"""
+Línea de comandos: `fraude-incapacidades audit <dir>` y la evaluación del modo cascada.
+
+    fraude-incapacidades audit /ruta/certificados --workers 4 --output auditoria.jsonl
+    fraude-incapacidades cascade-calibrate
+    fraude-incapacidades cascade-eval /ruta/certificados --limit 50
+    fraude-incapacidades reanalyze --history
+    fraude-incapacidades names-audit --medicos rethus.csv --pacientes bdua.csv -o discrepancias.jsonl
+    fraude-incapacidades cie10-index --catalogo cie10_oficial.csv
+    fraude-incapacidades cie10-audit -o diagnosticos_discrepantes.jsonl
+    fraude-incapacidades cie10-durations
+    fraude-incapacidades intervals-rebuild
+
+Volver a ejecutar el mismo `audit` retoma la corrida desde su checkpoint.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+
+def _load_env() -> None:
+    try:
+        from dotenv import load_dotenv
+
+        load_dotenv()  # OPENAI_API_KEY, FRAUDE_* desde .env en el cwd
+    except Exception:
+        pass
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="fraude-incapacidades", description="Evaluación de autenticidad de incapacidades médicas",
+    )
+    sub = parser.add_subparsers(dest="comando", required=True)
+
+    audit = sub.add_parser("audit", help="audita en lote todos los certificados de un directorio")
+    audit.add_argument("directorio", type=Path, help="raíz del árbol con PDF/PNG/JPG")
+    audit.add_argument("-w", "--workers", type=int, default=2, help="procesos en paralelo (2)")
+    audit.add_argument("-o", "--output", type=Path, default=Path("auditoria.jsonl"),
+                       help="resultados JSONL, uno por archivo (auditoria.jsonl)")
+    audit.add_argument("--checkpoint", type=Path, default=None,
+                       help="checkpoint SQLite (por defecto <output>.checkpoint.sqlite)")
+    audit.add_argument("--retry-errors", action="store_true", help="reintentar archivos que fallaron")
+    audit.add_argument("--reanalyze", action="store_true",
+                       help="no omitir documentos que ya tienen un análisis exitoso en el historial")
+    audit.add_argument("--limit", type=int, default=None, help="procesar solo los primeros N archivos")
+    audit.add_argument("--progress-every", type=float, default=5.0, help="segundos entre líneas de avance")
+    audit.add_argument("--profile", action="store_true",
+                       help="perfilar cada análisis (DATA_DIR/perfiles/<analysis_id>.json)")
+
+    sub.add_parser("cascade-calibrate",
+                   help="recalibra la confianza de la cascada con los dictámenes del historial")
+
+    evaluar = sub.add_parser("cascade-eval", help="compara Crew completo y cascada sobre un directorio")
+    evaluar.add_argument("directorio", type=Path)
+    evaluar.add_argument("--limit", type=int, default=None, help="evaluar solo los primeros N archivos")
+    evaluar.add_argument("-o", "--output", type=Path, default=None, help="detalle por documento (JSONL)")
+
+    reanalizar = sub.add_parser(
+        "reanalyze", help="re-analiza documentos recalculando solo las etapas invalidadas (DAG memoizado)",
+    )
+    reanalizar.add_argument("rutas", type=Path, nargs="*", help="archivos o directorios a re-analizar")
+    reanalizar.add_argument("--history", action="store_true",
+                            help="re-analizar todos los documentos exitosos del historial")
+    reanalizar.add_argument("--uploads", type=Path, default=None,
+                            help="directorio de archivos subidos (por defecto test/uploads)")
+    reanalizar.add_argument("--limit", type=int, default=None, help="re-analizar solo los primeros N documentos")
+
+    nombres = sub.add_parser(
+        "names-audit", help="concilia los nombres del historial con padrones locales (documento, nombre)",
+    )
+    nombres.add_argument("--medicos", type=Path, default=None, help="CSV de profesionales (p. ej. exportación RETHUS)")
+    nombres.add_argument("--pacientes", type=Path, default=None, help="CSV de afiliados (p. ej. exportación BDUA)")
+    nombres.add_argument("-o", "--output", type=Path, default=None, help="nombres parciales o discrepantes (JSONL)")
+
+    indice = sub.add_parser("cie10-index", help="construye el índice de descripciones CIE-10 (TF-IDF de n-gramas)")
+    indice.add_argument("--catalogo", type=Path, default=None,
+                        help="CSV oficial (codigo, descripcion); por defecto FRAUDE_CIE10_CATALOGO o la base embebida")
+
+    diagnosticos = sub.add_parser(
+        "cie10-audit", help="revisa en lote que el diagnóstico escrito corresponda al código CIE-10 (historial)",
+    )
+    diagnosticos.add_argument("-o", "--output", type=Path, default=None, help="diagnósticos discrepantes (JSONL)")
+
+    sub.add_parser("cie10-durations",
+                   help="reconstruye la distribución de días por código CIE-10 con los certificados del historial")
+
+    periodos = sub.add_parser(
+        "intervals-rebuild",
+        help="reconstruye el índice de periodos por paciente (superposiciones) con las extracciones guardadas",
+    )
+    periodos.add_argument("--directorio", type=Path, default=None,
+                          help="carpeta de extracciones JSON; por defecto la de FRAUDE_DATA_DIR")
+
+    args = parser.parse_args(argv)
+    _load_env()
+
+    if args.comando == "audit":
+        if not args.directorio.is_dir():
+            parser.error(f"no es un directorio: {args.directorio}")
+        from .audit import run_audit
+
+        try:
+            resumen = run_audit(
+                args.directorio, args.output, workers=args.workers, checkpoint=args.checkpoint,
+                retry_errors=args.retry_errors, skip_history=not args.reanalyze, limit=args.limit,
+                progress_every_s=args.progress_every, profile=args.profile,
+            )
+        except KeyboardInterrupt:
+            return 130
+        print(json.dumps(resumen, ensure_ascii=False, indent=2))
+        return 1 if resumen["errores"] else 0
+
+    if args.comando == "cascade-calibrate":
+        from .cascade import calibrate
+
+        print(json.dumps(calibrate(), ensure_ascii=False, indent=2))
+        return 0
+
+    if args.comando == "cascade-eval":
+        if not args.directorio.is_dir():
+            parser.error(f"no es un directorio: {args.directorio}")
+        from .audit import iter_documents
+        from .cascade import evaluate
+
+        paths = list(iter_documents(args.directorio))[:args.limit]
+        detalle = open(args.output, "w", encoding="utf-8") if args.output else None
+        try:
+            resumen = evaluate(paths, out=detalle)
+        finally:
+            if detalle is not None:
+                detalle.close()
+        print(json.dumps(resumen, ensure_ascii=False, indent=2))
+        return 0
+
+    if args.comando == "reanalyze":
+        if not args.rutas and not args.history:
+            parser.error("indique rutas o --history")
+        from .audit import iter_documents
+        from .pipeline import UPLOAD_DIR, reanalyze
+
+        paths = [p for ruta in args.rutas for p in (iter_documents(ruta) if ruta.is_dir() else [ruta])]
+        resumen = reanalyze(paths, history=args.history, limit=args.limit,
+                            uploads=args.uploads or UPLOAD_DIR, out=sys.stdout)
+        print(json.dumps(resumen, ensure_ascii=False, indent=2))
+        return 1 if resumen["errores"] else 0
+
+    if args.comando == "names-audit":
+        if not args.medicos and not args.pacientes:
+            parser.error("indique --medicos y/o --pacientes")
+        from .names import load_registry, reconcile_history
+
+        detalle = open(args.output, "w", encoding="utf-8") if args.output else None
+        try:
+            resumen = reconcile_history(
+                medicos=load_registry(args.medicos) if args.medicos else None,
+                pacientes=load_registry(args.pacientes) if args.pacientes else None,
+                out=detalle,
+            )
+        finally:
+            if detalle is not None:
+                detalle.close()
+        print(json.dumps(resumen, ensure_ascii=False, indent=2))
+        return 0
+
+    if args.comando == "cie10-index":
+        import os
+
+        if args.catalogo is not None:
+            if not args.catalogo.is_file():
+                parser.error(f"no existe el catálogo: {args.catalogo}")
+            os.environ["FRAUDE_CIE10_CATALOGO"] = str(args.catalogo.resolve())
+        from .diagnosis import get_index
+
+        index = get_index()
+        print(json.dumps({"codigos": len(index), "directorio": str(index.directorio),
+                          "nnz": int(index.filas.shape[0])}, ensure_ascii=False, indent=2))
+        return 0
+
+    if args.comando == "cie10-audit":
+        from .diagnosis import audit_history
+
+        detalle = open(args.output, "w", encoding="utf-8") if args.output else None
+        try:
+            resumen = audit_history(out=detalle)
+        finally:
+            if detalle is not None:
+                detalle.close()
+        print(json.dumps(resumen, ensure_ascii=False, indent=2))
+        return 0
+
+    if args.comando == "cie10-durations":
+        from .storage.durations import rebuild_from_history
+
+        print(json.dumps(rebuild_from_history(), ensure_ascii=False, indent=2))
+        return 0
+
+    if args.comando == "intervals-rebuild":
+        if args.directorio is not None and not args.directorio.is_dir():
+            parser.error(f"no es un directorio: {args.directorio}")
+        from .storage.intervals import get_interval_index, rebuild_from_extractions
+
+        periodos = rebuild_from_extractions(args.directorio)
+        print(json.dumps({"periodos_importados": periodos, "periodos_en_indice": len(get_interval_index())},
+                         ensure_ascii=False, indent=2))
+        return 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,6 +3,7 @@ from __future__ import annotations
 from pathlib import Path
 from typing import Dict
 import os
+import threading
 from crewai import Agent, Task, Crew, Process, LLM
 
 try:
@@ -17,6 +18,10 @@ from .tools.rethus_tool import RETHUSVerificationTool
 from .tools.adres_tool import ADRESVerificationTool
 from .tools.search_tool import OSINTSearchTool
 from .tools.eps_tool import EPSValidationTool
+from .llm.cassette import llm_mode, wrap_llm
+from .llm.scheduler import SchedulerInterceptor
+from .llm.payloads import compact_mode, legend, project_context
+from .llm.usage import record_context, token_stage
 
 def _load_yaml(path: Path) -> dict:
     with open(path, "r", encoding="utf-8") as f:
@@ -26,28 +31,41 @@ _BASE = Path(__file__).parent / "config"
 agents_cfg = _load_yaml(_BASE / "agents.yaml")
 tasks_cfg = _load_yaml(_BASE / "tasks.yaml")
 
-def _build_agents(cfg: dict) -> Dict[str, Agent]:
+def _agent_model(data: dict, low_risk: bool) -> str:
+    """Modelo del agente según agents.yaml (`llm`, y `llm_bajo_riesgo` en rutas de bajo riesgo)."""
+    if low_risk and data.get("llm_bajo_riesgo"):
+        return data["llm_bajo_riesgo"]
+    return data.get("llm") or "gpt-4o"
+
+
+def _build_agents(cfg: dict, low_risk: bool = False) -> Dict[str, Agent]:
     agents: Dict[str, Agent] = {}
     
     from dotenv import load_dotenv
     load_dotenv(Path(__file__).resolve().parents[3] / ".env", override=True)
     
     api_key = os.environ.get("OPENAI_API_KEY", "")
-    default_llm = LLM(model="gpt-4o", api_key=api_key) if api_key else None
-    
-    # Tool instances
-    pdf_extract = PDFForensicExtractTool()
-    cie10_validator = CIE10ValidationTool()
-    rethus_verifier = RETHUSVerificationTool()
-    adres_verifier = ADRESVerificationTool()
-    osint_search = OSINTSearchTool()
-    eps_validator = EPSValidationTool()
+    if not api_key and llm_mode() == "replay":
+        # En replay no se llama a OpenAI; la clave solo satisface la validación del cliente.
+        api_key = "replay"
+    # Todas las llamadas de los agentes pasan por el planificador global de OpenAI
+    # (un LLM por modelo distinto configurado en agents.yaml).
+    llms: Dict[str, LLM] = {}
+
+    def llm_for(model: str):
+        if not api_key:
+            return None
+        if model not in llms:
+            llms[model] = wrap_llm(LLM(model=model, api_key=api_key, interceptor=SchedulerInterceptor()))
+        return llms[model]
     
-    # Asignar nuevas herramientas a los roles existentes
-    tools_map = {
-        "auditor_medico_forense": [pdf_extract, cie10_validator],
-        "investigador_osint": [eps_validator, rethus_verifier, adres_verifier, osint_search],
-        "redactor_dictamen": [], 
+    # Herramientas por rol (solo se instancian las de los agentes pedidos)
+    tool_factories = {
+        "auditor_medico_forense": lambda: [PDFForensicExtractTool(), CIE10ValidationTool()],
+        "investigador_osint": lambda: [
+            EPSValidationTool(), RETHUSVerificationTool(), ADRESVerificationTool(), OSINTSearchTool(),
+        ],
+        "redactor_dictamen": lambda: [],
     }
     
     for name, data in cfg.items():
@@ -55,40 +73,125 @@ def _build_agents(cfg: dict) -> Dict[str, Agent]:
             role=data.get("role", ""),
             goal=data.get("goal", ""),
             backstory=data.get("backstory", ""),
-            tools=tools_map.get(name, []),
-            llm=default_llm,
+            tools=tool_factories.get(name, list)(),
+            llm=llm_for(_agent_model(data, low_risk)),
             verbose=False,
             allow_delegation=False
         )
     return agents
 
+class StagedTask(Task):
+    """Tarea que contabiliza sus tokens como una etapa propia (`llm.usage`).
+
+    En modo compacto recibe de las tareas de su `context` solo los campos declarados en
+    `context_fields` (tasks.yaml), minificados, en lugar de su salida completa.
+    """
+
+    context_fields: Dict[str, list[str]] | None = None
+
+    def _stage_context(self, context: str | None) -> str | None:
+        if compact_mode() and isinstance(self.context, list):
+            fields = self.context_fields or {}
+            context = "\n\n----------\n\n".join(
+                f"[{task.name}] {project_context(task.output.raw, fields.get(task.name or ''))}"
+                for task in self.context
+                if task.output is not None
+            )
+        record_context(len(context or "") // 4)
+        return context
+
+    def _execute_core(self, agent, context, tools):
+        with token_stage(self.name or "tarea"):
+            return super()._execute_core(agent, self._stage_context(context), tools)
+
+    async def _aexecute_core(self, agent, context, tools):
+        with token_stage(self.name or "tarea"):
+            return await super()._aexecute_core(agent, self._stage_context(context), tools)
+
+
 def _build_tasks(cfg: dict, agents: Dict[str, Agent]) -> Dict[str, Task]:
     tasks: Dict[str, Task] = {}
+    compact = compact_mode()
     for name, data in cfg.items():
         agent_key = data.get("agent", "")
         agent = agents.get(agent_key)
         if agent is None:
             raise ValueError(f"Tarea '{name}' referencia agente desconocido '{agent_key}'")
-        tasks[name] = Task(
-            description=data.get("description", ""),
+        description = data.get("description", "")
+        expected_output = data.get("expected_output", "")
+        if compact:
+            expected_output = data.get("compact_expected_output", expected_output)
+            if agent.tools:
+                description = f"{description}\n\n{legend(tool.name for tool in agent.tools)}"
+        context = data.get("context")
+        unknown = [ref for ref in context or [] if ref not in tasks]
+        if unknown:
+            raise ValueError(f"Tarea '{name}' usa como contexto tareas desconocidas o posteriores: {unknown}")
+        extra = {} if context is None else {"context": [tasks[ref] for ref in context]}
+        tasks[name] = StagedTask(
+            name=name,
+            description=description,
             agent=agent,
-            expected_output=data.get("expected_output", ""),
+            expected_output=expected_output,
+            context_fields=data.get("context_fields"),
+            **extra,
         )
     return tasks
 
-_agents = _build_agents(agents_cfg)
-_tasks = _build_tasks(tasks_cfg, _agents)
-
-crew = Crew(
-    agents=[
-        _agents["auditor_medico_forense"],
-        _agents["investigador_osint"],
-        _agents["redactor_dictamen"],
-    ],
-    tasks=[
-        _tasks["extract_and_validate_task"],
-        _tasks["search_and_verify_task"],
-        _tasks["generate_final_report_task"],
-    ],
-    process=Process.sequential,
-)
+def build_crew(low_risk: bool = False) -> Crew:
+    """Construye un Crew nuevo (agentes, herramientas y LLM) desde la configuración YAML.
+
+    Con `low_risk` los agentes que definen `llm_bajo_riesgo` usan ese modelo.
+    """
+    agents = _build_agents(agents_cfg, low_risk)
+    tasks = _build_tasks(tasks_cfg, agents)
+    return Crew(
+        agents=[
+            agents["auditor_medico_forense"],
+            agents["investigador_osint"],
+            agents["redactor_dictamen"],
+        ],
+        tasks=[
+            tasks["extract_and_validate_task"],
+            tasks["search_and_verify_task"],
+            tasks["generate_final_report_task"],
+        ],
+        process=Process.sequential,
+    )
+
+
+def build_report_crew(evidencia: str, low_risk: bool = False) -> Crew:
+    """Crew de una sola tarea: el agente redactor dictamina sobre evidencia ya reunida
+    (modo cascada, `cascade.py`)."""
+    name = "generate_final_report_task"
+    data = tasks_cfg[name]
+    agents = _build_agents({data["agent"]: agents_cfg[data["agent"]]}, low_risk)
+    task = StagedTask(
+        name=name,
+        description=f"{data.get('description', '')}\n\nEVIDENCIA REUNIDA (JSON):\n{evidencia}",
+        agent=agents[data["agent"]],
+        expected_output=data.get("expected_output", ""),
+    )
+    return Crew(agents=list(agents.values()), tasks=[task], process=Process.sequential)
+
+
+# Un Crew no es seguro para ejecuciones simultáneas (guarda estado de tareas y agentes):
+# cada hilo que ejecuta análisis construye el suyo la primera vez que lo necesita.
+_local = threading.local()
+
+
+def get_crew(low_risk: bool = False) -> Crew:
+    crews = getattr(_local, "crews", None)
+    if crews is None:
+        crews = _local.crews = {}
+    if low_risk not in crews:
+        crews[low_risk] = build_crew(low_risk)
+    return crews[low_risk]
+
+
+def __getattr__(name: str):
+    # Compatibilidad con `from fraude_incapacidades.crew import crew` sin construir
+    # nada al importar el módulo.
+    if name == "crew":
+        return get_crew()
+    raise AttributeError(name)
@@ -0,0 +1,140 @@
+"""
+Plazo de cada análisis, propagado a herramientas y llamadas a OpenAI.
+
+La latencia de un análisis era la suma de esperas sin tope (ADRES 2×20 s, RETHUS 30 s de
+navegación + 15 s de selector + 4 s, las búsquedas OSINT y los reintentos del LLM). La API
+abre `analysis_deadline()` con el SLO configurado (FRAUDE_SLO_S, 120 s contados desde que
+llega la petición; FRAUDE_SLO_LOTE_S para el carril de lote, sin plazo por defecto) y
+dentro del bloque:
+
+- `budget(tope)` acota cada timeout de red de las herramientas al tiempo que queda, así
+  que una consulta en curso se corta al vencer el plazo;
+- los transportes e interceptor del planificador hacen lo mismo con la espera de turno y
+  los timeouts de cada petición a OpenAI, y vencido el plazo fallan de inmediato;
+- `within_deadline(verificacion)` envuelve el `_run` de cada herramienta: si el plazo ya
+  venció (o vence durante la consulta) devuelve el aviso "sin_tiempo" en lugar del
+  resultado, y si no, anota la salida como verificación completada.
+
+Con lo completado, `cascade.partial_report` arma el informe parcial que la API entrega
+cuando el análisis no termina a tiempo. Fuera de un plazo todo se comporta como antes.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import functools
+import math
+import threading
+import time
+from typing import Any, Callable, Iterator
+
+from .settings import env_float
+
+_deadline: contextvars.ContextVar[Deadline | None] = contextvars.ContextVar("fraude_deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """El plazo del análisis venció antes de poder hacer (o terminar) la operación."""
+
+
+class Deadline:
+    """Instante límite de un análisis y verificaciones completadas antes de él (seguro entre hilos)."""
+
+    def __init__(self, segundos: float) -> None:
+        self.segundos = segundos
+        self.limite = time.monotonic() + segundos
+        self._lock = threading.Lock()
+        self.completadas: dict[str, str] = {}
+
+    def remaining(self) -> float:
+        return self.limite - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def record(self, verificacion: str, salida: str) -> None:
+        with self._lock:
+            self.completadas[verificacion] = salida
+
+    def snapshot(self) -> dict[str, str]:
+        with self._lock:
+            return dict(self.completadas)
+
+
+def slo_seconds(lote: bool = False) -> float:
+    """Latencia objetivo del análisis (0 = sin plazo)."""
+    return env_float("FRAUDE_SLO_LOTE_S", 0.0) if lote else env_float("FRAUDE_SLO_S", 120.0)
+
+
+def slo_margin() -> float:
+    """Reserva del SLO para armar y enviar la respuesta (y tolerancia antes de cortar)."""
+    return max(0.0, env_float("FRAUDE_SLO_MARGEN_S", 3.0))
+
+
+def request_deadline(transcurrido_s: float = 0.0, lote: bool = False) -> Deadline | None:
+    """Plazo de un análisis de la API: SLO menos margen menos lo ya consumido (carga, cola).
+
+    Nunca negativo: si la carga y la cola ya agotaron el SLO el plazo nace vencido.
+    """
+    slo = slo_seconds(lote)
+    if slo <= 0:
+        return None
+    return Deadline(max(0.0, slo - slo_margin() - transcurrido_s))
+
+
+@contextlib.contextmanager
+def analysis_deadline(plazo: Deadline | None) -> Iterator[Deadline | None]:
+    """Aplica el plazo a todo lo que se ejecute dentro del bloque (None: sin plazo)."""
+    token = _deadline.set(plazo)
+    try:
+        yield plazo
+    finally:
+        _deadline.reset(token)
+
+
+def current_deadline() -> Deadline | None:
+    return _deadline.get()
+
+
+def budget(tope: float = math.inf) -> float:
+    """Timeout para una operación: `tope` acotado al tiempo restante; vencido, `DeadlineExceeded`."""
+    plazo = _deadline.get()
+    if plazo is None:
+        return tope
+    restante = plazo.remaining()
+    if restante <= 0:
+        raise DeadlineExceeded("Plazo del análisis vencido")
+    return min(tope, restante)
+
+
+def _sin_tiempo(verificacion: str) -> str:
+    from .llm.payloads import tool_payload
+
+    return tool_payload({"verificado": None, "riesgo": "NO_APLICA"}, aviso="sin_tiempo", verificacion=verificacion)
+
+
+def within_deadline(verificacion: str) -> Callable[[Callable], Callable]:
+    """Decorador para `_run` de herramientas: respeta el plazo y anota la verificación completada."""
+
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(self, *args: Any, **kwargs: Any) -> Any:
+            plazo = _deadline.get()
+            if plazo is None:
+                return fn(self, *args, **kwargs)
+            if plazo.expired():
+                return _sin_tiempo(verificacion)
+            try:
+                salida = fn(self, *args, **kwargs)
+            except DeadlineExceeded:
+                return _sin_tiempo(verificacion)
+            # Una consulta cortada por el plazo vuelve como falla técnica: tampoco cuenta
+            if plazo.expired():
+                return _sin_tiempo(verificacion)
+            plazo.record(verificacion, salida)
+            return salida
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,456 @@
+"""
+Coherencia entre el diagnóstico escrito por el médico y el código CIE-10 del certificado.
+
+La validación por código solo mira el código y los días: un código real con un
+diagnóstico que no le corresponde ("J06" con "esguince de tobillo") pasaba sin alerta.
+`check_diagnosis` compara el texto con las descripciones del catálogo mediante TF-IDF
+de n-gramas de caracteres (3 y 4 por palabra, sin tildes ni mayúsculas: tolera
+abreviaturas, plurales y errores de OCR) y devuelve la similitud coseno 0-1 con el
+código declarado y los códigos más plausibles para el texto:
+
+- el catálogo es la base embebida (`CIE10_DATABASE`) con términos frecuentes en los
+  certificados (`TERMINOS`: "lumbalgia", "IRA", "IVU"…) y, si FRAUDE_CIE10_CATALOGO
+  apunta a un CSV (`codigo` y `descripcion` o `nombre`), la tabla oficial completa;
+- los n-gramas se proyectan por hashing a `DIM` columnas (no hay vocabulario que
+  guardar) y el índice se guarda invertido (por columna, los códigos que la contienen
+  y su peso) en `DATA_DIR/cie10_indice/<huella del catálogo>/` como arreglos .npy que
+  se abren con memory-map: los workers comparten las páginas y no lo reconstruyen. Si
+  el catálogo cambia, cambia la huella y el índice se reconstruye al primer uso (o con
+  `fraude-incapacidades cie10-index`);
+- una consulta recorre solo las listas de sus n-gramas (decenas de µs); `similarity_batch`
+  hace lo mismo con NumPy para miles de pares (textos únicos, bloques de memoria
+  acotada), que es lo que usa `fraude-incapacidades cie10-audit` sobre el historial.
+
+Un código de 3 caracteres cubre su categoría (J06 vale por J06.x); uno más largo que no
+está en el catálogo cae a su categoría. Niveles: "coherente" si la similitud llega a
+FRAUDE_CIE10_TEXTO_COHERENTE (0.30) o el código está entre los plausibles;
+"discrepante" si no llega a FRAUDE_CIE10_TEXTO_DISCREPANTE (0.12) y el texto sí se parece
+a otro código (al menos el umbral de coherente); "parcial" en otro caso, y "sin_datos"
+sin texto, con un código fuera del catálogo o con un texto que no se parece a ninguno.
+"""
+
+from __future__ import annotations
+
+import csv
+import functools
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+import unicodedata
+import zlib
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterator, Sequence, TextIO
+
+from .settings import DATA_DIR, env_float, env_str
+
+if TYPE_CHECKING:
+    import numpy as np
+
+DIM = 1 << 18  # columnas del hashing de n-gramas
+NGRAMS = (3, 4)
+TOP_K = 3
+_FORMAT = 1  # versión del formato en disco (entra en la huella)
+_CHUNK = 4_000_000  # celdas textos × códigos por bloque en lote
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+
+# Términos con que los médicos suelen escribir estos diagnósticos, cada abreviatura en el
+# código que designa (se indexan con la descripción oficial, o con la de su categoría si la
+# subcategoría no está en el catálogo; no se muestran)
+TERMINOS: dict[str, str] = {
+    "A09": "EDA enfermedad diarreica aguda",
+    "A90": "dengue sin signos de alarma",
+    "B34": "síndrome viral virosis",
+    "F32": "depresión",
+    "F41": "trastorno de ansiedad generalizada",
+    "F43": "estrés",
+    "G43": "migraña con aura sin aura",
+    "G44": "cefalea tensional",
+    "G56": "síndrome del túnel carpiano",
+    "I10": "HTA hipertensión arterial",
+    "J00": "resfriado gripa catarro",
+    "J02": "dolor de garganta",
+    "J06": "IRA infección respiratoria aguda",
+    "J11": "gripe influenza",
+    "K35": "apendicectomía",
+    "M54": "cervicalgia dolor de espalda",
+    "M54.5": "lumbalgia dolor lumbar",
+    "M75": "manguito rotador tendinitis del hombro",
+    "N30": "cistitis IVU baja",
+    "N39.0": "IVU infección de vías urinarias sitio no especificado",
+    "O80": "licencia de maternidad",
+    "O82": "cesárea",
+    "S83": "esguince de rodilla",
+    "S93": "esguince de tobillo",
+}
+
+
+def normalize(text: str | None) -> str:
+    """Minúsculas, sin tildes y solo letras y dígitos separados por espacios."""
+    text = unicodedata.normalize("NFKD", str(text or "").lower())
+    return _NON_ALNUM.sub(" ", "".join(ch for ch in text if not unicodedata.combining(ch))).strip()
+
+
+def code_key(codigo: str | None) -> str:
+    """"m54.5 " -> "M545"."""
+    return re.sub(r"[^A-Z0-9]", "", str(codigo or "").upper())
+
+
+def _ngrams(text: str) -> list[str]:
+    grams = []
+    for word in normalize(text).split():
+        padded = f" {word} "
+        for n in NGRAMS:
+            grams.extend(padded[i:i + n] for i in range(max(1, len(padded) - n + 1)))
+    return grams
+
+
+def _features(text: str) -> tuple[np.ndarray, np.ndarray]:
+    """Columnas (ordenadas, únicas) y frecuencias de los n-gramas del texto."""
+    import numpy as np
+
+    grams = _ngrams(text)
+    hashes = np.fromiter((zlib.crc32(g.encode()) & (DIM - 1) for g in grams), dtype=np.int64, count=len(grams))
+    return np.unique(hashes, return_counts=True)
+
+
+# ── Catálogo e índice en disco ───────────────────────────────────────────────
+
+def _load_catalog(path: Path) -> Iterator[tuple[str, str]]:
+    """CSV oficial (`codigo` y `descripcion`/`nombre`; separador `,` o `;`)."""
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        muestra = f.read(4096)
+        f.seek(0)
+        dialecto = csv.Sniffer().sniff(muestra, delimiters=",;\t") if muestra else csv.excel
+        for row in csv.DictReader(f, dialect=dialecto):
+            row = {str(k).strip().lower(): v for k, v in row.items() if k}
+            codigo = str(row.get("codigo") or row.get("código") or "").strip()
+            descripcion = str(row.get("descripcion") or row.get("descripción") or row.get("nombre") or "").strip()
+            if codigo and descripcion:
+                yield codigo, descripcion
+
+
+def catalog_entries() -> list[tuple[str, str, str]]:
+    """(código, descripción, texto indexado) de cada código del catálogo, ordenados."""
+    from .tools.cie10_tool import CIE10_DATABASE
+
+    entradas: dict[str, list[str]] = {}
+    ruta = env_str("FRAUDE_CIE10_CATALOGO")
+    if ruta:
+        for codigo, descripcion in _load_catalog(Path(ruta)):
+            entradas[code_key(codigo)] = [codigo, descripcion, descripcion]
+    for codigo, entry in CIE10_DATABASE.items():
+        entradas.setdefault(code_key(codigo), [codigo, entry["desc"], entry["desc"]])
+    for codigo, terminos in TERMINOS.items():
+        clave = code_key(codigo)
+        clave = clave if clave in entradas else clave[:3]
+        if clave in entradas:
+            entradas[clave][2] += f" {terminos}"
+    return [tuple(entradas[clave]) for clave in sorted(entradas)]
+
+
+def catalog_fingerprint(entradas: Sequence[tuple[str, str, str]]) -> str:
+    data = json.dumps([_FORMAT, DIM, NGRAMS, list(entradas)], ensure_ascii=False)
+    return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+
+def _index_root() -> Path:
+    return DATA_DIR / "cie10_indice"
+
+
+def build_index(entradas: Sequence[tuple[str, str, str]], directorio: Path) -> None:
+    """Escribe el índice invertido (col_ptr, filas, pesos, idf y meta.json) en `directorio`."""
+    import numpy as np
+
+    n = len(entradas)
+    filas, cols, tfs = [], [], []
+    for fila, (_, _, texto) in enumerate(entradas):
+        c, tf = _features(texto)
+        filas.append(np.full(len(c), fila, dtype=np.int64))
+        cols.append(c)
+        tfs.append(tf)
+    fila_de = np.concatenate(filas) if filas else np.zeros(0, dtype=np.int64)
+    col = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64)
+    tf = np.concatenate(tfs) if tfs else np.zeros(0, dtype=np.int64)
+
+    df = np.bincount(col, minlength=DIM)
+    idf = np.log((1 + n) / (1 + df)) + 1.0  # idf suavizado; columnas sin códigos: el máximo
+    pesos = (1 + np.log(tf)) * idf[col]
+    normas = np.sqrt(np.bincount(fila_de, weights=pesos ** 2, minlength=n))
+    pesos /= np.maximum(normas[fila_de], 1e-12)
+    orden = np.lexsort((fila_de, col))
+    col_ptr = np.zeros(DIM + 1, dtype=np.int64)
+    np.cumsum(df, out=col_ptr[1:])
+
+    directorio.mkdir(parents=True, exist_ok=True)
+    np.save(directorio / "col_ptr.npy", col_ptr.astype(np.int32 if col_ptr[-1] < 2**31 else np.int64))
+    np.save(directorio / "filas.npy", fila_de[orden].astype(np.int32))
+    np.save(directorio / "pesos.npy", pesos[orden].astype(np.float32))
+    np.save(directorio / "idf.npy", idf.astype(np.float32))
+    meta = {"codigos": [e[0] for e in entradas], "descripciones": [e[1] for e in entradas],
+            "dim": DIM, "ngramas": list(NGRAMS), "creado": time.time()}
+    (directorio / "meta.json").write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+
+
+def ensure_index() -> Path:
+    """Directorio del índice del catálogo actual; lo construye si no existe.
+
+    Se construye en un directorio temporal que se renombra al final: un proceso que
+    pierde la carrera descarta el suyo, y nadie ve un índice a medio escribir.
+    """
+    entradas = catalog_entries()
+    raiz = _index_root()
+    destino = raiz / catalog_fingerprint(entradas)
+    if (destino / "meta.json").exists():
+        return destino
+    tmp = raiz / f".tmp-{os.getpid()}-{destino.name}"
+    build_index(entradas, tmp)
+    try:
+        os.rename(tmp, destino)
+    except OSError:  # otro proceso lo construyó primero
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not (destino / "meta.json").exists():
+            raise
+    for viejo in raiz.iterdir():  # índices de catálogos anteriores (un mapeo abierto sigue siendo válido)
+        if viejo.is_dir() and viejo.name != destino.name and not viejo.name.startswith("."):
+            shutil.rmtree(viejo, ignore_errors=True)
+    return destino
+
+
+# ── Consultas ────────────────────────────────────────────────────────────────
+
+class DiagnosisIndex:
+    """Índice invertido TF-IDF abierto con memory-map (solo lectura, compartible entre hilos)."""
+
+    def __init__(self, directorio: Path) -> None:
+        import numpy as np
+
+        meta = json.loads((directorio / "meta.json").read_text(encoding="utf-8"))
+        self.directorio = directorio
+        self.codigos: list[str] = meta["codigos"]
+        self.descripciones: list[str] = meta["descripciones"]
+        self.col_ptr = np.load(directorio / "col_ptr.npy", mmap_mode="r")
+        self.filas = np.load(directorio / "filas.npy", mmap_mode="r")
+        self.pesos = np.load(directorio / "pesos.npy", mmap_mode="r")
+        self.idf = np.load(directorio / "idf.npy", mmap_mode="r")
+        self._exactas: dict[str, int] = {}
+        self._categorias: dict[str, list[int]] = {}
+        for fila, codigo in enumerate(self.codigos):
+            clave = code_key(codigo)
+            self._exactas[clave] = fila
+            self._categorias.setdefault(clave[:3], []).append(fila)
+
+    def __len__(self) -> int:
+        return len(self.codigos)
+
+    def rows_for(self, codigo: str | None) -> list[int]:
+        """Filas del código: la exacta si es una subcategoría del catálogo; si no, toda su categoría."""
+        clave = code_key(codigo)
+        if len(clave) > 3 and clave in self._exactas:
+            return [self._exactas[clave]]
+        return self._categorias.get(clave[:3], []) if len(clave) >= 3 else []
+
+    def query(self, texto: str) -> tuple[np.ndarray, np.ndarray]:
+        """Columnas y pesos TF-IDF normalizados del texto."""
+        import numpy as np
+
+        cols, tf = _features(texto)
+        pesos = (1 + np.log(tf)) * self.idf[cols]
+        norma = np.sqrt(np.dot(pesos, pesos))
+        return cols, (pesos / norma if norma > 0 else pesos)
+
+    def scores(self, cols: np.ndarray, pesos: np.ndarray, consulta: np.ndarray | None = None,
+               consultas: int = 1) -> np.ndarray:
+        """Similitud coseno de una o varias consultas (`consulta`: a cuál pertenece cada columna)
+        con todos los códigos: (consultas, len(self))."""
+        import numpy as np
+
+        n = len(self.codigos)
+        inicio = self.col_ptr[cols].astype(np.int64)
+        largos = self.col_ptr[cols + 1].astype(np.int64) - inicio
+        total = int(largos.sum())
+        if total == 0:
+            return np.zeros((consultas, n))
+        # Posiciones de todas las listas de las columnas consultadas, sin bucle
+        idx = np.repeat(inicio - (np.cumsum(largos) - largos), largos) + np.arange(total)
+        destino = self.filas[idx].astype(np.int64)
+        if consulta is not None:
+            destino += np.repeat(consulta, largos) * n
+        contrib = self.pesos[idx] * np.repeat(pesos, largos)
+        return np.bincount(destino, weights=contrib, minlength=consultas * n).reshape(consultas, n)
+
+
+def _catalog_stamp() -> tuple[str, int]:
+    ruta = env_str("FRAUDE_CIE10_CATALOGO")
+    try:
+        return ruta, os.stat(ruta).st_mtime_ns if ruta else 0
+    except OSError:
+        return ruta, 0
+
+
+@functools.lru_cache(maxsize=1)
+def _index_for(stamp: tuple[str, int]) -> DiagnosisIndex:
+    return DiagnosisIndex(ensure_index())
+
+
+def get_index() -> DiagnosisIndex:
+    """Índice del catálogo actual (abierto una vez por proceso; se reabre si cambia el CSV)."""
+    return _index_for(_catalog_stamp())
+
+
+def index_version() -> str:
+    """Huella del catálogo indexado (para versionar las etapas que dependen de él)."""
+    return get_index().directorio.name
+
+
+@dataclass
+class BatchResult:
+    similitud: np.ndarray  # (m,) con el código declarado; NaN sin texto o código fuera del catálogo
+    plausibles: np.ndarray  # (m, k) filas del índice, de mayor a menor similitud
+    puntajes: np.ndarray  # (m, k)
+
+
+def similarity_batch(textos: Sequence[str | None], codigos: Sequence[str | None], k: int = TOP_K,
+                     index: DiagnosisIndex | None = None) -> BatchResult:
+    """Similitud texto-código y los `k` códigos más plausibles de cada par, vectorizado."""
+    import numpy as np
+
+    index = index or get_index()
+    m, n = len(textos), len(index)
+    k = max(1, min(k, n))
+    unicos: dict[str, int] = {}
+    texto_id = np.array([unicos.setdefault(normalize(t), len(unicos)) for t in textos], dtype=np.int64)
+    textos_unicos = list(unicos)
+    consultas = [index.query(t) for t in textos_unicos]
+
+    # Filas del código declarado por par (un código de categoría puede tener varias)
+    filas_par = [index.rows_for(c) if textos_unicos[t] else [] for t, c in zip(texto_id.tolist(), codigos)]
+    par_rep = np.repeat(np.arange(m), [len(f) for f in filas_par])
+    filas_rep = np.array([f for fs in filas_par for f in fs], dtype=np.int64)
+    texto_rep = texto_id[par_rep]
+    similitud = np.full(m, -np.inf)
+
+    top_unicos = np.zeros((len(textos_unicos), k), dtype=np.int64)
+    top_puntajes = np.zeros((len(textos_unicos), k))
+    bloque = max(1, _CHUNK // max(n, 1))
+    for inicio in range(0, len(textos_unicos), bloque):
+        parte = consultas[inicio:inicio + bloque]
+        cols = np.concatenate([c for c, _ in parte])
+        pesos = np.concatenate([p for _, p in parte])
+        consulta = np.repeat(np.arange(len(parte)), [len(c) for c, _ in parte])
+        S = index.scores(cols, pesos, consulta, len(parte))
+        sel = (texto_rep >= inicio) & (texto_rep < inicio + len(parte))
+        np.maximum.at(similitud, par_rep[sel], S[texto_rep[sel] - inicio, filas_rep[sel]])
+        top = np.argpartition(-S, k - 1, axis=1)[:, :k] if k < n else np.tile(np.arange(n), (len(parte), 1))
+        puntajes = np.take_along_axis(S, top, axis=1)
+        orden = np.argsort(-puntajes, axis=1, kind="stable")
+        top_unicos[inicio:inicio + len(parte)] = np.take_along_axis(top, orden, axis=1)
+        top_puntajes[inicio:inicio + len(parte)] = np.take_along_axis(puntajes, orden, axis=1)
+    similitud[np.isneginf(similitud)] = np.nan
+    return BatchResult(np.minimum(similitud, 1.0), top_unicos[texto_id], top_puntajes[texto_id])
+
+
+def level(similitud: float | None, mejor: float, en_plausibles: bool) -> str:
+    coherente = env_float("FRAUDE_CIE10_TEXTO_COHERENTE", 0.30)
+    discrepante = env_float("FRAUDE_CIE10_TEXTO_DISCREPANTE", 0.12)
+    if similitud is None or mejor < discrepante:
+        return "sin_datos"
+    if similitud >= coherente or (en_plausibles and similitud >= discrepante):
+        return "coherente"
+    if similitud < discrepante and mejor >= coherente:
+        return "discrepante"
+    return "parcial"
+
+
+@dataclass(frozen=True)
+class DiagnosisMatch:
+    codigo: str
+    texto: str
+    similitud: float | None
+    nivel: str  # coherente | parcial | discrepante | sin_datos
+    plausibles: list[dict] = field(default_factory=list)  # [{codigo, descripcion, similitud}]
+
+    def as_dict(self) -> dict:
+        return {"similitud": self.similitud, "nivel": self.nivel, "plausibles": self.plausibles}
+
+    def alerta(self) -> dict | None:
+        """Alerta estructurada si el texto no corresponde al código declarado."""
+        if self.nivel != "discrepante":
+            return None
+        otros = ", ".join(f"{p['codigo']} ({p['descripcion']})" for p in self.plausibles[:2])
+        return {
+            "tipo": "cie10_texto_discrepante",
+            "codigo": self.codigo,
+            "puntaje": self.similitud,
+            "detalle": f"El diagnóstico escrito ('{self.texto}') no corresponde al código {self.codigo}; "
+                       f"se parece más a {otros}.",
+        }
+
+
+def _matches(textos: Sequence[str | None], codigos: Sequence[str | None], resultado: BatchResult,
+             index: DiagnosisIndex) -> Iterator[DiagnosisMatch]:
+    for i, (texto, codigo) in enumerate(zip(textos, codigos)):
+        score = float(resultado.similitud[i])
+        similitud = None if score != score else round(score, 3)
+        plausibles = [
+            {"codigo": index.codigos[fila], "descripcion": index.descripciones[fila], "similitud": round(float(p), 3)}
+            for fila, p in zip(resultado.plausibles[i].tolist(), resultado.puntajes[i].tolist()) if p > 0
+        ]
+        filas = set(index.rows_for(codigo))
+        en_plausibles = any(fila in filas for fila in resultado.plausibles[i].tolist())
+        mejor = plausibles[0]["similitud"] if plausibles else 0.0
+        yield DiagnosisMatch(str(codigo or ""), str(texto or ""), similitud,
+                             level(similitud, mejor, en_plausibles), plausibles)
+
+
+def check_diagnosis(texto: str | None, codigo: str | None, k: int = TOP_K) -> DiagnosisMatch:
+    """Coherencia del diagnóstico escrito con el código declarado, y los códigos plausibles."""
+    if not normalize(texto):
+        return DiagnosisMatch(str(codigo or ""), str(texto or ""), None, "sin_datos")
+    index = get_index()
+    return next(_matches([texto], [codigo], similarity_batch([texto], [codigo], k, index), index))
+
+
+# ── Auditoría histórica en lote ──────────────────────────────────────────────
+
+def audit_history(out: TextIO | None = None, batch_size: int = 100000) -> dict:
+    """Revisa el diagnóstico escrito contra el código de todos los análisis del historial.
+
+    Escribe en `out` una línea JSON por diagnóstico discrepante y devuelve el conteo por nivel.
+    """
+    from .storage.history import get_history_store
+
+    index = get_index()
+    niveles = {"coherente": 0, "parcial": 0, "discrepante": 0, "sin_datos": 0}
+    inicio = time.perf_counter()
+    pares = 0
+
+    def flush(batch: list[tuple[str, str, str, str]]) -> None:
+        textos, codigos = [b[3] for b in batch], [b[2] for b in batch]
+        for (analysis_id, doc_id, _, _), match in zip(
+            batch, _matches(textos, codigos, similarity_batch(textos, codigos, index=index), index),
+        ):
+            niveles[match.nivel] += 1
+            alerta = match.alerta()
+            if alerta and out is not None:
+                print(json.dumps(dict(alerta, analysis_id=analysis_id, doc_id=doc_id), ensure_ascii=False), file=out)
+
+    batch: list[tuple[str, str, str, str]] = []
+    for analysis_id, doc_id, codigo, texto in get_history_store().iter_diagnoses():
+        if not codigo or not texto:
+            niveles["sin_datos"] += 1
+            continue
+        batch.append((analysis_id, doc_id, str(codigo), str(texto)))
+        if len(batch) >= batch_size:
+            pares += len(batch)
+            flush(batch)
+            batch = []
+    if batch:
+        pares += len(batch)
+        flush(batch)
+    duracion = time.perf_counter() - inicio
+    return {"pares": pares, "niveles": niveles, "catalogo": len(index), "duracion_s": round(duracion, 3),
+            "pares_por_s": round(pares / duracion, 1) if duracion > 0 else None}
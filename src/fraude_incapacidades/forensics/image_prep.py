@@ -0,0 +1,243 @@
+"""
+Preprocesamiento de certificados fotografiados (PNG/JPG) antes de enviarlos a visión.
+
+Las fotos de celular llegan rotadas, torcidas, con sombras, fondo alrededor del papel
+y a 12 MP, aunque GPT-4o Vision las reescala internamente a lado corto <= 768 px.
+Aquí se corrige la orientación EXIF, se recorta el papel, se endereza, se normaliza
+la iluminación y se reduce a la resolución que el extractor realmente usa. El EXIF
+original se conserva como evidencia forense.
+"""
+
+from __future__ import annotations
+
+import io
+import math
+from dataclasses import dataclass, field
+
+import numpy as np
+from PIL import ExifTags, Image, ImageOps
+
+from ..settings import env_int
+
+_EDITORES = ("photoshop", "gimp", "canva", "snapseed", "lightroom", "picsart", "pixlr", "illustrator")
+_ANALYSIS_SIDE = 800  # resolución de trabajo para detectar bordes e inclinación
+
+
+@dataclass
+class PreparedImage:
+    data: bytes
+    mime: str
+    width: int
+    height: int
+    exif: dict = field(default_factory=dict)
+    pasos: list[str] = field(default_factory=list)
+    bytes_originales: int = 0
+    tokens_originales: int = 0
+    tokens_finales: int = 0
+
+    def resumen(self) -> dict:
+        return {
+            "pasos_aplicados": self.pasos,
+            "formato_enviado": self.mime,
+            "dimensiones_enviadas": [self.width, self.height],
+            "bytes_originales": self.bytes_originales,
+            "bytes_enviados": len(self.data),
+            "bytes_ahorrados": self.bytes_originales - len(self.data),
+            "tokens_vision_originales": self.tokens_originales,
+            "tokens_vision_enviados": self.tokens_finales,
+            "tokens_vision_ahorrados": self.tokens_originales - self.tokens_finales,
+        }
+
+
+def vision_tokens(width: int, height: int) -> int:
+    """Costo en tokens de una imagen `detail: high` según las reglas de OpenAI."""
+    scale = min(1.0, 2048 / max(width, height))
+    w, h = width * scale, height * scale
+    scale = min(1.0, 768 / min(w, h))
+    w, h = w * scale, h * scale
+    return 85 + 170 * math.ceil(w / 512) * math.ceil(h / 512)
+
+
+# ── EXIF ──
+
+def extract_exif(img: Image.Image) -> dict:
+    """Etiquetas EXIF legibles (incluye GPS); se guardan tal cual como evidencia."""
+    exif = img.getexif()
+    if not exif:
+        return {}
+    result: dict = {}
+    tags = dict(exif.items())
+    try:
+        tags.update(exif.get_ifd(ExifTags.IFD.Exif).items())
+    except Exception:
+        pass
+    for tag, value in tags.items():
+        name = ExifTags.TAGS.get(tag, str(tag))
+        if isinstance(value, bytes):
+            if len(value) > 64:
+                continue  # MakerNote y miniaturas: sin valor forense legible
+            value = value.decode("latin-1", errors="replace").strip("\x00 ")
+        result[name] = str(value)
+    try:
+        gps = exif.get_ifd(ExifTags.IFD.GPSInfo)
+        if gps:
+            result["GPSInfo"] = {ExifTags.GPSTAGS.get(k, str(k)): str(v) for k, v in gps.items()}
+    except Exception:
+        pass
+    return result
+
+
+def exif_alerts(exif: dict) -> list[str]:
+    alertas = []
+    software = exif.get("Software", "")
+    if any(ed in software.lower() for ed in _EDITORES):
+        alertas.append(f"⚠️ EXIF indica edición con '{software}'. La foto pasó por un editor de imágenes.")
+    original, modificada = exif.get("DateTimeOriginal"), exif.get("DateTime")
+    if original and modificada and original != modificada:
+        alertas.append(
+            f"⚠️ Fecha EXIF de modificación ({modificada}) distinta a la de captura ({original}). "
+            "La imagen fue re-guardada después de tomada."
+        )
+    return alertas
+
+
+# ── Etapas ──
+
+def _work_gray(img: Image.Image) -> tuple[np.ndarray, float]:
+    """Copia en gris reducida para el análisis y su factor respecto a la imagen real."""
+    factor = max(1.0, max(img.size) / _ANALYSIS_SIDE)
+    small = img.convert("L").resize((max(1, round(img.width / factor)), max(1, round(img.height / factor))))
+    return np.asarray(small, dtype=np.float32), factor
+
+
+def _otsu(gray: np.ndarray) -> float:
+    hist = np.bincount(gray.astype(np.uint8).ravel(), minlength=256).astype(np.float64)
+    prob = hist / max(hist.sum(), 1)
+    omega = np.cumsum(prob)
+    mu = np.cumsum(prob * np.arange(256))
+    between = (mu[-1] * omega - mu) ** 2 / np.maximum(omega * (1 - omega), 1e-12)
+    return float(np.argmax(between))
+
+
+def document_bbox(gray: np.ndarray, min_fraction: float = 0.2) -> tuple[int, int, int, int] | None:
+    """Caja del papel (claro) sobre el fondo: filas/columnas mayoritariamente claras."""
+    paper = gray > _otsu(gray)
+    rows = np.flatnonzero(paper.mean(axis=1) > 0.5)
+    cols = np.flatnonzero(paper.mean(axis=0) > 0.5)
+    if rows.size == 0 or cols.size == 0:
+        return None
+    top, bottom, left, right = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+    area = (bottom - top) * (right - left) / gray.size
+    if area < min_fraction or area > 0.95:
+        return None  # sin fondo visible o detección poco fiable
+    return int(left), int(top), int(right), int(bottom)
+
+
+def skew_angle(gray: np.ndarray, max_angle: float = 10.0, step: float = 0.25, max_points: int = 40000) -> float:
+    """Inclinación del texto (grados) que maximiza la nitidez del perfil de proyección horizontal."""
+    ink = gray < min(_otsu(gray), 160)
+    ys, xs = np.nonzero(ink)
+    if ys.size < 200:
+        return 0.0
+    if ys.size > max_points:
+        pick = np.random.default_rng(0).choice(ys.size, max_points, replace=False)
+        ys, xs = ys[pick], xs[pick]
+    angles = np.arange(-max_angle, max_angle + step / 2, step)
+    rad = np.deg2rad(angles)[:, None]
+    projected = (ys[None, :] * np.cos(rad) - xs[None, :] * np.sin(rad)).astype(np.int64)
+    projected -= projected.min(axis=1, keepdims=True)
+    scores = [np.square(np.bincount(p)).sum() for p in projected]
+    return float(angles[int(np.argmax(scores))])
+
+
+def flatten_illumination(img: Image.Image) -> tuple[Image.Image, bool]:
+    """Divide por el fondo estimado (sombras, degradados) y estira el contraste."""
+    gray = img.convert("L")
+    bg_small = gray.resize((max(1, gray.width // 32), max(1, gray.height // 32)), Image.Resampling.BOX)
+    bg = np.asarray(bg_small.resize(gray.size, Image.Resampling.BILINEAR), dtype=np.float32)
+    p5, p95 = np.percentile(bg, [5, 95])
+    if p95 - p5 < 30:
+        return ImageOps.autocontrast(img, cutoff=1), False
+    arr = np.asarray(img, dtype=np.float32)
+    flat = np.clip(arr * (p95 / np.maximum(bg, 1.0))[:, :, None], 0, 255).astype(np.uint8)
+    return ImageOps.autocontrast(Image.fromarray(flat), cutoff=1), True
+
+
+def target_size(width: int, height: int) -> tuple[int, int]:
+    """Tamaño final: el mismo al que la API reescala (`detail: high`), nunca mayor.
+
+    Si un lado apenas sobrepasa un múltiplo de 512 px se ajusta a ese múltiplo para
+    ahorrar una fila/columna completa de teselas (170 tokens cada una).
+    """
+    long_side = env_int("FRAUDE_IMAGE_LONG_SIDE", 2048)
+    short_side = env_int("FRAUDE_IMAGE_SHORT_SIDE", 768)
+    scale = min(1.0, long_side / max(width, height), short_side / min(width, height))
+    for dim in (width, height):
+        side = dim * scale
+        snapped = (math.ceil(side / 512) - 1) * 512
+        if snapped and side <= snapped * 1.1:
+            scale *= snapped / side
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def prepare_image(raw: bytes) -> PreparedImage:
+    """Orientación EXIF → recorte del papel → enderezado → iluminación → reducción."""
+    with Image.open(io.BytesIO(raw)) as src:
+        fmt = (src.format or "PNG").upper()
+        exif = extract_exif(src)
+        original_size = src.size
+        if fmt == "JPEG":
+            # Decodificación JPEG a escala reducida (DCT): nunca por debajo de 2x el lado corto final
+            keep = min(1.0, 2 * env_int("FRAUDE_IMAGE_SHORT_SIDE", 768) / min(src.size))
+            src.draft("RGB", (round(src.width * keep), round(src.height * keep)))
+        img = ImageOps.exif_transpose(src)
+        pasos = []
+        if exif.get("Orientation", "1") != "1":
+            pasos.append(f"orientacion_exif({exif.get('Orientation')})")
+        img = img.convert("RGB")
+
+    gray, factor = _work_gray(img)
+    bbox = document_bbox(gray)
+    if bbox is not None:
+        left, top, right, bottom = (round(v * factor) for v in bbox)
+        img = img.crop((left, top, right, bottom))
+        pasos.append("recorte_bordes")
+        gray, factor = _work_gray(img)
+
+    # Reducción gruesa previa (rápida) para que enderezar y normalizar no trabajen a 12 MP
+    final = target_size(*img.size)
+    if img.width > final[0] * 1.5:
+        img = img.resize((round(final[0] * 1.5), round(img.height * final[0] * 1.5 / img.width)),
+                         Image.Resampling.BILINEAR, reducing_gap=2.0)
+
+    angle = skew_angle(gray)
+    if abs(angle) >= 0.5:
+        img = img.rotate(angle, resample=Image.Resampling.BICUBIC, expand=True, fillcolor=(255, 255, 255))
+        pasos.append(f"enderezado({-angle:+.2f}°)")
+
+    img, flattened = flatten_illumination(img)
+    pasos.append("normalizacion_iluminacion" if flattened else "normalizacion_contraste")
+
+    size = target_size(*img.size)
+    if size != img.size:
+        img = img.resize(size, Image.Resampling.LANCZOS)
+        pasos.append(f"reduccion({size[0]}x{size[1]})")
+
+    out = io.BytesIO()
+    if fmt in ("JPEG", "MPO"):
+        img.save(out, format="JPEG", quality=85, optimize=True)
+        mime = "image/jpeg"
+    else:
+        img.save(out, format="PNG", optimize=True)
+        mime = "image/png"
+    return PreparedImage(
+        data=out.getvalue(),
+        mime=mime,
+        width=img.width,
+        height=img.height,
+        exif=exif,
+        pasos=pasos,
+        bytes_originales=len(raw),
+        tokens_originales=vision_tokens(*original_size),
+        tokens_finales=vision_tokens(*img.size),
+    )
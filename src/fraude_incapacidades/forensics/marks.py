@@ -0,0 +1,267 @@
+"""
+Detección local de firma, sello y logo sobre las páginas renderizadas (sin GPT-4o Vision).
+
+Trabaja sobre el pixmap de PyMuPDF como arreglo NumPy, a ~600 px de ancho:
+
+1. tinta = píxeles oscuros o de color saturado, sin el texto de la capa de texto del PDF
+   (así un PDF nativo deja solo trazos, sellos e imágenes);
+2. componentes conexos sobre una rejilla de celdas de 4 px (propagación de etiquetas con
+   saltos de puntero, solo NumPy);
+3. por componente: tamaño, proporción, densidad de tinta, grosor de trazo, color y forma:
+   - firma: trazos finos y dispersos, más anchos que altos y altos en relación con el
+     grosor del trazo (a diferencia de una línea de texto impreso);
+   - sello: tinta de color (o negra) en anillo o marco, casi cuadrado;
+   - logo: imagen incrustada (o tinta de color densa) en la franja superior.
+
+Las confianzas (0-1) son heurísticas, no probabilidades calibradas; la cascada las usa
+para adelantar la decisión local (umbral FRAUDE_MARCAS_UMBRAL, 0.6) y el extractor para
+completar `tiene_firma`/`tiene_sello` cuando no hay visión. Cada página toma unos
+pocos milisegundos en CPU.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import Sequence
+
+import numpy as np
+
+from ..settings import env_float
+
+WORK_WIDTH = 600  # ancho de trabajo en píxeles
+CELL = 4  # lado de la celda de la rejilla de componentes
+MIN_CONFIDENCE = 0.3  # regiones por debajo no se reportan
+_BIG = np.iinfo(np.int64).max
+
+# bbox normalizado a la página: (x0, y0, x1, y1) en [0, 1]
+BBox = tuple[float, float, float, float]
+
+
+def marks_threshold() -> float:
+    return env_float("FRAUDE_MARCAS_UMBRAL", 0.6)
+
+
+@dataclass
+class PageMarks:
+    firma: float = 0.0
+    sello: float = 0.0
+    logo: float = 0.0
+    regiones: list[dict] = field(default_factory=list)  # {"tipo", "bbox", "confianza"}
+    duracion_ms: float = 0.0
+
+
+def _ramp(x: float, lo: float, hi: float) -> float:
+    """0 por debajo de `lo`, 1 por encima de `hi`, lineal entre ambos."""
+    return float(min(1.0, max(0.0, (x - lo) / (hi - lo))))
+
+
+def _band(x: float, lo: float, hi: float, soft: float) -> float:
+    """1 dentro de [lo, hi] con bordes suaves de ancho `soft`."""
+    return _ramp(x, lo - soft, lo) * (1.0 - _ramp(x, hi, hi + soft))
+
+
+def _downscale(pixels: np.ndarray) -> np.ndarray:
+    arr = np.asarray(pixels)
+    if arr.ndim == 2:
+        arr = arr[:, :, None]
+    step = max(1, -(-arr.shape[1] // WORK_WIDTH))
+    return arr[::step, ::step, :3]
+
+
+def _ink(rgb: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """(tinta, tinta de color): oscuro o saturado, sobre fondo claro."""
+    if rgb.shape[2] < 3:
+        gray = rgb[:, :, 0]
+        return gray < 150, np.zeros(gray.shape, dtype=bool)
+    # Canal por canal en enteros: reducir sobre el eje de 3 canales es varias veces más lento
+    r, g, b = (rgb[:, :, i].astype(np.int16) for i in range(3))
+    mx = np.maximum(np.maximum(r, g), b)
+    mn = np.minimum(np.minimum(r, g), b)
+    colored = ((mx - mn) * 100 > 35 * mx) & (mx > 60) & (mn < 190)  # saturación > 0.35
+    return (mx < 130) | colored, colored
+
+
+def _mask_boxes(mask: np.ndarray, boxes: Sequence[BBox], pad: int = 1) -> None:
+    h, w = mask.shape
+    for x0, y0, x1, y1 in boxes:
+        mask[max(0, int(y0 * h) - pad):int(y1 * h) + pad + 1, max(0, int(x0 * w) - pad):int(x1 * w) + pad + 1] = False
+
+
+def _cells(mask: np.ndarray) -> np.ndarray:
+    """Conteo de píxeles por celda CELL x CELL."""
+    h, w = mask.shape
+    hc, wc = -(-h // CELL), -(-w // CELL)
+    padded = np.zeros((hc * CELL, wc * CELL), dtype=np.int32)
+    padded[:h, :w] = mask
+    return padded.reshape(hc, CELL, wc, CELL).sum(axis=(1, 3))
+
+
+def label_components(mask: np.ndarray) -> np.ndarray:
+    """Etiquetas de componentes 8-conexos (0 = fondo) por propagación del mínimo con
+    saltos de puntero; converge en pocas iteraciones incluso con componentes largos."""
+    h, w = mask.shape
+    flat_index = np.arange(h * w, dtype=np.int64).reshape(h, w)
+    labels = np.where(mask, flat_index, _BIG)
+    while True:
+        padded = np.pad(labels, 1, constant_values=_BIG)
+        neighbours = labels.copy()
+        for dy in (0, 1, 2):
+            for dx in (0, 1, 2):
+                np.minimum(neighbours, padded[dy:dy + h, dx:dx + w], out=neighbours)
+        neighbours = np.where(mask, neighbours, _BIG)
+        flat = neighbours.ravel()
+        while True:  # saltos de puntero: cada celda adopta la etiqueta de su etiqueta
+            inside = flat != _BIG
+            jumped = flat.copy()
+            jumped[inside] = flat[flat[inside]]
+            if np.array_equal(jumped, flat):
+                break
+            flat = jumped
+        neighbours = flat.reshape(h, w)
+        if np.array_equal(neighbours, labels):
+            break
+        labels = neighbours
+    out = np.zeros((h, w), dtype=np.int64)
+    if mask.any():
+        _, inverse = np.unique(labels[mask], return_inverse=True)
+        out[mask] = inverse + 1
+    return out
+
+
+def _overlap(a: BBox, b: BBox) -> float:
+    """Fracción de `a` cubierta por `b`."""
+    iw = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+    ih = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    area = max((a[2] - a[0]) * (a[3] - a[1]), 1e-9)
+    return iw * ih / area
+
+
+def _scores(region: np.ndarray, colored: np.ndarray, boundary: np.ndarray, bbox: BBox, width_px: int,
+            height_px: int, image_boxes: Sequence[BBox]) -> dict[str, float]:
+    h, w = region.shape
+    ink = int(region.sum())
+    fill = ink / max(h * w, 1)
+    color_frac = float(colored[region].mean()) if ink else 0.0
+    stroke = 2.0 * ink / max(int(boundary[region].sum()), 1)  # grosor medio del trazo (px)
+    aspect = w / max(h, 1)
+    rel_w, rel_h = w / width_px, h / height_px
+
+    ys, xs = np.nonzero(region)
+    r = np.sqrt(((xs + 0.5) / (w / 2) - 1) ** 2 + ((ys + 0.5) / (h / 2) - 1) ** 2)
+    ring = float(((r > 0.7) & (r < 1.08)).mean()) if ink else 0.0
+    edge = 0.12
+    border = float(((xs < w * edge) | (xs > w * (1 - edge)) | (ys < h * edge) | (ys > h * (1 - edge))).mean()) if ink else 0.0
+    shape = max(_ramp(ring, 0.45, 0.8), _ramp(border, 0.55, 0.85))
+    squareish = _band(aspect, 0.7, 1.5, 0.4)
+
+    sello = (
+        shape * squareish
+        * _band(rel_w, 0.06, 0.35, 0.03)
+        * (1.0 - _ramp(fill, 0.45, 0.65))
+        * (0.55 + 0.45 * _ramp(color_frac, 0.2, 0.6))
+    )
+    firma = (
+        _ramp(aspect, 1.1, 2.2)
+        * _band(rel_w, 0.08, 0.45, 0.04)
+        * _band(rel_h, 0.02, 0.14, 0.01)
+        * (1.0 - _ramp(fill, 0.14, 0.3))
+        * (1.0 - _ramp(stroke, 5.0, 9.0))
+        * _ramp(h / stroke, 9.0, 16.0)  # una línea de texto impreso mide ~6-8 grosores de trazo
+        * (1.0 - 0.8 * shape * squareish)
+    )
+    in_image = max((_overlap(bbox, box) for box in image_boxes), default=0.0)
+    top = 1.0 - _ramp(bbox[1], 0.25, 0.4)
+    logo = top * _band(rel_w, 0.05, 0.45, 0.03) * max(
+        0.5 + 0.4 * _ramp(in_image, 0.5, 0.9) + 0.1 * _ramp(color_frac, 0.2, 0.5),
+        0.7 * _ramp(color_frac, 0.25, 0.6) * _ramp(fill, 0.2, 0.4),
+    ) * (1.0 - sello) * (1.0 - firma)
+    return {"firma": firma, "sello": sello, "logo": logo if in_image > 0.5 or color_frac > 0.25 else 0.0}
+
+
+def detect_marks(pixels: np.ndarray, text_boxes: Sequence[BBox] = (), image_boxes: Sequence[BBox] = ()) -> PageMarks:
+    """Confianzas de firma, sello y logo de una página (HxWx3/4 uint8).
+
+    `text_boxes` (palabras de la capa de texto) se excluyen de la tinta; `image_boxes`
+    (imágenes incrustadas) cuentan como candidatas a logo. Ambos normalizados a la página.
+    """
+    import time
+
+    inicio = time.perf_counter()
+    rgb = _downscale(pixels)
+    ink, colored = _ink(rgb)
+    _mask_boxes(ink, text_boxes)
+    height_px, width_px = ink.shape
+    eroded = ink.copy()
+    eroded[1:, :] &= ink[:-1, :]
+    eroded[:-1, :] &= ink[1:, :]
+    eroded[:, 1:] &= ink[:, :-1]
+    eroded[:, :-1] &= ink[:, 1:]
+    boundary = ink & ~eroded
+
+    counts = _cells(ink)
+    labels = label_components(counts >= 2)  # celdas con algo más que ruido
+    marks = PageMarks()
+    if labels.max() > 0:
+        ys, xs = np.nonzero(labels)
+        comp = labels[ys, xs]
+        n = int(comp.max())
+        y0 = np.full(n + 1, _BIG)
+        x0 = np.full(n + 1, _BIG)
+        y1 = np.zeros(n + 1, dtype=np.int64)
+        x1 = np.zeros(n + 1, dtype=np.int64)
+        np.minimum.at(y0, comp, ys)
+        np.minimum.at(x0, comp, xs)
+        np.maximum.at(y1, comp, ys)
+        np.maximum.at(x1, comp, xs)
+        for c in range(1, n + 1):
+            cy0, cy1 = y0[c] * CELL, min((y1[c] + 1) * CELL, height_px)
+            cx0, cx1 = x0[c] * CELL, min((x1[c] + 1) * CELL, width_px)
+            if (cx1 - cx0) < width_px * 0.04 or (cy1 - cy0) < height_px * 0.012:
+                continue  # puntos, guiones y ruido
+            in_comp = np.repeat(np.repeat(labels[y0[c]:y1[c] + 1, x0[c]:x1[c] + 1] == c, CELL, 0), CELL, 1)
+            in_comp = in_comp[:cy1 - cy0, :cx1 - cx0]
+            region = ink[cy0:cy1, cx0:cx1] & in_comp
+            bbox = (cx0 / width_px, cy0 / height_px, cx1 / width_px, cy1 / height_px)
+            scores = _scores(region, colored[cy0:cy1, cx0:cx1], boundary[cy0:cy1, cx0:cx1], bbox,
+                             width_px, height_px, image_boxes)
+            tipo = max(scores, key=scores.get)
+            if scores[tipo] >= MIN_CONFIDENCE:
+                marks.regiones.append({"tipo": tipo, "bbox": [round(float(v), 3) for v in bbox],
+                                       "confianza": round(scores[tipo], 3)})
+            marks.firma = max(marks.firma, scores["firma"])
+            marks.sello = max(marks.sello, scores["sello"])
+            marks.logo = max(marks.logo, scores["logo"])
+    # Imagen incrustada en la franja superior sin tinta visible (logo claro): candidata débil
+    for box in image_boxes:
+        if box[1] < 0.3 and 0.05 <= box[2] - box[0] <= 0.5:
+            marks.logo = max(marks.logo, 0.5)
+    marks.firma, marks.sello, marks.logo = (round(float(v), 3) for v in (marks.firma, marks.sello, marks.logo))
+    marks.regiones.sort(key=lambda r: -r["confianza"])
+    marks.duracion_ms = round((time.perf_counter() - inicio) * 1000, 2)
+    return marks
+
+
+def page_boxes(page) -> tuple[list[BBox], list[BBox]]:
+    """(palabras, imágenes incrustadas) de una página PyMuPDF, normalizadas a la página."""
+    rect = page.rect
+    w, h = max(rect.width, 1), max(rect.height, 1)
+
+    def norm(b) -> BBox:
+        return ((b[0] - rect.x0) / w, (b[1] - rect.y0) / h, (b[2] - rect.x0) / w, (b[3] - rect.y0) / h)
+
+    words = [norm(word[:4]) for word in page.get_text("words")]
+    images = [norm(info["bbox"]) for info in page.get_image_info()]
+    return words, images
+
+
+def summarize(pages: Sequence[PageMarks], numeros: Sequence[int] | None = None) -> dict:
+    """Mejor confianza por tipo sobre las páginas analizadas (números de página 1-based)."""
+    numeros = list(numeros or range(1, len(pages) + 1))
+    out: dict = {}
+    for tipo in ("firma", "sello", "logo"):
+        best = max(range(len(pages)), key=lambda i: getattr(pages[i], tipo), default=None)
+        confianza = getattr(pages[best], tipo) if best is not None else 0.0
+        out[tipo] = {"confianza": confianza, "pagina": numeros[best] if best is not None and confianza else None}
+    out["regiones"] = [dict(r, pagina=numeros[i]) for i, p in enumerate(pages) for r in p.regiones][:6]
+    out["duracion_ms"] = round(sum(p.duracion_ms for p in pages), 2)
+    return out
@@ -0,0 +1,131 @@
+"""
+Selección de páginas relevantes antes de renderizar y enviar a visión.
+
+En lugar de "las primeras 3 páginas", cada página se puntúa de forma barata con su
+capa de texto (palabras clave del certificado, códigos CIE-10, cartas remisorias) y
+sus imágenes (logos, firmas, escaneos de página completa). Solo las top-k se
+renderizan; el resto nunca se rasteriza, así que un PDF largo cuesta lo mismo que uno
+corto salvo por la lectura del texto, que también está acotada.
+"""
+
+from __future__ import annotations
+
+import re
+import unicodedata
+from dataclasses import dataclass, field
+
+from ..settings import env_float, env_int
+
+_PALABRAS = {
+    "incapacidad": 5.0,
+    "certificado de incapacidad": 4.0,
+    "licencia de maternidad": 4.0,
+    "dias de incapacidad": 3.0,
+    "diagnostico": 2.0,
+    "cie": 2.0,
+    "registro medico": 2.0,
+    "medico tratante": 2.0,
+    "fecha de inicio": 1.5,
+    "fecha final": 1.5,
+    "eps": 1.0,
+    "ips": 1.0,
+    "paciente": 1.0,
+    "firma": 1.0,
+    "sello": 1.0,
+}
+# Cartas remisorias, historias clínicas anexas y formularios que empujan el certificado
+_PENALIZACIONES = {
+    "cordial saludo": 2.0,
+    "atentamente": 2.0,
+    "senores": 1.5,
+    "historia clinica": 1.5,
+    "evolucion": 1.0,
+    "antecedentes": 1.0,
+    "examen fisico": 1.0,
+}
+_PATRONES = {p: re.compile(rf"\b{p}\b") for p in (*_PALABRAS, *_PENALIZACIONES)}
+_CIE10 = re.compile(r"\b[A-TV-Z]\d{2}(?:\.?\d{1,2})?\b")
+
+
+def _normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(ch for ch in text if not unicodedata.combining(ch))
+
+
+@dataclass
+class PageScore:
+    index: int
+    puntaje: float
+    motivos: list[str] = field(default_factory=list)
+
+
+def score_page(page, text: str | None = None) -> PageScore:
+    """Puntaje de relevancia de una página usando solo texto e información de imágenes."""
+    raw = page.get_text("text") if text is None else text
+    norm = _normalize(raw)
+    score, motivos = 0.0, []
+
+    for palabra, peso in _PALABRAS.items():
+        if _PATRONES[palabra].search(norm):
+            score += peso
+            motivos.append(palabra)
+    for palabra, peso in _PENALIZACIONES.items():
+        if _PATRONES[palabra].search(norm):
+            score -= peso
+            motivos.append(f"-{palabra}")
+
+    codigos = len(_CIE10.findall(raw))
+    if codigos:
+        score += min(codigos, 3) * 1.5
+        motivos.append(f"cie10x{codigos}")
+
+    page_area = abs(page.rect) or 1.0
+    logos = 0
+    for info in page.get_image_info():
+        x0, y0, x1, y1 = info.get("bbox", (0, 0, 0, 0))
+        fraction = abs((x1 - x0) * (y1 - y0)) / page_area
+        if fraction >= 0.6 and len(norm.strip()) < 50:
+            # Página escaneada sin capa de texto: no se puede descartar sin verla
+            score += 4.0
+            motivos.append("escaneo")
+        elif 0.002 <= fraction < 0.2:
+            logos += 1
+    if logos:
+        score += min(logos, 3) * 1.0
+        motivos.append(f"imagenesx{logos}")
+
+    return PageScore(index=page.number, puntaje=round(score, 2), motivos=motivos)
+
+
+def select_pages(doc) -> tuple[list[int], dict]:
+    """Índices (orden del documento) de las páginas a renderizar y un resumen.
+
+    Se puntúan como máximo FRAUDE_PAGE_SCAN_LIMIT páginas; se eligen hasta
+    FRAUDE_VISION_MAX_PAGES y se descartan las que no alcanzan
+    FRAUDE_PAGE_MIN_RELATIVE_SCORE del mejor puntaje (documentos cortos con páginas
+    de relleno no pagan por ellas).
+    """
+    max_pages = max(1, env_int("FRAUDE_VISION_MAX_PAGES", 3))
+    scan_limit = max(max_pages, env_int("FRAUDE_PAGE_SCAN_LIMIT", 50))
+    min_relative = env_float("FRAUDE_PAGE_MIN_RELATIVE_SCORE", 0.35)
+
+    total = doc.page_count
+    scores = [score_page(doc[i]) for i in range(min(total, scan_limit))]
+    ranked = sorted(scores, key=lambda s: (-s.puntaje, s.index))
+    best = ranked[0].puntaje if ranked else 0.0
+    chosen = [
+        s for s in ranked[:max_pages]
+        if s is ranked[0] or best <= 0 or s.puntaje >= best * min_relative
+    ]
+    selected = sorted(s.index for s in chosen)
+    resumen = {
+        "total_paginas": total,
+        "paginas_puntuadas": len(scores),
+        "paginas_seleccionadas": [i + 1 for i in selected],
+        "pagina_principal": ranked[0].index + 1 if ranked else 1,
+        "puntajes": [
+            {"pagina": s.index + 1, "puntaje": s.puntaje, "motivos": s.motivos}
+            for s in ranked[:max(max_pages * 2, 5)]
+        ],
+    }
+    return selected, resumen
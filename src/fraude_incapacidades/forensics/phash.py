@@ -0,0 +1,299 @@
+"""
+Huellas perceptuales (pHash / dHash de 64 bits) de las páginas renderizadas y un
+índice de búsqueda por distancia de Hamming para detectar certificados reutilizados
+o casi idénticos a envíos anteriores.
+
+El índice usa multi-index hashing: cada pHash se parte en 4 bloques de 16 bits y,
+por el principio del palomar, dos hashes a distancia <= r coinciden en algún bloque
+con distancia <= r // 4. Solo se verifican los candidatos de esos buckets, así que la
+consulta es sub-lineal incluso con cientos de miles de páginas. Las huellas se
+persisten en SQLite y cada proceso sincroniza incrementalmente su índice en memoria.
+
+Dos fuentes de falsos duplicados quedan fuera: las páginas en blanco o casi en blanco
+(contraste por debajo de FRAUDE_PHASH_MIN_STD) no se indexan ni se buscan, porque todas
+dan el mismo hash; y los certificados de una misma plantilla conocida de EPS se parecen
+por construcción, así que entre ellos se exige una distancia más estricta
+(FRAUDE_PHASH_MAX_DISTANCE_PLANTILLA en pHash y dHash): un mismo certificado editado y
+reenviado sigue apareciendo, dos pacientes distintos en el mismo formato no.
+"""
+
+from __future__ import annotations
+
+import itertools
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+from ..settings import data_path, env_float, env_int
+
+HASH_BITS = 64
+CHUNKS = 4
+CHUNK_BITS = HASH_BITS // CHUNKS
+_CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+
+# ── Cálculo de hashes ──
+
+def to_gray(pixels: np.ndarray) -> np.ndarray:
+    """Convierte un arreglo HxW, HxWx3 o HxWx4 (uint8) a escala de grises float32."""
+    arr = np.asarray(pixels, dtype=np.float32)
+    if arr.ndim == 2:
+        return arr
+    if arr.shape[2] == 1:
+        return arr[:, :, 0]
+    return arr[:, :, 0] * 0.299 + arr[:, :, 1] * 0.587 + arr[:, :, 2] * 0.114
+
+
+def pixmap_to_array(pix) -> np.ndarray:
+    """Vista NumPy (sin copia) de un `fitz.Pixmap`."""
+    return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+
+
+def resize_area(gray: np.ndarray, height: int, width: int) -> np.ndarray:
+    """Reducción por promedio de áreas (equivalente a INTER_AREA) solo con NumPy."""
+    rows = np.linspace(0, gray.shape[0], height + 1).astype(int)
+    cols = np.linspace(0, gray.shape[1], width + 1).astype(int)
+    rows[-1], cols[-1] = gray.shape[0], gray.shape[1]
+    summed = np.add.reduceat(np.add.reduceat(gray, rows[:-1], axis=0), cols[:-1], axis=1)
+    counts = np.outer(np.diff(rows), np.diff(cols))
+    return summed / np.maximum(counts, 1)
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    value = 0
+    for bit in bits.ravel():
+        value = (value << 1) | int(bool(bit))
+    return value
+
+
+_DCT_CACHE: dict[int, np.ndarray] = {}
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    if n not in _DCT_CACHE:
+        k = np.arange(n)[:, None]
+        i = np.arange(n)[None, :]
+        mat = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+        mat[0, :] = np.sqrt(1.0 / n)
+        _DCT_CACHE[n] = mat
+    return _DCT_CACHE[n]
+
+
+def dhash(gray: np.ndarray, size: int = 8) -> int:
+    """Hash de diferencias horizontales (size x size bits)."""
+    small = resize_area(gray, size, size + 1)
+    return _bits_to_int(small[:, 1:] > small[:, :-1])
+
+
+def phash(gray: np.ndarray, size: int = 8, factor: int = 4) -> int:
+    """Hash perceptual: DCT-II 2D de la imagen a 32x32 y umbral sobre la mediana."""
+    n = size * factor
+    small = resize_area(gray, n, n)
+    dct = _dct_matrix(n)
+    coeffs = dct @ small @ dct.T
+    low = coeffs[:size, :size].ravel()
+    median = np.median(low[1:])  # se excluye el componente DC
+    return _bits_to_int(low > median)
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def page_hashes(pixels: np.ndarray, max_side: int = 512) -> tuple[int, int] | None:
+    """(pHash, dHash) de una página; diezma páginas grandes antes de convertir a gris.
+
+    None si la página casi no tiene contraste (en blanco, solo un pie de página): su
+    hash es el mismo para todas y no identifica nada.
+    """
+    step = max(1, max(pixels.shape[0], pixels.shape[1]) // max_side)
+    gray = to_gray(pixels[::step, ::step])
+    if resize_area(gray, 32, 32).std() < env_float("FRAUDE_PHASH_MIN_STD", 4.0):
+        return None
+    return phash(gray), dhash(gray)
+
+
+# ── Índice ──
+
+@dataclass
+class HashMatch:
+    doc_id: str
+    page: int
+    distancia_phash: int
+    distancia_dhash: int
+    archivo: str
+    registrado_en: str
+    plantilla: str = ""
+
+
+def _to_signed(value: int) -> int:
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _to_unsigned(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+class PerceptualHashIndex:
+    """Índice persistente de pHash/dHash por página con búsqueda multi-index."""
+
+    def __init__(self, path: Path | str):
+        self.path = str(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS page_hashes ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, doc_id TEXT NOT NULL, page INTEGER NOT NULL,"
+            " phash INTEGER NOT NULL, dhash INTEGER NOT NULL, archivo TEXT, registrado_en TEXT,"
+            " UNIQUE(doc_id, page))"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(page_hashes)")}
+        if "plantilla" not in columns:  # índices creados antes de registrar la plantilla
+            self._conn.execute("ALTER TABLE page_hashes ADD COLUMN plantilla TEXT")
+        self._conn.commit()
+        self._rows: list[tuple[str, int, int, int, str, str, str]] = []
+        self._buckets: list[dict[int, list[int]]] = [dict() for _ in range(CHUNKS)]
+        self._last_id = 0
+
+    def __len__(self) -> int:
+        self._sync()
+        return len(self._rows)
+
+    def _add_row(self, row: tuple[str, int, int, int, str, str, str]) -> None:
+        pos = len(self._rows)
+        self._rows.append(row)
+        ph = row[2]
+        for c in range(CHUNKS):
+            self._buckets[c].setdefault((ph >> (c * CHUNK_BITS)) & _CHUNK_MASK, []).append(pos)
+
+    def _sync(self) -> None:
+        """Carga las filas que otros procesos (o este) hayan añadido desde la última vez."""
+        with self._lock:
+            cur = self._conn.execute(
+                "SELECT id, doc_id, page, phash, dhash, archivo, registrado_en, plantilla FROM page_hashes"
+                " WHERE id > ? ORDER BY id", (self._last_id,),
+            )
+            for rid, doc_id, page, ph, dh, archivo, registrado, plantilla in cur:
+                self._add_row((doc_id, page, _to_unsigned(ph), _to_unsigned(dh), archivo or "", registrado or "",
+                               plantilla or ""))
+                self._last_id = rid
+
+    @staticmethod
+    def _probe_keys(chunk: int, radius: int):
+        yield chunk
+        for r in range(1, radius + 1):
+            for bits in itertools.combinations(range(CHUNK_BITS), r):
+                flipped = chunk
+                for b in bits:
+                    flipped ^= 1 << b
+                yield flipped
+
+    def query(self, ph: int, dh: int | None = None, max_distance: int = 6,
+              exclude_doc: str | None = None, limit: int = 10,
+              plantilla: str | None = None, plantilla_max_distance: int | None = None) -> list[HashMatch]:
+        """Páginas previas con distancia pHash <= max_distance, más cercanas primero.
+
+        Las de la misma `plantilla` deben quedar además a <= `plantilla_max_distance` en
+        pHash y en dHash; el filtro se aplica antes de `limit`.
+        """
+        self._sync()
+        estricta = max_distance if plantilla_max_distance is None else min(plantilla_max_distance, max_distance)
+        sub_radius = max_distance // CHUNKS
+        seen: set[int] = set()
+        found: list[HashMatch] = []
+        for c in range(CHUNKS):
+            chunk = (ph >> (c * CHUNK_BITS)) & _CHUNK_MASK
+            bucket_map = self._buckets[c]
+            for key in self._probe_keys(chunk, sub_radius):
+                for pos in bucket_map.get(key, ()):
+                    if pos in seen:
+                        continue
+                    seen.add(pos)
+                    doc_id, page, cand_ph, cand_dh, archivo, registrado, cand_plantilla = self._rows[pos]
+                    if doc_id == exclude_doc:
+                        continue
+                    dist = hamming(ph, cand_ph)
+                    if dist > max_distance:
+                        continue
+                    dist_dh = hamming(dh, cand_dh) if dh is not None else -1
+                    if plantilla and cand_plantilla == plantilla and max(dist, dist_dh) > estricta:
+                        continue
+                    found.append(HashMatch(
+                        doc_id=doc_id, page=page, distancia_phash=dist, distancia_dhash=dist_dh,
+                        archivo=archivo, registrado_en=registrado, plantilla=cand_plantilla,
+                    ))
+        found.sort(key=lambda m: (m.distancia_phash, m.distancia_dhash))
+        return found[:limit]
+
+    def add(self, doc_id: str, page: int, ph: int, dh: int, archivo: str = "", plantilla: str | None = None) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO page_hashes (doc_id, page, phash, dhash, archivo, registrado_en, plantilla)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (doc_id, page, _to_signed(ph), _to_signed(dh), archivo, time.strftime("%Y-%m-%d %H:%M:%S"),
+                 plantilla),
+            )
+            self._conn.commit()
+        self._sync()
+
+
+_index: PerceptualHashIndex | None = None
+_index_lock = threading.Lock()
+
+
+def get_phash_index() -> PerceptualHashIndex:
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = PerceptualHashIndex(data_path("phash_index.sqlite"))
+        return _index
+
+
+def check_and_register(doc_id: str, archivo: str, pages: list[tuple[int, int] | None],
+                       page_numbers: list[int] | None = None,
+                       plantilla: str | None = None) -> tuple[list[dict], list[str]]:
+    """Busca duplicados perceptuales de cada página y luego registra el documento.
+
+    `pages` es una lista de (phash, dhash), None para las páginas sin contraste (ni se
+    buscan ni se registran); `page_numbers` sus números de página (por defecto 1..n) y
+    `plantilla` el id de la plantilla conocida del documento, si la hay: con documentos de
+    la misma plantilla solo cuentan las coincidencias dentro de
+    FRAUDE_PHASH_MAX_DISTANCE_PLANTILLA (marcadas `misma_plantilla`). Devuelve
+    (coincidencias serializables, alertas forenses).
+    """
+    numbers = page_numbers or list(range(1, len(pages) + 1))
+    hashed = [(n, hashes) for n, hashes in zip(numbers, pages) if hashes is not None]
+    index = get_phash_index()
+    max_distance = env_int("FRAUDE_PHASH_MAX_DISTANCE", 6)
+    plantilla_max_distance = env_int("FRAUDE_PHASH_MAX_DISTANCE_PLANTILLA", 2)
+    coincidencias: list[dict] = []
+    alertas: list[str] = []
+    for page_num, (ph, dh) in hashed:
+        matches = index.query(ph, dh, max_distance=max_distance, exclude_doc=doc_id, limit=3,
+                              plantilla=plantilla, plantilla_max_distance=plantilla_max_distance)
+        for m in matches:
+            coincidencias.append({
+                "pagina": page_num,
+                "documento_previo": m.doc_id[:16],
+                "archivo_previo": m.archivo,
+                "pagina_previa": m.page,
+                "distancia_phash": m.distancia_phash,
+                "distancia_dhash": m.distancia_dhash,
+                "registrado_en": m.registrado_en,
+                "misma_plantilla": bool(plantilla) and m.plantilla == plantilla,
+            })
+        if matches:
+            best = matches[0]
+            alertas.append(
+                f"⚠️ Página {page_num} casi idéntica (distancia Hamming {best.distancia_phash}/64) a "
+                f"'{best.archivo}' analizado el {best.registrado_en}. "
+                "Posible reutilización de plantilla o de un certificado previo."
+            )
+    for page_num, (ph, dh) in hashed:
+        index.add(doc_id, page_num, ph, dh, archivo, plantilla)
+    return coincidencias, alertas
@@ -0,0 +1,145 @@
+"""
+Validación previa de PDFs e imágenes, antes de renderizar nada.
+
+`fitz.open` seguido de `get_pixmap` a 2× procesa sin quejarse una página de 20000×20000
+pt, miles de páginas o imágenes incrustadas enormes: bloquea el worker y puede agotar su
+memoria. `check_pdf` revisa solo lo barato (tamaño del archivo, cifrado, cantidad de
+objetos y de páginas, dimensiones de las páginas y de las imágenes según su diccionario,
+sin decodificarlas) y decide:
+
+- rechazar: archivo de más de FRAUDE_PDF_MAX_MB (25), protegido con contraseña, con más
+  de FRAUDE_PDF_MAX_OBJETOS objetos (200 000) o FRAUDE_PDF_MAX_PAGINAS páginas (500), o
+  con páginas de más de FRAUDE_PDF_MAX_LADO_PT por lado (14 400 pt, el máximo de la
+  especificación PDF) o imágenes de más de FRAUDE_PDF_MAX_IMAGEN_MPX megapíxeles (150);
+- acotar sin alerta: las páginas grandes se renderizan con menos zoom para no pasar de
+  FRAUDE_RENDER_MAX_MPX megapíxeles (12; `render_zoom`). Es un límite de recursos, no un
+  indicio: hay EPS que emiten sus certificados en A0 (2384×3370 pt, como el de ejemplo);
+- analizar con alerta forense un PDF cifrado que abre sin contraseña.
+
+Lo que este examen no ve (contenido anidado, filtros costosos) lo contiene el renderizado
+aislado con límites de memoria y tiempo (forensics/render.py). `check_image` hace lo
+mismo con las fotos: el tamaño sale de la cabecera, sin decodificar los píxeles.
+"""
+
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from ..settings import env_float, env_int
+
+BASE_ZOOM = 2.0  # zoom de renderizado para visión (≈144 dpi)
+
+
+@dataclass
+class Preflight:
+    rechazo: str | None = None  # motivo (None: el documento puede procesarse)
+    alertas: list[str] = field(default_factory=list)
+    resumen: dict = field(default_factory=dict)
+
+    def reject(self, motivo: str) -> Preflight:
+        self.rechazo = motivo
+        self.alertas.append(f"⚠️ Documento rechazado por la validación previa: {motivo}.")
+        return self
+
+
+def render_max_pixels() -> float:
+    return max(0.5, env_float("FRAUDE_RENDER_MAX_MPX", 12.0)) * 1e6
+
+
+def render_zoom(ancho_pt: float, alto_pt: float) -> float:
+    """Zoom de renderizado: BASE_ZOOM salvo que la página exceda el máximo de píxeles."""
+    area = max(ancho_pt, 1.0) * max(alto_pt, 1.0)
+    return min(BASE_ZOOM, math.sqrt(render_max_pixels() / area))
+
+
+def _size_check(path: Path, out: Preflight) -> bool:
+    max_mb = env_float("FRAUDE_PDF_MAX_MB", 25.0)
+    mb = path.stat().st_size / 2**20
+    out.resumen["tamano_mb"] = round(mb, 2)
+    if mb > max_mb:
+        out.reject(f"archivo de {mb:.1f} MB (máximo {max_mb:g} MB)")
+        return False
+    return True
+
+
+def check_pdf(path: Path | str) -> Preflight:
+    """Inspecciona el PDF sin renderizar ni decodificar imágenes."""
+    import fitz  # PyMuPDF
+
+    path = Path(path)
+    out = Preflight()
+    if not _size_check(path, out):
+        return out
+    try:
+        doc = fitz.open(str(path))
+    except Exception as e:
+        return out.reject(f"PDF ilegible ({e})")
+    try:
+        objetos, paginas = doc.xref_length() - 1, doc.page_count
+        out.resumen.update(objetos=objetos, paginas=paginas, cifrado=bool(doc.is_encrypted))
+        if doc.needs_pass:
+            return out.reject("PDF protegido con contraseña")
+        if doc.is_encrypted:
+            out.alertas.append("⚠️ PDF cifrado (restricciones de permisos, sin contraseña de apertura).")
+        max_objetos = env_int("FRAUDE_PDF_MAX_OBJETOS", 200_000)
+        if objetos > max_objetos:
+            return out.reject(f"{objetos} objetos internos (máximo {max_objetos})")
+        max_paginas = env_int("FRAUDE_PDF_MAX_PAGINAS", 500)
+        if paginas > max_paginas:
+            return out.reject(f"{paginas} páginas (máximo {max_paginas})")
+
+        # Dimensiones de página: las que pasan del máximo de la especificación se rechazan;
+        # las grandes pero válidas se renderizan con menos zoom, sin alerta
+        max_lado = env_float("FRAUDE_PDF_MAX_LADO_PT", 14400.0)
+        mayor = (0.0, 0.0)
+        for i in range(paginas):
+            rect = doc[i].rect
+            if rect.width * rect.height > mayor[0] * mayor[1]:
+                mayor = (rect.width, rect.height)
+            if max(rect.width, rect.height) > max_lado:
+                return out.reject(f"página {i + 1} de {rect.width:.0f}×{rect.height:.0f} pt "
+                                  f"(máximo {max_lado:.0f} pt por lado)")
+        out.resumen["pagina_mayor_pt"] = [round(mayor[0]), round(mayor[1])]
+
+        # Imágenes incrustadas: tamaño declarado en su diccionario (no se decodifican)
+        max_mpx = env_float("FRAUDE_PDF_MAX_IMAGEN_MPX", 150.0)
+        imagen_mayor = 0.0
+        for xref in range(1, objetos + 1):
+            if doc.xref_get_key(xref, "Subtype")[1] != "/Image":
+                continue
+            try:
+                ancho = int(doc.xref_get_key(xref, "Width")[1])
+                alto = int(doc.xref_get_key(xref, "Height")[1])
+            except ValueError:  # referencia indirecta o valor ausente
+                continue
+            mpx = ancho * alto / 1e6
+            imagen_mayor = max(imagen_mayor, mpx)
+            if mpx > max_mpx:
+                return out.reject(f"imagen incrustada de {ancho}×{alto} px ({mpx:.0f} Mpx, máximo {max_mpx:g})")
+        out.resumen["imagen_mayor_mpx"] = round(imagen_mayor, 1)
+        return out
+    finally:
+        doc.close()
+
+
+def check_image(path: Path | str) -> Preflight:
+    """Tamaño de archivo y de imagen (de la cabecera) de una foto, antes de decodificarla."""
+    from PIL import Image
+
+    path = Path(path)
+    out = Preflight()
+    if not _size_check(path, out):
+        return out
+    try:
+        with Image.open(path) as img:
+            ancho, alto = img.size
+    except Exception as e:
+        return out.reject(f"imagen ilegible ({e})")
+    mpx = ancho * alto / 1e6
+    out.resumen["imagen_mpx"] = round(mpx, 1)
+    max_mpx = env_float("FRAUDE_IMAGEN_MAX_MPX", 80.0)
+    if mpx > max_mpx:
+        out.reject(f"imagen de {ancho}×{alto} px ({mpx:.0f} Mpx, máximo {max_mpx:g})")
+    return out
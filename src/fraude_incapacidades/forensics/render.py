@@ -0,0 +1,127 @@
+"""
+Renderizado de páginas PDF en un proceso aislado con límites de memoria y tiempo.
+
+El rasterizado es donde un PDF hostil cuesta de verdad (contenido anidado, imágenes que
+hay que decodificar, filtros costosos) y la validación previa (preflight.py) no lo ve.
+Cada documento se renderiza en un proceso hijo (forkserver en Linux: el worker tiene
+hilos y `fork` no es seguro; spawn en el resto) con un tope de memoria virtual de
+FRAUDE_RENDER_MEMORIA_MB (1536, RLIMIT_AS donde existe) y un tiempo máximo de
+FRAUDE_RENDER_TIMEOUT_S (30, acotado además al plazo del análisis). Si los excede el
+hijo muere o se mata y se lanza `RenderLimitExceeded`; el worker sigue intacto.
+
+El hijo devuelve, por página, el PNG para visión, las huellas perceptuales y las marcas
+del detector local (todo el trabajo sobre píxeles queda dentro del proceso aislado), con
+el zoom acotado por `preflight.render_zoom`.
+FRAUDE_RENDER_AISLADO=0 renderiza en el propio proceso (desarrollo).
+
+Con forkserver (y spawn) el hijo importa de nuevo el módulo principal: un script que
+llame al extractor debe proteger su punto de entrada con `if __name__ == "__main__":`,
+o cada proceso hijo volvería a ejecutarlo.
+"""
+
+from __future__ import annotations
+
+import multiprocessing
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Sequence
+
+from ..deadline import budget
+from ..settings import env_bool, env_float
+from . import marks, phash
+from .preflight import render_zoom
+
+
+class RenderLimitExceeded(RuntimeError):
+    """El renderizado superó el tiempo o la memoria permitidos."""
+
+
+@dataclass
+class RenderedPage:
+    index: int
+    png: bytes
+    hashes: tuple[int, int] | None  # (pHash, dHash); None si la página no tiene contraste
+    marcas: marks.PageMarks
+    zoom: float
+    ancho_pt: float
+    alto_pt: float
+
+
+def _render(path: str, indices: Sequence[int]) -> list[RenderedPage]:
+    import fitz  # PyMuPDF
+
+    out = []
+    with fitz.open(path) as doc:
+        for i in indices:
+            page = doc[i]
+            zoom = render_zoom(page.rect.width, page.rect.height)
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            pixels = phash.pixmap_to_array(pix)
+            out.append(RenderedPage(i, pix.tobytes("png"), phash.page_hashes(pixels),
+                                    marks.detect_marks(pixels, *marks.page_boxes(page)),
+                                    round(zoom, 3), page.rect.width, page.rect.height))
+    return out
+
+
+def _child(conn, path: str, indices: list[int], memoria_mb: float) -> None:
+    try:
+        import resource
+
+        limite = int(memoria_mb * 2**20)
+        resource.setrlimit(resource.RLIMIT_AS, (limite, limite))
+    except (ImportError, ValueError, OSError):  # Windows o límite no aplicable
+        pass
+    try:
+        conn.send(("ok", _render(path, indices)))
+    except MemoryError:
+        conn.send(("memoria", "memoria agotada"))
+    except Exception as e:
+        texto = str(e)  # MuPDF informa la memoria agotada como error propio ("malloc/calloc ... failed")
+        conn.send(("memoria" if "alloc" in texto or "memory" in texto.lower() else "error", texto))
+    finally:
+        conn.close()
+
+
+_context = None
+
+
+def _mp_context():
+    global _context
+    if _context is None:
+        if sys.platform.startswith("linux"):
+            _context = multiprocessing.get_context("forkserver")
+            _context.set_forkserver_preload([__name__])  # fitz y NumPy se importan una vez
+        else:
+            _context = multiprocessing.get_context("spawn")
+    return _context
+
+
+def render_pages(path: Path | str, indices: Sequence[int]) -> list[RenderedPage]:
+    """Renderiza las páginas `indices` (0-based) del PDF en un proceso aislado."""
+    if not env_bool("FRAUDE_RENDER_AISLADO", True):
+        return _render(str(path), indices)
+    memoria_mb = env_float("FRAUDE_RENDER_MEMORIA_MB", 1536.0)
+    timeout = budget(env_float("FRAUDE_RENDER_TIMEOUT_S", 30.0))
+    ctx = _mp_context()
+    receptor, emisor = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_child, args=(emisor, str(path), list(indices), memoria_mb), daemon=True)
+    proc.start()
+    emisor.close()
+    try:
+        if not receptor.poll(timeout):
+            raise RenderLimitExceeded(f"el renderizado superó {timeout:.3g} s")
+        estado, valor = receptor.recv()
+    except EOFError:
+        proc.join(1)
+        raise RenderLimitExceeded(f"el proceso de renderizado terminó de forma anómala (código {proc.exitcode})")
+    finally:
+        if proc.is_alive():
+            proc.kill()
+        proc.join(1)
+        receptor.close()
+    if estado == "memoria":
+        raise RenderLimitExceeded(f"el renderizado superó {memoria_mb:g} MB de memoria ({valor})")
+    if estado != "ok":
+        raise RuntimeError(f"Error renderizando el PDF: {valor}")
+    return valor
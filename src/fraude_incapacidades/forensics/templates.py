@@ -0,0 +1,463 @@
+"""
+Biblioteca de plantillas conocidas (formatos de EPS/IPS/HIS) aprendidas de documentos
+que el pipeline ya dictaminó como válidos.
+
+Cada plantilla guarda la firma de maquetación de la primera página: tamaño de página,
+conjunto de fuentes, hash de las imágenes embebidas (logos) con su posición, los
+textos fijos ("anclas") que se repiten en la misma posición en todos los documentos
+aprendidos, y la región donde aparece cada campo. Con eso:
+
+- un PDF nuevo se compara contra la biblioteca con una búsqueda por clave exacta
+  (tamaño + fuentes + logos) y, si no existe, contra las plantillas del mismo tamaño;
+- ante una coincidencia confiable, los campos se leen de sus regiones (anclados al
+  texto fijo más cercano) y se puede omitir la llamada a GPT-4o Vision;
+- las desviaciones (bloques movidos, fuentes extra, logo cambiado o ausente) se
+  reportan como alertas forenses precisas.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+from ..settings import data_path, env_float, env_int
+from ..storage.locks import file_lock
+
+FIELDS = (
+    "paciente_nombre", "paciente_cedula", "medico_nombre", "medico_cedula", "eps_o_ips",
+    "codigo_cie10", "diagnostico_texto", "dias_incapacidad", "fecha_inicio", "fecha_fin",
+)
+POS_TOLERANCE = 6.0    # puntos PDF
+SIZE_TOLERANCE = 2.0
+MIN_FIELD_LEN = 3      # valores más cortos (o solo dígitos) exigen etiqueta: "5" está en cualquier fecha
+# Campos que son la propia plantilla (cada EPS/IPS tiene la suya): no se ubican, se leen de su nombre
+TEMPLATE_FIELDS = ("eps_o_ips",)
+
+
+def _norm(text: str) -> str:
+    text = unicodedata.normalize("NFKD", str(text)).encode("ascii", "ignore").decode("ascii")
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def _dist(a: list[float], b: list[float]) -> float:
+    return max(abs(a[0] - b[0]), abs(a[1] - b[1]))
+
+
+def _min_docs() -> int:
+    return env_int("FRAUDE_TEMPLATE_MIN_DOCS", 3)
+
+
+def _anchor_positions(anchor: dict, spans: list[tuple[str, list[float], str]]) -> list[list[float]]:
+    """Posiciones del ancla en la página: el span con ese texto o, si el ancla es la etiqueta
+    de un campo ("prefijo"), el span que empieza con ella seguida del valor."""
+    texto = anchor["texto"]
+    if anchor.get("prefijo"):
+        return [b for t, b, _ in spans if t.startswith(texto)]
+    return [b for t, b, _ in spans if t == texto]
+
+
+def _anchor_cost(anchor_bbox: list[float], region_bbox: list[float]) -> float:
+    # Se prefiere la etiqueta de la misma fila (p.ej. "Documento:" a la izquierda del valor).
+    return abs(anchor_bbox[0] - region_bbox[0]) + 4 * abs(anchor_bbox[1] - region_bbox[1])
+
+
+@dataclass
+class PageLayout:
+    """Firma de maquetación de una página."""
+
+    width: float
+    height: float
+    fonts: list[str]
+    logos: list[dict]            # {"hash", "bbox"}
+    spans: list[tuple[str, list[float], str]]  # (texto normalizado, bbox, texto original)
+
+    def key(self) -> str:
+        raw = json.dumps([
+            round(self.width), round(self.height), sorted(self.fonts),
+            sorted(logo["hash"] for logo in self.logos),
+        ])
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:20]
+
+
+def extract_layout(doc, page_index: int = 0) -> PageLayout:
+    """Lee la firma de una página de un `fitz.Document` sin renderizarla."""
+    page = doc[page_index]
+    fonts: set[str] = set()
+    spans: list[tuple[str, list[float], str]] = []
+    for block in page.get_text("dict").get("blocks", []):
+        if block.get("type") != 0:
+            continue
+        for line in block.get("lines", []):
+            for span in line.get("spans", []):
+                text = span.get("text", "").strip()
+                fonts.add(span.get("font", "unknown"))
+                if text:
+                    spans.append((_norm(text), [round(v, 1) for v in span["bbox"]], text))
+    logos = []
+    for img in page.get_images(full=True):
+        xref = img[0]
+        try:
+            digest = hashlib.sha1(doc.xref_stream_raw(xref) or b"").hexdigest()[:16]
+            rects = page.get_image_rects(xref)
+        except Exception:
+            continue
+        for rect in rects or []:
+            logos.append({"hash": digest, "bbox": [round(v, 1) for v in rect]})
+    return PageLayout(
+        width=round(page.rect.width, 1), height=round(page.rect.height, 1),
+        fonts=sorted(fonts), logos=logos, spans=spans,
+    )
+
+
+@dataclass
+class Template:
+    id: str
+    nombre: str
+    width: float
+    height: float
+    fonts: list[str]
+    logos: list[dict]
+    anchors: list[dict]                 # {"texto", "bbox", "prefijo"}: texto fijo o etiqueta de un campo
+    field_regions: dict[str, dict] = field(default_factory=dict)  # campo → {"bbox", "prefijo", "ancla"}
+    campos_inestables: list[str] = field(default_factory=list)  # cambiaron de región entre documentos
+    atributos_visuales: dict[str, bool] = field(default_factory=dict)  # tiene_firma / tiene_sello
+    documentos: int = 0
+
+
+@dataclass
+class TemplateMatch:
+    template: Template
+    confianza: float
+    desviaciones: list[str]
+    campos: dict[str, str]
+
+
+class TemplateLibrary:
+    """Biblioteca persistida en JSON; se recarga si otro proceso la modificó."""
+
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._mtime = 0.0
+        self._by_id: dict[str, Template] = {}
+        self._by_size: dict[tuple[int, int], list[Template]] = {}
+        self._reload()
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def _reload(self) -> None:
+        try:
+            mtime = self.path.stat().st_mtime
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime:
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        self._by_id = {t["id"]: Template(**t) for t in data.get("plantillas", [])}
+        self._by_size = {}
+        for tpl in self._by_id.values():
+            self._by_size.setdefault((round(tpl.width), round(tpl.height)), []).append(tpl)
+        self._mtime = mtime
+
+    def _save(self) -> None:
+        tmp = self.path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"plantillas": [asdict(t) for t in self._by_id.values()]}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+        self._mtime = self.path.stat().st_mtime
+
+    # ── Coincidencia ──
+    def match(self, layout: PageLayout, doc=None, page_index: int = 0) -> TemplateMatch | None:
+        """Mejor plantilla para la página (None si ninguna supera 0.5 de confianza)."""
+        with self._lock:
+            self._reload()
+            exact = self._by_id.get(layout.key())
+            candidates = [exact] if exact else self._by_size.get((round(layout.width), round(layout.height)), [])
+        best: TemplateMatch | None = None
+        for tpl in candidates:
+            m = self._score(tpl, layout)
+            if m and (best is None or m.confianza > best.confianza):
+                best = m
+        if best is None or best.confianza < 0.5:
+            return None
+        if doc is not None:
+            best.campos = self._extract_fields(best.template, layout, doc[page_index])
+        return best
+
+    def _score(self, tpl: Template, layout: PageLayout) -> TemplateMatch | None:
+        if abs(tpl.width - layout.width) > SIZE_TOLERANCE or abs(tpl.height - layout.height) > SIZE_TOLERANCE:
+            return None
+        desviaciones: list[str] = []
+
+        tpl_fonts, doc_fonts = set(tpl.fonts), set(layout.fonts)
+        font_score = len(tpl_fonts & doc_fonts) / max(1, len(tpl_fonts | doc_fonts))
+        extra = sorted(doc_fonts - tpl_fonts)
+        if extra:
+            desviaciones.append(f"Fuentes ajenas a la plantilla '{tpl.nombre}': {', '.join(extra)}.")
+
+        logo_hits = 0
+        doc_logos = {logo["hash"]: logo for logo in layout.logos}
+        for logo in tpl.logos:
+            if logo["hash"] in doc_logos:
+                logo_hits += 1
+                continue
+            same_place = [d for d in layout.logos if _dist(d["bbox"], logo["bbox"]) <= POS_TOLERANCE]
+            if same_place:
+                desviaciones.append(
+                    f"Logo reemplazado: la imagen en {logo['bbox'][:2]} no coincide con el logo de '{tpl.nombre}'."
+                )
+            else:
+                desviaciones.append(f"Falta el logo de '{tpl.nombre}' esperado en {logo['bbox'][:2]}.")
+        logo_score = logo_hits / len(tpl.logos) if tpl.logos else 1.0
+
+        anchor_hits = 0
+        for anchor in tpl.anchors:
+            positions = _anchor_positions(anchor, layout.spans)
+            if not positions:
+                desviaciones.append(f"Texto fijo ausente: '{anchor['texto']}'.")
+                continue
+            offset = min(_dist(p, anchor["bbox"]) for p in positions)
+            if offset <= POS_TOLERANCE:
+                anchor_hits += 1
+            else:
+                desviaciones.append(f"Bloque '{anchor['texto']}' desplazado {offset:.0f} pt respecto a la plantilla.")
+        anchor_score = anchor_hits / len(tpl.anchors) if tpl.anchors else 0.0
+
+        confianza = 0.2 * font_score + 0.3 * logo_score + 0.5 * anchor_score
+        if tpl.documentos < _min_docs():
+            # Con pocos documentos aprendidos aún hay datos variables entre las "anclas":
+            # su ausencia no es una desviación
+            desviaciones = []
+        return TemplateMatch(template=tpl, confianza=round(confianza, 3), desviaciones=desviaciones, campos={})
+
+    @staticmethod
+    def _extract_fields(tpl: Template, layout: PageLayout, page) -> dict[str, str]:
+        """Lee cada campo de su región, desplazada según la posición actual de su ancla."""
+        campos: dict[str, str] = {name: tpl.nombre for name in TEMPLATE_FIELDS}
+        for name, region in tpl.field_regions.items():
+            if name in TEMPLATE_FIELDS:  # plantillas aprendidas antes de leerlo del nombre
+                continue
+            x0, y0, x1, y1 = region["bbox"]
+            ancla = region.get("ancla")
+            posiciones = _anchor_positions(ancla, layout.spans) if ancla else []
+            if posiciones:
+                cur = min(posiciones, key=lambda p: _dist(p, ancla["bbox"]))
+                dx, dy = cur[0] - ancla["bbox"][0], cur[1] - ancla["bbox"][1]
+                x0, y0, x1, y1 = x0 + dx, y0 + dy, x1 + dx, y1 + dy
+            text = page.get_textbox((x0 - 1, y0 - 1, x1 + 1, y1 + 1)) or ""
+            text = re.sub(r"\s+", " ", text).strip()
+            prefijo = region.get("prefijo", "")
+            if prefijo and text.lower().startswith(prefijo.lower()):
+                text = text[len(prefijo):].strip(" :")
+            campos[name] = text
+        return campos
+
+    # ── Aprendizaje ──
+    def learn(self, layout: PageLayout, nombre: str, datos: dict) -> Template:
+        """Incorpora un documento válido a su plantilla (creándola si no existe).
+
+        Las anclas son la intersección de textos en la misma posición entre todos los
+        documentos aprendidos; así los datos variables (nombres, fechas) se descartan. Un
+        span que lleva un campo aporta su etiqueta ("Paciente:") como ancla de prefijo.
+        """
+        with self._lock, file_lock(self.path):
+            self._reload()
+            key = layout.key()
+            tpl = self._by_id.get(key)
+            regions = self._locate_fields(layout, datos, tpl.field_regions if tpl else None)
+            field_boxes = [r["bbox"] for r in regions.values()]
+            spans_anchor = [
+                {"texto": t, "bbox": b} for t, b, _ in layout.spans
+                if len(t) >= 3 and b not in field_boxes
+            ]
+            etiquetas = {
+                (_norm(r["prefijo"]), tuple(r["bbox"])) for r in regions.values()
+                if len(r["prefijo"]) >= 3 and _is_label(_norm(r["prefijo"]))
+            }
+            spans_anchor += [{"texto": t, "bbox": list(b), "prefijo": True} for t, b in sorted(etiquetas)]
+            if tpl is None:
+                tpl = Template(
+                    id=key, nombre=nombre or "Plantilla sin nombre", width=layout.width, height=layout.height,
+                    fonts=list(layout.fonts), logos=list(layout.logos), anchors=spans_anchor,
+                    field_regions={}, documentos=0,
+                )
+                self._by_id[key] = tpl
+                self._by_size.setdefault((round(tpl.width), round(tpl.height)), []).append(tpl)
+            else:
+                tpl.anchors = [
+                    a for a in tpl.anchors
+                    if any(s["texto"] == a["texto"] and s.get("prefijo") == a.get("prefijo")
+                           and _dist(s["bbox"], a["bbox"]) <= POS_TOLERANCE for s in spans_anchor)
+                ]
+            for name, region in regions.items():
+                if name in tpl.campos_inestables:
+                    continue
+                prev = tpl.field_regions.get(name)
+                if prev and _dist(prev["bbox"], region["bbox"]) > POS_TOLERANCE:
+                    # El valor apareció en otra región: el campo no tiene posición fija en la plantilla
+                    del tpl.field_regions[name]
+                    tpl.campos_inestables.append(name)
+                    continue
+                if prev:
+                    region["bbox"] = [
+                        min(prev["bbox"][0], region["bbox"][0]), min(prev["bbox"][1], region["bbox"][1]),
+                        max(prev["bbox"][2], region["bbox"][2]), max(prev["bbox"][3], region["bbox"][3]),
+                    ]
+                tpl.field_regions[name] = region
+            for region in tpl.field_regions.values():
+                # El ancla de cada campo es el texto fijo (aún vigente) más cercano a su región.
+                region["ancla"] = min(
+                    tpl.anchors,
+                    key=lambda a: _anchor_cost(a["bbox"], region["bbox"]),
+                    default=None,
+                )
+            for attr in ("tiene_firma", "tiene_sello"):
+                if attr in datos:
+                    tpl.atributos_visuales[attr] = bool(datos[attr]) and tpl.atributos_visuales.get(attr, True)
+            tpl.documentos += 1
+            self._save()
+            return tpl
+
+    @staticmethod
+    def _locate_fields(layout: PageLayout, datos: dict, previas: dict[str, dict] | None = None) -> dict[str, dict]:
+        """Región de cada campo: el span que contiene el valor como palabras completas.
+
+        Los valores cortos o solo numéricos exigen una etiqueta (texto antes del valor en el
+        mismo span o en el span anterior de la misma línea). Si hay varios candidatos se
+        prefiere el de la región ya aprendida (`previas`) y, sin ella, el único con etiqueta
+        (mejor si termina en dos puntos);
+        si el valor sigue apareciendo en más de un lugar, el campo se omite en este documento.
+        """
+        regions: dict[str, dict] = {}
+        for name in FIELDS:
+            if name in TEMPLATE_FIELDS:
+                continue
+            value = _norm(datos.get(name, ""))
+            if not value or value in ("no legible", "no presente"):
+                continue
+            needs_label = len(value) < MIN_FIELD_LEN or value.replace(" ", "").isdigit()
+            pattern = re.compile(rf"(?<![a-z0-9]){re.escape(value)}(?![a-z0-9])")
+            candidates = []
+            for i, (text, bbox, original) in enumerate(layout.spans):
+                found = pattern.search(text)
+                if not found:
+                    continue
+                prefijo = _prefix(original, text, found.start())
+                etiquetado = _labelled(prefijo, layout.spans, i)
+                if needs_label and not etiquetado:
+                    continue
+                candidates.append(({"bbox": list(bbox), "prefijo": prefijo}, etiquetado))
+            prev = (previas or {}).get(name)
+            if prev:
+                candidates = [c for c in candidates if _dist(c[0]["bbox"], prev["bbox"]) <= POS_TOLERANCE] or candidates
+            elif len(candidates) > 1:
+                # Etiqueta con dos puntos ("Paciente:") antes que texto corrido ("Expedido a")
+                candidates = [c for c in candidates if c[1]] or candidates
+                candidates = [c for c in candidates if c[0]["prefijo"].endswith(":")] or candidates
+            candidates = [c[0] for c in candidates]
+            if len(candidates) == 1 or (prev and candidates):
+                regions[name] = candidates[0]
+        return regions
+
+
+def _prefix(original: str, text: str, idx: int) -> str:
+    """Texto original antes del valor (el índice es del texto normalizado)."""
+    if _norm(original[:idx]) == text[:idx].strip():
+        return original[:idx].strip()
+    return text[:idx].strip()
+
+
+def _is_label(text: str) -> bool:
+    # "Días de incapacidad:", "Documento", pero no "Calle 5 #" ni "Dirección: Calle 5 #"
+    return bool(text) and (text.endswith(":") or re.fullmatch(r"[a-z ]+", text) is not None)
+
+
+def _labelled(prefijo: str, spans: list[tuple[str, list[float], str]], i: int) -> bool:
+    """¿El valor lleva etiqueta? Justo antes de él en el span o en el span anterior de la línea."""
+    if prefijo:
+        return _is_label(_norm(prefijo))
+    if i == 0:
+        return False
+    text, bbox, _ = spans[i - 1]
+    cur = spans[i][1]
+    same_line = abs(bbox[1] - cur[1]) <= 2 and bbox[2] <= cur[0] + 1
+    return same_line and _is_label(text)
+
+
+_library: TemplateLibrary | None = None
+_library_lock = threading.Lock()
+
+
+def get_template_library() -> TemplateLibrary:
+    global _library
+    with _library_lock:
+        if _library is None:
+            _library = TemplateLibrary(data_path("plantillas.json"))
+        return _library
+
+
+def try_template_extraction(doc, page_index: int = 0) -> tuple[TemplateMatch | None, bool]:
+    """Compara la página del certificado (por defecto la primera) con la biblioteca.
+
+    Devuelve (coincidencia, puede_omitir_vision). Solo se omite la visión si la plantilla
+    está consolidada (FRAUDE_TEMPLATE_MIN_DOCS documentos), la confianza supera
+    FRAUDE_TEMPLATE_MIN_CONFIDENCE, no hay desviaciones, ningún campo cambió de región entre
+    los documentos aprendidos y se leyeron todos los campos.
+    """
+    library = get_template_library()
+    if not len(library):
+        return None, False
+    match = library.match(extract_layout(doc, page_index), doc, page_index)
+    if match is None:
+        return None, False
+    tpl = match.template
+    skip = (
+        tpl.documentos >= _min_docs()
+        and match.confianza >= env_float("FRAUDE_TEMPLATE_MIN_CONFIDENCE", 0.95)
+        and not match.desviaciones
+        and bool(tpl.field_regions)
+        and not tpl.campos_inestables
+        and all(match.campos.get(name) for name in tpl.field_regions)
+    )
+    return match, skip
+
+
+def learn_from_document(file_path: Path | str, datos: dict, page_index: int = 0) -> Template | None:
+    """Aprende la plantilla de un PDF ya dictaminado como válido."""
+    import fitz  # PyMuPDF
+
+    if Path(file_path).suffix.lower() != ".pdf":
+        return None
+    doc = fitz.open(str(file_path))
+    try:
+        layout = extract_layout(doc, min(page_index, doc.page_count - 1))
+    finally:
+        doc.close()
+    return get_template_library().learn(layout, str(datos.get("eps_o_ips", "")), datos)
+
+
+def learn_from_analysis(file_path: Path | str, doc_id: str, veredicto: str, puntaje: int) -> Template | None:
+    """Hook posterior al dictamen: aprende solo de PDFs válidos cuya extracción hizo
+    GPT-4o Vision (nunca de una extracción por plantilla, para no auto-reforzarse)."""
+    from ..storage.extractions import load_extraction
+
+    if veredicto != "Válida" or puntaje < env_int("FRAUDE_TEMPLATE_LEARN_MIN_SCORE", 85):
+        return None
+    extraction = load_extraction(doc_id)
+    if not extraction or (extraction.get("plantilla_conocida") or {}).get("vision_omitida"):
+        return None
+    if not extraction.get("paginas_analizadas_por_vision", 1):  # p. ej. cascada detenida antes de visión
+        return None
+    datos = extraction.get("datos_estructurados") or {}
+    if "error_extraccion_vision" in datos:
+        return None
+    principal = (extraction.get("seleccion_paginas") or {}).get("pagina_principal", 1)
+    return learn_from_document(file_path, datos, principal - 1)
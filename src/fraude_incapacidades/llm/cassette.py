@@ -0,0 +1,290 @@
+"""
+Capa de grabación/reproducción (record/replay) para las llamadas a OpenAI.
+
+Tanto la llamada de visión de `PDFForensicExtractTool` como los agentes de CrewAI
+pasan por aquí. El modo se controla con variables de entorno:
+
+- FRAUDE_LLM_MODE: "live" (por defecto), "record", "replay" o "auto"
+  (reproduce si existe la respuesta, si no la graba).
+- FRAUDE_CASSETTE_DIR / FRAUDE_CASSETTE: directorio y nombre del cassette (JSONL).
+- FRAUDE_REPLAY_LATENCY: latencia simulada al reproducir: "0", "recorded"
+  (la latencia grabada), "<ms>" o "<ms>:<jitter_ms>".
+- FRAUDE_REPLAY_STRICT: si está activo, una llamada sin grabación lanza error en
+  vez de reutilizar la siguiente respuesta grabada del mismo agente.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable
+
+from ..settings import ROOT_DIR, env_bool, env_str
+
+MODES = ("live", "record", "replay", "auto")
+
+
+class CassetteMissError(LookupError):
+    """No hay una respuesta grabada para la llamada en modo replay."""
+
+
+def llm_mode() -> str:
+    mode = env_str("FRAUDE_LLM_MODE", "live").lower()
+    return mode if mode in MODES else "live"
+
+
+def request_key(model: str, messages: Any, **params: Any) -> str:
+    """Hash canónico de una petición (modelo + mensajes + parámetros)."""
+    canonical = json.dumps(
+        {"model": model, "messages": messages, "params": params},
+        sort_keys=True, ensure_ascii=False, default=str,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def request_scope(messages: Any) -> str:
+    """Identifica el "hilo" de la llamada (p.ej. el agente) por su primer mensaje."""
+    if isinstance(messages, str):
+        first = messages
+    elif messages:
+        first = messages[0].get("content", "") if isinstance(messages[0], dict) else str(messages[0])
+    else:
+        first = ""
+    if not isinstance(first, str):
+        first = json.dumps(first, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(first[:2000].encode("utf-8")).hexdigest()[:16]
+
+
+class Cassette:
+    """Archivo JSONL con una interacción grabada por línea."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._by_key: dict[str, dict] = {}
+        self._by_scope: dict[str, list[dict]] = {}
+        self._cursor: dict[str, int] = {}
+        if self.path.exists():
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        self._index(json.loads(line))
+
+    def _index(self, entry: dict) -> None:
+        self._by_key.setdefault(entry["key"], entry)
+        self._by_scope.setdefault(entry.get("scope", ""), []).append(entry)
+
+    def __len__(self) -> int:
+        return len(self._by_key)
+
+    def lookup(self, key: str, scope: str, strict: bool = False) -> dict | None:
+        """Busca por hash exacto; si no, devuelve (en orden cíclico) la siguiente
+        respuesta grabada del mismo scope, salvo en modo estricto."""
+        entry = self._by_key.get(key)
+        if entry is not None or strict:
+            return entry
+        candidates = self._by_scope.get(scope)
+        if not candidates:
+            return None
+        with self._lock:
+            idx = self._cursor.get(scope, 0)
+            self._cursor[scope] = idx + 1
+        return candidates[idx % len(candidates)]
+
+    def record(self, key: str, scope: str, request: dict, response: dict, latency_ms: float) -> None:
+        entry = {
+            "key": key,
+            "scope": scope,
+            "request": request,
+            "response": response,
+            "latency_ms": round(latency_ms, 1),
+            "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._index(entry)
+
+
+_cassettes: dict[Path, Cassette] = {}
+_cassettes_lock = threading.Lock()
+
+
+def get_cassette() -> Cassette:
+    """Cassette compartido por todo el proceso según la configuración actual."""
+    directory = Path(env_str("FRAUDE_CASSETTE_DIR") or ROOT_DIR / "test" / "cassettes")
+    path = directory / f"{env_str('FRAUDE_CASSETTE', 'default')}.jsonl"
+    with _cassettes_lock:
+        if path not in _cassettes:
+            _cassettes[path] = Cassette(path)
+        return _cassettes[path]
+
+
+def replay_delay_ms(entry: dict, key: str) -> float:
+    """Latencia simulada, determinista para una misma petición."""
+    spec = env_str("FRAUDE_REPLAY_LATENCY", "0").lower()
+    if spec == "recorded":
+        return float(entry.get("latency_ms", 0.0))
+    base, _, jitter = spec.partition(":")
+    try:
+        base_ms, jitter_ms = float(base or 0), float(jitter or 0)
+    except ValueError:
+        return 0.0
+    if jitter_ms:
+        base_ms += random.Random(key).uniform(-jitter_ms, jitter_ms)
+    return max(0.0, base_ms)
+
+
+def _summarize(messages: Any) -> list[dict]:
+    """Resumen legible de los mensajes para el cassette (sin imágenes en base64)."""
+    if isinstance(messages, str):
+        messages = [{"role": "user", "content": messages}]
+    summary = []
+    for msg in messages or []:
+        content = msg.get("content", "") if isinstance(msg, dict) else str(msg)
+        if isinstance(content, list):
+            parts = []
+            for part in content:
+                if part.get("type") == "text":
+                    parts.append(part.get("text", "")[:300])
+                else:
+                    parts.append(f"<{part.get('type', 'parte')}>")
+            content = " | ".join(parts)
+        summary.append({"role": msg.get("role", "") if isinstance(msg, dict) else "", "content": str(content)[:300]})
+    return summary
+
+
+def _response_text(response: Any) -> tuple[str, dict]:
+    """Normaliza una respuesta del SDK de OpenAI (o un str) a (texto, usage)."""
+    if isinstance(response, str):
+        return response, {}
+    text = response.choices[0].message.content or ""
+    usage = getattr(response, "usage", None)
+    usage_dict = usage.model_dump() if hasattr(usage, "model_dump") else {}
+    return text, usage_dict
+
+
+def _replayed(mode: str, model: str, messages: Any, params: dict) -> tuple[Cassette, str, str, dict | None]:
+    """Busca la grabación de la petición; en replay estricto sin grabación lanza error."""
+    cassette = get_cassette()
+    key = request_key(model, messages, **params)
+    scope = request_scope(messages)
+    entry = None
+    if mode in ("replay", "auto"):
+        entry = cassette.lookup(key, scope, strict=env_bool("FRAUDE_REPLAY_STRICT") or mode == "auto")
+        if entry is None and mode == "replay":
+            raise CassetteMissError(f"Sin respuesta grabada en {cassette.path.name} para la petición {key[:12]}")
+    return cassette, key, scope, entry
+
+
+def _record(cassette: Cassette, key: str, scope: str, model: str, messages: Any, params: dict,
+            response: Any, start: float) -> str:
+    text, usage = _response_text(response)
+    cassette.record(
+        key, scope,
+        request={"model": model, "params": params, "messages": _summarize(messages)},
+        response={"content": text, "usage": usage},
+        latency_ms=(time.perf_counter() - start) * 1000.0,
+    )
+    return text
+
+
+def chat_completion(model: str, messages: Any, create: Callable[[], Any], **params: Any) -> str:
+    """Ejecuta `create()` (llamada real) o la reproduce desde el cassette.
+
+    `create` no recibe argumentos y devuelve una respuesta del SDK de OpenAI o un str;
+    solo se invoca en los modos live/record, o en auto cuando no hay grabación.
+    """
+    mode = llm_mode()
+    if mode == "live":
+        return _response_text(create())[0]
+
+    cassette, key, scope, entry = _replayed(mode, model, messages, params)
+    if entry is not None:
+        delay = replay_delay_ms(entry, key)
+        if delay:
+            time.sleep(delay / 1000.0)
+        return entry["response"].get("content", "")
+
+    start = time.perf_counter()
+    return _record(cassette, key, scope, model, messages, params, create(), start)
+
+
+async def achat_completion(model: str, messages: Any, acreate: Callable[[], Awaitable[Any]], **params: Any) -> str:
+    """Variante asíncrona de `chat_completion`: `acreate()` devuelve un awaitable."""
+    mode = llm_mode()
+    if mode == "live":
+        return _response_text(await acreate())[0]
+
+    cassette, key, scope, entry = _replayed(mode, model, messages, params)
+    if entry is not None:
+        delay = replay_delay_ms(entry, key)
+        if delay:
+            await asyncio.sleep(delay / 1000.0)
+        return entry["response"].get("content", "")
+
+    start = time.perf_counter()
+    return _record(cassette, key, scope, model, messages, params, await acreate(), start)
+
+
+try:
+    from crewai import BaseLLM
+except ImportError:  # pragma: no cover - crewai es dependencia del proyecto
+    BaseLLM = None  # type: ignore[assignment,misc]
+
+
+if BaseLLM is not None:
+
+    class ReplayLLM(BaseLLM):
+        """LLM de CrewAI que graba/reproduce las respuestas de otro LLM (`inner`).
+
+        Se declara sin function calling nativo para que CrewAI use el formato ReAct:
+        así las herramientas se siguen ejecutando de verdad durante el replay.
+        """
+
+        llm_type: str = "replay"
+        inner: Any = None
+
+        def call(self, messages, tools=None, callbacks=None, available_functions=None,
+                 from_task=None, from_agent=None, response_model=None):
+            msgs = [{"role": "user", "content": messages}] if isinstance(messages, str) else messages
+
+            def _live() -> str:
+                if self.inner is None:
+                    raise CassetteMissError("ReplayLLM sin LLM real configurado para grabar.")
+                if self.stop and hasattr(self.inner, "stop"):
+                    self.inner.stop = list(self.stop)
+                return str(self.inner.call(
+                    messages, callbacks=callbacks, from_task=from_task, from_agent=from_agent,
+                ))
+
+            return chat_completion(self.model, msgs, _live, temperature=self.temperature)
+
+        def supports_function_calling(self) -> bool:
+            return False
+
+        def supports_stop_words(self) -> bool:
+            return True
+
+        def get_context_window_size(self) -> int:
+            if self.inner is not None and hasattr(self.inner, "get_context_window_size"):
+                return self.inner.get_context_window_size()
+            return 128000
+
+
+def wrap_llm(llm: Any) -> Any:
+    """Envuelve un LLM de CrewAI con ReplayLLM cuando el modo no es "live"."""
+    if llm is None or llm_mode() == "live" or BaseLLM is None:
+        return llm
+    return ReplayLLM(
+        model=getattr(llm, "model", "gpt-4o"),
+        temperature=getattr(llm, "temperature", None),
+        inner=llm,
+    )
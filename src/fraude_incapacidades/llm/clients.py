@@ -0,0 +1,108 @@
+"""
+Clientes de OpenAI compartidos por todo el proceso (síncrono y asíncrono).
+
+Crear un `openai.OpenAI` por llamada descarta el pool de conexiones y la sesión TLS;
+aquí se construye uno solo por proceso (y uno asíncrono por event loop) con
+keep-alive, HTTP/2 cuando el paquete `h2` está instalado y límites configurables:
+
+- FRAUDE_OPENAI_MAX_CONNECTIONS (20) y FRAUDE_OPENAI_MAX_KEEPALIVE (10): tamaño del pool.
+- FRAUDE_OPENAI_KEEPALIVE_S (60): tiempo que una conexión ociosa sigue abierta.
+- FRAUDE_OPENAI_TIMEOUT_S (120) y FRAUDE_OPENAI_CONNECT_TIMEOUT_S (10): timeouts por
+  defecto; cada llamada puede pasar su propio `timeout=`.
+- FRAUDE_OPENAI_HTTP2 (1): desactívelo con 0 aunque `h2` esté disponible.
+
+Todas las peticiones siguen pasando por el planificador global (`scheduler.py`).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import importlib.util
+import os
+import threading
+import weakref
+
+import httpx
+import openai
+
+from ..settings import env_bool, env_float, env_int
+from .scheduler import AsyncScheduledTransport, ScheduledTransport
+
+
+def http2_enabled() -> bool:
+    return env_bool("FRAUDE_OPENAI_HTTP2", True) and importlib.util.find_spec("h2") is not None
+
+
+def pool_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=env_int("FRAUDE_OPENAI_MAX_CONNECTIONS", 20),
+        max_keepalive_connections=env_int("FRAUDE_OPENAI_MAX_KEEPALIVE", 10),
+        keepalive_expiry=env_float("FRAUDE_OPENAI_KEEPALIVE_S", 60.0),
+    )
+
+
+def default_timeout() -> httpx.Timeout:
+    return httpx.Timeout(
+        env_float("FRAUDE_OPENAI_TIMEOUT_S", 120.0),
+        connect=env_float("FRAUDE_OPENAI_CONNECT_TIMEOUT_S", 10.0),
+    )
+
+
+_sync_client: openai.OpenAI | None = None
+_sync_key: str | None = None
+_async_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def get_openai_client() -> openai.OpenAI:
+    """Cliente síncrono del proceso; se recrea solo si cambia OPENAI_API_KEY."""
+    global _sync_client, _sync_key
+    api_key = os.environ.get("OPENAI_API_KEY", "")
+    with _lock:
+        if _sync_client is None or _sync_key != api_key:
+            # El cliente anterior no se cierra: puede haber llamadas en curso en otros hilos
+            transport = ScheduledTransport(http2=http2_enabled(), limits=pool_limits())
+            _sync_client = openai.OpenAI(
+                api_key=api_key,
+                timeout=default_timeout(),
+                http_client=openai.DefaultHttpxClient(transport=transport, timeout=default_timeout()),
+            )
+            _sync_key = api_key
+        return _sync_client
+
+
+def get_async_openai_client() -> openai.AsyncOpenAI:
+    """Cliente asíncrono del event loop actual.
+
+    Las conexiones de httpx quedan atadas al loop que las abrió, así que se mantiene un
+    cliente por loop (se libera junto con el loop).
+    """
+    loop = asyncio.get_running_loop()
+    api_key = os.environ.get("OPENAI_API_KEY", "")
+    with _lock:
+        client, key = _async_clients.get(loop, (None, None))
+        if client is None or key != api_key:
+            transport = AsyncScheduledTransport(http2=http2_enabled(), limits=pool_limits())
+            client = openai.AsyncOpenAI(
+                api_key=api_key,
+                timeout=default_timeout(),
+                http_client=openai.DefaultAsyncHttpxClient(transport=transport, timeout=default_timeout()),
+            )
+            _async_clients[loop] = (client, api_key)
+        return client
+
+
+async def aclose_clients() -> None:
+    """Cierra el cliente asíncrono del loop actual (apagado ordenado del servidor)."""
+    entry = _async_clients.pop(asyncio.get_running_loop(), None)
+    if entry is not None:
+        await entry[0].close()
+
+
+def close_clients() -> None:
+    """Cierra el cliente síncrono del proceso."""
+    global _sync_client, _sync_key
+    with _lock:
+        if _sync_client is not None:
+            _sync_client.close()
+        _sync_client, _sync_key = None, None
@@ -0,0 +1,285 @@
+"""
+Payloads compactos entre herramientas y agentes.
+
+Cada salida de herramienta termina en el prompt del agente y, a través de la salida de
+su tarea, en los de las tareas siguientes. Con FRAUDE_PAYLOAD_MODE=compact (por
+defecto) las herramientas devuelven JSON minificado con claves cortas estables, sin
+valores vacíos ni campos que el agente no usa, y los avisos repetitivos (CAPTCHA,
+URLs de verificación manual, "esto NO es evidencia de fraude") viajan como un código
+cuyo texto aparece una sola vez en la descripción de la tarea (`legend`).
+FRAUDE_PAYLOAD_MODE=full conserva las salidas originales (indentadas y con el texto
+completo de los avisos).
+
+Las tareas también reciben solo los campos que necesitan de las tareas anteriores
+(`project_context`, campos `context_fields` de tasks.yaml).
+"""
+
+from __future__ import annotations
+
+import json
+import re
+from typing import Any, Iterable
+
+from ..settings import env_str
+
+# Clave original -> clave compacta (estables: aparecen en la leyenda de las tareas)
+KEYS = {
+    "verificado": "ver",
+    "riesgo": "r",
+    "fuente": "src",
+    "datos": "d",
+    "alerta": "al",
+    "alertas": "al",
+    "codigo": "cod",
+    "encontrado_en_base": "ok",
+    "encontrada": "ok",
+    "descripcion_oficial": "desc",
+    "dias_incapacidad": "dias",
+    "rango_esperado_dias": "rango",
+    "eps_oficial": "eps",
+    "estado_afiliacion": "estado",
+    "detalle_tecnico": "det",
+    "datos_estructurados": "datos",
+    "hallazgos_forenses": "forense",
+    "cantidad_imagenes_en_pdf": "imgs",
+    "software_creador": "creador",
+    "fecha_creacion_pdf": "f_creacion",
+    "fecha_modificacion_pdf": "f_modif",
+    "fuentes_tipograficas": "fuentes",
+    "alertas_forenses_automaticas": "al",
+    "duplicados_perceptuales": "dup",
+    "historial_paciente": "hist",
+    "paginas_analizadas_por_vision": "pags_vision",
+    "plantilla_conocida": "plantilla",
+    "coincidencia_nombre": "nom",
+    "marcas_locales": "marcas",
+    "coherencia_diagnostico": "diag",
+    "distribucion_dias": "dist",
+    "percentil": "pct",
+    "similitud": "sim",
+}
+
+# Campos que el agente no necesita (quedan en la extracción guardada y en el historial)
+OMIT = {
+    "url_consulta", "recomendacion", "nota", "diagnostico_medico", "eps_buscada",
+    "seleccion_paginas", "preprocesamiento_imagen", "exif_imagen", "productor", "regiones", "duracion_ms",
+}
+
+# Avisos: texto compacto (leyenda) y campos completos del modo full
+NOTICES: dict[str, tuple[str, dict[str, str]]] = {
+    "adres_captcha": (
+        "ADRES con CAPTCHA, no verificable: no penalizar, verificar a mano",
+        {
+            "nota": "El servicio ADRES está protegido por Google reCAPTCHA Enterprise. "
+                    "No es posible la consulta automatizada. Es OBLIGATORIO que el validador humano lo consulte.",
+            "recomendacion": "Verificar manualmente en: https://servicios.adres.gov.co/BDUA/Consulta-Afiliados-BDUA "
+                             "con documento {documento}",
+        },
+    ),
+    "rethus_no_encontrado": (
+        "médico NO está en RETHUS: muy sospechoso",
+        {"alerta": "Profesional con {documento} NO encontrado en RETHUS. Esto es MUY SOSPECHOSO."},
+    ),
+    "rethus_ambiguo": (
+        "RETHUS ambiguo: no penalizar, verificar a mano",
+        {
+            "nota": "El servicio RETHUS respondió pero el resultado fue ambiguo. No se penalizará.",
+            "recomendacion": "Verificar manualmente en: "
+                             "https://web.sispro.gov.co/THS/Cliente/ConsultasPublicas/ConsultaPublicaDeTHxIdentificacion.aspx "
+                             "con documento {documento}",
+        },
+    ),
+    "rethus_falla": (
+        "RETHUS con falla técnica: no penalizar",
+        {"nota": "El portal RETHUS presentó fallos técnicos temporales (timeout)."},
+    ),
+    "sin_modulo": (
+        "verificación no disponible: no penalizar",
+        {"nota": "Módulo '{modulo}' no instalado."},
+    ),
+    "eps_valida": (
+        "EPS real y válida",
+        {"alerta": "La EPS mencionada existe en el sistema de salud colombiano y es válida."},
+    ),
+    "eps_desconocida": (
+        "no es una EPS real: fraude solo si el documento dice ser de esa EPS (IPS/clínica: ignorar)",
+        {
+            "alerta": "ADVERTENCIA CRÍTICA: La entidad '{entidad}' NO se encuentra en la base de datos "
+                      "interna de EPS reales operativas en Colombia. Puede ser un error de OCR, o bien "
+                      "el documento usa un nombre de EPS inventado/fachada.",
+            "recomendacion": "Si es una IPS o clínica pequeña (no una EPS), este error puede ignorarse. "
+                             "Pero si el documento afirma ser emitido por esta EPS, "
+                             "es una fuerte señal de fraude.",
+        },
+    ),
+    "cie10_desconocido": (
+        "CIE-10 inexistente, obsoleto o muy raro",
+        {"alerta": "Código CIE-10 '{codigo}' NO encontrado en la base de datos. Puede ser un código inválido, "
+                   "obsoleto o extremadamente raro."},
+    ),
+    "cie10_texto_discrepante": (
+        "el diagnóstico escrito NO corresponde al código CIE-10: sospechoso",
+        {"alerta": "El diagnóstico escrito ('{diagnostico}') no corresponde a la descripción oficial de "
+                   "'{codigo}'. Un código real con un diagnóstico ajeno puede indicar un certificado alterado."},
+    ),
+    "nombre_discrepante": (
+        "el nombre registrado NO coincide con el del certificado: posible cédula ajena, muy sospechoso",
+        {"alerta": "El nombre registrado ('{registrado}') NO coincide con el del certificado ('{extraido}'). "
+                   "Una cédula real usada con otro nombre es un patrón clásico de fraude."},
+    ),
+    "osint_sin_resultados": (
+        "sin resultados web: no es evidencia de fraude",
+        {},
+    ),
+    "osint_generico": (
+        "solo alertan los resultados c=fraude que nombran a la entidad",
+        {},
+    ),
+    "sin_tiempo": (
+        "no verificado por tiempo (plazo del análisis vencido): no penalizar",
+        {"nota": "No verificado por tiempo: el análisis alcanzó su plazo antes de completar '{verificacion}'."},
+    ),
+}
+
+# Avisos que puede emitir cada herramienta (por `name`), para la leyenda de su tarea
+TOOL_NOTICES = {
+    "Extraccion Forense y Estructuracion PDF": ("sin_tiempo",),
+    "Verificacion ADRES BDUA": ("adres_captcha", "sin_modulo", "nombre_discrepante", "sin_tiempo"),
+    "Verificacion RETHUS SISPRO": ("rethus_no_encontrado", "rethus_ambiguo", "rethus_falla", "sin_modulo",
+                                   "nombre_discrepante", "sin_tiempo"),
+    "Validacion EPS Colombia": ("eps_valida", "eps_desconocida", "sin_tiempo"),
+    "Validacion CIE-10": ("cie10_desconocido", "cie10_texto_discrepante", "sin_tiempo"),
+    "Busqueda Web OSINT": ("osint_sin_resultados", "osint_generico", "sin_tiempo"),
+}
+
+
+# Claves propias de una herramienta que no cubre la leyenda general
+TOOL_KEYS = {
+    "Extraccion Forense y Estructuracion PDF": (
+        "forense: imgs=imágenes, dup=duplicados, hist=historial del paciente, "
+        "marcas=firma/sello/logo detectados localmente (confianza 0-1)"
+    ),
+    "Busqueda Web OSINT": "res: c=categoría, t=título, s=resumen, u=URL",
+    "Validacion CIE-10": (
+        "dist: días otorgados frente al historial del código (pct=percentil, muestras, p50/p90/p95, nivel); "
+        "diag: diagnóstico escrito vs código (sim 0-1, nivel, plausibles=códigos más parecidos al texto)"
+    ),
+    "Verificacion RETHUS SISPRO": "nom: nombre del certificado vs registrado (puntaje 0-1, nivel, alerta)",
+    "Verificacion ADRES BDUA": "nom: nombre del certificado vs registrado (puntaje 0-1, nivel, alerta)",
+}
+
+
+def payload_mode() -> str:
+    return "full" if env_str("FRAUDE_PAYLOAD_MODE", "compact").lower() == "full" else "compact"
+
+
+def compact_mode() -> bool:
+    return payload_mode() == "compact"
+
+
+def _compact(value: Any, rename: bool = True) -> Any:
+    """Quita vacíos (y, para salidas de herramientas, campos omitidos y claves largas)."""
+    if isinstance(value, dict):
+        out = {}
+        for key, item in value.items():
+            if rename and key in OMIT:
+                continue
+            item = _compact(item, rename)
+            if item is None or item == "" or item == [] or item == {}:
+                continue
+            out[KEYS.get(key, key) if rename else key] = item
+        return out
+    if isinstance(value, list):
+        return [_compact(item, rename) for item in value]
+    return value
+
+
+def minify(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def tool_payload(data: dict, aviso: str | None = None, **params: Any) -> str:
+    """Serializa la salida de una herramienta según el modo.
+
+    `aviso` es un código de NOTICES: en modo full se expande a sus campos de texto
+    (formateados con `params`); en modo compacto viaja solo el código.
+    """
+    if not compact_mode():
+        if aviso:
+            data = dict(data, **{k: v.format(**params) for k, v in NOTICES[aviso][1].items()})
+        return json.dumps(data, ensure_ascii=False, indent=2)
+    compact = _compact(data)
+    if aviso:
+        compact["aviso"] = aviso
+    return minify(compact)
+
+
+def extend_payload(raw: str, data: dict, aviso: str | None = None, **params: Any) -> str:
+    """Añade campos (y un aviso) a una salida de herramienta ya serializada con `tool_payload`."""
+    try:
+        current = json.loads(raw)
+    except (json.JSONDecodeError, TypeError):
+        return raw
+    if not isinstance(current, dict):
+        return raw
+    if not compact_mode():
+        current.update(data)
+        if aviso:
+            current.update({k: v.format(**params) for k, v in NOTICES[aviso][1].items()})
+        return json.dumps(current, ensure_ascii=False, indent=2)
+    current.update(_compact(data))
+    if aviso:
+        current.setdefault("aviso", aviso)
+    return minify(current)
+
+
+def legend(tool_names: Iterable[str]) -> str:
+    """Texto que se añade una vez a la descripción de la tarea en modo compacto."""
+    tool_names = list(tool_names)
+    codes = [code for name in tool_names for code in TOOL_NOTICES.get(name, ())]
+    lines = ["Herramientas (JSON compacto): ver=verificado (null=no verificable), r=riesgo, al=alertas, ok=encontrado"]
+    lines.extend(dict.fromkeys(TOOL_KEYS[name] for name in tool_names if name in TOOL_KEYS))
+    if codes:
+        lines.append("aviso: " + "; ".join(f"{code}={NOTICES[code][0]}" for code in dict.fromkeys(codes)))
+    return "\n".join(lines)
+
+
+_JSON_OBJECT = re.compile(r"\{[\s\S]*\}")
+
+
+def _select(data: dict, path: str) -> tuple[bool, Any]:
+    node: Any = data
+    for part in path.split("."):
+        if not isinstance(node, dict) or part not in node:
+            return False, None
+        node = node[part]
+    return True, node
+
+
+def project_context(raw: str, fields: list[str] | None) -> str:
+    """Vista de la salida de una tarea para otra: solo `fields` (rutas con punto), minificada.
+
+    Si la salida no es JSON se devuelve tal cual (el agente la redactó en texto libre).
+    """
+    match = _JSON_OBJECT.search(raw or "")
+    if not match:
+        return raw
+    try:
+        data = json.loads(match.group())
+    except ValueError:
+        return raw
+    if not isinstance(data, dict):
+        return raw
+    if fields:
+        projected: dict = {}
+        for path in fields:
+            found, value = _select(data, path)
+            if not found:
+                continue
+            node = projected
+            *parents, leaf = path.split(".")
+            for part in parents:
+                node = node.setdefault(part, {})
+            node[leaf] = value
+        data = projected
+    return minify(_compact(data, rename=False))
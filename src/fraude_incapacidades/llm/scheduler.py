@@ -0,0 +1,528 @@
+"""
+Planificador global de llamadas a OpenAI (RPM/TPM) compartido por todo el proceso.
+
+Cada petición HTTP a la API (visión de `PDFForensicExtractTool` y agentes de CrewAI)
+pide turno al planificador antes de salir:
+
+- mide peticiones y tokens estimados en una ventana deslizante de 60 s contra los
+  límites configurados (FRAUDE_OPENAI_RPM, FRAUDE_OPENAI_TPM) y limita la
+  concurrencia (FRAUDE_OPENAI_MAX_CONCURRENCY);
+- atiende por prioridad: las cargas interactivas pasan antes que las auditorías batch;
+- ante un 429 aplica un enfriamiento GLOBAL (Retry-After o backoff exponencial con
+  jitter), de modo que los reintentos del SDK de OpenAI y de CrewAI no se amontonan;
+- dentro del plazo de un análisis (deadline.py) ni la espera de turno ni la petición
+  pasan del tiempo restante, y vencido el plazo la llamada falla sin salir.
+
+Los reintentos los sigue haciendo cada cliente; el planificador solo decide cuándo
+puede salir cada intento.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import json
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Iterator
+
+import httpx
+
+from ..deadline import budget, current_deadline
+from ..profiling import current_profile
+from ..settings import env_float, env_int, worker_count
+from .usage import current_ledger, current_stage, record_response
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 5
+PRIORITY_BATCH = 10
+
+WINDOW_S = 60.0
+# Estimación de tokens por imagen enviada a GPT-4o (detalle alto ≈ 4 teselas de 512 px).
+IMAGE_TOKENS = {"high": 765, "low": 85, "auto": 765}
+
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar("llm_priority", default=PRIORITY_NORMAL)
+
+
+@contextlib.contextmanager
+def llm_priority(level: int) -> Iterator[None]:
+    """Fija la prioridad de las llamadas LLM hechas dentro del bloque."""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> int:
+    return _priority.get()
+
+
+def _parse_body(body: bytes | str | dict | None) -> dict | None:
+    if isinstance(body, (bytes, str)):
+        try:
+            return json.loads(body)
+        except (ValueError, UnicodeDecodeError):
+            return None
+    return body
+
+
+def estimate_prompt_tokens(body: bytes | str | dict | None) -> int:
+    """Estimación barata (≈4 caracteres por token) de los mensajes de una petición."""
+    if not body:
+        return 1
+    parsed = _parse_body(body)
+    if parsed is None:
+        return max(1, len(body) // 4)
+    tokens = 0
+    for msg in parsed.get("messages", []) or []:
+        content = msg.get("content", "")
+        if isinstance(content, str):
+            tokens += len(content) // 4 + 4
+            continue
+        for part in content or []:
+            if part.get("type") == "image_url":
+                detail = (part.get("image_url") or {}).get("detail", "auto")
+                tokens += IMAGE_TOKENS.get(detail, IMAGE_TOKENS["auto"])
+            else:
+                tokens += len(str(part.get("text", ""))) // 4
+    return max(1, tokens)
+
+
+def estimate_request_tokens(body: bytes | str | dict | None) -> int:
+    """Estimación de una petición chat/completions: mensajes más la respuesta máxima."""
+    parsed = _parse_body(body) if body else None
+    if not parsed:
+        return estimate_prompt_tokens(body)
+    completion = parsed.get("max_tokens") or parsed.get("max_completion_tokens") or 1000
+    return max(1, estimate_prompt_tokens(parsed) + int(completion))
+
+
+def retry_after_seconds(headers: Any) -> float | None:
+    """Lee `retry-after-ms` / `retry-after` (segundos) de una respuesta 429."""
+    if headers is None:
+        return None
+    try:
+        ms = headers.get("retry-after-ms")
+        if ms:
+            return float(ms) / 1000.0
+        secs = headers.get("retry-after")
+        if secs:
+            return float(secs)
+    except (TypeError, ValueError):
+        return None
+    return None
+
+
+@dataclass
+class Lease:
+    id: int
+    tokens: int
+    priority: int
+    granted_at: float
+    expires_at: float = float("inf")
+    window_entry: list = field(default_factory=list)
+
+
+class LLMScheduler:
+    def __init__(
+        self,
+        rpm: int = 500,
+        tpm: int = 30000,
+        max_concurrency: int = 8,
+        base_backoff_s: float = 1.0,
+        max_backoff_s: float = 60.0,
+        lease_timeout_s: float = 120.0,
+    ):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.base_backoff_s = base_backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.lease_timeout_s = lease_timeout_s
+
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._heap: list[tuple[int, int]] = []
+        self._window: deque[list] = deque()  # [timestamp, tokens]
+        self._leases: dict[int, Lease] = {}
+        self._cooldown_until = 0.0
+        self._consecutive_429 = 0
+        self._stats = {
+            "admitidas": 0,
+            "completadas": 0,
+            "esperas_por_limite": 0,
+            "espera_total_s": 0.0,
+            "espera_max_s": 0.0,
+            "respuestas_429": 0,
+            "enfriamiento_total_s": 0.0,
+            "leases_expirados": 0,
+        }
+
+    # ── Ventana y espera ──
+    def _purge(self, now: float) -> None:
+        while self._window and now - self._window[0][0] >= WINDOW_S:
+            self._window.popleft()
+        for lease_id, lease in list(self._leases.items()):
+            if now > lease.expires_at:
+                # Petición que nunca devolvió respuesta (p.ej. error de red en CrewAI).
+                del self._leases[lease_id]
+                self._stats["leases_expirados"] += 1
+
+    def _wait_time(self, tokens: int, now: float) -> float:
+        waits = [self._cooldown_until - now]
+        if len(self._leases) >= self.max_concurrency:
+            waits.append(0.25)
+        if len(self._window) >= self.rpm:
+            waits.append(self._window[0][0] + WINDOW_S - now)
+        used = sum(entry[1] for entry in self._window)
+        if self._window and used + tokens > self.tpm:
+            # Esperar hasta que expiren suficientes tokens de la ventana.
+            freed = 0
+            for ts, tok in self._window:
+                freed += tok
+                if used - freed + tokens <= self.tpm:
+                    waits.append(ts + WINDOW_S - now)
+                    break
+            else:
+                waits.append(self._window[-1][0] + WINDOW_S - now)
+        return max(waits)
+
+    def acquire(self, tokens: int, priority: int | None = None, timeout: float | None = None,
+                hold: float | None = None, cancel: threading.Event | None = None) -> Lease:
+        """Bloquea hasta que la petición puede salir; devuelve el lease a liberar.
+
+        Un lease no liberado expira a los `hold` segundos (el tiempo máximo de la petición,
+        p. ej. lo que queda del plazo) o, como máximo, a los `lease_timeout_s`. Con `cancel`
+        activado la espera se abandona (`InterruptedError`) sin tomar turno.
+        """
+        priority = current_priority() if priority is None else priority
+        start = time.monotonic()
+        throttled = False
+        with self._cond:
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._heap, entry)
+            try:
+                while True:
+                    if cancel is not None and cancel.is_set():
+                        raise InterruptedError("Espera de turno de OpenAI cancelada")
+                    now = time.monotonic()
+                    self._purge(now)
+                    wait = 1.0
+                    if self._heap[0] == entry:
+                        wait = self._wait_time(tokens, now)
+                        if wait <= 0:
+                            break
+                        throttled = True
+                    if timeout is not None and now - start + min(wait, 1.0) > timeout:
+                        raise TimeoutError("Tiempo de espera agotado en la cola de OpenAI")
+                    self._cond.wait(timeout=min(max(wait, 0.01), 1.0))
+            except BaseException:
+                self._heap.remove(entry)
+                heapq.heapify(self._heap)
+                self._cond.notify_all()
+                raise
+            heapq.heappop(self._heap)
+
+            now = time.monotonic()
+            window_entry = [now, tokens]
+            self._window.append(window_entry)
+            vigencia = self.lease_timeout_s if hold is None else min(hold, self.lease_timeout_s)
+            lease = Lease(id=entry[1], tokens=tokens, priority=priority, granted_at=now,
+                          expires_at=now + vigencia, window_entry=window_entry)
+            self._leases[lease.id] = lease
+
+            waited = now - start
+            self._stats["admitidas"] += 1
+            self._stats["espera_total_s"] += waited
+            self._stats["espera_max_s"] = max(self._stats["espera_max_s"], waited)
+            if throttled:
+                self._stats["esperas_por_limite"] += 1
+            self._cond.notify_all()
+            return lease
+
+    async def aacquire(self, tokens: int, priority: int | None = None, timeout: float | None = None,
+                       hold: float | None = None) -> Lease:
+        """`acquire` sin bloquear el loop. Si la tarea que espera se cancela, la espera del
+        hilo se abandona y, si el turno ya se había concedido, se devuelve de inmediato en
+        vez de quedar ocupado hasta que expire el lease."""
+        priority = current_priority() if priority is None else priority
+        cancel = threading.Event()
+        espera = asyncio.ensure_future(asyncio.to_thread(self.acquire, tokens, priority, timeout, hold, cancel))
+        try:
+            return await asyncio.shield(espera)
+        except asyncio.CancelledError:
+            cancel.set()
+            with self._cond:
+                self._cond.notify_all()
+            espera.add_done_callback(self._release_abandoned)
+            raise
+
+    def _release_abandoned(self, espera: asyncio.Future) -> None:
+        if espera.cancelled() or espera.exception() is not None:
+            return
+        self.release(espera.result(), actual_tokens=0)  # la petición nunca salió
+
+    def release(
+        self,
+        lease: Lease | None,
+        status_code: int | None = None,
+        retry_after: float | None = None,
+        actual_tokens: int | None = None,
+    ) -> None:
+        """Libera el turno; ante un 429 impone un enfriamiento global con jitter."""
+        if lease is None:
+            return
+        with self._cond:
+            self._leases.pop(lease.id, None)
+            self._stats["completadas"] += 1
+            if actual_tokens is not None:
+                lease.window_entry[1] = actual_tokens
+            if status_code == 429:
+                self._stats["respuestas_429"] += 1
+                self._consecutive_429 += 1
+                delay = self.backoff_delay(self._consecutive_429, retry_after)
+                now = time.monotonic()
+                self._stats["enfriamiento_total_s"] += max(0.0, now + delay - max(self._cooldown_until, now))
+                self._cooldown_until = max(self._cooldown_until, now + delay)
+            elif status_code is not None and status_code < 400:
+                self._consecutive_429 = 0
+            self._cond.notify_all()
+
+    def backoff_delay(self, attempt: int, retry_after: float | None = None) -> float:
+        """Retry-After (con hasta 10 % de jitter) o backoff exponencial con jitter completo."""
+        if retry_after is not None:
+            return retry_after * (1.0 + random.uniform(0.0, 0.1))
+        cap = min(self.max_backoff_s, self.base_backoff_s * (2 ** max(0, attempt - 1)))
+        return random.uniform(cap / 2.0, cap)
+
+    def stats(self) -> dict:
+        with self._cond:
+            now = time.monotonic()
+            self._purge(now)
+            en_cola: dict[str, int] = {}
+            for prio, _ in self._heap:
+                en_cola[str(prio)] = en_cola.get(str(prio), 0) + 1
+            return {
+                "limites": {"rpm": self.rpm, "tpm": self.tpm, "max_concurrencia": self.max_concurrency},
+                "en_cola": len(self._heap),
+                "en_cola_por_prioridad": en_cola,
+                "en_vuelo": len(self._leases),
+                "peticiones_ultimo_minuto": len(self._window),
+                "tokens_ultimo_minuto": sum(entry[1] for entry in self._window),
+                "enfriamiento_restante_s": round(max(0.0, self._cooldown_until - now), 2),
+                **{k: round(v, 3) if isinstance(v, float) else v for k, v in self._stats.items()},
+            }
+
+
+_scheduler: LLMScheduler | None = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> LLMScheduler:
+    """Planificador único del proceso, configurado por variables de entorno.
+
+    Los límites RPM/TPM son de la cuenta; con varios workers cada proceso recibe su
+    parte (FRAUDE_WORKERS) para que la suma no los supere.
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            workers = worker_count()
+            _scheduler = LLMScheduler(
+                rpm=max(1, env_int("FRAUDE_OPENAI_RPM", 500) // workers),
+                tpm=max(1, env_int("FRAUDE_OPENAI_TPM", 30000) // workers),
+                max_concurrency=env_int("FRAUDE_OPENAI_MAX_CONCURRENCY", 8),
+                base_backoff_s=env_float("FRAUDE_OPENAI_BACKOFF_S", 1.0),
+                max_backoff_s=env_float("FRAUDE_OPENAI_MAX_BACKOFF_S", 60.0),
+                lease_timeout_s=env_float("FRAUDE_OPENAI_LEASE_TIMEOUT_S", 120.0),
+            )
+        return _scheduler
+
+
+def _usage_tokens(response: httpx.Response) -> int | None:
+    """Tokens reales de una respuesta JSON ya leída (None si no aplica)."""
+    if "json" not in response.headers.get("content-type", ""):
+        return None
+    try:
+        usage = response.json().get("usage") or {}
+        return int(usage["total_tokens"]) if "total_tokens" in usage else None
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+def _watch_thread() -> None:
+    """Muestrea también el hilo que hace la llamada (CrewAI llama al LLM desde sus propios hilos)."""
+    profile = current_profile()
+    if profile is not None:
+        profile.watch_current_thread()
+
+
+def _deadline_timeout(request: httpx.Request) -> float | None:
+    """Acota los timeouts de la petición al plazo del análisis y devuelve el tiempo restante
+    para la espera de turno (None sin plazo; vencido, `DeadlineExceeded`)."""
+    if current_deadline() is None:
+        return None
+    restante = budget()
+    timeouts = request.extensions.get("timeout") or {}
+    request.extensions["timeout"] = {
+        key: restante if timeouts.get(key) is None else min(timeouts[key], restante)
+        for key in ("connect", "read", "write", "pool")
+    }
+    return restante
+
+
+def _llm_span(content: bytes, inicio: float, turno: float, status_code: int | None) -> None:
+    """Intervalo "llm" en el perfil activo (modelo, etapa, espera de turno); sin perfil no hace nada."""
+    profile = current_profile()
+    if profile is None:
+        return
+    fin = time.perf_counter()
+    body = _parse_body(content) or {}
+    profile.add_span("llm", str(body.get("model") or "desconocido"), inicio, fin,
+                     etapa=current_stage(), espera_ms=round((turno - inicio) * 1000, 1), status=status_code)
+
+
+class ScheduledTransport(httpx.HTTPTransport):
+    """Transporte httpx que pide turno al planificador antes de cada petición."""
+
+    def __init__(self, scheduler: LLMScheduler | None = None, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.scheduler = scheduler
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        scheduler = self.scheduler or get_scheduler()
+        _watch_thread()
+        inicio = time.perf_counter()
+        lease = scheduler.acquire(estimate_request_tokens(request.content), timeout=_deadline_timeout(request))
+        turno = time.perf_counter()
+        status_code = retry_after = actual = None
+        try:
+            response = super().handle_request(request)
+            status_code = response.status_code
+            retry_after = retry_after_seconds(response.headers)
+            if status_code == 200 and "json" in response.headers.get("content-type", ""):
+                response.read()
+                actual = _usage_tokens(response)
+                record_response(response, estimate_prompt_tokens(request.content))
+            return response
+        finally:
+            scheduler.release(lease, status_code, retry_after, actual)
+            _llm_span(request.content, inicio, turno, status_code)
+
+
+class AsyncScheduledTransport(httpx.AsyncHTTPTransport):
+    """Versión asíncrona de `ScheduledTransport` (la espera del turno no bloquea el loop)."""
+
+    def __init__(self, scheduler: LLMScheduler | None = None, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.scheduler = scheduler
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        scheduler = self.scheduler or get_scheduler()
+        inicio = time.perf_counter()
+        lease = await scheduler.aacquire(estimate_request_tokens(request.content), timeout=_deadline_timeout(request))
+        turno = time.perf_counter()
+        status_code = retry_after = actual = None
+        try:
+            response = await super().handle_async_request(request)
+            status_code = response.status_code
+            retry_after = retry_after_seconds(response.headers)
+            if status_code == 200 and "json" in response.headers.get("content-type", ""):
+                await response.aread()
+                actual = _usage_tokens(response)
+                record_response(response, estimate_prompt_tokens(request.content))
+            return response
+        finally:
+            scheduler.release(lease, status_code, retry_after, actual)
+            _llm_span(request.content, inicio, turno, status_code)
+
+
+try:
+    from crewai.llms.hooks.base import BaseInterceptor
+except ImportError:  # pragma: no cover - versiones de crewai sin interceptores
+    BaseInterceptor = None  # type: ignore[assignment,misc]
+
+
+if BaseInterceptor is not None:
+
+    _interceptor_lease: contextvars.ContextVar[tuple[Lease, int, float, float, bytes] | None] = contextvars.ContextVar(
+        "fraude_interceptor_lease", default=None
+    )
+
+    class SchedulerInterceptor(BaseInterceptor[httpx.Request, httpx.Response]):
+        """Interceptor de CrewAI: mismo planificador para las llamadas de los agentes.
+
+        El transporte de CrewAI llama a `on_outbound` y `on_inbound` en el mismo hilo
+        (o tarea) antes de que httpx asocie la petición a la respuesta, así que el lease
+        viaja en una ContextVar. Si la petición falla (conexión, timeout) CrewAI no llama
+        a `on_inbound`: el lease pendiente se libera en el siguiente `on_outbound` del
+        mismo contexto (los reintentos del SDK) y, si no lo hay, expira al acabar el
+        tiempo máximo de la petición (el plazo restante o FRAUDE_OPENAI_LEASE_TIMEOUT_S).
+        """
+
+        def __init__(self, scheduler: LLMScheduler | None = None):
+            self.scheduler = scheduler
+
+        def _sched(self) -> LLMScheduler:
+            return self.scheduler or get_scheduler()
+
+        def _release_pending(self) -> None:
+            """Libera el lease de una petición anterior de este contexto que falló sin respuesta."""
+            pendiente = _interceptor_lease.get()
+            if pendiente is None:
+                return
+            _interceptor_lease.set(None)
+            lease, _, inicio, turno, content = pendiente
+            self._sched().release(lease)
+            _llm_span(content, inicio, turno, None)
+
+        def on_outbound(self, message: httpx.Request) -> httpx.Request:
+            _watch_thread()
+            self._release_pending()
+            inicio = time.perf_counter()
+            restante = _deadline_timeout(message)
+            lease = self._sched().acquire(estimate_request_tokens(message.content), timeout=restante, hold=restante)
+            _interceptor_lease.set((lease, estimate_prompt_tokens(message.content), inicio, time.perf_counter(),
+                                  message.content))
+            return message
+
+        def on_inbound(self, message: httpx.Response) -> httpx.Response:
+            lease, prompt_tokens, inicio, turno, content = _interceptor_lease.get() or (None, 0, None, None, b"")
+            _interceptor_lease.set(None)
+            if current_ledger() is not None and message.status_code == 200 \
+                    and "json" in message.headers.get("content-type", ""):
+                message.read()
+                record_response(message, prompt_tokens)
+            self._sched().release(lease, message.status_code, retry_after_seconds(message.headers))
+            if inicio is not None:
+                _llm_span(content, inicio, turno, message.status_code)
+            return message
+
+        async def aon_outbound(self, message: httpx.Request) -> httpx.Request:
+            self._release_pending()
+            inicio = time.perf_counter()
+            restante = _deadline_timeout(message)
+            lease = await self._sched().aacquire(estimate_request_tokens(message.content),
+                                                 timeout=restante, hold=restante)
+            _interceptor_lease.set((lease, estimate_prompt_tokens(message.content), inicio, time.perf_counter(),
+                                  message.content))
+            return message
+
+        async def aon_inbound(self, message: httpx.Response) -> httpx.Response:
+            lease, prompt_tokens, inicio, turno, content = _interceptor_lease.get() or (None, 0, None, None, b"")
+            _interceptor_lease.set(None)
+            if current_ledger() is not None and message.status_code == 200 \
+                    and "json" in message.headers.get("content-type", ""):
+                await message.aread()
+                record_response(message, prompt_tokens)
+            self._sched().release(lease, message.status_code, retry_after_seconds(message.headers))
+            if inicio is not None:
+                _llm_span(content, inicio, turno, message.status_code)
+            return message
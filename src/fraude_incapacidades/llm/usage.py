@@ -0,0 +1,124 @@
+"""
+Contabilidad de tokens por etapa del análisis.
+
+Dentro de `token_ledger()` cada respuesta de OpenAI que pasa por el planificador
+(transportes del cliente de visión e interceptor de CrewAI) se suma a la etapa activa
+(`token_stage`): una por tarea del Crew y "vision" para la extracción. Se usan los
+tokens reales de `usage` y, si la respuesta no los trae, la estimación del planificador.
+Fuera de un ledger el registro no hace nada.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import json
+import threading
+from dataclasses import asdict, dataclass
+from typing import Iterator
+
+import httpx
+
+
+@dataclass
+class StageUsage:
+    llamadas: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    estimadas: int = 0  # llamadas sin `usage` en la respuesta
+    contexto_tokens: int = 0  # contexto de tareas previas inyectado en el prompt (estimado)
+
+
+class TokenLedger:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.etapas: dict[str, StageUsage] = {}
+        self.modelos: dict[str, StageUsage] = {}  # para estimar costo (modelos con precios distintos)
+
+    def _stage(self, etapa: str) -> StageUsage:
+        return self.etapas.setdefault(etapa, StageUsage())
+
+    def add(self, etapa: str, prompt_tokens: int, completion_tokens: int, estimada: bool = False,
+            modelo: str = "desconocido") -> None:
+        with self._lock:
+            for stage in (self._stage(etapa), self.modelos.setdefault(modelo, StageUsage())):
+                stage.llamadas += 1
+                stage.prompt_tokens += prompt_tokens
+                stage.completion_tokens += completion_tokens
+                stage.estimadas += int(estimada)
+
+    def add_context(self, etapa: str, tokens: int) -> None:
+        with self._lock:
+            self._stage(etapa).contexto_tokens += tokens
+
+    def resumen(self) -> dict:
+        with self._lock:
+            etapas = {name: asdict(stage) for name, stage in self.etapas.items()}
+            modelos = {
+                name: {"llamadas": m.llamadas, "prompt_tokens": m.prompt_tokens, "completion_tokens": m.completion_tokens}
+                for name, m in self.modelos.items()
+            }
+        total = {
+            key: sum(stage[key] for stage in etapas.values())
+            for key in ("llamadas", "prompt_tokens", "completion_tokens", "contexto_tokens")
+        }
+        return {"etapas": etapas, "modelos": modelos, "total": total}
+
+
+_ledger: contextvars.ContextVar[TokenLedger | None] = contextvars.ContextVar("token_ledger", default=None)
+_stage: contextvars.ContextVar[str] = contextvars.ContextVar("token_stage", default="sin_etapa")
+
+
+@contextlib.contextmanager
+def token_ledger() -> Iterator[TokenLedger]:
+    """Activa la contabilidad para todo lo que se ejecute dentro del bloque."""
+    ledger = TokenLedger()
+    token = _ledger.set(ledger)
+    try:
+        yield ledger
+    finally:
+        _ledger.reset(token)
+
+
+@contextlib.contextmanager
+def token_stage(etapa: str) -> Iterator[None]:
+    token = _stage.set(etapa)
+    try:
+        yield
+    finally:
+        _stage.reset(token)
+
+
+def current_ledger() -> TokenLedger | None:
+    return _ledger.get()
+
+
+def current_stage() -> str:
+    return _stage.get()
+
+
+def record_context(tokens: int) -> None:
+    ledger = _ledger.get()
+    if ledger is not None:
+        ledger.add_context(_stage.get(), tokens)
+
+
+def record_response(response: httpx.Response, estimated_prompt_tokens: int) -> None:
+    """Suma una respuesta ya leída a la etapa activa (sin ledger no hace nada)."""
+    ledger = _ledger.get()
+    if ledger is None or response.status_code != 200:
+        return
+    body: dict = {}
+    if "json" in response.headers.get("content-type", ""):
+        try:
+            body = json.loads(response.content)
+        except (ValueError, httpx.ResponseNotRead):
+            body = {}
+    if not isinstance(body, dict):
+        body = {}
+    usage = body.get("usage") or {}
+    modelo = str(body.get("model") or "desconocido")
+    if "prompt_tokens" in usage:
+        ledger.add(_stage.get(), int(usage["prompt_tokens"]), int(usage.get("completion_tokens", 0)), modelo=modelo)
+    else:
+        ledger.add(_stage.get(), estimated_prompt_tokens, 0, estimada=True, modelo=modelo)
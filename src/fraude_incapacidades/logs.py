@@ -0,0 +1,243 @@
+"""
+Logging estructurado y no bloqueante.
+
+Los registros (incluidos los `print` de CrewAI y de las herramientas, capturados desde
+stdout/stderr) se encolan con un `QueueHandler` y un único hilo (`QueueListener`) los
+escribe como líneas JSON en un archivo con rotación. La escritura a disco nunca ocurre
+en el hilo de la petición: si la cola se llena, el registro se descarta y se cuenta.
+
+Cada línea lleva `request_id`/`job_id` (ver `log_context`) y los tiempos de etapa
+(`log_stage`). Configuración por entorno:
+
+- FRAUDE_LOG_DIR (DATA_DIR/logs), FRAUDE_LOG_FILE (fraude.jsonl; admite `{pid}`). Con
+  varios workers (FRAUDE_WORKERS > 1) el nombre por defecto es `fraude-{pid}.jsonl`:
+  la rotación de `logging` no es segura entre procesos que comparten archivo
+- FRAUDE_LOG_LEVEL (INFO) y FRAUDE_LOG_LEVELS por subsistema, p. ej.
+  "crewai=WARNING,fraude_incapacidades.llm=DEBUG,stdout=INFO"
+- FRAUDE_LOG_ROTATION: "size" (FRAUDE_LOG_MAX_MB, 50) o "time" (FRAUDE_LOG_WHEN,
+  "midnight"); FRAUDE_LOG_BACKUPS (10) archivos conservados
+- FRAUDE_LOG_QUEUE_SIZE (10000), FRAUDE_LOG_CAPTURE_STDOUT (1), FRAUDE_LOG_CONSOLE (0)
+"""
+
+from __future__ import annotations
+
+import atexit
+import contextlib
+import contextvars
+import io
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Iterator
+
+from .settings import DATA_DIR, env_bool, env_int, env_str, worker_count
+
+_request_id: contextvars.ContextVar[str | None] = contextvars.ContextVar("request_id", default=None)
+_job_id: contextvars.ContextVar[str | None] = contextvars.ContextVar("job_id", default=None)
+
+# Atributos estándar de LogRecord: todo lo demás que llegue por `extra=` va al JSON.
+_RESERVED = set(logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {"message", "asctime"}
+_ANSI = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]")
+
+
+@contextlib.contextmanager
+def log_context(request_id: str | None = None, job_id: str | None = None) -> Iterator[None]:
+    """Asocia los registros emitidos dentro del bloque a una petición y/o trabajo."""
+    tokens = []
+    if request_id is not None:
+        tokens.append((_request_id, _request_id.set(request_id)))
+    if job_id is not None:
+        tokens.append((_job_id, _job_id.set(job_id)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def current_request_id() -> str | None:
+    return _request_id.get()
+
+
+@contextlib.contextmanager
+def log_stage(logger: logging.Logger, etapa: str, **fields: Any) -> Iterator[dict]:
+    """Registra la duración de una etapa; el dict cedido permite añadir campos."""
+    extra = dict(fields)
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield extra
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        extra.update(etapa=etapa, estado=status, duracion_ms=round((time.perf_counter() - start) * 1000, 1))
+        logger.info("etapa %s", etapa, extra=extra)
+
+
+class ContextFilter(logging.Filter):
+    """Copia request_id/job_id del contexto al registro (en el hilo productor)."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "request_id", None) is None:
+            record.request_id = _request_id.get()
+        if getattr(record, "job_id", None) is None:
+            record.job_id = _job_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry: dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "nivel": record.levelname,
+            "logger": record.name,
+            "mensaje": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["excepcion"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler que descarta (y cuenta) en vez de bloquear si la cola está llena."""
+
+    dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+
+class StreamToLogger(io.TextIOBase):
+    """Reemplazo de stdout/stderr que convierte cada línea impresa en un registro."""
+
+    def __init__(self, logger: logging.Logger, level: int, original: Any = None):
+        self.logger = logger
+        self.level = level
+        self.original = original
+        self._local = threading.local()
+
+    @property
+    def encoding(self) -> str:  # type: ignore[override]
+        return "utf-8"
+
+    def writable(self) -> bool:
+        return True
+
+    def isatty(self) -> bool:
+        return False
+
+    def fileno(self) -> int:
+        if self.original is not None:
+            return self.original.fileno()
+        raise io.UnsupportedOperation("fileno")
+
+    def write(self, text: str) -> int:
+        buffer = getattr(self._local, "buffer", "") + text
+        *lines, rest = buffer.split("\n")
+        self._local.buffer = rest
+        for line in lines:
+            line = _ANSI.sub("", line).rstrip()
+            if line.strip():
+                self.logger.log(self.level, line)
+        return len(text)
+
+    def flush(self) -> None:
+        rest = getattr(self._local, "buffer", "")
+        if rest.strip():
+            self.logger.log(self.level, _ANSI.sub("", rest).rstrip())
+        self._local.buffer = ""
+
+
+def _parse_levels(spec: str) -> dict[str, int]:
+    levels = {}
+    for item in spec.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = logging.getLevelName(level.strip().upper())
+    return levels
+
+
+def _file_handler() -> logging.Handler:
+    directory = env_str("FRAUDE_LOG_DIR") or str(DATA_DIR / "logs")
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    default = "fraude-{pid}.jsonl" if worker_count() > 1 else "fraude.jsonl"
+    path = str(Path(directory) / env_str("FRAUDE_LOG_FILE", default).replace("{pid}", str(os.getpid())))
+    backups = env_int("FRAUDE_LOG_BACKUPS", 10)
+    if env_str("FRAUDE_LOG_ROTATION", "size").lower() == "time":
+        return logging.handlers.TimedRotatingFileHandler(
+            path, when=env_str("FRAUDE_LOG_WHEN", "midnight"), backupCount=backups, encoding="utf-8",
+        )
+    return logging.handlers.RotatingFileHandler(
+        path, maxBytes=env_int("FRAUDE_LOG_MAX_MB", 50) * 1024 * 1024, backupCount=backups, encoding="utf-8",
+    )
+
+
+_listener: logging.handlers.QueueListener | None = None
+_setup_lock = threading.Lock()
+
+
+def setup_logging(capture_stdout: bool | None = None) -> None:
+    """Configura el pipeline de logging una sola vez por proceso (idempotente)."""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+        handlers: list[logging.Handler] = [_file_handler()]
+        if env_bool("FRAUDE_LOG_CONSOLE"):
+            handlers.append(logging.StreamHandler(sys.__stderr__))
+        formatter = JsonFormatter()
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        log_queue: queue.Queue = queue.Queue(maxsize=env_int("FRAUDE_LOG_QUEUE_SIZE", 10000))
+        queue_handler = DroppingQueueHandler(log_queue)
+        queue_handler.addFilter(ContextFilter())
+
+        root = logging.getLogger()
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(queue_handler)
+        root.setLevel(logging.getLevelName(env_str("FRAUDE_LOG_LEVEL", "INFO").upper()))
+        for name, level in _parse_levels(env_str("FRAUDE_LOG_LEVELS", "httpx=WARNING,httpcore=WARNING")).items():
+            logging.getLogger(name).setLevel(level)
+
+        _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown_logging)
+
+        if env_bool("FRAUDE_LOG_CAPTURE_STDOUT", True) if capture_stdout is None else capture_stdout:
+            sys.stdout = StreamToLogger(logging.getLogger("stdout"), logging.INFO, sys.__stdout__)
+            sys.stderr = StreamToLogger(logging.getLogger("stderr"), logging.WARNING, sys.__stderr__)
+
+
+def shutdown_logging() -> None:
+    """Vacía la cola y detiene el hilo escritor (al salir del proceso)."""
+    global _listener
+    with _setup_lock:
+        if _listener is None:
+            return
+        for stream in (sys.stdout, sys.stderr):
+            if isinstance(stream, StreamToLogger):
+                stream.flush()
+        _listener.stop()
+        _listener = None
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+
+
+def dropped_records() -> int:
+    return DroppingQueueHandler.dropped
@@ -0,0 +1,332 @@
+"""
+Conciliación de nombres del certificado con los de registros (RETHUS, ADRES, padrones locales).
+
+Una cédula real de otro médico con un nombre distinto es un patrón clásico de fraude:
+el registro confirma la cédula, pero no a quien firma. La comparación es insensible a
+tildes, mayúsculas y orden de los nombres, tolera iniciales ("J. Pérez") y ruido de OCR
+(dígitos por letras, letras cambiadas) y devuelve un puntaje 0-1:
+
+- cada nombre se normaliza a tokens (sin títulos como "Dr." ni partículas "de", "del"…);
+- la similitud entre tokens es Jaro-Winkler; una inicial vale 0.9 frente a un token que
+  empieza con esa letra; por debajo de FRAUDE_NOMBRE_TOKEN_MIN (0.85) un par de tokens
+  cuenta como 0 ("Jorge"/"Jose", "Rojas"/"Rios" no son el mismo nombre a medias);
+- el puntaje combina la cobertura del nombre más corto (cada token con su mejor pareja
+  en el otro, peso 0.8) y la del más largo (0.2): el certificado suele traer solo un
+  nombre y un apellido de los cuatro del registro;
+- al menos un apellido del registrado debe coincidir; si no, el puntaje queda en
+  `NO_SURNAME_CAP` (no coincide). Los registros dan "nombres apellidos": en un nombre
+  registrado de dos o tres tokens son apellidos todos menos el primero, y con cuatro o
+  más, todos menos los dos primeros.
+
+`similarity_batch` calcula todo con NumPy sobre vocabularios de tokens y pares únicos
+(un mismo médico aparece en miles de certificados), de modo que conciliar cientos de
+miles de pares en una auditoría histórica toma segundos; `match_names` usa el mismo
+camino para un par. Umbrales: FRAUDE_NOMBRE_COINCIDE (0.85) y FRAUDE_NOMBRE_DISCREPANTE
+(0.70); entre ambos el nivel es "parcial".
+"""
+
+from __future__ import annotations
+
+import csv
+import json
+import re
+import time
+import unicodedata
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Iterator, Sequence, TextIO
+
+from .llm.payloads import extend_payload
+from .settings import env_float
+
+if TYPE_CHECKING:
+    import numpy as np
+
+MAX_TOKENS = 6  # tokens por nombre (los demás se ignoran)
+MAX_TOKEN_LEN = 16  # caracteres por token
+INITIAL_SCORE = 0.9
+NO_SURNAME_CAP = 0.5  # puntaje máximo si ningún apellido del registrado coincide
+_CHUNK = 20000  # pares de nombres por bloque (memoria acotada)
+
+_HONORIFICS = {"dr", "dra", "doctor", "doctora", "md", "lic", "enf", "sr", "sra"}
+_PARTICLES = {"de", "del", "la", "las", "los", "y", "da", "do", "san"}
+# Confusiones típicas de OCR en nombres (no hay dígitos en un nombre)
+_OCR = str.maketrans({"0": "o", "1": "i", "3": "e", "4": "a", "5": "s", "7": "t", "8": "b", "|": "l", "@": "a"})
+_NON_LETTER = re.compile(r"[^a-z\s]")
+
+
+def name_tokens(text: str | None) -> tuple[str, ...]:
+    """Tokens normalizados: minúsculas, sin tildes, sin títulos ni partículas."""
+    text = unicodedata.normalize("NFKD", str(text or "").lower().translate(_OCR))
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    tokens = _NON_LETTER.sub(" ", text.replace(".", ". ")).split()
+    return tuple(t[:MAX_TOKEN_LEN] for t in tokens if t not in _HONORIFICS and t not in _PARTICLES)[:MAX_TOKENS]
+
+
+def _jaro_winkler(a: np.ndarray, la: np.ndarray, b: np.ndarray, lb: np.ndarray, prefix_weight: float = 0.1) -> np.ndarray:
+    """Jaro-Winkler vectorizado: `a`, `b` son códigos (n, L) rellenos con 0 y `la`, `lb` sus longitudes."""
+    import numpy as np
+
+    n, width = a.shape
+    cols = np.arange(width)
+    window = np.maximum(np.maximum(la, lb) // 2 - 1, 0)
+    a_match = np.zeros((n, width), dtype=bool)
+    b_match = np.zeros((n, width), dtype=bool)
+    rows = np.arange(n)
+    for i in range(width):
+        lo = (i - window)[:, None]
+        hi = np.minimum(i + window + 1, lb)[:, None]
+        candidates = (a[:, i:i + 1] == b) & ~b_match & (cols >= lo) & (cols < hi) & (i < la)[:, None]
+        found = candidates.any(axis=1)
+        j = candidates.argmax(axis=1)  # primera coincidencia libre dentro de la ventana
+        b_match[rows[found], j[found]] = True
+        a_match[found, i] = True
+    m = a_match.sum(axis=1)
+    # Transposiciones: caracteres coincidentes de cada lado, en orden
+    sa = np.take_along_axis(a, np.argsort(~a_match, axis=1, kind="stable"), axis=1)
+    sb = np.take_along_axis(b, np.argsort(~b_match, axis=1, kind="stable"), axis=1)
+    t = ((sa != sb) & (cols < m[:, None])).sum(axis=1) / 2
+    mf = m.astype(float)
+    safe = np.maximum(mf, 1)
+    jaro = np.where(m > 0, (mf / np.maximum(la, 1) + mf / np.maximum(lb, 1) + (mf - t) / safe) / 3, 0.0)
+    k = min(4, width)
+    same = (a[:, :k] == b[:, :k]) & (cols[:k] < np.minimum(la, lb)[:, None])
+    prefix = np.cumprod(same, axis=1).sum(axis=1)
+    return jaro + prefix * prefix_weight * (1 - jaro)
+
+
+def _token_similarity(codes: np.ndarray, lengths: np.ndarray, ia: np.ndarray, ib: np.ndarray,
+                      minimo: float = 0.0) -> np.ndarray:
+    """Similitud por par de tokens; la de tokens completos por debajo de `minimo` cuenta como 0."""
+    import numpy as np
+
+    la, lb = lengths[ia], lengths[ib]
+    sim = _jaro_winkler(codes[ia], la, codes[ib], lb)
+    sim = np.where(sim >= minimo, sim, 0.0)
+    initial = (la == 1) | (lb == 1)
+    return np.where(initial, np.where(codes[ia, 0] == codes[ib, 0], INITIAL_SCORE, 0.0), sim)
+
+
+def similarity_batch(extraidos: Sequence[str | None], registrados: Sequence[str | None]) -> np.ndarray:
+    """Puntaje 0-1 por par (NaN si alguno de los dos nombres queda vacío)."""
+    import numpy as np
+
+    if len(extraidos) != len(registrados):
+        raise ValueError("extraidos y registrados deben tener la misma longitud")
+    vocab: dict[str, int] = {}
+    parsed: dict[str | None, list[int]] = {}
+
+    def ids(name: str | None) -> list[int]:
+        if name not in parsed:
+            parsed[name] = [vocab.setdefault(t, len(vocab)) for t in dict.fromkeys(name_tokens(name))]
+        return parsed[name]
+
+    n = len(extraidos)
+    ta = np.full((n, MAX_TOKENS), -1, dtype=np.int64)
+    tb = np.full((n, MAX_TOKENS), -1, dtype=np.int64)
+    for row, (x, y) in enumerate(zip(extraidos, registrados)):
+        tx, ty = ids(x), ids(y)
+        ta[row, :len(tx)] = tx
+        tb[row, :len(ty)] = ty
+
+    tokens = list(vocab)
+    if not tokens:
+        return np.full(n, np.nan)
+    codes = np.array(tokens, dtype=f"<U{MAX_TOKEN_LEN}").view(np.uint32).reshape(len(tokens), MAX_TOKEN_LEN)
+    lengths = np.char.str_len(np.array(tokens))
+    weights = np.where(lengths == 1, 0.5, 1.0)  # una inicial aporta la mitad que un nombre completo
+    minimo = env_float("FRAUDE_NOMBRE_TOKEN_MIN", 0.85)
+
+    scores = np.full(n, np.nan)
+    computed: dict[int, float] = {}
+    v = len(tokens)
+    for start in range(0, n, _CHUNK):
+        xa, xb = ta[start:start + _CHUNK], tb[start:start + _CHUNK]
+        valid = (xa[:, :, None] >= 0) & (xb[:, None, :] >= 0)
+        keys = np.where(valid, xa[:, :, None] * v + xb[:, None, :], -1)
+        unique, inverse = np.unique(keys[valid], return_inverse=True)
+        todo = np.array([k for k in unique.tolist() if k not in computed], dtype=np.int64)
+        if todo.size:  # cada par de tokens se calcula una sola vez en toda la corrida
+            computed.update(zip(todo.tolist(), _token_similarity(codes, lengths, todo // v, todo % v, minimo).tolist()))
+        sim = np.zeros(valid.shape)
+        sim[valid] = np.array([computed[k] for k in unique.tolist()])[inverse]
+
+        wa = np.where(xa >= 0, weights[np.maximum(xa, 0)], 0.0)
+        wb = np.where(xb >= 0, weights[np.maximum(xb, 0)], 0.0)
+        sa, sb = wa.sum(axis=1), wb.sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            cov_a = (sim.max(axis=2) * wa).sum(axis=1) / sa
+            cov_b = (sim.max(axis=1) * wb).sum(axis=1) / sb
+        shorter_a = sa <= sb
+        score = 0.8 * np.where(shorter_a, cov_a, cov_b) + 0.2 * np.where(shorter_a, cov_b, cov_a)
+        # Apellidos del registrado ("nombres apellidos"): todos menos el primer token (dos
+        # primeros con cuatro o más); alguno debe tener pareja en el extraído
+        nb = (xb >= 0).sum(axis=1)
+        primero = np.where(nb >= 4, 2, np.where(nb >= 2, 1, 0))
+        apellidos = (xb >= 0) & (np.arange(MAX_TOKENS)[None, :] >= primero[:, None])
+        con_apellido = ((sim.max(axis=1) > 0) & apellidos).any(axis=1)
+        score = np.where(con_apellido, score, np.minimum(score, NO_SURNAME_CAP))
+        scores[start:start + _CHUNK] = np.where((sa > 0) & (sb > 0), score, np.nan)
+    return scores
+
+
+@dataclass(frozen=True)
+class NameMatch:
+    extraido: str
+    registrado: str
+    puntaje: float | None
+    nivel: str  # coincide | parcial | no_coincide | sin_datos
+
+    def as_dict(self) -> dict:
+        return {"extraido": self.extraido, "registrado": self.registrado, "puntaje": self.puntaje, "nivel": self.nivel}
+
+    def alerta(self, rol: str, registro: str) -> dict | None:
+        """Alerta estructurada para el dictamen (None si los nombres coinciden o no hay datos).
+        Los nombres de pacientes van anonimizados (Habeas Data)."""
+        if self.nivel not in ("parcial", "no_coincide"):
+            return None
+        extraido, registrado = (
+            (mask_name(self.extraido), mask_name(self.registrado)) if rol == "paciente"
+            else (self.extraido, self.registrado)
+        )
+        return {
+            "tipo": "nombre_discrepante" if self.nivel == "no_coincide" else "nombre_parcial",
+            "rol": rol,
+            "registro": registro,
+            "puntaje": self.puntaje,
+            "detalle": f"El nombre del {rol} en el certificado ('{extraido}') "
+                       f"{'no coincide' if self.nivel == 'no_coincide' else 'coincide solo en parte'} "
+                       f"con el registrado en {registro} ('{registrado}').",
+        }
+
+
+def level(puntaje: float | None) -> str:
+    if puntaje is None:
+        return "sin_datos"
+    if puntaje >= env_float("FRAUDE_NOMBRE_COINCIDE", 0.85):
+        return "coincide"
+    if puntaje >= env_float("FRAUDE_NOMBRE_DISCREPANTE", 0.70):
+        return "parcial"
+    return "no_coincide"
+
+
+def match_names(extraido: str | None, registrado: str | None) -> NameMatch:
+    score = float(similarity_batch([extraido], [registrado])[0])
+    puntaje = None if score != score else round(score, 3)  # NaN: algún nombre vacío
+    return NameMatch(str(extraido or ""), str(registrado or ""), puntaje, level(puntaje))
+
+
+def mask_name(name: str) -> str:
+    """"Juan Pérez" -> "J*** P***"."""
+    return " ".join(f"{word[0]}***" for word in str(name).split() if word)
+
+
+def registered_name(raw: str) -> str | None:
+    """Nombre que devolvió un registro en la salida (compacta o completa) de su herramienta."""
+    try:
+        data = json.loads(raw)
+    except (json.JSONDecodeError, TypeError):
+        return None
+    datos = (data.get("datos") or data.get("d") or {}) if isinstance(data, dict) else {}
+    if not isinstance(datos, dict):
+        return None
+    nombre = datos.get("nombre") or " ".join(str(datos.get(k) or "") for k in ("nombres", "apellidos")).strip()
+    return nombre if nombre and nombre != "Presente en tabla" else None
+
+
+def input_name(input_data: str) -> str | None:
+    """Nombre del certificado (opcional) en la entrada JSON de RETHUS/ADRES."""
+    try:
+        return str(json.loads(input_data).get("nombre") or "").strip() or None
+    except (json.JSONDecodeError, TypeError, AttributeError):
+        return None
+
+
+def annotate_registry(raw: str, nombre: str | None, rol: str, registro: str) -> str:
+    """Añade a la salida de RETHUS/ADRES la coincidencia entre el nombre del certificado y el
+    registrado (`coincidencia_nombre`, con su alerta) y el aviso `nombre_discrepante` si no coinciden."""
+    registrado = registered_name(raw)
+    if not nombre or not registrado:
+        return raw
+    match = match_names(nombre, registrado)
+    discrepante = match.nivel == "no_coincide"
+    alerta = match.alerta(rol, registro)
+    if rol == "paciente":
+        match = NameMatch(mask_name(match.extraido), mask_name(match.registrado), match.puntaje, match.nivel)
+    return extend_payload(
+        raw, {"coincidencia_nombre": dict(match.as_dict(), alerta=alerta)},
+        aviso="nombre_discrepante" if discrepante else None,
+        extraido=match.extraido, registrado=match.registrado,
+    )
+
+
+# ── Conciliación histórica en lote ───────────────────────────────────────────
+
+def _documento(value: Any) -> str:
+    return "".join(ch for ch in str(value or "") if ch.isdigit())
+
+
+def load_registry(path: Path) -> dict[str, str]:
+    """Padrón local CSV (`documento` y `nombre`, o `nombres` y `apellidos`) -> {documento: nombre}."""
+    registro: dict[str, str] = {}
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        for row in csv.DictReader(f):
+            row = {str(k).strip().lower(): v for k, v in row.items() if k}
+            nombre = row.get("nombre") or " ".join(str(row.get(k) or "") for k in ("nombres", "apellidos")).strip()
+            documento = _documento(row.get("documento") or row.get("numero_documento") or row.get("cedula"))
+            if documento and nombre:
+                registro[documento] = nombre
+    return registro
+
+
+def reconcile_history(medicos: dict[str, str] | None = None, pacientes: dict[str, str] | None = None,
+                      out: TextIO | None = None, batch_size: int = 200000) -> dict:
+    """Concilia los nombres de todos los análisis del historial con los padrones dados.
+
+    Escribe en `out` una línea JSON por nombre parcial o discrepante y devuelve el conteo por nivel.
+    """
+    from .storage.history import get_history_store
+
+    registros = {"médico": medicos or {}, "paciente": pacientes or {}}
+    niveles = {rol: {"coincide": 0, "parcial": 0, "no_coincide": 0, "sin_registro": 0} for rol in registros}
+    inicio = time.perf_counter()
+    pares = 0
+
+    def pairs() -> Iterator[tuple[str, str, str, str, str]]:
+        for analysis_id, doc_id, medico_doc, medico_nombre, paciente_doc, paciente_nombre in (
+            get_history_store().iter_names()
+        ):
+            for rol, documento, nombre in (("médico", medico_doc, medico_nombre), ("paciente", paciente_doc, paciente_nombre)):
+                if not documento or not nombre or not registros[rol]:
+                    continue
+                registrado = registros[rol].get(_documento(documento))
+                if registrado is None:
+                    niveles[rol]["sin_registro"] += 1
+                    continue
+                yield analysis_id, doc_id, rol, str(nombre), registrado
+
+    def flush(batch: list[tuple[str, str, str, str, str]]) -> None:
+        scores = similarity_batch([b[3] for b in batch], [b[4] for b in batch])
+        for (analysis_id, doc_id, rol, extraido, registrado), score in zip(batch, scores.tolist()):
+            puntaje = None if score != score else round(score, 3)
+            match = NameMatch(extraido, registrado, puntaje, level(puntaje))
+            if match.nivel == "sin_datos":
+                continue
+            niveles[rol][match.nivel] += 1
+            alerta = match.alerta(rol, "padrón")
+            if alerta and out is not None:
+                print(json.dumps(dict(alerta, analysis_id=analysis_id, doc_id=doc_id), ensure_ascii=False), file=out)
+
+    batch: list[tuple[str, str, str, str, str]] = []
+    for pair in pairs():
+        batch.append(pair)
+        if len(batch) >= batch_size:
+            pares += len(batch)
+            flush(batch)
+            batch = []
+    if batch:
+        pares += len(batch)
+        flush(batch)
+    duracion = time.perf_counter() - inicio
+    return {"pares": pares, "niveles": niveles, "duracion_s": round(duracion, 3),
+            "pares_por_s": round(pares / duracion, 1) if duracion > 0 else None}
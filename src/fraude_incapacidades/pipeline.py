@@ -0,0 +1,360 @@
+"""
+Análisis como DAG de etapas memoizadas, para re-análisis incremental.
+
+    extract ─┬─ forensic ──┐
+             ├─ cie10 ─────┤
+             ├─ eps ───────┼─ score
+             └─ registries ┘
+
+Cada etapa guarda su salida en la caché compartida (espacio `etapa_<nombre>`) bajo una
+clave que combina el hash de sus entradas (el SHA-256 del documento para `extract`, el de
+la salida de cada dependencia para las demás) y la versión de la etapa: hash de su
+código y de la configuración que usa (tabla CIE-10, lista de EPS, reglas de puntaje de
+tasks.yaml/agents.yaml…). Al cambiar, por ejemplo, las reglas de puntaje solo se
+invalida `score`; si una etapa se recalcula y produce la misma salida, las siguientes
+siguen acertando en caché.
+
+`extract` incluye los chequeos que dependen del resto del historial (duplicados
+perceptuales, periodos superpuestos): se memoizan tal como se calcularon la primera vez.
+
+Se usa con FRAUDE_ANALYSIS_MODE=dag, `fraude-incapacidades reanalyze` (documentos o todo
+el historial) y `POST /api/history/{id}/reanalyze`; el resultado indica qué etapas
+acertaron en caché (`tiempos.etapas`).
+"""
+
+from __future__ import annotations
+
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Iterator, TextIO
+
+from .profiling import span
+from .settings import ROOT_DIR
+from .storage.cache import cache_get, cache_key, cache_set, ttl_for
+from .storage.extractions import document_id, load_extraction
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = ROOT_DIR / "test" / "uploads"
+
+
+@dataclass
+class StageContext:
+    doc_id: str
+    file_path: Path | None  # None: solo se puede reutilizar lo memoizado o la extracción guardada
+
+
+@dataclass(frozen=True)
+class Stage:
+    name: str
+    deps: tuple[str, ...]
+    run: Callable[[StageContext, dict[str, Any]], dict]
+    version_of: Callable[[], list[Any]]  # código y configuración de los que depende la salida
+    ttl_s: float = 90 * 86400
+
+    @functools.cached_property
+    def version(self) -> str:
+        parts = [inspect.getsource(self.run)] + self.version_of()
+        return cache_key(self.name, *parts)[:16]
+
+
+def _source(*objects: Any) -> list[str]:
+    return [inspect.getsource(obj) for obj in objects]
+
+
+def _output_hash(value: Any) -> str:
+    return hashlib.sha256(json.dumps(value, ensure_ascii=False, sort_keys=True, default=str).encode()).hexdigest()
+
+
+# ── Etapas ───────────────────────────────────────────────────────────────────
+
+def _extract(ctx: StageContext, inputs: dict) -> dict:
+    from .tools.ocr_tool import PDFForensicExtractTool
+
+    if ctx.file_path is not None and ctx.file_path.exists():
+        resultado = PDFForensicExtractTool()._run(str(ctx.file_path))
+        extraccion = load_extraction(ctx.doc_id)
+        if extraccion is None:
+            raise RuntimeError(f"extracción fallida: {resultado[:300]}")
+    else:
+        extraccion = load_extraction(ctx.doc_id)  # re-análisis sin el archivo original
+        if extraccion is None:
+            raise FileNotFoundError(f"sin archivo ni extracción guardada para {ctx.doc_id[:16]}")
+    extraccion.pop("archivo", None)
+    extraccion.pop("texto_capa", None)
+    return extraccion
+
+
+def _extract_version() -> list[Any]:
+    from .forensics import image_prep, page_select, phash, templates
+    from .storage import intervals
+    from .tools import ocr_tool
+
+    return _source(ocr_tool, image_prep, page_select, phash, templates, intervals)
+
+
+def _forensic(ctx: StageContext, inputs: dict) -> dict:
+    from .cascade import signals
+
+    extraccion = inputs["extract"]
+    evidencia = {k: extraccion.get(k) for k in ("hallazgos_forenses", "plantilla_conocida")}
+    señales = signals(evidencia, "local")  # sin datos estructurados: solo las de los hallazgos
+    hallazgos = dict(extraccion.get("hallazgos_forenses") or {})
+    hallazgos.pop("exif_imagen", None)
+    return {"hallazgos": hallazgos, "senales": [{"senal": s.clave, "detalle": s.detalle} for s in señales]}
+
+
+def _cascade_version() -> list[Any]:
+    from . import cascade, diagnosis
+    from .storage import durations
+
+    fuentes = _source(cascade.signals, cascade._cie10_signals, cascade.eps_official, diagnosis, durations)
+    return fuentes + [cascade.WEIGHTS, diagnosis.index_version()]
+
+
+def _cie10(ctx: StageContext, inputs: dict) -> dict:
+    from .diagnosis import check_diagnosis
+    from .storage.durations import assess_days
+    from .tools.cie10_tool import CIE10_DATABASE
+
+    datos = inputs["extract"].get("datos_estructurados") or {}
+    codigo = str(datos.get("codigo_cie10") or "").upper().strip()
+    entry = CIE10_DATABASE.get(codigo) or CIE10_DATABASE.get(codigo.split(".")[0][:3]) if codigo else None
+    out: dict[str, Any] = {"codigo": codigo or None, "encontrado": entry is not None,
+                           "diagnostico_texto": datos.get("diagnostico_texto")}
+    if datos.get("diagnostico_texto"):
+        out["coherencia_diagnostico"] = check_diagnosis(datos.get("diagnostico_texto"), codigo).as_dict()
+    if entry is None:
+        return out
+    try:
+        dias = int(float(str(datos.get("dias_incapacidad") or 0)))
+    except ValueError:
+        dias = 0
+    out.update(descripcion=entry["desc"], rango_dias=[entry["dias_min"], entry["dias_max"]], dias=dias or None)
+    duracion = assess_days(codigo, dias, entry)
+    if duracion is not None:  # percentil en el historial al momento de calcular la etapa (queda memoizado)
+        out["coherente"] = duracion.nivel != "exceso"
+        if duracion.fuente == "historial":
+            out["distribucion_dias"] = duracion.as_dict()
+    return out
+
+
+def _cie10_version() -> list[Any]:
+    from . import diagnosis
+    from .storage import durations
+    from .tools.cie10_tool import CIE10_DATABASE
+
+    return [CIE10_DATABASE, diagnosis.index_version()] + _source(diagnosis, durations)
+
+
+def _eps(ctx: StageContext, inputs: dict) -> dict:
+    from .cascade import eps_official
+
+    datos = inputs["extract"].get("datos_estructurados") or {}
+    entidad = str(datos.get("eps_o_ips") or "")
+    oficial = eps_official(entidad) or eps_official(str(datos.get("logo_detectado") or ""))
+    return {"entidad": entidad or None, "eps_oficial": oficial, "encontrada": oficial is not None}
+
+
+def _eps_version() -> list[Any]:
+    from .cascade import eps_official
+    from .tools.eps_tool import EPS_COLOMBIA
+
+    return _source(eps_official) + [EPS_COLOMBIA]
+
+
+def _registries(ctx: StageContext, inputs: dict) -> dict:
+    from .cascade import registry_lookups
+
+    datos = inputs["extract"].get("datos_estructurados") or {}
+    campos = ("medico_cedula", "medico_nombre", "paciente_cedula", "paciente_nombre", "eps_o_ips")
+    return registry_lookups({k: datos.get(k) for k in campos})
+
+
+def _registries_version() -> list[Any]:
+    from . import names
+    from .cascade import registry_lookups
+    from .tools import adres_tool, rethus_tool, search_tool
+
+    return _source(registry_lookups, names, adres_tool, rethus_tool, search_tool)
+
+
+def _score(ctx: StageContext, inputs: dict) -> dict:
+    from .cascade import name_alerts
+    from .crew import build_report_crew
+    from .llm.payloads import minify
+    from .report import parse_crew_result
+
+    extraccion = inputs["extract"]
+    evidencia = minify({
+        "datos_estructurados": extraccion.get("datos_estructurados"),
+        "plantilla_conocida": extraccion.get("plantilla_conocida"),
+        "forense": inputs["forensic"],
+        "cie10": inputs["cie10"],
+        "eps": inputs["eps"],
+        "registros": inputs["registries"],
+    })
+    result = build_report_crew(evidencia).kickoff()
+    report, raw_text = parse_crew_result(result)
+    if report is not None:  # las alertas de nombres no dependen de que el agente las copie
+        report.alertas_estructuradas = name_alerts(inputs["registries"])
+    return {"reporte": report.model_dump() if report is not None else None, "raw": raw_text}
+
+
+def _score_version() -> list[Any]:
+    from . import crew
+
+    task = crew.tasks_cfg["generate_final_report_task"]
+    return [task, crew.agents_cfg[task["agent"]], inspect.getsource(crew.build_report_crew)]
+
+
+STAGES: dict[str, Stage] = {
+    stage.name: stage
+    for stage in (
+        Stage("extract", (), _extract, _extract_version, ttl_s=30 * 86400),
+        Stage("forensic", ("extract",), _forensic, _cascade_version),
+        Stage("cie10", ("extract",), _cie10, _cie10_version),
+        Stage("eps", ("extract",), _eps, _eps_version),
+        Stage("registries", ("extract",), _registries, _registries_version, ttl_s=86400),
+        Stage("score", ("extract", "forensic", "cie10", "eps", "registries"), _score, _score_version),
+    )
+}
+
+
+def _topological(stages: dict[str, Stage]) -> list[Stage]:
+    ordered: list[Stage] = []
+    seen: set[str] = set()
+
+    def visit(name: str, path: tuple[str, ...] = ()) -> None:
+        if name in path:
+            raise ValueError(f"ciclo en el DAG de etapas: {' -> '.join(path + (name,))}")
+        if name in seen:
+            return
+        for dep in stages[name].deps:
+            visit(dep, path + (name,))
+        seen.add(name)
+        ordered.append(stages[name])
+
+    for name in stages:
+        visit(name)
+    return ordered
+
+
+# ── Ejecución ────────────────────────────────────────────────────────────────
+
+@dataclass
+class PipelineResult:
+    """Resultado con la interfaz que usan `parse_crew_result` y `record_analysis`."""
+
+    raw: str
+    etapas: dict[str, dict] = field(default_factory=dict)
+    tasks_output: list[str] = field(default_factory=list)
+
+    def resumen(self) -> dict:
+        return self.etapas
+
+
+def run_pipeline(doc_id: str, file_path: Path | str | None = None, force: tuple[str, ...] = ()) -> PipelineResult:
+    """Ejecuta el DAG para un documento; `force` recalcula esas etapas aunque estén en caché."""
+    ctx = StageContext(doc_id=doc_id, file_path=Path(file_path) if file_path else None)
+    outputs: dict[str, Any] = {}
+    hashes: dict[str, str] = {}
+    etapas: dict[str, dict] = {}
+    for stage in _topological(STAGES):
+        namespace = f"etapa_{stage.name}"
+        key = cache_key(stage.version, doc_id if not stage.deps else {d: hashes[d] for d in stage.deps})
+        ttl = ttl_for(namespace, stage.ttl_s)
+        inicio = time.perf_counter()
+        with span("etapa", stage.name) as extra:
+            output = cache_get(namespace, key) if ttl > 0 and stage.name not in force else None
+            hit = output is not None
+            if not hit:
+                output = stage.run(ctx, {d: outputs[d] for d in stage.deps})
+                if ttl > 0:
+                    cache_set(namespace, key, output, ttl)
+            if extra is not None:
+                extra["cache"] = "hit" if hit else "miss"
+        outputs[stage.name] = output
+        hashes[stage.name] = _output_hash(output)
+        etapas[stage.name] = {"cache": "hit" if hit else "miss", "version": stage.version,
+                              "duracion_s": round(time.perf_counter() - inicio, 3)}
+    score = outputs["score"]
+    raw = json.dumps(score["reporte"], ensure_ascii=False) if score.get("reporte") else score.get("raw", "")
+    logger.info("pipeline completado", extra={"doc_id": doc_id,
+                                              "etapas": {k: v["cache"] for k, v in etapas.items()}})
+    return PipelineResult(raw=raw, etapas=etapas,
+                          tasks_output=[json.dumps(outputs[s], ensure_ascii=False) for s in STAGES])
+
+
+def locate_upload(doc_id: str, archivo: str | None = None, uploads: Path = UPLOAD_DIR) -> Path | None:
+    """Archivo subido de un documento (`<uploads>/<hash[:16]>/<nombre>`), si sigue en disco."""
+    folder = uploads / doc_id[:16]
+    if archivo and (folder / archivo).exists():
+        return folder / archivo
+    return next((p for p in sorted(folder.glob("*")) if p.is_file() and not p.name.startswith(".")), None)
+
+
+def reanalyze_document(doc_id: str, file_path: Path | None, nombre: str) -> dict:
+    """Re-analiza un documento por el DAG y guarda el resultado como un análisis nuevo."""
+    from .llm.usage import token_ledger
+    from .report import parse_crew_result, record_analysis
+
+    inicio = time.perf_counter()
+    tiempos: dict = {}
+    with token_ledger() as ledger:
+        try:
+            result = run_pipeline(doc_id, file_path)
+        except Exception as e:
+            tiempos.update(total_s=round(time.perf_counter() - inicio, 3), tokens=ledger.resumen())
+            analysis_id = record_analysis(Path(nombre), doc_id, "error", None, "", None, tiempos, str(e))
+            return {"doc_id": doc_id, "archivo": nombre, "status": "error", "analysis_id": analysis_id,
+                    "error": str(e)}
+        tiempos.update(total_s=round(time.perf_counter() - inicio, 3), tokens=ledger.resumen(),
+                       etapas=result.etapas)
+    report, raw_text = parse_crew_result(result)
+    analysis_id = record_analysis(Path(nombre), doc_id, "success", report, raw_text, result, tiempos, None)
+    return {"doc_id": doc_id, "archivo": nombre, "status": "success", "analysis_id": analysis_id,
+            "reporte": report.model_dump() if report else None, "raw_report": raw_text,
+            "etapas": {k: v["cache"] for k, v in result.etapas.items()}}
+
+
+def reanalyze(paths: list[Path] | None = None, history: bool = False, limit: int | None = None,
+              uploads: Path = UPLOAD_DIR, out: TextIO | None = None) -> dict:
+    """Re-analiza documentos (rutas y/o todos los del historial) recalculando solo las etapas
+    invalidadas; imprime una línea JSON por documento en `out` y devuelve los aciertos por etapa."""
+
+    def targets() -> Iterator[tuple[str, Path | None, str]]:
+        for path in paths or []:
+            yield document_id(path), path, path.name
+        if history:
+            from .storage.history import get_history_store
+
+            for doc_id, archivo in get_history_store().documents():
+                yield doc_id, locate_upload(doc_id, archivo, uploads), archivo or doc_id[:16]
+
+    aciertos: dict[str, dict[str, int]] = {name: {"hit": 0, "miss": 0} for name in STAGES}
+    documentos = errores = 0
+    seen: set[str] = set()
+    for doc_id, path, nombre in targets():
+        if doc_id in seen:
+            continue
+        if limit is not None and documentos >= limit:
+            break
+        seen.add(doc_id)
+        documentos += 1
+        fila = reanalyze_document(doc_id, path, nombre)
+        if fila["status"] == "error":
+            errores += 1
+        for name, cache in (fila.get("etapas") or {}).items():
+            aciertos[name][cache] += 1
+        if out is not None:
+            resumen = {k: fila.get(k) for k in ("doc_id", "archivo", "status", "analysis_id", "etapas", "error")}
+            resumen["veredicto"] = (fila.get("reporte") or {}).get("veredicto")
+            print(json.dumps(resumen, ensure_ascii=False), file=out, flush=True)
+    return {"documentos": documentos, "errores": errores, "etapas": aciertos}
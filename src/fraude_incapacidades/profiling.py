@@ -0,0 +1,255 @@
+"""
+Perfilado bajo demanda de un análisis.
+
+Se activa por petición (cabecera `X-Profile: 1` en la API, `--profile` en `audit`) y
+solo para ese análisis: `profile_run()` arranca un muestreador de pilas (un hilo que cada
+FRAUDE_PERFIL_INTERVALO_MS, 5 por defecto, lee `sys._current_frames()` de los hilos del
+análisis) y abre una línea de tiempo donde se registran los intervalos (`span`) de cada
+`_run` de herramienta (`traced`), cada llamada a OpenAI (transportes e interceptor del
+planificador) y cada etapa del DAG.
+
+Sin perfil activo, los puntos de instrumentación solo leen una ContextVar: no hay hilo
+de muestreo, ni reloj, ni memoria asignada. FRAUDE_PERFILADO=0 ignora las solicitudes.
+
+El perfil se guarda junto al análisis en DATA_DIR/perfiles/<analysis_id>.json y se
+exporta como pilas colapsadas (flamegraph.pl, speedscope) o eventos de traza (Perfetto,
+chrome://tracing); en `tiempos["perfil"]` del historial queda el resumen.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+from .settings import data_path, env_bool, env_float
+
+MAX_DEPTH = 128  # marcos por muestra (los más externos se descartan)
+
+_profile: contextvars.ContextVar[Profile | None] = contextvars.ContextVar("fraude_profile", default=None)
+
+
+def profiling_allowed() -> bool:
+    return env_bool("FRAUDE_PERFILADO", True)
+
+
+def wants_profile(value: str | None) -> bool:
+    """Interpreta la cabecera de la solicitud ("1", "true", "si"...)."""
+    return bool(value) and str(value).strip().lower() in {"1", "true", "yes", "si", "sí", "on"}
+
+
+def _label(code) -> str:
+    parts = Path(code.co_filename).parts
+    return f"{code.co_name} ({'/'.join(parts[-2:])}:{code.co_firstlineno})"
+
+
+class Profile:
+    """Muestras de pila y línea de tiempo de un análisis (seguro entre hilos)."""
+
+    def __init__(self, intervalo_s: float) -> None:
+        self.intervalo_s = intervalo_s
+        self.creado_en = datetime.now().isoformat(timespec="seconds")
+        self.inicio = time.perf_counter()
+        self.fin: float | None = None
+        self.spans: list[dict] = []
+        self.pilas: Counter[str] = Counter()
+        self.muestras = 0
+        self._lock = threading.Lock()
+        self._hilos: set[int] = set()
+        self._labels: dict[Any, str] = {}
+        self._stop = threading.Event()
+        self._sampler: threading.Thread | None = None
+
+    # ── Línea de tiempo ──
+
+    def watch_current_thread(self) -> None:
+        ident = threading.get_ident()
+        if ident not in self._hilos:
+            with self._lock:
+                self._hilos.add(ident)
+
+    def add_span(self, tipo: str, nombre: str, inicio: float, fin: float, **attrs: Any) -> None:
+        span = {
+            "tipo": tipo, "nombre": nombre, "inicio_ms": round((inicio - self.inicio) * 1000, 2),
+            "duracion_ms": round((fin - inicio) * 1000, 2), "hilo": threading.get_ident(),
+            **{k: v for k, v in attrs.items() if v is not None},
+        }
+        with self._lock:
+            self.spans.append(span)
+
+    # ── Muestreo ──
+
+    def _stack(self, frame) -> str:
+        labels = []
+        while frame is not None and len(labels) < MAX_DEPTH:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                label = self._labels[code] = _label(code)
+            labels.append(label)
+            frame = frame.f_back
+        return ";".join(reversed(labels))
+
+    def _sample_loop(self) -> None:
+        while not self._stop.wait(self.intervalo_s):
+            frames = sys._current_frames()
+            with self._lock:
+                hilos = list(self._hilos)
+            pilas = [self._stack(frames[ident]) for ident in hilos if ident in frames]
+            del frames
+            with self._lock:
+                self.pilas.update(pilas)
+                self.muestras += len(pilas)
+
+    def start(self) -> None:
+        self.inicio = time.perf_counter()
+        self._hilos.add(threading.get_ident())
+        self._sampler = threading.Thread(target=self._sample_loop, name="fraude-profiler", daemon=True)
+        self._sampler.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        self.fin = time.perf_counter()
+
+    # ── Exportación ──
+
+    def resumen(self) -> dict:
+        """Totales por tipo y nombre de intervalo (para `tiempos["perfil"]`)."""
+        totales: dict[str, dict[str, dict]] = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            entry = totales.setdefault(span["tipo"], {}).setdefault(span["nombre"], {"n": 0, "total_ms": 0.0})
+            entry["n"] += 1
+            entry["total_ms"] = round(entry["total_ms"] + span["duracion_ms"], 2)
+        return {
+            "duracion_s": round(((self.fin or time.perf_counter()) - self.inicio), 3),
+            "muestras": self.muestras, "intervalo_ms": round(self.intervalo_s * 1000, 2),
+            "spans": len(spans), "totales": totales,
+        }
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s["inicio_ms"])
+            pilas = dict(self.pilas.most_common())
+        return {"creado_en": self.creado_en, **self.resumen(), "linea_de_tiempo": spans, "pilas": pilas}
+
+
+def new_profile(enabled: bool) -> Profile | None:
+    """Perfil vacío si se solicitó (y FRAUDE_PERFILADO lo permite); si no, None."""
+    if not enabled or not profiling_allowed():
+        return None
+    return Profile(max(0.001, env_float("FRAUDE_PERFIL_INTERVALO_MS", 5.0) / 1000))
+
+
+@contextlib.contextmanager
+def profile_run(profile: Profile | None) -> Iterator[Profile | None]:
+    """Activa `profile` (si no es None) para lo que se ejecute dentro del bloque, en el
+    hilo actual y en los hilos que abran intervalos con este contexto."""
+    if profile is None:
+        yield None
+        return
+    token = _profile.set(profile)
+    profile.start()
+    try:
+        yield profile
+    finally:
+        profile.stop()
+        _profile.reset(token)
+
+
+def current_profile() -> Profile | None:
+    return _profile.get()
+
+
+@contextlib.contextmanager
+def span(tipo: str, nombre: str, **attrs: Any) -> Iterator[dict | None]:
+    """Registra la duración del bloque en el perfil activo; el dict cedido admite campos."""
+    profile = _profile.get()
+    if profile is None:
+        yield None
+        return
+    profile.watch_current_thread()
+    extra = dict(attrs)
+    inicio = time.perf_counter()
+    try:
+        yield extra
+    except BaseException as e:
+        extra["error"] = type(e).__name__
+        raise
+    finally:
+        profile.add_span(tipo, nombre, inicio, time.perf_counter(), **extra)
+
+
+def record_span(tipo: str, nombre: str, inicio: float, **attrs: Any) -> None:
+    """Intervalo desde `inicio` (perf_counter) hasta ahora, para código que ya mide sus etapas."""
+    profile = _profile.get()
+    if profile is not None:
+        profile.add_span(tipo, nombre, inicio, time.perf_counter(), **attrs)
+
+
+def traced(fn: Callable) -> Callable:
+    """Decorador para `_run` de herramientas: un intervalo "herramienta" con su nombre."""
+
+    @functools.wraps(fn)
+    def wrapper(self, *args: Any, **kwargs: Any) -> Any:
+        if _profile.get() is None:
+            return fn(self, *args, **kwargs)
+        with span("herramienta", getattr(self, "name", type(self).__name__)):
+            return fn(self, *args, **kwargs)
+
+    return wrapper
+
+
+# ── Almacenamiento y formatos ──
+
+def _path_for(analysis_id: str) -> Path:
+    return data_path("perfiles", f"{analysis_id}.json")
+
+
+def save_profile(analysis_id: str | None, profile: Profile | None) -> None:
+    if not analysis_id or profile is None:
+        return
+    path = _path_for(analysis_id)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(profile.to_dict(), f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def load_profile(analysis_id: str) -> dict | None:
+    path = _path_for(Path(analysis_id).name)
+    if not path.exists():
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def collapsed(perfil: dict) -> str:
+    """Pilas colapsadas ("a;b;c N" por línea), entrada de flamegraph.pl y speedscope."""
+    return "".join(f"{pila} {n}\n" for pila, n in perfil.get("pilas", {}).items())
+
+
+def trace_events(perfil: dict) -> dict:
+    """Línea de tiempo en formato Trace Event (Perfetto / chrome://tracing)."""
+    campos = {"tipo", "nombre", "inicio_ms", "duracion_ms", "hilo"}
+    return {
+        "displayTimeUnit": "ms",
+        "traceEvents": [
+            {"name": s["nombre"], "cat": s["tipo"], "ph": "X", "pid": 1, "tid": s["hilo"],
+             "ts": round(s["inicio_ms"] * 1000), "dur": round(s["duracion_ms"] * 1000),
+             "args": {k: v for k, v in s.items() if k not in campos}}
+            for s in perfil.get("linea_de_tiempo", [])
+        ],
+    }
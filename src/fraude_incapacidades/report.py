@@ -0,0 +1,99 @@
+"""
+Dictamen estructurado del crew, compartido por la API y las auditorías en lote.
+
+`parse_crew_result` extrae el JSON final del agente de reporte y `record_analysis`
+lo guarda en el historial junto con la extracción y las salidas de cada tarea (y
+alimenta la distribución de días por código CIE-10, storage/durations.py).
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import re
+from pathlib import Path
+
+from pydantic import BaseModel
+
+from .storage.durations import learn
+from .storage.extractions import load_extraction
+from .storage.history import get_history_store
+
+logger = logging.getLogger(__name__)
+
+
+class StructuredReport(BaseModel):
+    puntaje_veracidad: int = 0
+    hallazgos_medicos: str = ""
+    analisis_forense: str = ""
+    verificacion_entidades: str = ""
+    alertas: list[str] = []
+    # Alertas con estructura fija (p. ej. nombre del certificado vs registrado: tipo, rol, registro, puntaje, detalle)
+    alertas_estructuradas: list[dict] = []
+    veredicto: str = "Indeterminado"
+    # Verificaciones que no terminaron antes del plazo del análisis (informe parcial)
+    no_verificados: list[str] = []
+
+
+def parse_crew_result(result) -> tuple[StructuredReport | None, str]:
+    """Parsea el resultado del crew intentando extraer JSON estructurado."""
+    raw_text = ""
+    if isinstance(result, str):
+        raw_text = result
+    elif hasattr(result, "raw"):
+        raw_text = str(result.raw)
+    elif hasattr(result, "output"):
+        raw_text = str(result.output)
+    else:
+        raw_text = str(result)
+
+    # Try to extract JSON from the text (it may be wrapped in markdown code blocks)
+    json_match = re.search(r'\{[\s\S]*\}', raw_text)
+    if json_match:
+        try:
+            data = json.loads(json_match.group())
+            report = StructuredReport(
+                puntaje_veracidad=int(data.get("puntaje_veracidad", 0)),
+                hallazgos_medicos=str(data.get("hallazgos_medicos", "")),
+                analisis_forense=str(data.get("analisis_forense", "")),
+                verificacion_entidades=str(data.get("verificacion_entidades", "")),
+                alertas=data.get("alertas", []),
+                alertas_estructuradas=[a for a in data.get("alertas_estructuradas") or [] if isinstance(a, dict)],
+                veredicto=str(data.get("veredicto", "Indeterminado")),
+                no_verificados=[str(v) for v in data.get("no_verificados") or []],
+            )
+            return report, raw_text
+        except (json.JSONDecodeError, ValueError, TypeError):
+            pass
+
+    # Fallback: return as raw text
+    return None, raw_text
+
+
+def record_analysis(file_path: Path, doc_id: str | None, status: str, report: StructuredReport | None,
+                    raw_text: str, result, tiempos: dict, error: str | None) -> str | None:
+    """Guarda el análisis en el historial (y aprende la duración del certificado);
+    un fallo aquí nunca afecta el resultado."""
+    try:
+        salidas = [str(getattr(t, "raw", t)) for t in (getattr(result, "tasks_output", None) or [])]
+        extraccion = load_extraction(doc_id) if doc_id else None
+        analysis_id = get_history_store().record(
+            archivo=file_path.name,
+            doc_id=doc_id,
+            status=status,
+            reporte=report.model_dump() if report is not None else None,
+            extraccion=extraccion,
+            salidas_tareas=salidas or None,
+            tiempos=tiempos,
+            error=error,
+            raw_report=raw_text,
+        )
+    except Exception as e:
+        logger.warning("No se pudo guardar el análisis de %s en el historial: %s", file_path.name, e)
+        return None
+    if status == "success" and report is not None and extraccion:
+        try:
+            learn(doc_id, extraccion.get("datos_estructurados") or {}, report.veredicto)
+        except Exception as e:
+            logger.warning("No se pudo registrar la duración de %s: %s", file_path.name, e)
+    return analysis_id
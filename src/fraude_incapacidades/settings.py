@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+import contextlib
+import os
+from pathlib import Path
+from typing import Iterator
+
+# Raíz del repositorio (…/fraude_incapacidades) y directorio de datos persistentes.
+ROOT_DIR = Path(__file__).resolve().parents[2]
+DATA_DIR = Path(os.environ.get("FRAUDE_DATA_DIR", str(ROOT_DIR / "data")))
+
+
+def env_str(name: str, default: str = "") -> str:
+    return os.environ.get(name, default).strip()
+
+
+def env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def env_bool(name: str, default: bool = False) -> bool:
+    val = os.environ.get(name)
+    if val is None:
+        return default
+    return val.strip().lower() in ("1", "true", "yes", "si", "sí", "on")
+
+
+@contextlib.contextmanager
+def env_override(**values: str) -> Iterator[None]:
+    """Fija variables de entorno dentro del bloque y restaura las anteriores al salir."""
+    previas = {name: os.environ.get(name) for name in values}
+    os.environ.update(values)
+    try:
+        yield
+    finally:
+        for name, valor in previas.items():
+            if valor is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = valor
+
+
+def data_path(*parts: str) -> Path:
+    """Ruta dentro de DATA_DIR, creando el directorio padre si no existe."""
+    path = DATA_DIR.joinpath(*parts)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def worker_count() -> int:
+    """Procesos worker del despliegue (FRAUDE_WORKERS o WEB_CONCURRENCY de gunicorn)."""
+    return max(1, env_int("FRAUDE_WORKERS", env_int("WEB_CONCURRENCY", 1)))
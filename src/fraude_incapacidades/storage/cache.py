@@ -0,0 +1,233 @@
+"""
+Caché compartida entre procesos para verificaciones externas, visión y resultados.
+
+Con varios workers (uvicorn/gunicorn) una caché en memoria se duplica por proceso y
+no se reutiliza entre ellos. Aquí el backend es, por defecto, SQLite en modo WAL
+(`data/cache.sqlite`, lecturas concurrentes y un escritor a la vez) o Redis si
+FRAUDE_CACHE_URL apunta a `redis://…` (requiere `pip install redis`).
+
+Los valores se guardan como JSON con TTL por espacio de nombres; el TTL se puede
+cambiar con FRAUDE_CACHE_TTL_<ESPACIO> (segundos, 0 desactiva ese espacio). Un fallo
+de la caché nunca interrumpe el análisis: se registra y se sigue sin caché.
+"""
+
+from __future__ import annotations
+
+import functools
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any, Callable
+
+from ..settings import data_path, env_float, env_str
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(*parts: Any) -> str:
+    """Clave estable (SHA-256) a partir de partes serializables."""
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def ttl_for(namespace: str, default_s: float) -> float:
+    return env_float(f"FRAUDE_CACHE_TTL_{namespace.upper()}", default_s)
+
+
+class SQLiteCache:
+    """Tabla clave/valor con expiración en SQLite (WAL); una conexión por hilo."""
+
+    def __init__(self, path: Path | str):
+        self.path = str(path)
+        self._local = threading.local()
+        self.hits: Counter = Counter()
+        self.misses: Counter = Counter()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL, PRIMARY KEY (namespace, key))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_cache_expires ON cache (expires_at)")
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, namespace: str, key: str) -> Any | None:
+        row = self._conn().execute(
+            "SELECT value FROM cache WHERE namespace = ? AND key = ? AND expires_at > ?",
+            (namespace, key, time.time()),
+        ).fetchone()
+        if row is None:
+            self.misses[namespace] += 1
+            return None
+        self.hits[namespace] += 1
+        return json.loads(row[0])
+
+    def set(self, namespace: str, key: str, value: Any, ttl_s: float) -> None:
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+            (namespace, key, json.dumps(value, ensure_ascii=False), time.time() + ttl_s),
+        )
+        conn.commit()
+
+    def delete(self, namespace: str, key: str) -> None:
+        conn = self._conn()
+        conn.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key))
+        conn.commit()
+
+    def purge_expired(self) -> int:
+        conn = self._conn()
+        deleted = conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),)).rowcount
+        conn.commit()
+        return deleted
+
+    def stats(self) -> dict:
+        rows = self._conn().execute(
+            "SELECT namespace, COUNT(*) FROM cache WHERE expires_at > ? GROUP BY namespace", (time.time(),)
+        ).fetchall()
+        return {
+            "backend": "sqlite",
+            "entradas": dict(rows),
+            "aciertos_proceso": dict(self.hits),
+            "fallos_proceso": dict(self.misses),
+        }
+
+
+class RedisCache:
+    """Mismo contrato sobre Redis (SETEX); útil si los workers están en varias máquinas."""
+
+    def __init__(self, url: str, prefix: str = "fraude"):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.hits: Counter = Counter()
+        self.misses: Counter = Counter()
+
+    def _k(self, namespace: str, key: str) -> str:
+        return f"{self.prefix}:{namespace}:{key}"
+
+    def get(self, namespace: str, key: str) -> Any | None:
+        raw = self.client.get(self._k(namespace, key))
+        if raw is None:
+            self.misses[namespace] += 1
+            return None
+        self.hits[namespace] += 1
+        return json.loads(raw)
+
+    def set(self, namespace: str, key: str, value: Any, ttl_s: float) -> None:
+        self.client.setex(self._k(namespace, key), max(1, int(ttl_s)), json.dumps(value, ensure_ascii=False))
+
+    def delete(self, namespace: str, key: str) -> None:
+        self.client.delete(self._k(namespace, key))
+
+    def purge_expired(self) -> int:
+        return 0  # Redis expira las claves por sí mismo
+
+    def stats(self) -> dict:
+        return {"backend": "redis", "aciertos_proceso": dict(self.hits), "fallos_proceso": dict(self.misses)}
+
+
+_cache: SQLiteCache | RedisCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> SQLiteCache | RedisCache:
+    """Caché del proceso según FRAUDE_CACHE_URL (`sqlite:///ruta` o `redis://…`)."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            url = env_str("FRAUDE_CACHE_URL")
+            if url.startswith("redis://") or url.startswith("rediss://"):
+                _cache = RedisCache(url)
+            elif url.startswith("sqlite:///"):
+                _cache = SQLiteCache(url[len("sqlite:///"):])
+            else:
+                _cache = SQLiteCache(data_path("cache.sqlite"))
+        return _cache
+
+
+def cache_get(namespace: str, key: str) -> Any | None:
+    try:
+        return get_cache().get(namespace, key)
+    except Exception as e:
+        logger.warning("Caché no disponible (%s): %s", namespace, e)
+        return None
+
+
+def cache_set(namespace: str, key: str, value: Any, ttl_s: float) -> None:
+    if ttl_s <= 0:
+        return
+    try:
+        get_cache().set(namespace, key, value, ttl_s)
+    except Exception as e:
+        logger.warning("No se pudo escribir en la caché (%s): %s", namespace, e)
+
+
+def cached_run(
+    namespace: str,
+    default_ttl_s: float,
+    key: Callable[..., str | None],
+    cacheable: Callable[[Any], bool],
+    variant: Callable[[], str] | None = None,
+) -> Callable:
+    """Decorador para `_run` de herramientas: reutiliza resultados entre procesos.
+
+    `key` recibe los argumentos de `_run` y devuelve la clave (None = no cachear);
+    `cacheable` decide si un resultado merece guardarse (p. ej. no los errores) y
+    `variant`, si se da, separa las entradas por formato de salida (p. ej. el modo de payload).
+    """
+
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(self, *args: Any, **kwargs: Any) -> Any:
+            ttl = ttl_for(namespace, default_ttl_s)
+            k = key(*args, **kwargs) if ttl > 0 else None
+            if k and variant is not None:
+                k = f"{variant()}:{k}"
+            if k:
+                hit = cache_get(namespace, k)
+                if hit is not None:
+                    return hit
+            result = fn(self, *args, **kwargs)
+            if k and cacheable(result):
+                cache_set(namespace, k, result, ttl)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def registry_key(input_data: str) -> str | None:
+    """Clave de caché de las consultas a registros (RETHUS, ADRES): tipo y número de
+    documento normalizados."""
+    try:
+        data = json.loads(input_data)
+    except (json.JSONDecodeError, TypeError):
+        return None
+    numero = "".join(ch for ch in str(data.get("numero_documento", "")) if ch.isalnum())
+    return f"{str(data.get('tipo_documento', 'CC')).upper().strip()}:{numero}" if numero else None
+
+
+def conclusive(result: str) -> bool:
+    """Solo se cachean respuestas concluyentes de un registro (no timeouts, CAPTCHA ni errores)."""
+    try:
+        data = json.loads(result)
+        return data.get("verificado", data.get("ver")) in (True, False)
+    except (json.JSONDecodeError, AttributeError):
+        return False
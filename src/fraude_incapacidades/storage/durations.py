@@ -0,0 +1,348 @@
+"""
+Distribución de los días de incapacidad por código CIE-10, aprendida del historial.
+
+Los rangos `dias_min`/`dias_max` de la base CIE-10 son estimaciones fijas y todo lo que
+queda fuera era riesgo "ALTO". Cada certificado analizado con éxito (uno por documento)
+alimenta un sketch de cuantiles de su código y de su categoría de 3 caracteres, y la
+validación informa el percentil de los días otorgados frente a ese historial. Solo se
+excluyen los que fallaron por la duración: días en "exceso" y veredicto distinto de
+"Válida" (`learnable`). Aprender solo de los válidos se reforzaría a sí mismo: lo que la
+distribución marca como exceso empuja el veredicto y ya no se aprendería nunca.
+
+El sketch usa buckets logarítmicos fijos al estilo DDSketch: error relativo ≤ ALPHA (2 %,
+exacto hasta ~25 días porque cada bucket contiene un solo entero) y de 1 a MAX_DIAS días,
+lo que da memoria constante por código (BUCKETS contadores), `add` O(1) y `merge` como
+suma de contadores. Los sketches se guardan en SQLite y cada worker fusiona en ellos,
+dentro de una transacción, lo que aprende; las lecturas usan una copia en memoria que se
+sincroniza de forma incremental cada FRAUDE_DURACION_REFRESCO_S (60 s). La sincronización
+sigue una versión creciente (rowid del registro `versiones`, asignado dentro de la
+transacción de escritura), no la hora: una escritura que confirma tarde no se pierde.
+`rebuild_from_history` (`fraude-incapacidades cie10-durations`) los reconstruye con NumPy
+desde el historial.
+
+Un código necesita FRAUDE_DURACION_MIN_MUESTRAS certificados (30) o se usa su categoría;
+sin historial suficiente se vuelve al rango fijo de la tabla.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import math
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterator
+
+from ..settings import data_path, env_float, env_int
+
+ALPHA = 0.02  # error relativo de los cuantiles
+GAMMA = (1 + ALPHA) / (1 - ALPHA)
+_LOG_GAMMA = math.log(GAMMA)
+MAX_DIAS = 730  # los días mayores cuentan en el último bucket
+BUCKETS = math.ceil(math.log(MAX_DIAS) / _LOG_GAMMA) + 1
+
+
+def bucket(dias: float) -> int:
+    return min(BUCKETS - 1, max(0, math.ceil(math.log(max(dias, 1.0)) / _LOG_GAMMA - 1e-9)))
+
+
+def bucket_value(indice: int) -> float:
+    """Valor representativo del bucket (error relativo ≤ ALPHA para todo valor dentro)."""
+    return 2 * GAMMA ** indice / (GAMMA + 1)
+
+
+class DurationSketch:
+    """Sketch de cuantiles de días: BUCKETS contadores, `add` O(1) y `merge` por suma."""
+
+    __slots__ = ("conteos",)
+
+    def __init__(self, conteos: array | None = None) -> None:
+        self.conteos = conteos if conteos is not None else array("Q", bytes(8 * BUCKETS))
+
+    def add(self, dias: float, n: int = 1) -> DurationSketch:
+        self.conteos[bucket(dias)] += n
+        return self
+
+    def merge(self, other: DurationSketch) -> DurationSketch:
+        for i, c in enumerate(other.conteos):
+            if c:
+                self.conteos[i] += c
+        return self
+
+    @property
+    def count(self) -> int:
+        return sum(self.conteos)
+
+    def quantile(self, q: float) -> float | None:
+        total = self.count
+        if total == 0:
+            return None
+        objetivo, acumulado = q * (total - 1), 0
+        for i, c in enumerate(self.conteos):
+            acumulado += c
+            if acumulado > objetivo:
+                return bucket_value(i)
+        return bucket_value(BUCKETS - 1)
+
+    def percentile(self, dias: float) -> float | None:
+        """Percentil 0-100 de `dias` (rango medio: los empates cuentan la mitad)."""
+        total = self.count
+        if total == 0:
+            return None
+        b = bucket(dias)
+        return 100.0 * (sum(self.conteos[:b]) + self.conteos[b] / 2) / total
+
+    def to_bytes(self) -> bytes:
+        return self.conteos.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> DurationSketch:
+        conteos = array("Q")
+        conteos.frombytes(data)
+        return cls(conteos) if len(conteos) == BUCKETS else cls()  # otro formato: se descarta
+
+
+def duration_keys(codigo: str | None) -> list[str]:
+    """Claves donde cuenta un certificado: el código (sin punto) y su categoría de 3 caracteres."""
+    clave = re.sub(r"[^A-Z0-9]", "", str(codigo or "").upper())
+    if len(clave) < 3:
+        return []
+    return [clave] if len(clave) == 3 else [clave, clave[:3]]
+
+
+class DurationStore:
+    def __init__(self, path: Path | str):
+        self.path = str(path)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._cache: dict[str, DurationSketch] = {}
+        self._visto_hasta = -1  # versión más reciente ya copiada a memoria
+        self._sincronizado = -math.inf
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS sketches (clave TEXT PRIMARY KEY, conteos BLOB NOT NULL,"
+                     " actualizado REAL NOT NULL, version INTEGER NOT NULL DEFAULT 0)")
+        if "version" not in {row[1] for row in conn.execute("PRAGMA table_info(sketches)")}:
+            conn.execute("ALTER TABLE sketches ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_sketches_version ON sketches (version)")
+        conn.execute("CREATE TABLE IF NOT EXISTS versiones (id INTEGER PRIMARY KEY AUTOINCREMENT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS vistos (doc_id TEXT PRIMARY KEY)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")  # fusiones de varios workers serializadas
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _next_version(conn: sqlite3.Connection) -> int:
+        """Versión nueva, dentro de la transacción: las escrituras se serializan, así que las
+        versiones se confirman en orden (AUTOINCREMENT no reutiliza las ya borradas)."""
+        version = conn.execute("INSERT INTO versiones DEFAULT VALUES").lastrowid
+        conn.execute("DELETE FROM versiones WHERE id < ?", (version,))
+        return version
+
+    @staticmethod
+    def _merge_row(conn: sqlite3.Connection, clave: str, sketch: DurationSketch, version: int) -> DurationSketch:
+        row = conn.execute("SELECT conteos FROM sketches WHERE clave = ?", (clave,)).fetchone()
+        if row is not None:
+            sketch = DurationSketch.from_bytes(row[0]).merge(sketch)
+        conn.execute("INSERT OR REPLACE INTO sketches (clave, conteos, actualizado, version) VALUES (?, ?, ?, ?)",
+                     (clave, sketch.to_bytes(), time.time(), version))
+        return sketch
+
+    def add(self, doc_id: str, codigo: str | None, dias: float) -> bool:
+        """Cuenta los días de un certificado (una sola vez por documento)."""
+        claves = duration_keys(codigo)
+        if not claves or dias <= 0:
+            return False
+        with self._transaction() as conn:
+            if conn.execute("INSERT OR IGNORE INTO vistos (doc_id) VALUES (?)", (doc_id,)).rowcount == 0:
+                return False
+            version = self._next_version(conn)
+            fusionados = {clave: self._merge_row(conn, clave, DurationSketch().add(dias), version) for clave in claves}
+        with self._lock:
+            self._cache.update(fusionados)
+        return True
+
+    def _sync(self) -> None:
+        ahora = time.monotonic()
+        if ahora - self._sincronizado < env_float("FRAUDE_DURACION_REFRESCO_S", 60.0):
+            return
+        rows = self._conn().execute(
+            "SELECT clave, conteos, version FROM sketches WHERE version > ?", (self._visto_hasta,),
+        ).fetchall()
+        with self._lock:
+            for clave, conteos, version in rows:
+                self._cache[clave] = DurationSketch.from_bytes(conteos)
+                self._visto_hasta = max(self._visto_hasta, version)
+            self._sincronizado = ahora
+
+    def get(self, clave: str) -> DurationSketch | None:
+        self._sync()
+        with self._lock:
+            return self._cache.get(clave)
+
+    def lookup(self, codigo: str | None) -> tuple[str, DurationSketch] | None:
+        """Sketch del código con muestras suficientes, o el de su categoría."""
+        minimo = env_int("FRAUDE_DURACION_MIN_MUESTRAS", 30)
+        for clave in duration_keys(codigo):
+            sketch = self.get(clave)
+            if sketch is not None and sketch.count >= minimo:
+                return clave, sketch
+        return None
+
+    def replace_all(self, sketches: dict[str, DurationSketch], doc_ids: set[str]) -> None:
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM sketches")
+            conn.execute("DELETE FROM vistos")
+            ahora, version = time.time(), self._next_version(conn)
+            conn.executemany("INSERT INTO sketches (clave, conteos, actualizado, version) VALUES (?, ?, ?, ?)",
+                             [(clave, s.to_bytes(), ahora, version) for clave, s in sketches.items()])
+            conn.executemany("INSERT INTO vistos (doc_id) VALUES (?)", [(d,) for d in doc_ids])
+        with self._lock:
+            self._cache = dict(sketches)
+            self._visto_hasta, self._sincronizado = version, time.monotonic()
+
+
+_store: DurationStore | None = None
+_store_lock = threading.Lock()
+
+
+def get_duration_store() -> DurationStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = DurationStore(data_path("duraciones_cie10.sqlite"))
+        return _store
+
+
+def _dias(value) -> int:
+    try:
+        return int(float(str(value or 0)))
+    except ValueError:
+        return 0
+
+
+def learnable(codigo: str | None, dias: int, veredicto: str | None) -> bool:
+    """Si un certificado enseña su duración: todos salvo los que fallaron por ella (días en
+    "exceso" frente al historial o la tabla y veredicto distinto de "Válida")."""
+    if veredicto == "Válida" or dias <= 0:
+        return True
+    from ..tools.cie10_tool import CIE10_DATABASE
+
+    codigo = str(codigo or "").upper().strip()
+    evaluacion = assess_days(codigo, dias, CIE10_DATABASE.get(codigo) or CIE10_DATABASE.get(codigo.split(".")[0][:3]))
+    return evaluacion is None or evaluacion.nivel != "exceso"
+
+
+def learn(doc_id: str | None, datos: dict, veredicto: str | None) -> bool:
+    """Aprende los días de un análisis exitoso, salvo que haya fallado por la duración."""
+    codigo, dias = datos.get("codigo_cie10"), _dias(datos.get("dias_incapacidad"))
+    if not doc_id or not learnable(codigo, dias, veredicto):
+        return False
+    return get_duration_store().add(doc_id, codigo, dias)
+
+
+# ── Evaluación de los días otorgados ─────────────────────────────────────────
+
+@dataclass
+class DaysAssessment:
+    dias: int
+    nivel: str  # habitual | alto | exceso | bajo
+    fuente: str  # historial | tabla
+    percentil: float | None = None
+    muestras: int = 0
+    cuantiles: dict[str, int] = field(default_factory=dict)  # p50, p90, p95 (historial)
+
+    def as_dict(self) -> dict:
+        return {"percentil": self.percentil, "muestras": self.muestras, **self.cuantiles,
+                "nivel": self.nivel, "fuente": self.fuente}
+
+
+def assess_days(codigo: str | None, dias: int, entry: dict | None = None) -> DaysAssessment | None:
+    """Percentil de `dias` en el historial del código; sin historial suficiente, el rango fijo de `entry`."""
+    if dias <= 0:
+        return None
+    encontrado = get_duration_store().lookup(codigo)
+    if encontrado is not None:
+        _, sketch = encontrado
+        percentil = sketch.percentile(dias)
+        if percentil >= env_float("FRAUDE_DURACION_PERCENTIL_EXCESO", 97.0):
+            nivel = "exceso"
+        elif percentil >= env_float("FRAUDE_DURACION_PERCENTIL_ALTO", 90.0):
+            nivel = "alto"
+        elif percentil <= env_float("FRAUDE_DURACION_PERCENTIL_BAJO", 3.0):
+            nivel = "bajo"
+        else:
+            nivel = "habitual"
+        cuantiles = {f"p{round(q * 100)}": round(sketch.quantile(q)) for q in (0.5, 0.9, 0.95)}
+        return DaysAssessment(dias, nivel, "historial", round(percentil, 1), sketch.count, cuantiles)
+    if entry is None:
+        return None
+    nivel = "exceso" if dias > entry["dias_max"] else "bajo" if dias < entry["dias_min"] else "habitual"
+    return DaysAssessment(dias, nivel, "tabla")
+
+
+def rebuild_from_history(chunk: int = 100000) -> dict:
+    """Reconstruye los sketches con los certificados del historial (uno por documento, con
+    el mismo criterio que `learn`, evaluado contra los sketches vigentes).
+
+    Cada bloque se resume con NumPy en sketches por clave que se fusionan con los anteriores.
+    """
+    import numpy as np
+
+    from .history import COLUMNS, get_history_store
+
+    inicio = time.perf_counter()
+    sketches: dict[str, DurationSketch] = {}
+    vistos: set[str] = set()
+    claves: list[str] = []
+    dias: list[int] = []
+
+    def flush() -> None:
+        if not claves:
+            return
+        unicas, inversa = np.unique(np.array(claves), return_inverse=True)
+        valores = np.maximum(np.array(dias, dtype=np.float64), 1.0)
+        b = np.minimum(BUCKETS - 1, np.ceil(np.log(valores) / _LOG_GAMMA - 1e-9).astype(np.int64))
+        conteos = np.bincount(inversa * BUCKETS + b, minlength=len(unicas) * BUCKETS).reshape(len(unicas), BUCKETS)
+        for clave, fila in zip(unicas.tolist(), conteos):
+            parcial = DurationSketch(array("Q", fila.astype(np.uint64).tobytes()))
+            sketches[clave] = sketches[clave].merge(parcial) if clave in sketches else parcial
+        claves.clear()
+        dias.clear()
+
+    filas = 0
+    for row in get_history_store().iter_rows({"status": "success"}):
+        item = dict(zip(COLUMNS, row))
+        doc_id, valor = item["doc_id"], _dias(item["dias_incapacidad"])
+        if not doc_id or doc_id in vistos or valor <= 0 or not learnable(item["cie10"], valor, item["veredicto"]):
+            continue
+        for clave in duration_keys(item["cie10"]):
+            claves.append(clave)
+            dias.append(valor)
+        if duration_keys(item["cie10"]):
+            vistos.add(doc_id)
+            filas += 1
+        if len(claves) >= chunk:
+            flush()
+    flush()
+    get_duration_store().replace_all(sketches, vistos)
+    return {"certificados": filas, "claves": len(sketches), "duracion_s": round(time.perf_counter() - inicio, 3)}
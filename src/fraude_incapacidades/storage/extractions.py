@@ -0,0 +1,45 @@
+"""
+Resultados de extracción por documento (JSON por hash SHA-256 del archivo).
+
+`PDFForensicExtractTool` guarda aquí su salida para que los pasos posteriores al
+dictamen (aprendizaje de plantillas, historial, re-análisis) no dependan del texto
+que los agentes se pasan entre sí.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from ..settings import data_path
+
+
+def document_id(path: Path | str) -> str:
+    """SHA-256 del contenido del archivo (identificador estable del documento)."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _path_for(doc_id: str) -> Path:
+    return data_path("extracciones", doc_id[:2], f"{doc_id}.json")
+
+
+def save_extraction(doc_id: str, report: dict) -> None:
+    path = _path_for(doc_id)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False)
+    os.replace(tmp, path)  # escritura atómica: seguro con varios procesos
+
+
+def load_extraction(doc_id: str) -> dict | None:
+    path = _path_for(doc_id)
+    if not path.exists():
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
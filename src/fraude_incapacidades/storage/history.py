@@ -0,0 +1,289 @@
+"""
+Historial persistente de análisis (SQLite) con consultas paginadas y exportación en
+streaming (CSV o Parquet) que nunca carga el resultado completo en memoria.
+
+Cada análisis guarda los campos estructurados, el dictamen, las salidas de las
+herramientas/tareas y los tiempos, indexado por fecha, EPS, médico, CIE-10 y veredicto.
+"""
+
+from __future__ import annotations
+
+import csv
+import io
+import json
+import sqlite3
+import tempfile
+import threading
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Iterator
+
+from ..settings import data_path
+
+COLUMNS = (
+    "id", "creado_en", "fecha", "archivo", "doc_id", "status", "veredicto", "puntaje",
+    "eps", "medico_documento", "paciente_documento", "cie10", "dias_incapacidad",
+    "duracion_s", "error",
+)
+JSON_COLUMNS = ("reporte", "extraccion", "salidas_tareas", "tiempos")
+FILTERS = {
+    "desde": "fecha >= ?",
+    "hasta": "fecha <= ?",
+    "eps": "eps = ?",
+    "medico_documento": "medico_documento = ?",
+    "paciente_documento": "paciente_documento = ?",
+    "cie10": "cie10 LIKE ?",
+    "veredicto": "veredicto = ?",
+    "status": "status = ?",
+}
+
+
+class HistoryStore:
+    def __init__(self, path: Path | str):
+        self.path = str(path)
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS analisis ("
+            " id TEXT PRIMARY KEY, creado_en TEXT NOT NULL, fecha TEXT NOT NULL, archivo TEXT, doc_id TEXT,"
+            " status TEXT, veredicto TEXT, puntaje INTEGER, eps TEXT, medico_documento TEXT,"
+            " paciente_documento TEXT, cie10 TEXT, dias_incapacidad INTEGER, duracion_s REAL, error TEXT,"
+            " reporte TEXT, extraccion TEXT, salidas_tareas TEXT, tiempos TEXT)"
+        )
+        for col in ("fecha", "eps", "medico_documento", "cie10", "veredicto", "doc_id"):
+            conn.execute(f"CREATE INDEX IF NOT EXISTS ix_analisis_{col} ON analisis ({col})")
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        # Una conexión por hilo: las lecturas en streaming no bloquean otras peticiones.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def record(
+        self,
+        *,
+        archivo: str,
+        doc_id: str | None,
+        status: str,
+        reporte: dict | None,
+        extraccion: dict | None = None,
+        salidas_tareas: list[str] | None = None,
+        tiempos: dict | None = None,
+        error: str | None = None,
+        raw_report: str = "",
+    ) -> str:
+        datos = (extraccion or {}).get("datos_estructurados") or {}
+        ahora = datetime.now()
+        try:
+            dias = int(float(str(datos.get("dias_incapacidad", "")).strip() or 0)) or None
+        except ValueError:
+            dias = None
+        reporte_json = dict(reporte or {}, raw_report=raw_report) if (reporte or raw_report) else None
+        row = {
+            "id": uuid.uuid4().hex,
+            "creado_en": ahora.isoformat(timespec="seconds"),
+            "fecha": ahora.date().isoformat(),
+            "archivo": archivo,
+            "doc_id": doc_id,
+            "status": status,
+            "veredicto": (reporte or {}).get("veredicto"),
+            "puntaje": (reporte or {}).get("puntaje_veracidad"),
+            "eps": str(datos.get("eps_o_ips", "") or "").strip().upper() or None,
+            "medico_documento": "".join(ch for ch in str(datos.get("medico_cedula", "")) if ch.isdigit()) or None,
+            "paciente_documento": "".join(ch for ch in str(datos.get("paciente_cedula", "")) if ch.isdigit()) or None,
+            "cie10": str(datos.get("codigo_cie10", "") or "").strip().upper() or None,
+            "dias_incapacidad": dias,
+            "duracion_s": (tiempos or {}).get("total_s"),
+            "error": error,
+            "reporte": json.dumps(reporte_json, ensure_ascii=False) if reporte_json else None,
+            "extraccion": json.dumps(extraccion, ensure_ascii=False) if extraccion else None,
+            "salidas_tareas": json.dumps(salidas_tareas, ensure_ascii=False) if salidas_tareas else None,
+            "tiempos": json.dumps(tiempos, ensure_ascii=False) if tiempos else None,
+        }
+        conn = self._conn()
+        conn.execute(
+            f"INSERT INTO analisis ({', '.join(row)}) VALUES ({', '.join('?' for _ in row)})",
+            tuple(row.values()),
+        )
+        conn.commit()
+        return row["id"]
+
+    @staticmethod
+    def _where(filters: dict[str, Any]) -> tuple[str, list]:
+        clauses, params = [], []
+        for name, value in filters.items():
+            if value in (None, "") or name not in FILTERS:
+                continue
+            clauses.append(FILTERS[name])
+            params.append(f"{str(value).upper()}%" if name == "cie10" else value)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def query(self, filters: dict[str, Any], page: int = 1, page_size: int = 50) -> dict:
+        """Página de resultados (solo columnas resumen), más recientes primero."""
+        page, page_size = max(1, page), max(1, min(page_size, 500))
+        where, params = self._where(filters)
+        conn = self._conn()
+        total = conn.execute(f"SELECT COUNT(*) FROM analisis{where}", params).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT {', '.join(COLUMNS)} FROM analisis{where} ORDER BY creado_en DESC, id LIMIT ? OFFSET ?",
+            params + [page_size, (page - 1) * page_size],
+        ).fetchall()
+        return {
+            "total": total,
+            "pagina": page,
+            "tamano_pagina": page_size,
+            "paginas": (total + page_size - 1) // page_size,
+            "resultados": [dict(r) for r in rows],
+        }
+
+    def latest_success(self, doc_id: str) -> str | None:
+        """Id del último análisis exitoso de un documento (para no repetirlo en lote)."""
+        row = self._conn().execute(
+            "SELECT id FROM analisis WHERE doc_id = ? AND status = 'success' ORDER BY creado_en DESC LIMIT 1",
+            (doc_id,),
+        ).fetchone()
+        return row[0] if row else None
+
+    def documents(self) -> list[tuple[str, str]]:
+        """(doc_id, archivo) de cada documento con algún análisis exitoso, del más antiguo al más reciente."""
+        rows = self._conn().execute(
+            "SELECT doc_id, archivo FROM analisis WHERE status = 'success' AND doc_id IS NOT NULL"
+            " GROUP BY doc_id ORDER BY MIN(creado_en)"
+        ).fetchall()
+        return [(row[0], row[1]) for row in rows]
+
+    def iter_labeled(self, batch_size: int = 500) -> Iterator[tuple[dict, str, dict | None]]:
+        """(extracción, veredicto, tiempos) de los análisis exitosos con extracción guardada
+        (ejemplos etiquetados para calibrar la cascada)."""
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            cur = conn.execute(
+                "SELECT extraccion, veredicto, tiempos FROM analisis"
+                " WHERE status = 'success' AND veredicto IS NOT NULL AND extraccion IS NOT NULL ORDER BY creado_en"
+            )
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                for extraccion, veredicto, tiempos in rows:
+                    yield json.loads(extraccion), veredicto, json.loads(tiempos) if tiempos else None
+        finally:
+            conn.close()
+
+    def iter_names(self, batch_size: int = 5000) -> Iterator[tuple]:
+        """(id, doc_id, medico_documento, medico_nombre, paciente_documento, paciente_nombre) de los
+        análisis exitosos (para conciliar nombres con registros en lote)."""
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            cur = conn.execute(
+                "SELECT id, doc_id, medico_documento, json_extract(extraccion, '$.datos_estructurados.medico_nombre'),"
+                " paciente_documento, json_extract(extraccion, '$.datos_estructurados.paciente_nombre')"
+                " FROM analisis WHERE status = 'success' AND extraccion IS NOT NULL ORDER BY creado_en, id"
+            )
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+
+    def iter_diagnoses(self, batch_size: int = 5000) -> Iterator[tuple]:
+        """(id, doc_id, codigo_cie10, diagnostico_texto) de los análisis exitosos (para revisar en
+        lote la coherencia del diagnóstico escrito con el código)."""
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            cur = conn.execute(
+                "SELECT id, doc_id, json_extract(extraccion, '$.datos_estructurados.codigo_cie10'),"
+                " json_extract(extraccion, '$.datos_estructurados.diagnostico_texto')"
+                " FROM analisis WHERE status = 'success' AND extraccion IS NOT NULL ORDER BY creado_en, id"
+            )
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+
+    def get(self, analysis_id: str) -> dict | None:
+        row = self._conn().execute("SELECT * FROM analisis WHERE id = ?", (analysis_id,)).fetchone()
+        if row is None:
+            return None
+        item = dict(row)
+        for col in JSON_COLUMNS:
+            item[col] = json.loads(item[col]) if item[col] else None
+        return item
+
+    def iter_rows(self, filters: dict[str, Any], batch_size: int = 1000) -> Iterator[tuple]:
+        """Recorre el resultado con un cursor en lotes (memoria acotada)."""
+        where, params = self._where(filters)
+        conn = sqlite3.connect(self.path, timeout=30)  # conexión propia para el streaming
+        try:
+            cur = conn.execute(f"SELECT {', '.join(COLUMNS)} FROM analisis{where} ORDER BY creado_en, id", params)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+
+    def export_csv(self, filters: dict[str, Any], batch_size: int = 1000) -> Iterator[bytes]:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(COLUMNS)
+        count = 0
+        for row in self.iter_rows(filters, batch_size):
+            writer.writerow(row)
+            count += 1
+            if count % batch_size == 0:
+                yield buffer.getvalue().encode("utf-8")
+                buffer.seek(0)
+                buffer.truncate(0)
+        yield buffer.getvalue().encode("utf-8")
+
+    def export_parquet(self, filters: dict[str, Any], batch_size: int = 10000) -> Iterator[bytes]:
+        """Parquet por row groups en un archivo temporal; requiere `pyarrow`."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema([
+            ("id", pa.string()), ("creado_en", pa.string()), ("fecha", pa.string()), ("archivo", pa.string()),
+            ("doc_id", pa.string()), ("status", pa.string()), ("veredicto", pa.string()), ("puntaje", pa.int64()),
+            ("eps", pa.string()), ("medico_documento", pa.string()), ("paciente_documento", pa.string()),
+            ("cie10", pa.string()), ("dias_incapacidad", pa.int64()), ("duracion_s", pa.float64()),
+            ("error", pa.string()),
+        ])
+        with tempfile.TemporaryFile() as tmp:
+            writer = pq.ParquetWriter(tmp, schema)
+            batch: list[tuple] = []
+            for row in self.iter_rows(filters, batch_size):
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    writer.write_table(pa.Table.from_pylist([dict(zip(COLUMNS, r)) for r in batch], schema=schema))
+                    batch = []
+            if batch:
+                writer.write_table(pa.Table.from_pylist([dict(zip(COLUMNS, r)) for r in batch], schema=schema))
+            writer.close()
+            tmp.seek(0)
+            for chunk in iter(lambda: tmp.read(1 << 20), b""):
+                yield chunk
+
+
+_store: HistoryStore | None = None
+_store_lock = threading.Lock()
+
+
+def get_history_store() -> HistoryStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = HistoryStore(data_path("historial.sqlite"))
+        return _store
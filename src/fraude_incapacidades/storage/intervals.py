@@ -0,0 +1,401 @@
+"""
+Índice de periodos de incapacidad por paciente para detectar certificados
+superpuestos (de distintos médicos) o cadenas ininterrumpidas de incapacidades cortas.
+
+Cada paciente tiene un árbol de intervalos (treap aumentado con el fin máximo del
+subárbol): inserción O(log n) y consulta de solapamiento O(log n + k). Los periodos
+se persisten en SQLite; cada proceso sincroniza incrementalmente su copia en memoria.
+`bulk_import` y `rebuild_from_extractions` reconstruyen el índice para cargas
+históricas en O(n log n).
+"""
+
+from __future__ import annotations
+
+import json
+import random
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from dataclasses import dataclass
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Iterable
+
+from ..settings import DATA_DIR, data_path, env_int
+
+_MESES = {
+    "enero": 1, "febrero": 2, "marzo": 3, "abril": 4, "mayo": 5, "junio": 6, "julio": 7,
+    "agosto": 8, "septiembre": 9, "setiembre": 9, "octubre": 10, "noviembre": 11, "diciembre": 12,
+    "ene": 1, "feb": 2, "mar": 3, "abr": 4, "may": 5, "jun": 6, "jul": 7, "ago": 8,
+    "sep": 9, "set": 9, "oct": 10, "nov": 11, "dic": 12,
+}
+
+
+def parse_fecha(value) -> date | None:
+    """Interpreta fechas como '2025-09-01', '01/09/2025', '1-9-25' o '1 de septiembre de 2025'."""
+    if not value:
+        return None
+    if isinstance(value, date):
+        return value
+    text = unicodedata.normalize("NFKD", str(value)).encode("ascii", "ignore").decode("ascii").lower().strip()
+    m = re.search(r"(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})", text)
+    if m:
+        y, mo, d = int(m.group(1)), int(m.group(2)), int(m.group(3))
+    else:
+        m = re.search(r"(\d{1,2})[-/.](\d{1,2})[-/.](\d{2,4})", text)
+        if m:
+            d, mo, y = int(m.group(1)), int(m.group(2)), int(m.group(3))
+        else:
+            m = re.search(r"(\d{1,2})[\s\-/.]*(?:de\s+)?([a-z]+)\.?[\s\-/.]*(?:de\s+|del\s+)?(\d{2,4})", text)
+            if not m or m.group(2) not in _MESES:
+                return None
+            d, mo, y = int(m.group(1)), _MESES[m.group(2)], int(m.group(3))
+    if y < 100:
+        y += 2000
+    try:
+        return date(y, mo, d)
+    except ValueError:
+        return None
+
+
+def normalizar_documento(value) -> str:
+    return re.sub(r"\D", "", str(value or ""))
+
+
+# ── Árbol de intervalos (treap aumentado) ──
+
+class _Node:
+    __slots__ = ("start", "end", "key", "prio", "max_end", "left", "right", "data")
+
+    def __init__(self, start: int, end: int, key: int, data: tuple, prio: float):
+        self.start, self.end, self.key, self.data, self.prio = start, end, key, data, prio
+        self.max_end = end
+        self.left: _Node | None = None
+        self.right: _Node | None = None
+
+    def update(self) -> None:
+        m = self.end
+        if self.left is not None and self.left.max_end > m:
+            m = self.left.max_end
+        if self.right is not None and self.right.max_end > m:
+            m = self.right.max_end
+        self.max_end = m
+
+
+def _rotate_right(node: _Node) -> _Node:
+    left = node.left
+    node.left, left.right = left.right, node
+    node.update()
+    left.update()
+    return left
+
+
+def _rotate_left(node: _Node) -> _Node:
+    right = node.right
+    node.right, right.left = right.left, node
+    node.update()
+    right.update()
+    return right
+
+
+class IntervalTree:
+    """Intervalos cerrados [start, end] (días ordinales) con datos asociados."""
+
+    def __init__(self):
+        self.root: _Node | None = None
+        self.size = 0
+
+    def insert(self, start: int, end: int, key: int, data: tuple) -> None:
+        def _insert(node: _Node | None) -> _Node:
+            if node is None:
+                return _Node(start, end, key, data, random.random())
+            if (start, key) < (node.start, node.key):
+                node.left = _insert(node.left)
+                if node.left.prio > node.prio:
+                    node = _rotate_right(node)
+            else:
+                node.right = _insert(node.right)
+                if node.right.prio > node.prio:
+                    node = _rotate_left(node)
+            node.update()
+            return node
+
+        self.root = _insert(self.root)
+        self.size += 1
+
+    def overlapping(self, lo: int, hi: int) -> list[_Node]:
+        """Nodos cuyo intervalo intersecta [lo, hi]."""
+        out: list[_Node] = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None or node.max_end < lo:
+                continue
+            stack.append(node.left)
+            if node.start <= hi:
+                if node.end >= lo:
+                    out.append(node)
+                stack.append(node.right)
+        return out
+
+    @classmethod
+    def from_sorted(cls, items: list[tuple[int, int, int, tuple]]) -> "IntervalTree":
+        """Construcción balanceada en O(n) a partir de intervalos ordenados por inicio.
+
+        Las prioridades aleatorias se reparten en orden BFS (mayores arriba) para que el
+        resultado siga siendo un treap válido ante inserciones futuras.
+        """
+        tree = cls()
+        if not items:
+            return tree
+        prios = sorted((random.random() for _ in items), reverse=True)
+        nodes: list[_Node | None] = []
+        # Construir la forma balanceada por niveles (BFS) sobre rangos del arreglo.
+        queue = [(0, len(items) - 1, None, "")]
+        bfs_index = 0
+        while queue:
+            next_queue = []
+            for lo, hi, parent, side in queue:
+                if lo > hi:
+                    continue
+                mid = (lo + hi) // 2
+                s, e, k, d = items[mid]
+                node = _Node(s, e, k, d, prios[bfs_index])
+                bfs_index += 1
+                nodes.append(node)
+                if parent is None:
+                    tree.root = node
+                elif side == "L":
+                    parent.left = node
+                else:
+                    parent.right = node
+                next_queue.append((lo, mid - 1, node, "L"))
+                next_queue.append((mid + 1, hi, node, "R"))
+            queue = next_queue
+        for node in reversed(nodes):
+            node.update()
+        tree.size = len(items)
+        return tree
+
+
+# ── Índice persistente por paciente ──
+
+@dataclass
+class Periodo:
+    doc_id: str
+    medico: str
+    inicio: date
+    fin: date
+    archivo: str
+
+    def to_dict(self) -> dict:
+        return {
+            "documento": self.doc_id[:16],
+            "archivo": self.archivo,
+            "medico_documento": self.medico,
+            "fecha_inicio": self.inicio.isoformat(),
+            "fecha_fin": self.fin.isoformat(),
+            "dias": (self.fin - self.inicio).days + 1,
+        }
+
+
+class IncapacidadIntervalIndex:
+    def __init__(self, path: Path | str):
+        self.path = str(path)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS periodos ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, paciente TEXT NOT NULL, doc_id TEXT NOT NULL UNIQUE,"
+            " medico TEXT, inicio INTEGER NOT NULL, fin INTEGER NOT NULL, archivo TEXT, registrado_en TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_periodos_paciente ON periodos (paciente, inicio)")
+        self._conn.commit()
+        self._trees: dict[str, IntervalTree] = {}
+        self._last_id = 0
+
+    def _sync(self) -> None:
+        with self._lock:
+            cur = self._conn.execute(
+                "SELECT id, paciente, doc_id, medico, inicio, fin, archivo FROM periodos WHERE id > ? ORDER BY id",
+                (self._last_id,),
+            )
+            for rid, paciente, doc_id, medico, inicio, fin, archivo in cur:
+                self._trees.setdefault(paciente, IntervalTree()).insert(
+                    inicio, fin, rid, (doc_id, medico or "", archivo or ""),
+                )
+                self._last_id = rid
+
+    def __len__(self) -> int:
+        self._sync()
+        return sum(t.size for t in self._trees.values())
+
+    def query(self, paciente: str, inicio: date, fin: date, gap_dias: int = 1,
+              exclude_doc: str | None = None) -> list[tuple[Periodo, str]]:
+        """Periodos del paciente que se solapan ("solapada") o son contiguos ("contigua")."""
+        self._sync()
+        tree = self._trees.get(paciente)
+        if tree is None:
+            return []
+        lo, hi = inicio.toordinal(), fin.toordinal()
+        out = []
+        for node in tree.overlapping(lo - gap_dias, hi + gap_dias):
+            doc_id, medico, archivo = node.data
+            if doc_id == exclude_doc:
+                continue
+            tipo = "solapada" if node.start <= hi and node.end >= lo else "contigua"
+            out.append((Periodo(doc_id, medico, date.fromordinal(node.start), date.fromordinal(node.end), archivo), tipo))
+        return out
+
+    def chain(self, paciente: str, inicio: date, fin: date, gap_dias: int = 1,
+              exclude_doc: str | None = None, max_steps: int = 200) -> tuple[date, date, list[Periodo]]:
+        """Cadena ininterrumpida (solapada o contigua) que contiene [inicio, fin]."""
+        lo, hi = inicio, fin
+        seen: dict[str, Periodo] = {}
+        for _ in range(max_steps):
+            nuevos = [p for p, _ in self.query(paciente, lo, hi, gap_dias, exclude_doc) if p.doc_id not in seen]
+            if not nuevos:
+                break
+            for p in nuevos:
+                seen[p.doc_id] = p
+                lo, hi = min(lo, p.inicio), max(hi, p.fin)
+        return lo, hi, sorted(seen.values(), key=lambda p: p.inicio)
+
+    def add(self, paciente: str, doc_id: str, medico: str, inicio: date, fin: date, archivo: str = "") -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO periodos (paciente, doc_id, medico, inicio, fin, archivo, registrado_en)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (paciente, doc_id, medico, inicio.toordinal(), fin.toordinal(), archivo, time.strftime("%Y-%m-%d %H:%M:%S")),
+            )
+            self._conn.commit()
+        self._sync()
+
+    def bulk_import(self, records: Iterable[dict]) -> int:
+        """Carga histórica: inserta en una sola transacción y reconstruye los árboles."""
+        rows = []
+        for rec in records:
+            periodo = periodo_desde_datos(rec)
+            if periodo is None:
+                continue
+            paciente, medico, inicio, fin = periodo
+            rows.append((paciente, rec.get("doc_id", ""), medico, inicio.toordinal(), fin.toordinal(),
+                         rec.get("archivo", ""), time.strftime("%Y-%m-%d %H:%M:%S")))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO periodos (paciente, doc_id, medico, inicio, fin, archivo, registrado_en)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)", rows,
+            )
+            self._conn.commit()
+            self.rebuild()
+        return len(rows)
+
+    def rebuild(self) -> None:
+        """Reconstruye todos los árboles desde SQLite (balanceados, O(n log n))."""
+        with self._lock:
+            grouped: dict[str, list[tuple[int, int, int, tuple]]] = {}
+            last_id = 0
+            cur = self._conn.execute(
+                "SELECT id, paciente, doc_id, medico, inicio, fin, archivo FROM periodos ORDER BY paciente, inicio, id"
+            )
+            for rid, paciente, doc_id, medico, inicio, fin, archivo in cur:
+                grouped.setdefault(paciente, []).append((inicio, fin, rid, (doc_id, medico or "", archivo or "")))
+                last_id = max(last_id, rid)
+            self._trees = {p: IntervalTree.from_sorted(items) for p, items in grouped.items()}
+            self._last_id = last_id
+
+
+def periodo_desde_datos(datos: dict) -> tuple[str, str, date, date] | None:
+    """(paciente, médico, inicio, fin) a partir de los datos extraídos del certificado."""
+    paciente = normalizar_documento(datos.get("paciente_cedula"))
+    inicio = parse_fecha(datos.get("fecha_inicio"))
+    if not paciente or inicio is None:
+        return None
+    fin = parse_fecha(datos.get("fecha_fin"))
+    try:
+        dias = int(float(str(datos.get("dias_incapacidad", "")).strip() or 0))
+    except ValueError:
+        dias = 0
+    if fin is None and dias > 0:
+        fin = inicio + timedelta(days=dias - 1)
+    if fin is None or fin < inicio:
+        fin = inicio
+    return paciente, normalizar_documento(datos.get("medico_cedula")), inicio, fin
+
+
+_index: IncapacidadIntervalIndex | None = None
+_index_lock = threading.Lock()
+
+
+def get_interval_index() -> IncapacidadIntervalIndex:
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = IncapacidadIntervalIndex(data_path("periodos_incapacidad.sqlite"))
+            _index.rebuild()
+        return _index
+
+
+def check_and_register(doc_id: str, archivo: str, datos: dict) -> tuple[dict | None, list[str]]:
+    """Consulta solapamientos/cadenas del paciente y registra el nuevo periodo."""
+    periodo = periodo_desde_datos(datos)
+    if periodo is None:
+        return None, []
+    paciente, medico, inicio, fin = periodo
+    index = get_interval_index()
+    gap = env_int("FRAUDE_CADENA_GAP_DIAS", 1)
+
+    relacionados = index.query(paciente, inicio, fin, gap, exclude_doc=doc_id)
+    cadena_ini, cadena_fin, cadena = index.chain(paciente, inicio, fin, gap, exclude_doc=doc_id)
+
+    alertas: list[str] = []
+    for p, tipo in relacionados:
+        if tipo != "solapada":
+            continue
+        if p.medico and medico and p.medico != medico:
+            alertas.append(
+                f"⚠️ Incapacidad SUPERPUESTA: el paciente ya tiene una incapacidad del {p.inicio} al {p.fin} "
+                f"emitida por OTRO médico (doc. {p.medico}, archivo '{p.archivo}')."
+            )
+        else:
+            alertas.append(
+                f"Incapacidad superpuesta con otra del mismo médico ({p.inicio} a {p.fin}, archivo '{p.archivo}'). "
+                "Puede ser prórroga o un duplicado."
+            )
+    total_dias = (cadena_fin - cadena_ini).days + 1
+    if len(cadena) + 1 >= env_int("FRAUDE_CADENA_MIN_CERTIFICADOS", 4):
+        medicos = {p.medico for p in cadena if p.medico} | ({medico} if medico else set())
+        alertas.append(
+            f"⚠️ Cadena ininterrumpida de {len(cadena) + 1} incapacidades ({total_dias} días) entre "
+            f"{cadena_ini} y {cadena_fin}, de {len(medicos)} médico(s) distinto(s)."
+        )
+
+    index.add(paciente, doc_id, medico, inicio, fin, archivo)
+    resumen = {
+        "periodo": {"fecha_inicio": inicio.isoformat(), "fecha_fin": fin.isoformat()},
+        "relacionadas": [dict(p.to_dict(), relacion=tipo) for p, tipo in relacionados],
+        "cadena": {
+            "certificados": len(cadena) + 1,
+            "fecha_inicio": cadena_ini.isoformat(),
+            "fecha_fin": cadena_fin.isoformat(),
+            "dias_totales": total_dias,
+        },
+    }
+    return resumen, alertas
+
+
+def rebuild_from_extractions(directory: Path | str | None = None) -> int:
+    """Reconstruye el índice con todas las extracciones guardadas (importación histórica)."""
+    base = Path(directory) if directory else DATA_DIR / "extracciones"
+    records = []
+    for path in base.rglob("*.json"):
+        with open(path, "r", encoding="utf-8") as f:
+            report = json.load(f)
+        datos = dict(report.get("datos_estructurados") or {})
+        datos["doc_id"] = path.stem
+        datos["archivo"] = report.get("archivo", "")
+        records.append(datos)
+    return get_interval_index().bulk_import(records)
@@ -0,0 +1,42 @@
+"""
+Bloqueo de archivo entre procesos (varios workers de uvicorn/gunicorn).
+
+Se usa para las actualizaciones leer-modificar-escribir de archivos compartidos
+(p. ej. la biblioteca de plantillas), donde `os.replace` evita archivos corruptos
+pero no la pérdida de una actualización concurrente.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import os
+from pathlib import Path
+from typing import Iterator
+
+
+@contextlib.contextmanager
+def file_lock(path: Path | str) -> Iterator[None]:
+    """Bloqueo exclusivo sobre `<path>.lock` (fcntl en POSIX, msvcrt en Windows)."""
+    lock_path = Path(f"{path}.lock")
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if os.name == "nt":
+            import msvcrt
+
+            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
@@ -3,6 +3,13 @@ from __future__ import annotations
 import json
 from crewai.tools import BaseTool
 
+from ..deadline import DeadlineExceeded, budget, within_deadline
+from ..llm.payloads import payload_mode, tool_payload
+from ..names import annotate_registry, input_name
+from ..profiling import traced
+from ..settings import env_str
+from ..storage.cache import cached_run, conclusive, registry_key
+
 
 class ADRESVerificationTool(BaseTool):
     name: str = "Verificacion ADRES BDUA"
@@ -10,11 +17,19 @@ class ADRESVerificationTool(BaseTool):
         "Verifica si un paciente está afiliado al Sistema General de Seguridad Social "
         "en Salud de Colombia (SGSSS) consultando la BDUA de ADRES. "
         "Recibe como input un JSON string con: 'tipo_documento' (CC, CE, TI, PA, RC, etc.) "
-        "y 'numero_documento' del paciente. "
+        "y 'numero_documento' del paciente, y opcionalmente 'nombre' (el del paciente en el "
+        "certificado) para conciliarlo con el nombre registrado. "
         "Intenta múltiples endpoints de ADRES para máxima compatibilidad."
     )
 
+    @traced
+    @within_deadline("adres")
     def _run(self, input_data: str) -> str:
+        # La consulta se cachea por documento; el nombre se concilia en cada llamada
+        return annotate_registry(self._consultar(input_data), input_name(input_data), "paciente", "ADRES")
+
+    @cached_run("adres", 86400, key=registry_key, cacheable=conclusive, variant=payload_mode)
+    def _consultar(self, input_data: str) -> str:
         try:
             try:
                 data = json.loads(input_data)
@@ -59,6 +74,9 @@ class ADRESVerificationTool(BaseTool):
                         },
                     },
                 ]
+                if env_str("FRAUDE_ADRES_URL"):  # servicio alterno o doble local (test/bench_load.py)
+                    endpoints = [{"url": env_str("FRAUDE_ADRES_URL"), "method": "GET",
+                                  "params": {"tipoDocumento": tipo_adres, "numero": numero_doc}}]
 
                 headers = {
                     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
@@ -72,7 +90,7 @@ class ADRESVerificationTool(BaseTool):
                             endpoint["url"],
                             params=endpoint["params"],
                             headers=headers,
-                            timeout=20,
+                            timeout=budget(20),  # acotado al plazo del análisis
                             verify=True,
                             allow_redirects=True,
                         )
@@ -88,9 +106,13 @@ class ADRESVerificationTool(BaseTool):
                                         estado = result_data.get("estado", result_data.get("Estado", ""))
                                         eps = result_data.get("eps", result_data.get("EPS", result_data.get("entidad", "")))
                                         regimen = result_data.get("regimen", result_data.get("Regimen", ""))
+                                        nombre = " ".join(
+                                            str(result_data.get(k) or result_data.get(k.capitalize()) or "")
+                                            for k in ("nombres", "apellidos")
+                                        ).strip()
 
                                         if estado or eps:
-                                            return json.dumps({
+                                            return tool_payload({
                                                 "verificado": True,
                                                 "fuente": "ADRES/BDUA (consulta automatizada)",
                                                 "url_consulta": "https://servicios.adres.gov.co/BDUA/Consulta-Afiliados-BDUA",
@@ -98,16 +120,17 @@ class ADRESVerificationTool(BaseTool):
                                                     "estado_afiliacion": estado or "Dato no disponible",
                                                     "eps": eps or "Dato no disponible",
                                                     "regimen": regimen or "Dato no disponible",
+                                                    "nombre": nombre or None,
                                                 },
                                                 "riesgo": "BAJO"
-                                            }, ensure_ascii=False, indent=2)
+                                            })
                                 except (json.JSONDecodeError, ValueError):
                                     pass
 
                             # If HTML response, check if it contains affiliation data
                             body = response.text[:3000].lower()
                             if "activo" in body and ("contributivo" in body or "subsidiado" in body):
-                                return json.dumps({
+                                return tool_payload({
                                     "verificado": True,
                                     "fuente": "ADRES/BDUA (consulta web)",
                                     "url_consulta": "https://servicios.adres.gov.co/BDUA/Consulta-Afiliados-BDUA",
@@ -116,8 +139,10 @@ class ADRESVerificationTool(BaseTool):
                                         "regimen": "Contributivo" if "contributivo" in body else "Subsidiado",
                                     },
                                     "riesgo": "BAJO"
-                                }, ensure_ascii=False, indent=2)
+                                })
 
+                    except DeadlineExceeded:
+                        raise
                     except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
                         last_error = str(e)
                         continue
@@ -126,22 +151,19 @@ class ADRESVerificationTool(BaseTool):
                         continue
 
                 # If all endpoints failed or returned unstructured data
-                return json.dumps({
+                return tool_payload({
                     "verificado": None,
                     "fuente": "ADRES/BDUA",
-                    "nota": "El servicio ADRES está protegido por Google reCAPTCHA Enterprise. "
-                            "No es posible la consulta automatizada. Es OBLIGATORIO que el validador humano lo consulte.",
-                    "recomendacion": f"Verificar manualmente en: https://servicios.adres.gov.co/BDUA/Consulta-Afiliados-BDUA "
-                                    f"con documento {tipo_doc} {numero_doc}",
                     "riesgo": "NO_APLICA"
-                }, ensure_ascii=False, indent=2)
+                }, aviso="adres_captcha", documento=f"{tipo_doc} {numero_doc}")
 
             except ImportError:
-                return json.dumps({
+                return tool_payload({
                     "verificado": None,
-                    "nota": "Módulo 'requests' no instalado.",
                     "riesgo": "NO_APLICA"
-                }, ensure_ascii=False, indent=2)
+                }, aviso="sin_modulo", modulo="requests")
 
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             return json.dumps({"error": f"Error en verificación ADRES: {str(e)}"}, ensure_ascii=False)
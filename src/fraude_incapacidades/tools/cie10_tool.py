@@ -3,8 +3,15 @@ from __future__ import annotations
 import json
 from crewai.tools import BaseTool
 
+from ..deadline import within_deadline
+from ..diagnosis import check_diagnosis
+from ..llm.payloads import tool_payload
+from ..profiling import traced
+from ..storage.durations import assess_days
+
 # Base de datos embebida con los códigos CIE-10 más frecuentes en incapacidades
-# colombianas, con rangos típicos de días según protocolos de medicina laboral.
+# colombianas, con rangos típicos de días según protocolos de medicina laboral (respaldo
+# cuando el historial no tiene suficientes certificados del código: storage/durations.py).
 CIE10_DATABASE: dict[str, dict] = {
     # --- Enfermedades infecciosas ---
     "A09": {"desc": "Diarrea y gastroenteritis de presunto origen infeccioso", "dias_min": 1, "dias_max": 5},
@@ -100,9 +107,13 @@ class CIE10ValidationTool(BaseTool):
         "Recibe como input un JSON string con los campos: "
         "'codigo' (ej: 'J06'), 'diagnostico_texto' (descripción del médico), "
         "'dias_incapacidad' (número de días otorgados). "
-        "Retorna la validación con coherencia de días y alertas."
+        "Retorna la validación con el percentil de los días otorgados en el historial del código "
+        "(o el rango esperado si no hay historial suficiente), coherencia del diagnóstico escrito con el código "
+        "(similitud y códigos más plausibles para el texto) y alertas."
     )
 
+    @traced
+    @within_deadline("cie10")
     def _run(self, input_data: str) -> str:
         try:
             # Parse input - accept flexible formats
@@ -126,38 +137,65 @@ class CIE10ValidationTool(BaseTool):
                 prefix = codigo.split(".")[0]
                 entry = CIE10_DATABASE.get(prefix)
 
+            diagnostico = check_diagnosis(diagnostico_texto, codigo)
+
             if not entry:
-                return json.dumps({
+                return tool_payload({
                     "codigo": codigo,
                     "encontrado_en_base": False,
-                    "alerta": f"Código CIE-10 '{codigo}' NO encontrado en la base de datos. Puede ser un código inválido, obsoleto o extremadamente raro.",
+                    "coherencia_diagnostico": {"plausibles": diagnostico.plausibles},
                     "riesgo": "ALTO"
-                }, ensure_ascii=False, indent=2)
+                }, aviso="cie10_desconocido", codigo=codigo)
 
             # Validate days coherence
             alertas = []
             riesgo = "BAJO"
 
-            if isinstance(dias, (int, float)) and dias > 0:
-                if dias < entry["dias_min"]:
+            duracion = assess_days(codigo, int(dias), entry) if isinstance(dias, (int, float)) else None
+            if duracion is not None and duracion.fuente == "historial":
+                # Percentil en los certificados del historial con este código
+                contexto = (f"percentil {duracion.percentil:.0f} de {duracion.muestras} certificados con "
+                            f"{codigo} (mediana {duracion.cuantiles['p50']}, p95 {duracion.cuantiles['p95']} días)")
+                if duracion.nivel == "exceso":
+                    alertas.append(f"Días de incapacidad ({dias}) en el {contexto}. Posible exceso.")
+                    riesgo = "ALTO"
+                elif duracion.nivel == "alto":
+                    alertas.append(f"Días de incapacidad ({dias}) por encima de lo habitual: {contexto}.")
+                    riesgo = "MEDIO"
+                elif duracion.nivel == "bajo":
+                    alertas.append(f"Días de incapacidad ({dias}) INFERIORES a lo habitual: {contexto}.")
+                    riesgo = "MEDIO"
+                else:
+                    alertas.append(f"Días de incapacidad ({dias}) dentro de lo habitual: {contexto}.")
+            elif duracion is not None:
+                if duracion.nivel == "bajo":
                     alertas.append(f"Días de incapacidad ({dias}) INFERIORES al mínimo esperado ({entry['dias_min']} días) para {entry['desc']}.")
                     riesgo = "MEDIO"
-                elif dias > entry["dias_max"]:
+                elif duracion.nivel == "exceso":
                     alertas.append(f"Días de incapacidad ({dias}) SUPERIORES al máximo esperado ({entry['dias_max']} días) para {entry['desc']}. Posible exceso.")
                     riesgo = "ALTO"
                 else:
                     alertas.append(f"Días de incapacidad ({dias}) dentro del rango esperado ({entry['dias_min']}-{entry['dias_max']} días).")
 
-            return json.dumps({
+            # Diagnóstico escrito vs. código declarado
+            alerta_texto = diagnostico.alerta()
+            if alerta_texto:
+                alertas.append(alerta_texto["detalle"])
+                riesgo = "ALTO" if riesgo == "ALTO" else "MEDIO"
+
+            return tool_payload({
                 "codigo": codigo,
                 "encontrado_en_base": True,
                 "descripcion_oficial": entry["desc"],
                 "diagnostico_medico": diagnostico_texto,
                 "dias_incapacidad": dias,
                 "rango_esperado_dias": f"{entry['dias_min']}-{entry['dias_max']}",
+                "distribucion_dias": duracion.as_dict() if duracion is not None and duracion.fuente == "historial" else None,
+                "coherencia_diagnostico": diagnostico.as_dict(),
                 "alertas": alertas,
                 "riesgo": riesgo,
-            }, ensure_ascii=False, indent=2)
+            }, aviso="cie10_texto_discrepante" if alerta_texto else None,
+                codigo=codigo, diagnostico=diagnostico_texto)
 
         except Exception as e:
             return json.dumps({"error": f"Error en validación CIE-10: {str(e)}"}, ensure_ascii=False)
@@ -3,6 +3,10 @@ from __future__ import annotations
 import json
 from crewai.tools import BaseTool
 
+from ..deadline import within_deadline
+from ..llm.payloads import tool_payload
+from ..profiling import traced
+
 
 # Lista Exhaustiva de EPS autorizadas en Colombia (Régimen Contributivo y Subsidiado)
 # Se incluyen variaciones comunes de nombre (siglas, nombres completos).
@@ -41,6 +45,8 @@ class EPSValidationTool(BaseTool):
         "Retorna si es válida, el nombre oficial y alertas en caso de no encontrarse."
     )
 
+    @traced
+    @within_deadline("eps")
     def _run(self, eps_name: str) -> str:
         try:
             if not eps_name or eps_name.strip() == "":
@@ -62,25 +68,18 @@ class EPSValidationTool(BaseTool):
                     break
 
             if eps_oficial_encontrada:
-                return json.dumps({
+                return tool_payload({
                     "encontrada": True,
                     "eps_buscada": eps_name,
                     "eps_oficial": eps_oficial_encontrada,
-                    "alerta": "La EPS mencionada existe en el sistema de salud colombiano y es válida.",
                     "riesgo": "BAJO"
-                }, ensure_ascii=False, indent=2)
+                }, aviso="eps_valida")
             else:
-                return json.dumps({
+                return tool_payload({
                     "encontrada": False,
                     "eps_buscada": eps_name,
-                    "alerta": f"ADVERTENCIA CRÍTICA: La entidad '{eps_name}' NO se encuentra en la base de datos "
-                              "interna de EPS reales operativas en Colombia. Puede ser un error de OCR, o bien "
-                              "el documento usa un nombre de EPS inventado/fachada.",
-                    "recomendacion": "Si es una IPS o clínica pequeña (no una EPS), este error puede ignorarse. "
-                                     "Pero si el documento afirma ser emitido por esta EPS, "
-                                     "es una fuerte señal de fraude.",
                     "riesgo": "ALTO"
-                }, ensure_ascii=False, indent=2)
+                }, aviso="eps_desconocida", entidad=eps_name)
 
         except Exception as e:
             return json.dumps({"error": f"Error en validación de EPS: {str(e)}"}, ensure_ascii=False)
@@ -1,12 +1,31 @@
 from __future__ import annotations
 
+import asyncio
 import os
+import io
 import json
 import base64
+import logging
 from pathlib import Path
+from typing import Any, Callable, Generator
 import fitz  # PyMuPDF
+import numpy as np
 from crewai.tools import BaseTool
-import openai
+
+from ..deadline import within_deadline
+from ..llm.cassette import achat_completion, chat_completion, llm_mode, request_key
+from ..llm.clients import get_async_openai_client, get_openai_client
+from ..llm.payloads import tool_payload
+from ..llm.usage import token_stage
+from ..logs import log_stage
+from ..profiling import traced
+from ..settings import env_float
+from ..forensics import image_prep, marks, page_select, phash, preflight, render, templates
+from ..storage import intervals
+from ..storage.cache import cache_get, cache_set, ttl_for
+from ..storage.extractions import document_id, save_extraction
+
+logger = logging.getLogger(__name__)
 
 
 class PDFForensicExtractTool(BaseTool):
@@ -20,14 +39,51 @@ class PDFForensicExtractTool(BaseTool):
         "Recibe la ruta absoluta del archivo."
     )
 
+    @traced
+    @within_deadline("extraccion")
     def _run(self, file_path: str) -> str:
+        steps = self._pipeline(file_path)
+        done, value = self._advance(lambda: next(steps))
+        while not done:
+            try:
+                structured_data = self._vision_extract(*value[:2])
+            except Exception as e:
+                done, value = self._advance(lambda: steps.throw(e))
+            else:
+                done, value = self._advance(lambda: steps.send(structured_data))
+        return value
+
+    async def _arun(self, file_path: str) -> str:
+        """Misma extracción, con la llamada de visión awaitable y el trabajo CPU en hilos."""
+        steps = self._pipeline(file_path)
+        done, value = await asyncio.to_thread(self._advance, lambda: next(steps))
+        while not done:
+            try:
+                structured_data = await self._avision_extract(*value[:2])
+            except Exception as e:
+                done, value = await asyncio.to_thread(self._advance, lambda: steps.throw(e))
+            else:
+                done, value = await asyncio.to_thread(self._advance, lambda: steps.send(structured_data))
+        return value
+
+    @staticmethod
+    def _advance(step: Callable[[], Any]) -> tuple[bool, Any]:
+        """Avanza el generador sin dejar escapar StopIteration (no cruza hilos ni futures)."""
+        try:
+            return False, step()
+        except StopIteration as finished:
+            return True, finished.value
+
+    def _pipeline(self, file_path: str) -> Generator[tuple[list[tuple[str, str]], str, dict], dict, str]:
+        """Extracción completa como generador: cede (imágenes, texto, hallazgos locales)
+        cuando necesita GPT-4o Vision y recibe el JSON estructurado; devuelve el reporte final."""
         try:
             path = Path(file_path.strip().strip("'\""))
             if not path.exists():
                 return json.dumps({"error": f"Archivo no encontrado: {file_path}"}, ensure_ascii=False)
 
             file_ext = path.suffix.lower()
-            page_images_b64 = []
+            page_images = []  # (mime, base64) por página/imagen enviada a visión
             full_text = ""
             images_found = 0
             metadata = {
@@ -38,6 +94,23 @@ class PDFForensicExtractTool(BaseTool):
             }
             fonts_found = set()
             alertas_forenses = []
+            page_hashes = []  # (pHash, dHash) por página renderizada (None: página sin contraste)
+            page_marks = []  # firma, sello y logo detectados localmente por página
+            exif_imagen = None
+            preprocesamiento = None
+            seleccion_paginas = None
+            template_match, skip_vision = None, False
+
+            # Validación previa: lo desmedido se rechaza antes de abrir o renderizar nada
+            if file_ext in ('.pdf', '.png', '.jpg', '.jpeg'):
+                validacion = (preflight.check_pdf if file_ext == '.pdf' else preflight.check_image)(path)
+                alertas_forenses.extend(validacion.alertas)
+                if validacion.rechazo:
+                    return json.dumps({
+                        "error": f"Documento rechazado por la validación previa: {validacion.rechazo}",
+                        "hallazgos_forenses": {"alertas_forenses_automaticas": alertas_forenses,
+                                               "validacion_previa": validacion.resumen},
+                    }, ensure_ascii=False)
 
             if file_ext == '.pdf':
                 doc = fitz.open(str(path))
@@ -48,11 +121,34 @@ class PDFForensicExtractTool(BaseTool):
                     "fecha_creacion": raw_meta.get("creationDate", ""),
                     "fecha_modificacion": raw_meta.get("modDate", ""),
                 })
-                for i, page in enumerate(doc):
-                    if i >= 3: break
-                    mat = fitz.Matrix(2.0, 2.0)
-                    pix = page.get_pixmap(matrix=mat)
-                    page_images_b64.append(base64.b64encode(pix.tobytes("png")).decode("utf-8"))
+                # Solo se renderizan las páginas más relevantes (no siempre las 3 primeras)
+                selected, seleccion_paginas = page_select.select_pages(doc)
+                try:
+                    template_match, skip_vision = templates.try_template_extraction(
+                        doc, seleccion_paginas["pagina_principal"] - 1
+                    )
+                except Exception as e:
+                    alertas_forenses.append(f"Biblioteca de plantillas no disponible: {e}")
+                # El rasterizado corre en un proceso aislado con límites de memoria y tiempo
+                try:
+                    rendered = render.render_pages(path, selected)
+                except render.RenderLimitExceeded as e:
+                    doc.close()
+                    alertas_forenses.append(f"⚠️ Documento rechazado: {e}.")
+                    return json.dumps({
+                        "error": f"Documento rechazado: {e}",
+                        "hallazgos_forenses": {"alertas_forenses_automaticas": alertas_forenses},
+                    }, ensure_ascii=False)
+                for rendered_page in rendered:
+                    page = doc[rendered_page.index]
+                    if rendered_page.zoom < preflight.BASE_ZOOM:
+                        # Límite de renderizado, no señal forense: hay EPS que emiten en A0
+                        logger.info("página renderizada con zoom reducido",
+                                    extra={"pagina": rendered_page.index + 1, "zoom": rendered_page.zoom,
+                                           "tamano_pt": [round(rendered_page.ancho_pt), round(rendered_page.alto_pt)]})
+                    page_images.append(("image/png", base64.b64encode(rendered_page.png).decode("utf-8")))
+                    page_hashes.append(rendered_page.hashes)
+                    page_marks.append(rendered_page.marcas)
                     full_text += page.get_text("text") + "\n"
                     images_found += len(page.get_images(full=True))
                     
@@ -73,8 +169,17 @@ class PDFForensicExtractTool(BaseTool):
                     alertas_forenses.append("⚠️ Sin logo ni imagen detectada (0 imágenes). Los certificados oficiales suelen tener logos.")
 
             elif file_ext in ['.png', '.jpg', '.jpeg']:
-                with open(str(path), "rb") as img_file:
-                    page_images_b64.append(base64.b64encode(img_file.read()).decode("utf-8"))
+                # Foto de celular: orientación, recorte, enderezado, iluminación y reducción
+                prepared = image_prep.prepare_image(path.read_bytes())
+                page_images.append((prepared.mime, base64.b64encode(prepared.data).decode("utf-8")))
+                from PIL import Image
+                with Image.open(io.BytesIO(prepared.data)) as img:
+                    pixels = np.asarray(img.convert("RGB"))
+                page_hashes.append(phash.page_hashes(pixels))
+                page_marks.append(marks.detect_marks(pixels))
+                exif_imagen = prepared.exif
+                preprocesamiento = prepared.resumen()
+                alertas_forenses.extend(image_prep.exif_alerts(prepared.exif))
                 images_found = 1
                 metadata["creador_software"] = "Imagen directa"
                 
@@ -89,98 +194,211 @@ class PDFForensicExtractTool(BaseTool):
             else:
                 return json.dumps({"error": f"Formato no soportado: {file_ext}"}, ensure_ascii=False)
 
-            # ── 4. GPT-4o Vision Analysis ──
-            api_key = os.environ.get("OPENAI_API_KEY", "")
-            if not api_key:
-                return json.dumps({"error": "OPENAI_API_KEY no encontrada."}, ensure_ascii=False)
-
-            client = openai.OpenAI(api_key=api_key)
-
-            vision_prompt = (
-                "Eres un perito forense especialista en documentos médicos colombianos. "
-                "Analiza visualmente este certificado de incapacidad médica.\n\n"
-                "EXTRAE la siguiente información en formato JSON estricto:\n"
-                "{\n"
-                '  "paciente_nombre": "nombre completo del paciente",\n'
-                '  "paciente_cedula": "número de cédula/documento del paciente",\n'
-                '  "medico_nombre": "nombre completo del médico",\n'
-                '  "medico_cedula": "cédula o registro profesional del médico",\n'
-                '  "eps_o_ips": "nombre de la EPS o IPS que aparece en el documento o logo",\n'
-                '  "codigo_cie10": "código CIE-10 si aparece",\n'
-                '  "diagnostico_texto": "descripción del diagnóstico",\n'
-                '  "dias_incapacidad": número de días,\n'
-                '  "fecha_inicio": "fecha de inicio de la incapacidad",\n'
-                '  "fecha_fin": "fecha fin de la incapacidad",\n'
-                '  "logo_detectado": "descripción del logo que ves (ej: Logo de Sanitas, Logo de Sura, etc.)",\n'
-                '  "tiene_firma": true/false,\n'
-                '  "tiene_sello": true/false,\n'
-                '  "evaluacion_visual": "tu evaluación profesional del aspecto visual del documento: '
-                '¿parece un formato institucional real? ¿El logo corresponde a la EPS/IPS mencionada? '
-                '¿Hay señales de edición visual (parches, texto superpuesto, alineación rota)?"\n'
-                "}\n\n"
-                "Si no puedes leer algún dato, escribe 'No legible' o 'No presente'.\n"
-                "Responde SOLAMENTE el JSON, sin markdown ni preámbulos."
-            )
-
-            # Build the messages with image content
-            content_parts = [{"type": "text", "text": vision_prompt}]
-            for i, img_b64 in enumerate(page_images_b64):
-                content_parts.append({
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/png;base64,{img_b64}",
-                        "detail": "high"
-                    }
-                })
+            # ── 3. Huella perceptual: ¿páginas casi idénticas a envíos anteriores? ──
+            duplicados = []
+            doc_id = document_id(path)
+            if page_hashes:
+                try:
+                    numeros = seleccion_paginas["paginas_seleccionadas"] if seleccion_paginas else None
+                    plantilla_id = template_match.template.id if template_match is not None else None
+                    duplicados, alertas_dup = phash.check_and_register(doc_id, path.name, page_hashes, numeros,
+                                                                       plantilla_id)
+                    alertas_forenses.extend(alertas_dup)
+                except Exception as e:
+                    alertas_forenses.append(f"Índice de huellas perceptuales no disponible: {e}")
 
-            # Also include the raw text as backup in case Vision misses something
-            if full_text.strip():
-                content_parts.append({
-                    "type": "text",
-                    "text": f"\n\nTEXTO EXTRAÍDO POR OCR (referencia adicional):\n{full_text[:3000]}"
-                })
+            # ── 4. Plantilla conocida o GPT-4o Vision ──
+            plantilla = None
+            if template_match is not None:
+                tpl = template_match.template
+                plantilla = {
+                    "nombre": tpl.nombre,
+                    "confianza": template_match.confianza,
+                    "documentos_aprendidos": tpl.documentos,
+                    "vision_omitida": skip_vision,
+                }
+                for desviacion in template_match.desviaciones:
+                    alertas_forenses.append(f"⚠️ Desviación de plantilla conocida: {desviacion}")
 
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[{"role": "user", "content": content_parts}],
-                max_tokens=2000,
-                temperature=0.0
-            )
+            # Hallazgos locales (sin visión); el modo cascada decide con ellos si hace falta visión
+            hallazgos = {
+                "cantidad_imagenes_en_pdf": images_found,
+                "software_creador": metadata["creador_software"] or "No especificado",
+                "productor": metadata["productor_software"] or "No especificado",
+                "fecha_creacion_pdf": metadata["fecha_creacion"],
+                "fecha_modificacion_pdf": metadata["fecha_modificacion"],
+                "fuentes_tipograficas": sorted(list(fonts_found)),
+                "alertas_forenses_automaticas": alertas_forenses,
+                "duplicados_perceptuales": duplicados,
+                "historial_paciente": None,
+                "exif_imagen": exif_imagen,
+                "marcas_locales": marks.summarize(
+                    page_marks, seleccion_paginas["paginas_seleccionadas"] if seleccion_paginas else None
+                ) if page_marks else None,
+            }
+            preliminar = {
+                "hallazgos_forenses": hallazgos,
+                "preprocesamiento_imagen": preprocesamiento,
+                "seleccion_paginas": seleccion_paginas,
+                "paginas_analizadas_por_vision": 0 if skip_vision else len(page_images),
+                "plantilla_conocida": plantilla,
+            }
 
-            llm_result_text = response.choices[0].message.content or "{}"
-            # Clean markdown fences if present
-            llm_result_text = llm_result_text.strip()
-            if llm_result_text.startswith("```"):
-                llm_result_text = llm_result_text.split("\n", 1)[1] if "\n" in llm_result_text else llm_result_text
-            if llm_result_text.endswith("```"):
-                llm_result_text = llm_result_text[:-3]
-            llm_result_text = llm_result_text.strip()
+            if skip_vision:
+                structured_data = dict(template_match.campos)
+                structured_data.update(template_match.template.atributos_visuales)
+                structured_data.update({
+                    "logo_detectado": f"Logo de la plantilla conocida '{template_match.template.nombre}'",
+                    "evaluacion_visual": (
+                        f"No evaluado por visión: el documento coincide exactamente con la plantilla "
+                        f"conocida '{template_match.template.nombre}' (confianza {template_match.confianza})."
+                    ),
+                })
+            else:
+                if not os.environ.get("OPENAI_API_KEY", "") and llm_mode() != "replay":
+                    return json.dumps({"error": "OPENAI_API_KEY no encontrada."}, ensure_ascii=False)
+                structured_data = yield page_images, full_text, preliminar
 
+            # Historial del paciente: incapacidades superpuestas o encadenadas
+            historial = None
             try:
-                structured_data = json.loads(llm_result_text)
-            except json.JSONDecodeError:
-                structured_data = {
-                    "error_extraccion_vision": "GPT-4o Vision no devolvió JSON válido.",
-                    "respuesta_cruda": llm_result_text[:500],
-                    "texto_ocr_backup": full_text[:1000]
-                }
+                historial, alertas_hist = intervals.check_and_register(doc_id, path.name, structured_data)
+                alertas_forenses.extend(alertas_hist)
+            except Exception as e:
+                alertas_forenses.append(f"Índice de periodos de incapacidad no disponible: {e}")
 
             # ── 5. Final Assembly ──
-            final_report = {
-                "datos_estructurados": structured_data,
-                "hallazgos_forenses": {
-                    "cantidad_imagenes_en_pdf": images_found,
-                    "software_creador": metadata["creador_software"] or "No especificado",
-                    "productor": metadata["productor_software"] or "No especificado",
-                    "fecha_creacion_pdf": metadata["fecha_creacion"],
-                    "fecha_modificacion_pdf": metadata["fecha_modificacion"],
-                    "fuentes_tipograficas": sorted(list(fonts_found)),
-                    "alertas_forenses_automaticas": alertas_forenses,
-                },
-                "paginas_analizadas_por_vision": len(page_images_b64),
-            }
+            hallazgos["historial_paciente"] = historial
+            final_report = {"datos_estructurados": structured_data, **preliminar}
+            # La capa de texto solo se guarda (no viaja a los agentes): con ella `cascade.calibrate`
+            # recalcula la evidencia de la etapa local tal como la ve la cascada
+            save_extraction(doc_id, dict(final_report, archivo=path.name, texto_capa=full_text))
 
-            return json.dumps(final_report, ensure_ascii=False, indent=2)
+            return tool_payload(final_report)
 
         except Exception as e:
             return json.dumps({"error": f"Error procesando archivo PDF: {str(e)}"}, ensure_ascii=False)
+
+    def _vision_extract(self, page_images: list[tuple[str, str]], full_text: str) -> dict:
+        """Envía las páginas renderizadas a GPT-4o Vision y devuelve el JSON estructurado."""
+        messages = self._vision_messages(page_images, full_text)
+        key = self._vision_cache_key(messages)
+        cached = cache_get("vision", key) if key else None
+        if cached is not None:
+            return cached
+        with log_stage(logger, "vision", paginas=len(page_images)), token_stage("vision"):
+            llm_result_text = chat_completion(
+                "gpt-4o", messages,
+                lambda: get_openai_client().chat.completions.create(
+                    model="gpt-4o",
+                    messages=messages,
+                    max_tokens=2000,
+                    temperature=0.0,
+                    timeout=env_float("FRAUDE_VISION_TIMEOUT_S", 120.0),
+                ),
+                max_tokens=2000, temperature=0.0,
+            )
+        return self._store_vision(key, self._parse_vision_response(llm_result_text, full_text))
+
+    async def _avision_extract(self, page_images: list[tuple[str, str]], full_text: str) -> dict:
+        """Variante awaitable de `_vision_extract` (cliente asíncrono compartido)."""
+        messages = self._vision_messages(page_images, full_text)
+        key = self._vision_cache_key(messages)
+        cached = await asyncio.to_thread(cache_get, "vision", key) if key else None
+        if cached is not None:
+            return cached
+        with log_stage(logger, "vision", paginas=len(page_images)), token_stage("vision"):
+            llm_result_text = await achat_completion(
+                "gpt-4o", messages,
+                lambda: get_async_openai_client().chat.completions.create(
+                    model="gpt-4o",
+                    messages=messages,
+                    max_tokens=2000,
+                    temperature=0.0,
+                    timeout=env_float("FRAUDE_VISION_TIMEOUT_S", 120.0),
+                ),
+                max_tokens=2000, temperature=0.0,
+            )
+        return self._store_vision(key, self._parse_vision_response(llm_result_text, full_text))
+
+    @staticmethod
+    def _vision_cache_key(messages: list[dict]) -> str | None:
+        """Misma petición de visión (páginas y texto idénticos) = misma respuesta; la caché
+        se comparte entre workers. En record/replay manda el cassette."""
+        if llm_mode() != "live" or ttl_for("vision", 30 * 86400) <= 0:
+            return None
+        return request_key("gpt-4o", messages, max_tokens=2000, temperature=0.0)
+
+    @staticmethod
+    def _store_vision(key: str | None, result: dict) -> dict:
+        if key and "error_extraccion_vision" not in result:
+            cache_set("vision", key, result, ttl_for("vision", 30 * 86400))
+        return result
+
+    @staticmethod
+    def _vision_messages(page_images: list[tuple[str, str]], full_text: str) -> list[dict]:
+        vision_prompt = (
+            "Eres un perito forense especialista en documentos médicos colombianos. "
+            "Analiza visualmente este certificado de incapacidad médica.\n\n"
+            "EXTRAE la siguiente información en formato JSON estricto:\n"
+            "{\n"
+            '  "paciente_nombre": "nombre completo del paciente",\n'
+            '  "paciente_cedula": "número de cédula/documento del paciente",\n'
+            '  "medico_nombre": "nombre completo del médico",\n'
+            '  "medico_cedula": "cédula o registro profesional del médico",\n'
+            '  "eps_o_ips": "nombre de la EPS o IPS que aparece en el documento o logo",\n'
+            '  "codigo_cie10": "código CIE-10 si aparece",\n'
+            '  "diagnostico_texto": "descripción del diagnóstico",\n'
+            '  "dias_incapacidad": número de días,\n'
+            '  "fecha_inicio": "fecha de inicio de la incapacidad",\n'
+            '  "fecha_fin": "fecha fin de la incapacidad",\n'
+            '  "logo_detectado": "descripción del logo que ves (ej: Logo de Sanitas, Logo de Sura, etc.)",\n'
+            '  "tiene_firma": true/false,\n'
+            '  "tiene_sello": true/false,\n'
+            '  "evaluacion_visual": "tu evaluación profesional del aspecto visual del documento: '
+            '¿parece un formato institucional real? ¿El logo corresponde a la EPS/IPS mencionada? '
+            '¿Hay señales de edición visual (parches, texto superpuesto, alineación rota)?"\n'
+            "}\n\n"
+            "Si no puedes leer algún dato, escribe 'No legible' o 'No presente'.\n"
+            "Responde SOLAMENTE el JSON, sin markdown ni preámbulos."
+        )
+
+        # Build the messages with image content
+        content_parts = [{"type": "text", "text": vision_prompt}]
+        for mime, img_b64 in page_images:
+            content_parts.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:{mime};base64,{img_b64}",
+                    "detail": "high"
+                }
+            })
+
+        # Also include the raw text as backup in case Vision misses something
+        if full_text.strip():
+            content_parts.append({
+                "type": "text",
+                "text": f"\n\nTEXTO EXTRAÍDO POR OCR (referencia adicional):\n{full_text[:3000]}"
+            })
+
+        return [{"role": "user", "content": content_parts}]
+
+    @staticmethod
+    def _parse_vision_response(llm_result_text: str, full_text: str) -> dict:
+        llm_result_text = llm_result_text or "{}"
+        # Clean markdown fences if present
+        llm_result_text = llm_result_text.strip()
+        if llm_result_text.startswith("```"):
+            llm_result_text = llm_result_text.split("\n", 1)[1] if "\n" in llm_result_text else llm_result_text
+        if llm_result_text.endswith("```"):
+            llm_result_text = llm_result_text[:-3]
+        llm_result_text = llm_result_text.strip()
+
+        try:
+            return json.loads(llm_result_text)
+        except json.JSONDecodeError:
+            return {
+                "error_extraccion_vision": "GPT-4o Vision no devolvió JSON válido.",
+                "respuesta_cruda": llm_result_text[:500],
+                "texto_ocr_backup": full_text[:1000]
+            }
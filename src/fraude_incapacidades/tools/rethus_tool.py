@@ -4,6 +4,16 @@ import json
 from crewai.tools import BaseTool
 import time
 
+from ..deadline import DeadlineExceeded, budget, within_deadline
+from ..llm.payloads import payload_mode, tool_payload
+from ..names import annotate_registry, input_name
+from ..profiling import traced
+from ..settings import env_str
+from ..storage.cache import cached_run, conclusive, registry_key
+
+# FRAUDE_RETHUS_URL permite apuntar a un doble local (pruebas de carga, test/bench_load.py)
+RETHUS_URL = "https://web.sispro.gov.co/THS/Cliente/ConsultasPublicas/ConsultaPublicaDeTHxIdentificacion.aspx"
+
 
 class RETHUSVerificationTool(BaseTool):
     name: str = "Verificacion RETHUS SISPRO"
@@ -11,11 +21,20 @@ class RETHUSVerificationTool(BaseTool):
         "Verifica si un profesional de salud está registrado en el RETHUS "
         "(Registro Único Nacional del Talento Humano en Salud) del SISPRO Colombia. "
         "Recibe como input un JSON string con: 'tipo_documento' (CC, CE, PA, etc.) "
-        "y 'numero_documento' del profesional. "
+        "y 'numero_documento' del profesional, y opcionalmente 'nombre' (el del médico en el "
+        "certificado) para conciliarlo con el nombre registrado. "
         "Intenta acceder a la página web real mediante Playwright y bypass del CAPTCHA."
     )
 
+    @traced
+    @within_deadline("rethus")
     def _run(self, input_data: str) -> str:
+        # La consulta se cachea por documento; el nombre se concilia en cada llamada
+        return annotate_registry(self._consultar(input_data), input_name(input_data), "médico", "RETHUS")
+
+    # Consultar RETHUS cuesta un navegador completo: el resultado se comparte entre workers (7 días)
+    @cached_run("rethus", 7 * 86400, key=registry_key, cacheable=conclusive, variant=payload_mode)
+    def _consultar(self, input_data: str) -> str:
         try:
             try:
                 data = json.loads(input_data)
@@ -49,8 +68,9 @@ class RETHUSVerificationTool(BaseTool):
                     page = context.new_page()
                     try:
                         # 1. Navegar a la página
-                        page.goto("https://web.sispro.gov.co/THS/Cliente/ConsultasPublicas/ConsultaPublicaDeTHxIdentificacion.aspx", timeout=30000)
-                        page.wait_for_selector("input#ctl00_cntContenido_txtNumeroIdentificacion", timeout=15000)
+                        page.goto(env_str("FRAUDE_RETHUS_URL", RETHUS_URL), timeout=budget(30) * 1000)
+                        page.wait_for_selector("input#ctl00_cntContenido_txtNumeroIdentificacion",
+                                               timeout=budget(15) * 1000)
                         
                         # 2. Leer CAPTCHA client-side variable bypass
                         captcha_val = page.evaluate("window.tc")
@@ -64,7 +84,7 @@ class RETHUSVerificationTool(BaseTool):
                         page.click("input#ctl00_cntContenido_btnVerificarIdentificacion")
                         
                         # 5. Esperar resultados o mensajes
-                        time.sleep(4) # Esperar a que el UpdatePanel responda
+                        time.sleep(budget(4)) # Esperar a que el UpdatePanel responda (sin pasar del plazo)
                         
                         # 6. Extraer resultados
                         page_text = page.inner_text("body").lower()
@@ -72,12 +92,11 @@ class RETHUSVerificationTool(BaseTool):
                         
                         # Si encuentra 'no se encontraron registros'
                         if "no se han encontrado resultados" in page_text or "no se encontrar" in page_text:
-                             return json.dumps({
+                             return tool_payload({
                                 "verificado": False,
                                 "fuente": "RETHUS/SISPRO (Raspado Web Automatizado)",
-                                "alerta": f"Profesional con {tipo_doc} {numero_doc} NO encontrado en RETHUS. Esto es MUY SOSPECHOSO.",
                                 "riesgo": "ALTO"
-                            }, ensure_ascii=False, indent=2)
+                            }, aviso="rethus_no_encontrado", documento=f"{tipo_doc} {numero_doc}")
                         
                         # Si encuentra la tabla de resultados
                         elif "nombres y apellidos" in page_text and "profesión" in page_text:
@@ -91,7 +110,7 @@ class RETHUSVerificationTool(BaseTool):
                                 profesion = "Presente en tabla"
                                 estado = "Presente en tabla"
                                 
-                            return json.dumps({
+                            return tool_payload({
                                 "verificado": True,
                                 "fuente": "RETHUS/SISPRO (Raspado Web Automatizado)",
                                 "datos": {
@@ -100,37 +119,37 @@ class RETHUSVerificationTool(BaseTool):
                                     "estado": estado
                                 },
                                 "riesgo": "BAJO"
-                            }, ensure_ascii=False, indent=2)
+                            })
                             
                         else:
                             # Caso indeterminado, tal vez falló la consulta temporalmente
-                            return json.dumps({
+                            return tool_payload({
                                 "verificado": None,
                                 "fuente": "RETHUS/SISPRO",
-                                "nota": "El servicio RETHUS respondió pero el resultado fue ambiguo. No se penalizará.",
-                                "recomendacion": f"Verificar manualmente en: https://web.sispro.gov.co/THS/Cliente/ConsultasPublicas/ConsultaPublicaDeTHxIdentificacion.aspx con documento {tipo_doc} {numero_doc}",
                                 "detalle_tecnico": "Texto extraído: " + page_text[:200],
                                 "riesgo": "NO_APLICA"
-                            }, ensure_ascii=False, indent=2)
+                            }, aviso="rethus_ambiguo", documento=f"{tipo_doc} {numero_doc}")
 
+                    except DeadlineExceeded:
+                        raise
                     except Exception as e:
                         # Error de Playwright
-                        return json.dumps({
+                        return tool_payload({
                             "verificado": None,
                             "fuente": "RETHUS/SISPRO",
-                            "nota": "El portal RETHUS presentó fallos técnicos temporales (timeout).",
                             "detalle_tecnico": str(e),
                             "riesgo": "NO_APLICA"
-                        }, ensure_ascii=False, indent=2)
+                        }, aviso="rethus_falla")
                     finally:
                         browser.close()
 
             except ImportError:
-                return json.dumps({
+                return tool_payload({
                     "verificado": None,
-                    "nota": "Módulo 'playwright' no instalado para extracción web.",
                     "riesgo": "NO_APLICA"
-                }, ensure_ascii=False, indent=2)
+                }, aviso="sin_modulo", modulo="playwright")
 
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             return json.dumps({"error": f"Error crítico en verificación RETHUS: {str(e)}"}, ensure_ascii=False)
@@ -2,6 +2,30 @@ from __future__ import annotations
 
 from crewai.tools import BaseTool
 
+from ..deadline import DeadlineExceeded, budget, within_deadline
+from ..llm.payloads import compact_mode, minify, payload_mode
+from ..profiling import traced
+from ..settings import env_str
+from ..storage.cache import cached_run
+
+
+def _query_key(query: str) -> str | None:
+    return " ".join(query.lower().split()) or None
+
+
+def _cacheable(result: str) -> bool:
+    return not result.startswith(("Error", "Módulo"))
+
+
+def _searx_text(base_url: str, query: str, max_results: int = 3) -> list[dict]:
+    """Búsqueda en una instancia SearXNG (API JSON) con el formato de resultados de DDGS."""
+    import httpx
+
+    response = httpx.get(base_url, params={"q": query, "format": "json"}, timeout=budget(20))
+    response.raise_for_status()
+    return [{"title": r.get("title", ""), "href": r.get("url", ""), "body": r.get("content", "")}
+            for r in (response.json().get("results") or [])[:max_results]]
+
 
 class OSINTSearchTool(BaseTool):
     name: str = "Busqueda Web OSINT"
@@ -11,9 +35,21 @@ class OSINTSearchTool(BaseTool):
         "específicos contra esa entidad en Colombia. Recibe el nombre a buscar."
     )
 
+    @traced
+    @within_deadline("osint")
+    @cached_run("osint", 86400, key=_query_key, cacheable=_cacheable, variant=payload_mode)
     def _run(self, query: str) -> str:
         try:
-            from duckduckgo_search import DDGS
+            # FRAUDE_OSINT_URL: instancia SearXNG (o el doble de test/bench_load.py) en lugar de DuckDuckGo
+            searx_url = env_str("FRAUDE_OSINT_URL")
+            if searx_url:
+                def search(q: str) -> list[dict]:
+                    return _searx_text(searx_url, q)
+            else:
+                from duckduckgo_search import DDGS
+
+                def search(q: str) -> list[dict]:
+                    return DDGS(timeout=budget(10)).text(q, max_results=3)
 
             # Búsqueda más neutral: primero verificar existencia, luego fraude específico
             searches = [
@@ -26,7 +62,7 @@ class OSINTSearchTool(BaseTool):
 
             for search_query, category in searches:
                 try:
-                    results = DDGS().text(search_query, max_results=3)
+                    results = search(search_query)
                     if results:
                         for r in results:
                             url = r.get("href", "")
@@ -44,15 +80,25 @@ class OSINTSearchTool(BaseTool):
                                 if category == "Fraude Específico" and not is_specific:
                                     category = "Resultado Genérico (NO específico de esta entidad)"
                                 
-                                all_results.append(
-                                    f"[{category}]\n"
-                                    f"  Título: {title}\n"
-                                    f"  Resumen: {body}\n"
-                                    f"  URL: {url}"
-                                )
+                                all_results.append((category, title, body, url))
+                except DeadlineExceeded:
+                    raise
                 except Exception:
+                    budget()  # consulta cortada por el plazo: "sin resultados" no debe quedar en caché
                     continue
 
+            if compact_mode():
+                # Resúmenes recortados; la regla "solo fraude específico cuenta" va en la leyenda
+                categorias = {"Existencia Entidad": "existencia", "Fraude Específico": "fraude"}
+                return minify({
+                    "q": query,
+                    "res": [
+                        {"c": categorias.get(c, "generico"), "t": t, "s": b[:200], "u": u}
+                        for c, t, b, u in all_results
+                    ],
+                    "aviso": "osint_generico" if all_results else "osint_sin_resultados",
+                })
+
             if not all_results:
                 return (
                     f"No se encontraron resultados para '{query}' en la web. "
@@ -62,8 +108,12 @@ class OSINTSearchTool(BaseTool):
 
             header = f"=== Resultados OSINT para: '{query}' ===\n"
             header += "NOTA: Solo los resultados marcados como 'Fraude Específico' que mencionan directamente esta entidad son relevantes.\n\n"
-            return header + "\n\n".join(all_results)
+            return header + "\n\n".join(
+                f"[{c}]\n  Título: {t}\n  Resumen: {b}\n  URL: {u}" for c, t, b, u in all_results
+            )
 
+        except DeadlineExceeded:
+            raise
         except ImportError:
             return (
                 "Módulo de búsqueda web no disponible. "
@@ -0,0 +1,402 @@
+"""
+Prueba de carga de extremo a extremo contra POST /api/analyze.
+
+Levanta la API real con uvicorn (un subproceso) y dobles locales de los servicios
+externos, cada uno con latencia y tasa de fallas configurables:
+
+- openai:   /v1/chat/completions con el guion de bench_payloads (visión + agentes);
+            una falla responde 429 con Retry-After, como la cuota real
+- adres:    /adres (JSON de afiliación, vía FRAUDE_ADRES_URL)
+- sispro:   /sispro (formulario de RETHUS para Playwright, vía FRAUDE_RETHUS_URL)
+- busqueda: /search (API JSON de SearXNG en lugar de DuckDuckGo, vía FRAUDE_OSINT_URL)
+
+Un generador asyncio reenvía el corpus sintético (cada envío con bytes únicos, para no
+acertar en la caché de resultados) con concurrencia creciente. Por nivel mide
+throughput, latencias p50/p95/p99, tasa de errores y rechazos (429/503) y la memoria
+(RSS) del servidor.
+
+    cd src && PYTHONPATH=. python ../test/bench_load.py --niveles 1,2,4,8 --duracion 20 \\
+        --latencia openai=0.8,adres=0.3,sispro=0.5,busqueda=0.2 --fallas openai=0.02,adres=0.1 \\
+        --salida carga.json [--comparar carga_anterior.json]
+
+El reporte JSON (salida estándar y --salida) incluye el commit y la configuración para
+compararlo entre versiones; --comparar agrega las diferencias por nivel. Las cachés de
+visión y registros se desactivan salvo --con-cache. Las variables FRAUDE_* del entorno
+(p. ej. FRAUDE_WORKER_CONCURRENCY, FRAUDE_ANALYSIS_MODE) pasan al servidor; un .env en la
+raíz del repositorio también se carga en él.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT))
+
+import bench_payloads  # noqa: E402  (guion de OpenAI y corpus sintético)
+
+SERVICIOS = ("openai", "adres", "sispro", "busqueda")
+
+_SISPRO_FORM = """<html><body><script>window.tc = "4821";</script>
+<select id="ctl00_cntContenido_ddlTipoIdentificacion"><option value="CC">CC</option><option value="CE">CE</option>
+<option value="PA">PA</option><option value="TI">TI</option><option value="PE">PE</option><option value="PT">PT</option></select>
+<input id="ctl00_cntContenido_txtNumeroIdentificacion"><input id="ctl00_cntContenido_txtCatpchaConfirmation">
+<input type="button" id="ctl00_cntContenido_btnVerificarIdentificacion" value="Verificar" onclick="
+  fetch('consulta?n=' + document.getElementById('ctl00_cntContenido_txtNumeroIdentificacion').value)
+    .then(r => r.ok ? r.text() : 'Servicio no disponible').then(t => document.getElementById('res').innerHTML = t)">
+<div id="res"></div></body></html>"""
+
+_SISPRO_RESULTADO = """<table id="ctl00_cntContenido_grdResultadosBasicos"><tr><th>Documento</th>
+<th>Nombres y Apellidos</th><th>Profesión</th></tr><tr><td>{n}</td><td>ANA MÉDICA</td><td>MEDICINA</td></tr></table>
+<table id="ctl00_cntContenido_grdResultadosAcademicos"><tr><th>a</th><th>b</th><th>c</th><th>Estado</th></tr>
+<tr><td></td><td></td><td></td><td>ACTIVO</td></tr></table>"""
+
+
+def _parse_spec(spec: str) -> dict[str, float]:
+    """"openai=0.8,adres=0.3" → {"openai": 0.8, "adres": 0.3}."""
+    valores = {}
+    for parte in filter(None, (p.strip() for p in spec.split(","))):
+        nombre, _, valor = parte.partition("=")
+        if nombre not in SERVICIOS:
+            raise argparse.ArgumentTypeError(f"servicio desconocido: {nombre} (válidos: {', '.join(SERVICIOS)})")
+        valores[nombre] = float(valor)
+    return valores
+
+
+class StandIns:
+    """Dobles de OpenAI, ADRES, SISPRO y SearXNG en un solo servidor HTTP local."""
+
+    def __init__(self, latencia: dict[str, float], fallas: dict[str, float], semilla: int = 7):
+        self.latencia, self.fallas = latencia, fallas
+        self.rng = random.Random(semilla)
+        self.lock = threading.Lock()
+        self.conteo = {s: {"peticiones": 0, "fallas": 0} for s in SERVICIOS}
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def _turno(self, servicio: str) -> bool:
+        """Espera la latencia del servicio (±50 %) y decide si esta petición falla."""
+        with self.lock:
+            demora = self.latencia.get(servicio, 0.0) * self.rng.uniform(0.5, 1.5)
+            falla = self.rng.random() < self.fallas.get(servicio, 0.0)
+            self.conteo[servicio]["peticiones"] += 1
+            self.conteo[servicio]["fallas"] += int(falla)
+        time.sleep(demora)
+        return falla
+
+    def _handler(self):
+        stand_ins = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: bytes, content_type: str, headers: dict | None = None) -> None:
+                self.send_response(status)
+                self.send_header("content-type", content_type)
+                self.send_header("content-length", str(len(body)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _json(self, status: int, data: dict, headers: dict | None = None) -> None:
+                self._send(status, json.dumps(data, ensure_ascii=False).encode(), "application/json", headers)
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get("content-length", 0))) or b"{}")
+                if stand_ins._turno("openai"):
+                    return self._json(429, {"error": {"message": "Rate limit (doble local)", "type": "requests",
+                                                      "code": "rate_limit_exceeded"}}, {"retry-after": "1"})
+                self._json(200, bench_payloads._reply(payload))
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                if url.path == "/adres":
+                    if stand_ins._turno("adres"):
+                        return self._send(503, b"Servicio no disponible", "text/plain")
+                    return self._json(200, {"estado": "ACTIVO", "eps": "EPS SURA", "regimen": "CONTRIBUTIVO",
+                                            "nombres": "PACIENTE", "apellidos": "PRUEBA"})
+                if url.path == "/sispro":
+                    return self._send(200, _SISPRO_FORM.encode(), "text/html; charset=utf-8")
+                if url.path == "/consulta":  # botón del formulario de /sispro
+                    if stand_ins._turno("sispro"):
+                        return self._send(503, b"", "text/plain")
+                    return self._send(200, _SISPRO_RESULTADO.format(n=query.get("n", "")).encode(),
+                                      "text/html; charset=utf-8")
+                if url.path == "/search":
+                    if stand_ins._turno("busqueda"):
+                        return self._send(503, b"", "text/plain")
+                    q = query.get("q", "")
+                    return self._json(200, {"query": q, "results": [
+                        {"title": f"{q[:40]} - sede principal", "url": f"https://ejemplo.co/{abs(hash(q)) % 997}",
+                         "content": "Institución prestadora de servicios de salud."}]})
+                self._send(404, b"", "text/plain")
+
+        return Handler
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _rss_mb(pid: int) -> float | None:
+    """RSS del proceso y sus hijos (workers de uvicorn) en MB; None fuera de Linux."""
+    procs = {pid}
+    try:
+        for entry in Path("/proc").iterdir():
+            if entry.name.isdigit():
+                try:
+                    campos = (entry / "stat").read_text().rsplit(")", 1)[1].split()
+                except OSError:
+                    continue
+                if int(campos[1]) == pid:
+                    procs.add(int(entry.name))
+        total = 0
+        for p in procs:
+            try:
+                status = Path(f"/proc/{p}/status").read_text()
+            except OSError:
+                continue
+            total += next((int(l.split()[1]) for l in status.splitlines() if l.startswith("VmRSS:")), 0)
+        return round(total / 1024, 1)
+    except OSError:
+        return None
+
+
+def _percentil(valores: list[float], p: float) -> float | None:
+    if not valores:
+        return None
+    orden = sorted(valores)
+    return round(orden[max(0, math.ceil(p / 100 * len(orden)) - 1)], 3)  # rango más cercano
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def _nivel(client: httpx.AsyncClient, corpus: list[tuple[str, bytes]], concurrencia: int,
+                 duracion_s: float, pid: int, contador: list[int]) -> dict:
+    latencias: list[float] = []
+    estados: dict[str, int] = {}
+    memoria: list[float] = []
+    fin = time.perf_counter() + duracion_s
+
+    async def usuario(n: int) -> None:
+        headers = {"X-API-Key": f"bench-usuario-{n}"}  # cada usuario virtual es un cliente (cuotas de admisión)
+        while time.perf_counter() < fin:
+            contador[0] += 1
+            nombre, base = corpus[contador[0] % len(corpus)]
+            contenido = base + f"\n%carga-{contador[0]}\n".encode()  # sha256 distinto, mismo documento
+            inicio = time.perf_counter()
+            try:
+                r = await client.post("/api/analyze", files={"file": (nombre, contenido, "application/pdf")},
+                                      headers=headers)
+                if r.status_code in (429, 503):
+                    estado = "rechazada"
+                elif r.status_code != 200:
+                    estado = f"http_{r.status_code}"
+                else:
+                    # "parcial": informe entregado al vencer el SLO (FRAUDE_SLO_S) con verificaciones pendientes
+                    estado = {"success": "ok", "parcial": "parcial"}.get(r.json().get("status"), "error_analisis")
+            except httpx.HTTPError as e:
+                estado = type(e).__name__
+            if estado in ("ok", "parcial"):  # latencias de informes entregados (un 429 responde en ms)
+                latencias.append(time.perf_counter() - inicio)
+            estados[estado] = estados.get(estado, 0) + 1
+            if estado == "rechazada":  # un cliente bien portado respeta Retry-After
+                espera = float(r.headers.get("retry-after") or 1)
+                await asyncio.sleep(max(0.0, min(espera, fin - time.perf_counter())))
+
+    async def muestrear_memoria() -> None:
+        while True:
+            rss = _rss_mb(pid)
+            if rss is not None:
+                memoria.append(rss)
+            await asyncio.sleep(0.5)
+
+    inicio = time.perf_counter()
+    monitor = asyncio.create_task(muestrear_memoria())
+    await asyncio.gather(*(usuario(n) for n in range(concurrencia)))
+    transcurrido = time.perf_counter() - inicio
+    monitor.cancel()
+    rss_final = _rss_mb(pid)
+    total = sum(estados.values())
+    errores = total - estados.get("ok", 0) - estados.get("parcial", 0) - estados.get("rechazada", 0)
+    return {
+        "concurrencia": concurrencia,
+        "duracion_s": round(transcurrido, 2),
+        "peticiones": total,
+        "estados": estados,
+        "tasa_error": round(errores / total, 4) if total else None,
+        "tasa_rechazo": round(estados.get("rechazada", 0) / total, 4) if total else None,
+        "tasa_parcial": round(estados.get("parcial", 0) / total, 4) if total else None,
+        "throughput_rps": round(estados.get("ok", 0) / transcurrido, 3) if transcurrido else None,
+        "latencia_s": {
+            "p50": _percentil(latencias, 50), "p95": _percentil(latencias, 95), "p99": _percentil(latencias, 99),
+            "max": round(max(latencias), 3) if latencias else None,
+            "media": round(sum(latencias) / len(latencias), 3) if latencias else None,
+        },
+        "memoria_mb": {
+            "inicio": memoria[0] if memoria else None, "fin": rss_final,
+            "max": max(memoria + [rss_final or 0]) if memoria else None,
+            "crecimiento": round(rss_final - memoria[0], 1) if memoria and rss_final is not None else None,
+        },
+    }
+
+
+def _comparar(actual: dict, anterior: dict) -> list[dict]:
+    """Diferencias porcentuales por nivel de concurrencia frente a un reporte anterior."""
+    previos = {n["concurrencia"]: n for n in anterior.get("niveles", [])}
+
+    def delta(a, b):
+        return round(100 * (a - b) / b, 1) if a is not None and b else None
+
+    filas = []
+    for nivel in actual["niveles"]:
+        previo = previos.get(nivel["concurrencia"])
+        if previo is None:
+            continue
+        filas.append({
+            "concurrencia": nivel["concurrencia"],
+            "throughput_pct": delta(nivel["throughput_rps"], previo["throughput_rps"]),
+            "p95_pct": delta(nivel["latencia_s"]["p95"], previo["latencia_s"]["p95"]),
+            "p99_pct": delta(nivel["latencia_s"]["p99"], previo["latencia_s"]["p99"]),
+            "tasa_error": [previo["tasa_error"], nivel["tasa_error"]],
+            "crecimiento_memoria_mb": [previo["memoria_mb"]["crecimiento"], nivel["memoria_mb"]["crecimiento"]],
+        })
+    return filas
+
+
+async def _run(args, corpus: list[tuple[str, bytes]], base_url: str, pid: int) -> list[dict]:
+    niveles = []
+    contador = [0]
+    timeout = httpx.Timeout(args.timeout, connect=10)
+    limits = httpx.Limits(max_connections=max(args.niveles) + 4)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        await client.post("/api/analyze", files={"file": (corpus[0][0], corpus[0][1] + b"\n%calentamiento\n")})
+        for concurrencia in args.niveles:
+            nivel = await _nivel(client, corpus, concurrencia, args.duracion, pid, contador)
+            niveles.append(nivel)
+            print(f"[carga] c={concurrencia}: {nivel['throughput_rps']} rps · p95 {nivel['latencia_s']['p95']} s"
+                  f" · errores {nivel['tasa_error']} · RSS {nivel['memoria_mb']['fin']} MB", file=sys.stderr,
+                  flush=True)
+    return niveles
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--niveles", type=lambda s: [int(x) for x in s.split(",")], default=[1, 2, 4, 8],
+                        help="concurrencias a recorrer (1,2,4,8)")
+    parser.add_argument("--duracion", type=float, default=20.0, help="segundos por nivel (20)")
+    parser.add_argument("--docs", type=int, default=8, help="certificados del corpus sintético (8)")
+    parser.add_argument("--latencia", type=_parse_spec, default=_parse_spec("openai=0.5,adres=0.2,sispro=0.3,"
+                                                                            "busqueda=0.2"),
+                        help="segundos medios por servicio (openai=0.5,adres=0.2,sispro=0.3,busqueda=0.2)")
+    parser.add_argument("--fallas", type=_parse_spec, default={}, help="tasa de fallas por servicio (openai=0.02)")
+    parser.add_argument("--workers", type=int, default=1, help="workers de uvicorn (1)")
+    parser.add_argument("--timeout", type=float, default=300.0, help="timeout por petición en segundos (300)")
+    parser.add_argument("--con-cache", action="store_true", help="no desactivar las cachés de visión y registros")
+    parser.add_argument("--salida", type=Path, default=None, help="escribir el reporte JSON en este archivo")
+    parser.add_argument("--comparar", type=Path, default=None, help="reporte anterior para calcular diferencias")
+    args = parser.parse_args()
+
+    stand_ins = StandIns(args.latencia, args.fallas)
+    port = _free_port()
+    with tempfile.TemporaryDirectory() as tmp:
+        corpus = [(Path(p).name, Path(p).read_bytes()) for p in bench_payloads._corpus(Path(tmp), args.docs)]
+        env = dict(
+            os.environ,
+            OPENAI_BASE_URL=f"{stand_ins.url}/v1",
+            OPENAI_API_KEY="sk-bench",
+            FRAUDE_LLM_MODE="live",
+            FRAUDE_ADRES_URL=f"{stand_ins.url}/adres",
+            FRAUDE_RETHUS_URL=f"{stand_ins.url}/sispro",
+            FRAUDE_OSINT_URL=f"{stand_ins.url}/search",
+            FRAUDE_DATA_DIR=str(Path(tmp) / "data"),
+            FRAUDE_WORKERS=str(args.workers),
+            FRAUDE_LOG_CAPTURE_STDOUT="0",
+            CREWAI_DISABLE_TELEMETRY="true",
+            OTEL_SDK_DISABLED="true",
+            PYTHONPATH=os.pathsep.join(filter(None, [str(ROOT.parent / "src"), os.environ.get("PYTHONPATH")])),
+        )
+        env.setdefault("FRAUDE_OPENAI_TPM", "10000000")  # el límite lo pone el doble, no el planificador
+        if not args.con_cache:
+            for ns in ("VISION", "RETHUS", "ADRES", "OSINT"):
+                env[f"FRAUDE_CACHE_TTL_{ns}"] = "0"
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "fraude_incapacidades.api.server:app", "--host", "127.0.0.1",
+             "--port", str(port), "--workers", str(args.workers), "--log-level", "warning"],
+            env=env, cwd=str(ROOT.parent / "src"),
+        )
+        base_url = f"http://127.0.0.1:{port}"
+        try:
+            limite = time.monotonic() + 120
+            while True:
+                if server.poll() is not None:
+                    raise SystemExit(f"el servidor terminó al iniciar (código {server.returncode})")
+                try:
+                    httpx.get(base_url + "/", timeout=2)
+                    break
+                except httpx.HTTPError:
+                    if time.monotonic() > limite:
+                        raise SystemExit("el servidor no respondió en 120 s")
+                    time.sleep(0.5)
+            niveles = asyncio.run(_run(args, corpus, base_url, server.pid))
+        finally:
+            server.terminate()
+            try:
+                server.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+    stand_ins.server.shutdown()
+
+    reporte = {
+        "version": {"commit": _git_commit(), "python": platform.python_version(),
+                    "fecha": datetime.now().isoformat(timespec="seconds"), "cpus": os.cpu_count()},
+        "config": {"duracion_s": args.duracion, "docs": args.docs, "workers": args.workers,
+                   "latencia_s": args.latencia, "fallas": args.fallas, "cache": args.con_cache,
+                   "entorno": {k: v for k, v in os.environ.items() if k.startswith("FRAUDE_")}},
+        "niveles": niveles,
+        "dobles": stand_ins.conteo,
+    }
+    if args.comparar:
+        reporte["comparacion"] = _comparar(reporte, json.loads(args.comparar.read_text(encoding="utf-8")))
+    texto = json.dumps(reporte, ensure_ascii=False, indent=2)
+    if args.salida:
+        args.salida.write_text(texto + "\n", encoding="utf-8")
+    print(texto)
+
+
+if __name__ == "__main__":
+    main()
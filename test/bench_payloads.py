@@ -0,0 +1,221 @@
+"""
+Tokens de prompt por certificado y por etapa con payloads completos vs compactos.
+
+Ejecuta el Crew real (agentes, herramientas, contexto entre tareas) sobre un corpus
+de certificados, una vez con FRAUDE_PAYLOAD_MODE=full y otra con compact. OpenAI se
+reemplaza por un servidor local con guion: llama cada herramienta del agente una vez,
+responde en el formato que pide la tarea y reporta `usage.prompt_tokens` estimado a
+partir del tamaño real de cada petición (~4 caracteres por token).
+
+    cd src && PYTHONPATH=. python ../test/bench_payloads.py --docs 4
+
+Imprime un JSON con tokens de prompt promedio por certificado y etapa en cada modo y
+la reducción porcentual.
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import fitz  # PyMuPDF
+
+ROOT = Path(__file__).resolve().parent
+
+_EXTRACCION = {
+    "logo_detectado": "EPS Sura", "paciente_nombre": "Paciente Prueba", "paciente_cedula": "1000000",
+    "medico_nombre": "Ana Médica", "medico_cedula": "52000000", "medico_registro": "RM-1234",
+    "eps_o_ips": "EPS Sura", "codigo_cie10": "J06", "diagnostico_texto": "Infección respiratoria aguda",
+    "dias_incapacidad": 3, "fecha_inicio": "2024-01-01", "fecha_fin": "2024-01-03",
+    "tiene_firma": True, "tiene_sello": True, "evaluacion_visual": "Formato institucional consistente.",
+}
+
+_ARGS = {
+    "file_path": lambda ctx: ctx["pdf"],
+    "input_data": lambda ctx: json.dumps(ctx["input_data"], ensure_ascii=False),
+    "eps_name": lambda ctx: _EXTRACCION["eps_o_ips"],
+    "query": lambda ctx: _EXTRACCION["eps_o_ips"],
+}
+
+
+def _input_data(function_name: str) -> dict:
+    if "cie" in function_name:
+        return {"codigo": _EXTRACCION["codigo_cie10"], "diagnostico_texto": _EXTRACCION["diagnostico_texto"],
+                "dias_incapacidad": _EXTRACCION["dias_incapacidad"]}
+    if "rethus" in function_name:
+        return {"tipo_documento": "CC", "numero_documento": _EXTRACCION["medico_cedula"]}
+    return {"tipo_documento": "CC", "numero_documento": _EXTRACCION["paciente_cedula"]}
+
+
+def _final_answer(tools: list[str], compact: bool) -> str:
+    """Respuesta final de la tarea en el formato que pide su expected_output."""
+    if any("pdf" in name for name in tools):
+        data = {"datos": {k: v for k, v in _EXTRACCION.items() if k != "evaluacion_visual"},
+                "cie10": {"valido": True, "coherente_dias": True, "rango": "1-5"},
+                "evaluacion_visual": _EXTRACCION["evaluacion_visual"],
+                "alertas_forenses": [], "positivos": ["datos completos", "logo presente", "CIE válido"],
+                "negativos": []}
+    elif tools:
+        data = {"eps": {"resultado": "EPS válida", "penaliza": False},
+                "rethus": {"resultado": "no verificable (módulo no disponible)", "penaliza": False},
+                "adres": {"resultado": "no verificable (módulo no disponible)", "penaliza": False},
+                "osint": {"resultado": "sin resultados", "penaliza": False}}
+    else:
+        return json.dumps({"puntaje_veracidad": 85, "hallazgos_medicos": "CIE-10 coherente con los días.",
+                           "analisis_forense": "Sin alertas.", "verificacion_entidades": "EPS válida.",
+                           "alertas": [], "veredicto": "Válida"}, ensure_ascii=False)
+    if compact:
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    # Sin formato compacto gpt-4o suele devolver el reporte como JSON indentado en un bloque markdown
+    return "```json\n" + json.dumps(data, ensure_ascii=False, indent=2) + "\n```"
+
+
+def _reply(payload: dict) -> dict:
+    messages = payload.get("messages", [])
+    images, text = 0, 0
+    for message in messages:  # cada imagen cuenta como ~765 tokens (detalle alto, 4 teselas)
+        if isinstance(message.get("content"), list):
+            images += sum(part.get("type") == "image_url" for part in message["content"])
+            message = dict(message, content=[p for p in message["content"] if p.get("type") != "image_url"])
+        text += len(json.dumps(message, ensure_ascii=False))
+    prompt_tokens = (text + len(json.dumps(payload.get("tools", []), ensure_ascii=False))) // 4 + 765 * images
+    if not payload.get("tools") and any(
+        isinstance(m.get("content"), list) for m in messages  # visión: páginas como imágenes
+    ):
+        message = {"role": "assistant", "content": json.dumps(_EXTRACCION, ensure_ascii=False)}
+    else:
+        tools = [t["function"]["name"] for t in payload.get("tools", [])]
+        called = {c["function"]["name"] for m in messages for c in (m.get("tool_calls") or [])}
+        pending = [name for name in tools if name not in called]
+        prompt = " ".join(str(m.get("content") or "") for m in messages)
+        if pending:
+            name = pending[0]
+            params = next(t["function"].get("parameters", {}) for t in payload["tools"]
+                          if t["function"]["name"] == name).get("properties", {})
+            pdf = re.search(r"\S+\.pdf", prompt)
+            ctx = {"pdf": pdf.group().strip("'\"`") if pdf else "", "input_data": _input_data(name.lower())}
+            args = {p: _ARGS[p](ctx) for p in params if p in _ARGS}
+            message = {"role": "assistant", "content": None, "tool_calls": [
+                {"id": f"call_{len(called)}", "type": "function",
+                 "function": {"name": name, "arguments": json.dumps(args, ensure_ascii=False)}}]}
+        else:
+            message = {"role": "assistant",
+                       "content": _final_answer([t.lower() for t in tools], "SOLO un JSON minificado" in prompt)}
+    completion_tokens = len(message.get("content") or json.dumps(message.get("tool_calls"))) // 4
+    return {
+        "id": "bench", "object": "chat.completion", "created": 0, "model": payload.get("model", "gpt-4o"),
+        "choices": [{"index": 0, "finish_reason": "tool_calls" if message.get("tool_calls") else "stop",
+                     "message": message}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+
+def _fake_openai() -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers.get("content-length", 0))) or b"{}")
+            body = json.dumps(_reply(payload), ensure_ascii=False).encode()
+            self.send_response(200)
+            self.send_header("content-type", "application/json")
+            self.send_header("content-length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _corpus(directory: Path, n: int) -> list[str]:
+    paths = [str(ROOT / "ejemplo_incapacidad.pdf")] if (ROOT / "ejemplo_incapacidad.pdf").exists() else []
+    for i in range(max(0, n - len(paths))):
+        doc = fitz.open()
+        page = doc.new_page()
+        page.insert_text((72, 72), "CERTIFICADO DE INCAPACIDAD", fontsize=16)
+        page.insert_text((72, 110), f"Paciente: Paciente {i}  C.C. {1000000 + i}")
+        page.insert_text((72, 130), f"Diagnostico CIE-10: J06  Dias de incapacidad: {1 + i % 5}")
+        path = directory / f"cert_{i:04d}.pdf"
+        doc.save(str(path))
+        paths.append(str(path))
+    return paths[:n]
+
+
+def _run_mode(pdfs: list[str]) -> dict:
+    """Corre el Crew sobre el corpus (en este proceso) y promedia los tokens por etapa."""
+    from fraude_incapacidades.crew import build_crew
+    from fraude_incapacidades.llm.usage import token_ledger
+
+    etapas: dict[str, dict] = {}
+    for pdf in pdfs:
+        with token_ledger() as ledger:
+            build_crew().kickoff(inputs={"file_path": pdf})
+        for name, usage in ledger.resumen()["etapas"].items():
+            acc = etapas.setdefault(name, {"llamadas": 0, "prompt_tokens": 0, "contexto_tokens": 0})
+            for key in acc:
+                acc[key] += usage[key]
+    n = len(pdfs)
+    etapas = {name: {k: round(v / n, 1) for k, v in acc.items()} for name, acc in etapas.items()}
+    total = round(sum(e["prompt_tokens"] for e in etapas.values()), 1)
+    return {"etapas": etapas, "prompt_tokens_por_certificado": total}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--docs", type=int, default=4)
+    parser.add_argument("--modo", choices=("full", "compact"), help=argparse.SUPPRESS)
+    parser.add_argument("--pdfs", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.modo:  # proceso hijo: un modo por proceso (el modo se lee al construir el Crew)
+        print("\n" + json.dumps(_run_mode(json.loads(args.pdfs))))
+        return
+
+    server = _fake_openai()
+    resultados = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        pdfs = _corpus(Path(tmp), args.docs)
+        for modo in ("full", "compact"):
+            env = dict(
+                os.environ,
+                OPENAI_BASE_URL=f"http://127.0.0.1:{server.server_address[1]}/v1",
+                OPENAI_API_KEY="sk-bench",
+                FRAUDE_LLM_MODE="live",
+                FRAUDE_PAYLOAD_MODE=modo,
+                FRAUDE_DATA_DIR=str(Path(tmp) / f"data_{modo}"),
+                FRAUDE_LOG_CAPTURE_STDOUT="0",
+                CREWAI_DISABLE_TELEMETRY="true",
+                OTEL_SDK_DISABLED="true",
+            )
+            out = subprocess.run(
+                [sys.executable, __file__, "--modo", modo, "--pdfs", json.dumps(pdfs)],
+                env=env, capture_output=True, text=True, check=True,
+            ).stdout
+            resultados[modo] = json.loads(out.strip().splitlines()[-1])
+    server.shutdown()
+
+    full = resultados["full"]["prompt_tokens_por_certificado"]
+    compact = resultados["compact"]["prompt_tokens_por_certificado"]
+    resultados["reduccion_pct"] = round(100 * (1 - compact / full), 1) if full else None
+    resultados["reduccion_por_etapa_pct"] = {
+        name: round(100 * (1 - resultados["compact"]["etapas"].get(name, {}).get("prompt_tokens", 0)
+                           / stage["prompt_tokens"]), 1)
+        for name, stage in resultados["full"]["etapas"].items() if stage["prompt_tokens"]
+    }
+    json.dump({"documentos": len(pdfs), **resultados}, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Prueba de carga del modelo multi-proceso: extracción forense de N certificados
+repartidos en pools de 1, 2 y 4 procesos que comparten las cachés SQLite.
+
+OpenAI se reemplaza por un servidor local con latencia fija (no se gasta cuota); el
+resto del pipeline (render, pHash, plantillas, caché de visión) es el real.
+
+    cd src && PYTHONPATH=. python ../test/bench_workers.py --docs 24 --latency 0.3
+
+Imprime un JSON con documentos/segundo por número de workers. La mejora esperada es
+casi lineal mientras la latencia de OpenAI domine; con pocos núcleos el render de
+páginas la limita.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import fitz  # PyMuPDF
+
+_RESPUESTA = {
+    "paciente_nombre": "Paciente Prueba",
+    "paciente_cedula": "1000000",
+    "fecha_inicio": "2024-01-01",
+    "fecha_fin": "2024-01-03",
+    "dias_incapacidad": 3,
+}
+
+
+def _fake_openai(latency: float) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("content-length", 0)))
+            time.sleep(latency)
+            body = json.dumps({
+                "id": "bench", "object": "chat.completion", "created": 0, "model": "gpt-4o",
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": json.dumps(_RESPUESTA)}}],
+                "usage": {"prompt_tokens": 800, "completion_tokens": 60, "total_tokens": 860},
+            }).encode()
+            self.send_response(200)
+            self.send_header("content-type", "application/json")
+            self.send_header("content-length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _make_pdfs(directory: Path, n: int) -> list[str]:
+    paths = []
+    for i in range(n):
+        doc = fitz.open()
+        page = doc.new_page()
+        page.insert_text((72, 72), "CERTIFICADO DE INCAPACIDAD", fontsize=16)
+        page.insert_text((72, 110), f"Paciente: Paciente {i}  C.C. {1000000 + i}")
+        page.insert_text((72, 130), f"Diagnostico CIE-10: J0{i % 10}  Dias de incapacidad: {1 + i % 7}")
+        page.draw_rect(fitz.Rect(72, 160 + i % 50, 300, 260), color=(0, 0, 0.6), fill=(0.9, 0.9, 1))
+        path = directory / f"cert_{i:04d}.pdf"
+        doc.save(str(path))
+        paths.append(str(path))
+    return paths
+
+
+def _extract(path: str) -> bool:
+    from fraude_incapacidades.tools.ocr_tool import PDFForensicExtractTool
+
+    result = json.loads(PDFForensicExtractTool()._run(path))
+    return "error" not in result
+
+
+def _run_pool(workers: int, pdfs: list[str], data_dir: Path) -> dict:
+    os.environ["FRAUDE_DATA_DIR"] = str(data_dir)
+    os.environ["FRAUDE_WORKERS"] = str(workers)
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        list(pool.map(_extract, pdfs[:workers]))  # calentamiento: importaciones por proceso
+        start = time.perf_counter()
+        ok = sum(pool.map(_extract, pdfs[workers:]))
+        elapsed = time.perf_counter() - start
+    docs = len(pdfs) - workers
+    return {
+        "workers": workers,
+        "documentos": docs,
+        "ok": ok,
+        "segundos": round(elapsed, 2),
+        "docs_por_s": round(docs / elapsed, 2) if elapsed else None,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--docs", type=int, default=24)
+    parser.add_argument("--latency", type=float, default=0.3, help="latencia simulada de OpenAI (s)")
+    parser.add_argument("--workers", default="1,2,4")
+    args = parser.parse_args()
+
+    server = _fake_openai(args.latency)
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+    os.environ["FRAUDE_LLM_MODE"] = "live"
+    os.environ["FRAUDE_LOG_CAPTURE_STDOUT"] = "0"
+
+    resultados = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for workers in (int(w) for w in args.workers.split(",")):
+            run_dir = Path(tmp) / f"w{workers}"
+            (run_dir / "pdfs").mkdir(parents=True)
+            pdfs = _make_pdfs(run_dir / "pdfs", args.docs + workers)
+            resultados.append(_run_pool(workers, pdfs, run_dir / "data"))
+    server.shutdown()
+
+    base = resultados[0]["docs_por_s"] or 1
+    for r in resultados:
+        r["aceleracion"] = round((r["docs_por_s"] or 0) / base, 2)
+    json.dump({"cpus": os.cpu_count(), "latencia_s": args.latency, "resultados": resultados},
+              sys.stdout, ensure_ascii=False, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
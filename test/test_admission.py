@@ -0,0 +1,143 @@
+"""
+Control de admisión (api/admission.py): carriles, turnos entre clientes, cuotas, colas
+acotadas, Retry-After y retención del cupo por un análisis que sigue en su hilo.
+
+    python -m pytest test/test_admission.py
+"""
+
+import asyncio
+
+import pytest
+
+from fraude_incapacidades.api.admission import BATCH, INTERACTIVE, AdmissionController, Lane, Overloaded
+
+
+def _controller(cupos=1, lote=1, cola=8, cuota=4, servicio=10.0):
+    return AdmissionController(cupos, {
+        INTERACTIVE: Lane(INTERACTIVE, cupos, cola, cuota, servicio),
+        BATCH: Lane(BATCH, lote, cola, cuota, servicio),
+    })
+
+
+def test_un_solo_cupo_queda_reservado_a_la_carga_interactiva(monkeypatch):
+    monkeypatch.setenv("FRAUDE_WORKER_CONCURRENCY", "1")
+    monkeypatch.delenv("FRAUDE_ADMISION_CUPOS_LOTE", raising=False)
+    ctl = AdmissionController.from_env()
+    assert ctl.lanes[BATCH].max_activos == 0
+    with pytest.raises(Overloaded) as e:
+        ctl.admit(BATCH, "auditor")
+    assert e.value.motivo == "sin_cupos"
+
+    monkeypatch.setenv("FRAUDE_ADMISION_CUPOS_LOTE", "1")
+    assert AdmissionController.from_env().lanes[BATCH].max_activos == 1
+
+    monkeypatch.setenv("FRAUDE_WORKER_CONCURRENCY", "4")
+    monkeypatch.delenv("FRAUDE_ADMISION_CUPOS_LOTE")
+    assert AdmissionController.from_env().lanes[BATCH].max_activos == 3
+
+
+def test_la_cola_interactiva_pasa_antes_que_el_lote():
+    async def main():
+        ctl = _controller()
+        orden = []
+        primero = ctl.admit(INTERACTIVE, "a")
+
+        async def correr(ticket, nombre):
+            async with ticket:
+                orden.append(nombre)
+
+        async with primero:
+            tareas = [asyncio.create_task(correr(ctl.admit(BATCH, "b"), "lote")),
+                      asyncio.create_task(correr(ctl.admit(INTERACTIVE, "c"), "interactiva"))]
+            await asyncio.sleep(0)
+        await asyncio.gather(*tareas)
+        return orden, ctl.activos
+
+    assert asyncio.run(main()) == (["interactiva", "lote"], 0)
+
+
+def test_turnos_entre_clientes_del_mismo_carril():
+    async def main():
+        ctl = _controller()
+        orden = []
+        ocupado = ctl.admit(INTERACTIVE, "x")
+
+        async def correr(ticket):
+            async with ticket:
+                orden.append(ticket.cliente)
+
+        async with ocupado:
+            tareas = [asyncio.create_task(correr(ctl.admit(INTERACTIVE, c))) for c in ("a", "a", "a", "b", "c")]
+            await asyncio.sleep(0)
+        await asyncio.gather(*tareas)
+        return orden
+
+    assert asyncio.run(main()) == ["a", "b", "c", "a", "a"]
+
+
+def test_cuota_por_cliente_y_cola_llena():
+    async def main():
+        ctl = _controller(cola=2, cuota=2)
+        ctl.admit(INTERACTIVE, "a")
+        ctl.admit(INTERACTIVE, "a")
+        with pytest.raises(Overloaded) as cuota:
+            ctl.admit(INTERACTIVE, "a")
+        ctl.admit(INTERACTIVE, "b")
+        with pytest.raises(Overloaded) as llena:
+            ctl.admit(INTERACTIVE, "c")
+        return cuota.value.motivo, llena.value.motivo, ctl.stats()["carriles"][INTERACTIVE]
+
+    cuota, llena, stats = asyncio.run(main())
+    assert (cuota, llena) == ("cuota_cliente", "cola_llena")
+    assert stats["en_cola"] == 2 and stats["rechazadas"] == {"cuota_cliente": 1, "cola_llena": 1}
+
+
+def test_retry_after_sigue_la_tasa_de_servicio():
+    ctl = _controller(servicio=10.0)
+    interactiva, lote = ctl.lanes[INTERACTIVE], ctl.lanes[BATCH]
+    assert ctl.retry_after(interactiva) == 10
+    assert ctl.retry_after(interactiva, adelante=3) == 30
+    interactiva.observe(30.0)
+    assert interactiva.servicio_s == pytest.approx(14.0)
+
+    async def main():
+        ctl.admit(INTERACTIVE, "a")
+        ctl.admit(INTERACTIVE, "b")  # en cola: el lote la tiene por delante
+        return ctl.retry_after(lote)
+
+    assert asyncio.run(main()) == 20
+
+
+def test_cancelar_en_cola_devuelve_el_lugar():
+    async def main():
+        ctl = _controller()
+        activo = ctl.admit(INTERACTIVE, "a")
+        await activo.__aenter__()
+        espera = ctl.admit(INTERACTIVE, "b")
+        espera.cancel()
+        await activo.__aexit__(None, None, None)
+        return ctl.stats()["carriles"][INTERACTIVE]
+
+    stats = asyncio.run(main())
+    assert stats["activos"] == 0 and stats["en_cola"] == 0 and stats["clientes"] == 0
+
+
+def test_hold_until_retiene_el_cupo_hasta_que_termina_el_hilo():
+    async def main():
+        ctl = _controller()
+        liberar = asyncio.Event()
+        ticket = ctl.admit(INTERACTIVE, "a")
+        async with ticket:
+            tarea = asyncio.ensure_future(liberar.wait())
+            ticket.hold_until(tarea)
+        retenido = ctl.activos
+        siguiente = ctl.admit(INTERACTIVE, "b")
+        assert siguiente.future is not None and not siguiente.future.done()
+        liberar.set()
+        await tarea
+        await asyncio.sleep(0)
+        async with siguiente:
+            pass
+        return retenido, ctl.activos
+
+    assert asyncio.run(main()) == (1, 0)
@@ -0,0 +1,70 @@
+"""
+Calibración de la cascada (cascade.py): la etapa local se ajusta con la evidencia que
+produce en ejecución (capa de texto, sin historial), no con los datos de la visión.
+
+    python -m pytest test/test_cascade.py
+"""
+
+import pytest
+
+from fraude_incapacidades import cascade
+from fraude_incapacidades.storage import history
+
+TEXTO = "EPS SURA\nCertificado de incapacidad\nCIE-10: A09\nDías de incapacidad: 3\n"
+
+
+def _extraccion(**extra):
+    return {
+        "datos_estructurados": {"paciente_nombre": "Ana Pérez", "paciente_cedula": "1012345",
+                                "medico_nombre": "Luis Gómez", "codigo_cie10": "J45", "tiene_firma": True,
+                                "tiene_sello": True, "eps_o_ips": "NUEVA EPS"},
+        "hallazgos_forenses": {
+            "alertas_forenses_automaticas": ["⚠️ Incapacidad SUPERPUESTA: el paciente ya tiene otra."],
+            "historial_paciente": {"periodos": 2},
+        },
+        "plantilla_conocida": None,
+        "paginas_analizadas_por_vision": 1,
+        **extra,
+    }
+
+
+def test_evidencia_local_sale_de_la_capa_de_texto():
+    evidencia = cascade._local_evidence(_extraccion(texto_capa=TEXTO))
+    datos = evidencia["datos_estructurados"]
+    assert datos["codigo_cie10"] == "A09" and datos["dias_incapacidad"] == 3
+    assert "paciente_nombre" not in datos and "tiene_firma" not in datos
+    assert evidencia["hallazgos_forenses"]["historial_paciente"] is None
+    assert "historial_superpuesto" not in {s.clave for s in cascade.signals(evidencia, "local")}
+
+
+def test_sin_capa_de_texto_o_con_plantilla_no_hay_muestra_local():
+    assert cascade._local_evidence(_extraccion()) is None
+    plantilla = _extraccion(texto_capa=TEXTO, plantilla_conocida={"nombre": "SURA"}, paginas_analizadas_por_vision=0)
+    assert cascade._local_evidence(plantilla) is None
+
+
+def test_calibrate_usa_la_evidencia_local(tmp_path, monkeypatch):
+    filas = []
+    for i in range(30):
+        valida = i % 2 == 0
+        texto = TEXTO if valida else "Certificado\n"
+        filas.append((_extraccion(texto_capa=texto), "Válida" if valida else "Fraudulenta", None))
+    filas.append((_extraccion(), "Válida", None))  # extracción antigua: solo cuenta para visión
+    filas.append((_extraccion(texto_capa=TEXTO), "Válida", {"cascada": {"etapa_final": "local"}}))
+
+    class Store:
+        def iter_labeled(self):
+            return iter(filas)
+
+    monkeypatch.setattr(history, "get_history_store", lambda: Store())
+    monkeypatch.setattr(cascade, "_calibration_path", lambda: tmp_path / "calibracion.json")
+    resumen = cascade.calibrate(min_samples=20)
+    assert resumen["muestras"] == {"local": 30, "vision": 31}
+    assert resumen["etapas"]["local"]["calibrada"] is True
+    # Solo la capa de texto separa las clases: la pendiente local sale positiva
+    assert resumen["etapas"]["local"]["a"] > 0
+
+
+@pytest.mark.parametrize("texto,esperado", [("NUEVA EPS", "NUEVA EPS"), ("", None)])
+def test_text_layer_data_eps(texto, esperado):
+    assert cascade._text_layer_data(texto).get("eps_o_ips") == esperado
@@ -0,0 +1,66 @@
+"""
+Coherencia diagnóstico escrito / código CIE-10 (diagnosis.py): niveles coherente,
+discrepante y sin_datos, abreviaturas en su código, caída a la categoría y consulta en
+lote igual a la individual.
+
+    python -m pytest test/test_diagnosis.py
+"""
+
+import pytest
+
+from fraude_incapacidades import diagnosis
+from fraude_incapacidades.diagnosis import check_diagnosis, similarity_batch
+
+
+@pytest.fixture(autouse=True)
+def indice(tmp_path, monkeypatch):
+    monkeypatch.setattr(diagnosis, "_index_root", lambda: tmp_path / "cie10_indice")
+    monkeypatch.delenv("FRAUDE_CIE10_CATALOGO", raising=False)
+    diagnosis._index_for.cache_clear()
+    yield
+    diagnosis._index_for.cache_clear()
+
+
+@pytest.mark.parametrize("texto,codigo", [
+    ("lumbalgia", "M54.5"),
+    ("Lumbalgía mecánica", "M54"),
+    ("IVU", "N39.0"),  # subcategoría fuera del catálogo embebido: cae a N39
+    ("cistitis", "N30"),
+    ("EDA", "A09"),
+    ("IRA", "J06.9"),
+    ("HTA", "I10"),
+])
+def test_coherente(texto, codigo):
+    assert check_diagnosis(texto, codigo).nivel == "coherente"
+
+
+def test_discrepante():
+    match = check_diagnosis("esguince de tobillo", "J06")
+    assert match.nivel == "discrepante"
+    assert match.plausibles[0]["codigo"] == "S93"
+    assert "S93" in match.alerta()["detalle"]
+    assert check_diagnosis("lumbalgia", "M54.5").alerta() is None
+
+
+@pytest.mark.parametrize("texto,codigo", [
+    (None, "J06"),
+    ("   ", "J06"),
+    ("lumbalgia", "Z99"),  # código fuera del catálogo
+    ("xqzw", "J06"),  # texto que no se parece a ningún código
+])
+def test_sin_datos(texto, codigo):
+    assert check_diagnosis(texto, codigo).nivel == "sin_datos"
+
+
+def test_lote_igual_a_la_consulta_individual():
+    pares = [("lumbalgia", "M54.5"), ("IVU", "N39.0"), ("esguince de tobillo", "J06"), ("", "A09"),
+             ("lumbalgia", "J06"), ("dengue", "A90"), ("xqzw", "J06"), ("migraña", "Z99"), ("IVU", "N39.0")]
+    textos, codigos = [t for t, _ in pares], [c for _, c in pares]
+    index = diagnosis.get_index()
+    lote = list(diagnosis._matches(textos, codigos, similarity_batch(textos, codigos, index=index), index))
+    for (texto, codigo), en_lote in zip(pares, lote):
+        individual = check_diagnosis(texto, codigo)
+        assert en_lote.nivel == individual.nivel
+        assert en_lote.similitud == individual.similitud
+        if texto.strip():
+            assert en_lote.plausibles == individual.plausibles
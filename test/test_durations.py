@@ -0,0 +1,110 @@
+"""
+Distribución de días por código CIE-10 (storage/durations.py): error de los buckets,
+fusión, percentiles, caída a la categoría de 3 caracteres, qué certificados enseñan y
+sincronización por versión entre workers.
+
+    python -m pytest test/test_durations.py
+"""
+
+import random
+
+import numpy as np
+import pytest
+
+from fraude_incapacidades.storage import durations
+from fraude_incapacidades.storage.durations import (
+    ALPHA, BUCKETS, MAX_DIAS, DurationSketch, DurationStore, bucket, bucket_value, duration_keys,
+)
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setenv("FRAUDE_DURACION_REFRESCO_S", "0")
+    monkeypatch.setenv("FRAUDE_DURACION_MIN_MUESTRAS", "5")
+    st = DurationStore(tmp_path / "duraciones.sqlite")
+    monkeypatch.setattr(durations, "_store", st)
+    return st
+
+
+def test_error_relativo_de_los_buckets():
+    for dias in range(1, MAX_DIAS + 1):
+        assert abs(bucket_value(bucket(dias)) - dias) / dias <= ALPHA + 1e-9
+    # Exacto para duraciones cortas: cada bucket tiene un solo entero
+    assert [round(bucket_value(bucket(d))) for d in range(1, 26)] == list(range(1, 26))
+    assert bucket(10_000) == BUCKETS - 1 and bucket(0) == 0
+
+
+def test_merge_equivale_a_agregar_todo():
+    rng = random.Random(1)
+    a_vals = [rng.randint(1, 60) for _ in range(300)]
+    b_vals = [rng.randint(1, 200) for _ in range(200)]
+    a, b, todo = DurationSketch(), DurationSketch(), DurationSketch()
+    for v in a_vals:
+        a.add(v)
+        todo.add(v)
+    for v in b_vals:
+        b.add(v)
+        todo.add(v)
+    assert list(a.merge(b).conteos) == list(todo.conteos)
+    assert a.count == 500
+    assert list(DurationSketch.from_bytes(a.to_bytes()).conteos) == list(a.conteos)
+    assert DurationSketch.from_bytes(b"\x00" * 8).count == 0  # otro formato: se descarta
+
+
+def test_cuantiles_y_percentil_contra_numpy():
+    rng = np.random.default_rng(2)
+    valores = np.clip(np.round(rng.lognormal(2.0, 0.8, 5000)), 1, MAX_DIAS)
+    sketch = DurationSketch()
+    for v in valores:
+        sketch.add(v)
+    for q in (0.5, 0.9, 0.95):
+        exacto = np.quantile(valores, q, method="lower")
+        assert abs(sketch.quantile(q) - exacto) / exacto <= ALPHA + 1e-9
+    for dias in (3, 7, 15, 25):  # exacto: un entero por bucket
+        esperado = 100 * (np.sum(valores < dias) + np.sum(valores == dias) / 2) / len(valores)
+        assert sketch.percentile(dias) == pytest.approx(esperado, abs=0.01)
+    # Más arriba el bucket agrupa varios días: el percentil queda entre los de sus extremos
+    assert 100 * np.mean(valores < 39) <= sketch.percentile(40) <= 100 * np.mean(valores <= 41)
+    assert DurationSketch().quantile(0.5) is None and DurationSketch().percentile(3) is None
+
+
+def test_claves_del_codigo_y_su_categoria():
+    assert duration_keys("j45.0") == ["J450", "J45"]
+    assert duration_keys("A09") == ["A09"]
+    assert duration_keys("") == [] and duration_keys(None) == []
+
+
+def test_codigo_sin_muestras_usa_la_categoria(store):
+    for i in range(6):
+        store.add(f"cat{i}", "M54.5" if i < 2 else "M54.2", 5 + i)
+    clave, sketch = store.lookup("M54.5")
+    assert clave == "M54" and sketch.count == 6
+    for i in range(5):
+        store.add(f"cod{i}", "M54.5", 3)
+    assert store.lookup("M54.5")[0] == "M545"
+    assert store.lookup("Z99") is None
+    assert not store.add("cod0", "M54.5", 3)  # un documento cuenta una sola vez
+
+
+def test_aprende_todo_salvo_lo_que_fallo_por_la_duracion(store):
+    for i in range(20):
+        assert durations.learn(f"v{i}", {"codigo_cie10": "J06", "dias_incapacidad": 2 + i % 2}, "Válida")
+    # Sospechoso por otra razón y con días habituales: enseña
+    assert durations.learn("s1", {"codigo_cie10": "J06", "dias_incapacidad": 3}, "Sospechosa")
+    # Fraudulento con días en exceso: no enseña
+    assert not durations.learn("f1", {"codigo_cie10": "J06", "dias_incapacidad": 60}, "Fraudulenta")
+    # Válido con días en exceso: enseña (la distribución puede moverse)
+    assert durations.learn("v99", {"codigo_cie10": "J06", "dias_incapacidad": 60}, "Válida")
+    assert store.get("J06").count == 22
+
+
+def test_sincroniza_por_version_no_por_hora(store, tmp_path, monkeypatch):
+    otro = DurationStore(tmp_path / "duraciones.sqlite")
+    store.add("a", "A09", 3)
+    assert otro.get("A09").count == 1
+    # Un worker con el reloj atrasado (o que confirma tarde) escribe con hora anterior
+    monkeypatch.setattr(durations.time, "time", lambda: 0.0)
+    store.add("b", "A09", 4)
+    assert otro.get("A09").count == 2
+    store.replace_all({"A09": DurationSketch().add(5)}, {"c"})
+    assert otro.get("A09").count == 1
@@ -0,0 +1,127 @@
+"""
+Índice de periodos de incapacidad (storage/intervals.py): treap de intervalos contra
+fuerza bruta, construcción balanceada, reconstrucción desde SQLite, alertas de
+solapamiento y cadena, y registro del periodo cuando la cascada se detiene en la etapa local.
+
+    python -m pytest test/test_intervals.py
+"""
+
+import random
+from datetime import date
+
+import pytest
+
+from fraude_incapacidades import cascade
+from fraude_incapacidades.storage import intervals
+from fraude_incapacidades.storage.intervals import IncapacidadIntervalIndex, IntervalTree, parse_fecha
+
+
+def _intervalos(n, rng):
+    out = []
+    for key in range(n):
+        inicio = rng.randint(0, 1000)
+        out.append((inicio, inicio + rng.randint(0, 30), key, (f"doc{key}",)))
+    return out
+
+
+def _ids(nodos):
+    return sorted(n.key for n in nodos)
+
+
+def _altura(node):
+    return 0 if node is None else 1 + max(_altura(node.left), _altura(node.right))
+
+
+def _es_treap(node):
+    if node is None:
+        return True
+    for hijo in (node.left, node.right):
+        if hijo is not None and hijo.prio > node.prio:
+            return False
+    return _es_treap(node.left) and _es_treap(node.right)
+
+
+def test_overlapping_igual_a_fuerza_bruta():
+    rng = random.Random(3)
+    items = _intervalos(500, rng)
+    tree = IntervalTree()
+    for s, e, k, d in items:
+        tree.insert(s, e, k, d)
+    for _ in range(200):
+        lo = rng.randint(-10, 1040)
+        hi = lo + rng.randint(0, 40)
+        assert _ids(tree.overlapping(lo, hi)) == sorted(k for s, e, k, _ in items if s <= hi and e >= lo)
+
+
+def test_from_sorted_balanceado_y_valido_para_insertar():
+    rng = random.Random(5)
+    items = sorted(_intervalos(1023, rng))
+    tree = IntervalTree.from_sorted(items)
+    assert tree.size == 1023 and _altura(tree.root) == 10 and _es_treap(tree.root)
+    tree.insert(500, 520, 5000, ("nuevo",))
+    assert _es_treap(tree.root)
+    esperados = sorted(k for s, e, k, _ in items + [(500, 520, 5000, None)] if s <= 510 and e >= 505)
+    assert _ids(tree.overlapping(505, 510)) == esperados
+    assert IntervalTree.from_sorted([]).root is None
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    idx = IncapacidadIntervalIndex(tmp_path / "periodos.sqlite")
+    monkeypatch.setattr(intervals, "_index", idx)
+    return idx
+
+
+def _datos(cedula, inicio, dias, medico="900"):
+    return {"paciente_cedula": cedula, "fecha_inicio": inicio, "dias_incapacidad": dias, "medico_cedula": medico}
+
+
+def test_superpuesta_con_otro_medico_y_cadena(index, monkeypatch):
+    monkeypatch.setenv("FRAUDE_CADENA_MIN_CERTIFICADOS", "3")
+    assert intervals.check_and_register("a", "a.pdf", _datos("1.012.345", "01/09/2025", 5))[1] == []
+    _, alertas = intervals.check_and_register("b", "b.pdf", _datos("1012345", "2025-09-04", 3, medico="901"))
+    assert any("SUPERPUESTA" in a for a in alertas)
+    historial, alertas = intervals.check_and_register("c", "c.pdf", _datos("1012345", "7 de septiembre de 2025", 2))
+    assert any("Cadena ininterrumpida de 3" in a for a in alertas)
+    assert historial["cadena"]["fecha_inicio"] == "2025-09-01"
+    # Otro paciente no genera alertas; el mismo documento no se compara consigo mismo ni se duplica
+    assert intervals.check_and_register("d", "d.pdf", _datos("999", "2025-09-02", 3))[1] == []
+    assert intervals.check_and_register("a", "a.pdf", _datos("1012345", "01/09/2025", 5))[1] != []
+    assert len(index) == 4
+
+
+def test_rebuild_y_bulk_import(index, tmp_path):
+    registros = [dict(_datos("555", f"2025-01-{d:02d}", 1), doc_id=f"doc{d}", archivo=f"{d}.pdf") for d in range(1, 11)]
+    registros.append({"doc_id": "sin_fecha", "paciente_cedula": "555"})
+    assert index.bulk_import(registros) == 10
+    otro = IncapacidadIntervalIndex(tmp_path / "periodos.sqlite")
+    otro.rebuild()
+    consulta = otro.query("555", date(2025, 1, 3), date(2025, 1, 4), gap_dias=0)
+    assert sorted(p.doc_id for p, _ in consulta) == ["doc3", "doc4"]
+    inicio, fin, cadena = otro.chain("555", date(2025, 1, 5), date(2025, 1, 5))
+    assert (inicio, fin, len(cadena)) == (date(2025, 1, 1), date(2025, 1, 10), 10)
+
+
+def test_parse_fecha():
+    assert parse_fecha("martes 02 de\nseptiembre de 2025") == date(2025, 9, 2)
+    assert parse_fecha("1-9-25") == date(2025, 9, 1)
+    assert parse_fecha("31/02/2025") is None
+
+
+def test_etapa_local_registra_el_periodo(index):
+    texto = ("EPS SURA\nAfiliado\nCC - 1035224592 JUAN PEREZ\nFecha Inicio\nMARTES 02 DE\nSEPTIEMBRE DE 2025\n"
+             "Fecha Fin\nJUEVES 04 DE\nSEPTIEMBRE DE 2025\nProfesional Responsable\nCC - 1140882096 MARCELA DURAN\n")
+    datos = cascade._text_layer_data(texto)
+    assert datos["paciente_cedula"] == "1035224592" and datos["medico_cedula"] == "1140882096"
+    assert (datos["fecha_inicio"], datos["fecha_fin"]) == ("2025-09-02", "2025-09-04")
+
+    evidencia, con_alertas = cascade._register_period("x", "x.pdf", {"datos_estructurados": datos,
+                                                                     "hallazgos_forenses": {}})
+    assert not con_alertas and evidencia["hallazgos_forenses"]["historial_paciente"] is not None
+    otro = dict(datos, medico_cedula="777")
+    evidencia, con_alertas = cascade._register_period("y", "y.pdf", {"datos_estructurados": otro,
+                                                                     "hallazgos_forenses": {}})
+    assert con_alertas
+    señales = {s.clave for s in cascade.signals(evidencia, "local")}
+    assert "historial_superpuesto" in señales
+    assert len(index) == 2
@@ -0,0 +1,56 @@
+"""
+Conciliación de nombres (names.py) con pares reales: impostores que comparten un nombre,
+un apellido o solo las primeras letras, y el mismo nombre con iniciales, tildes, orden
+distinto o ruido de OCR.
+
+    python -m pytest test/test_names.py
+"""
+
+import pytest
+
+from fraude_incapacidades.names import match_names, similarity_batch
+
+IMPOSTORES = [
+    ("Ana Martinez", "Ana Maria Rodriguez"),
+    ("Jorge Hernandez", "Jose Herrera"),
+    ("Camilo Rojas", "Carolina Rios"),
+    ("Pedro Garcia", "Luis Garcia"),
+    ("Juan Carlos", "Juan Carlos Perez Gomez"),  # solo los nombres, ningún apellido
+]
+
+MISMA_PERSONA = [
+    ("J. Pérez", "Juan Pérez Gómez"),
+    ("Dr. Juan Pérez", "JUAN CARLOS PEREZ GOMEZ"),
+    ("Pérez Gómez Juan", "Juan Pérez Gómez"),
+    ("MARIA FERNANDA LOPEZ", "María Fernanda López Ruiz"),
+    ("Luz Dary Rodrigez", "Luz Dary Rodríguez Díaz"),
+    ("Jvan Peres", "Juan Pérez"),  # OCR
+    ("Juan P.", "Juan Pérez"),
+]
+
+
+@pytest.mark.parametrize("extraido, registrado", IMPOSTORES)
+def test_impostor_no_coincide(extraido, registrado):
+    assert match_names(extraido, registrado).nivel == "no_coincide"
+
+
+@pytest.mark.parametrize("extraido, registrado", MISMA_PERSONA)
+def test_misma_persona_coincide(extraido, registrado):
+    assert match_names(extraido, registrado).nivel == "coincide"
+
+
+def test_token_bajo_el_minimo_no_suma(monkeypatch):
+    # Con el corte desactivado "Jorge"/"Jose" y "Hernandez"/"Herrera" vuelven a sumar
+    monkeypatch.setenv("FRAUDE_NOMBRE_TOKEN_MIN", "0")
+    assert match_names("Jorge Hernandez", "Jose Herrera").puntaje > 0.7
+
+
+def test_sin_datos():
+    assert match_names("", "Juan Pérez").nivel == "sin_datos"
+    assert match_names("Dr.", "Juan Pérez").nivel == "sin_datos"
+
+
+def test_lote_igual_a_pares():
+    pares = IMPOSTORES + MISMA_PERSONA
+    scores = similarity_batch([a for a, _ in pares], [b for _, b in pares])
+    assert [round(s, 3) for s in scores.tolist()] == [match_names(a, b).puntaje for a, b in pares]
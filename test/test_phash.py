@@ -0,0 +1,80 @@
+"""
+Índice de huellas perceptuales (forensics/phash.py): búsqueda multi-index contra fuerza
+bruta, exclusión del propio documento, umbral, trato de la misma plantilla y páginas
+sin contraste.
+
+    python -m pytest test/test_phash.py
+"""
+
+import random
+
+import numpy as np
+import pytest
+
+from fraude_incapacidades.forensics import phash
+from fraude_incapacidades.forensics.phash import PerceptualHashIndex, hamming
+
+
+def _flip(value, bits, rng):
+    for b in rng.sample(range(64), bits):
+        value ^= 1 << b
+    return value
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    idx = PerceptualHashIndex(tmp_path / "phash.sqlite")
+    monkeypatch.setattr(phash, "_index", idx)
+    return idx
+
+
+def test_consulta_igual_a_fuerza_bruta(index):
+    rng = random.Random(7)
+    base = rng.getrandbits(64)
+    hashes = [_flip(base, rng.randint(0, 12), rng) for _ in range(300)] + [rng.getrandbits(64) for _ in range(300)]
+    for i, h in enumerate(hashes):
+        index.add(f"doc{i}", 1, h, h)
+    esperados = sorted(f"doc{i}" for i, h in enumerate(hashes) if hamming(base, h) <= 6)
+    encontrados = sorted(m.doc_id for m in index.query(base, max_distance=6, limit=10_000))
+    assert encontrados == esperados
+
+
+def test_excluye_el_mismo_documento_y_respeta_el_umbral(index):
+    index.add("a", 1, 0b1111, 0)
+    index.add("b", 1, 0b1111 ^ (0b111 << 20), 0)  # distancia 3
+    assert [m.doc_id for m in index.query(0b1111, 0, max_distance=6, exclude_doc="a")] == ["b"]
+    assert index.query(0b1111, 0, max_distance=2, exclude_doc="a") == []
+
+
+def test_misma_plantilla_exige_distancia_estricta(index):
+    index.add("mismo_formato", 1, 0b111, 0b111, plantilla="sura")
+    index.add("reenviado", 1, 0b1, 0b1, plantilla="sura")
+    index.add("otro_formato", 1, 0b111, 0b111, plantilla="sanitas")
+    matches = index.query(0, 0, max_distance=6, plantilla="sura", plantilla_max_distance=2)
+    assert {m.doc_id for m in matches} == {"reenviado", "otro_formato"}
+
+
+def test_filtro_de_plantilla_antes_del_limite(index):
+    for i in range(5):
+        index.add(f"plantilla{i}", 1, 0b111, 0b111, plantilla="sura")  # distancia 3
+    index.add("copia", 1, 0b1111, 0b1111, plantilla="sanitas")  # distancia 4, otra plantilla
+    matches = index.query(0, 0, max_distance=6, limit=3, plantilla="sura", plantilla_max_distance=2)
+    assert [m.doc_id for m in matches] == ["copia"]
+
+
+def test_check_and_register_alerta_y_registra(index):
+    coincidencias, alertas = phash.check_and_register("d1", "a.pdf", [(5, 5), None], plantilla="sura")
+    assert coincidencias == [] and alertas == [] and len(index) == 1  # la página sin contraste no se indexa
+    coincidencias, alertas = phash.check_and_register("d2", "b.pdf", [(5, 5)], plantilla="sura")
+    assert coincidencias[0]["misma_plantilla"] and "casi idéntica" in alertas[0]
+
+
+def test_pagina_en_blanco_sin_hash():
+    blanca = np.full((800, 600, 3), 255, dtype=np.uint8)
+    assert phash.page_hashes(blanca) is None
+    rng = np.random.default_rng(0)
+    texto = blanca.copy()
+    for _ in range(60):
+        y, x = rng.integers(0, 760), rng.integers(0, 400)
+        texto[y:y + 12, x:x + 180] = 0
+    assert phash.page_hashes(texto) is not None
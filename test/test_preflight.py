@@ -0,0 +1,46 @@
+"""
+Validación previa (forensics/preflight.py): el certificado de ejemplo (A0) pasa sin
+alertas y solo se renderiza con menos zoom; lo que excede los límites se rechaza.
+
+    python -m pytest test/test_preflight.py
+"""
+
+from pathlib import Path
+
+import pytest
+
+fitz = pytest.importorskip("fitz")
+
+from fraude_incapacidades.forensics import preflight
+
+EJEMPLO = Path(__file__).parent / "ejemplo_incapacidad.pdf"
+
+
+def test_pagina_grande_sin_alerta_y_con_zoom_acotado():
+    out = preflight.check_pdf(EJEMPLO)
+    assert out.rechazo is None and out.alertas == []
+    ancho, alto = out.resumen["pagina_mayor_pt"]
+    zoom = preflight.render_zoom(ancho, alto)
+    assert zoom < preflight.BASE_ZOOM
+    assert ancho * alto * zoom**2 <= preflight.render_max_pixels() * 1.001
+    assert preflight.render_zoom(612, 792) == preflight.BASE_ZOOM
+
+
+def test_pagina_fuera_de_especificacion_se_rechaza(tmp_path):
+    doc = fitz.open()
+    doc.new_page(width=15000, height=800)
+    doc.save(tmp_path / "grande.pdf")
+    out = preflight.check_pdf(tmp_path / "grande.pdf")
+    assert out.rechazo and "por lado" in out.rechazo
+    assert out.alertas and out.alertas[0].startswith("⚠️ Documento rechazado")
+
+
+def test_imagen_demasiado_grande_se_rechaza(tmp_path, monkeypatch):
+    from PIL import Image
+
+    Image.new("RGB", (2000, 1000)).save(tmp_path / "foto.png")
+    monkeypatch.setenv("FRAUDE_IMAGEN_MAX_MPX", "1")
+    out = preflight.check_image(tmp_path / "foto.png")
+    assert out.rechazo and "2000×1000" in out.rechazo
+    monkeypatch.setenv("FRAUDE_IMAGEN_MAX_MPX", "80")
+    assert preflight.check_image(tmp_path / "foto.png").rechazo is None
@@ -0,0 +1,124 @@
+"""
+Planificador de llamadas a OpenAI (llm/scheduler.py): ventana RPM/TPM, concurrencia,
+enfriamiento tras un 429, liberación y expiración de leases, y cancelación de `aacquire`.
+
+    python -m pytest test/test_scheduler.py
+"""
+
+import asyncio
+import time
+
+import pytest
+
+from fraude_incapacidades.llm.scheduler import LLMScheduler
+
+
+def test_limite_rpm_de_la_ventana():
+    sched = LLMScheduler(rpm=2, tpm=10_000, max_concurrency=10)
+    for _ in range(2):
+        sched.release(sched.acquire(10, timeout=0.1))
+    with pytest.raises(TimeoutError):
+        sched.acquire(10, timeout=0.2)
+    assert sched.stats()["peticiones_ultimo_minuto"] == 2
+
+
+def test_limite_tpm_cuenta_los_tokens_reales():
+    sched = LLMScheduler(rpm=100, tpm=1000, max_concurrency=10)
+    lease = sched.acquire(900, timeout=0.1)
+    with pytest.raises(TimeoutError):
+        sched.acquire(200, timeout=0.2)
+    sched.release(lease, status_code=200, actual_tokens=100)
+    sched.release(sched.acquire(200, timeout=0.2))
+    assert sched.stats()["tokens_ultimo_minuto"] == 300
+
+
+def test_concurrencia_se_libera_con_release():
+    sched = LLMScheduler(rpm=100, tpm=10_000, max_concurrency=1)
+    lease = sched.acquire(1)
+    with pytest.raises(TimeoutError):
+        sched.acquire(1, timeout=0.3)
+    sched.release(lease, status_code=200)
+    sched.release(sched.acquire(1, timeout=0.3))
+    assert sched.stats()["en_vuelo"] == 0
+
+
+def test_enfriamiento_global_tras_429():
+    sched = LLMScheduler(rpm=100, tpm=10_000, max_concurrency=10)
+    sched.release(sched.acquire(1), status_code=429, retry_after=0.3)
+    inicio = time.monotonic()
+    sched.release(sched.acquire(1, timeout=2.0), status_code=200)
+    assert time.monotonic() - inicio >= 0.3
+    stats = sched.stats()
+    assert stats["respuestas_429"] == 1 and stats["enfriamiento_restante_s"] == 0
+
+
+def test_backoff_exponencial_acotado():
+    sched = LLMScheduler(base_backoff_s=1.0, max_backoff_s=8.0)
+    assert 0.5 <= sched.backoff_delay(1) <= 1.0
+    assert 4.0 <= sched.backoff_delay(10) <= 8.0
+    assert 2.0 <= sched.backoff_delay(1, retry_after=2.0) <= 2.2
+
+
+def test_lease_no_liberado_expira_a_los_hold_segundos():
+    sched = LLMScheduler(rpm=100, tpm=10_000, max_concurrency=1)
+    sched.acquire(1, hold=0.2)
+    sched.release(sched.acquire(1, timeout=1.5))
+    assert sched.stats()["leases_expirados"] == 1
+
+
+def test_prioridad_interactiva_pasa_antes():
+    sched = LLMScheduler(rpm=100, tpm=10_000, max_concurrency=1)
+    orden = []
+
+    async def pedir(nombre, prioridad):
+        lease = await sched.aacquire(1, priority=prioridad, timeout=2.0)
+        orden.append(nombre)
+        sched.release(lease, status_code=200)
+
+    async def main():
+        lease = sched.acquire(1)
+        tareas = [asyncio.create_task(pedir("lote", 10))]
+        await asyncio.sleep(0.05)
+        tareas.append(asyncio.create_task(pedir("interactiva", 0)))
+        await asyncio.sleep(0.05)
+        sched.release(lease)
+        await asyncio.gather(*tareas)
+
+    asyncio.run(main())
+    assert orden == ["interactiva", "lote"]
+
+
+def test_aacquire_cancelado_no_retiene_el_turno():
+    sched = LLMScheduler(rpm=100, tpm=10_000, max_concurrency=1)
+
+    async def main():
+        lease = sched.acquire(1)
+        espera = asyncio.create_task(sched.aacquire(1, timeout=5.0))
+        await asyncio.sleep(0.05)
+        espera.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await espera
+        sched.release(lease)
+        inicio = time.monotonic()
+        siguiente = await sched.aacquire(1, timeout=2.0)
+        sched.release(siguiente)
+        return time.monotonic() - inicio
+
+    assert asyncio.run(main()) < 1.0
+    stats = sched.stats()
+    assert stats["en_vuelo"] == 0 and stats["en_cola"] == 0 and stats["leases_expirados"] == 0
+
+
+def test_aacquire_cancelado_tras_la_concesion_devuelve_el_lease():
+    sched = LLMScheduler(rpm=100, tpm=10_000, max_concurrency=1)
+
+    async def main():
+        espera = asyncio.create_task(sched.aacquire(1))
+        await asyncio.sleep(0)  # el hilo obtiene el turno mientras la tarea se cancela
+        espera.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await espera
+        await asyncio.sleep(0.2)
+
+    asyncio.run(main())
+    assert sched.stats()["en_vuelo"] == 0
@@ -0,0 +1,28 @@
+"""
+Variables de entorno (settings.py): `env_override` restaura los valores previos.
+
+    python -m pytest test/test_settings.py
+"""
+
+import os
+
+import pytest
+
+from fraude_incapacidades.settings import env_float, env_override
+
+
+def test_env_override_restaura_al_salir(monkeypatch):
+    monkeypatch.setenv("FRAUDE_CACHE_TTL_VISION", "600")
+    monkeypatch.delenv("FRAUDE_CACHE_TTL_OSINT", raising=False)
+    with env_override(FRAUDE_CACHE_TTL_VISION="0", FRAUDE_CACHE_TTL_OSINT="0"):
+        assert env_float("FRAUDE_CACHE_TTL_VISION", 1.0) == 0.0
+        assert env_float("FRAUDE_CACHE_TTL_OSINT", 1.0) == 0.0
+    assert os.environ["FRAUDE_CACHE_TTL_VISION"] == "600"
+    assert "FRAUDE_CACHE_TTL_OSINT" not in os.environ
+
+
+def test_env_override_restaura_ante_errores(monkeypatch):
+    monkeypatch.delenv("FRAUDE_CACHE_TTL_ADRES", raising=False)
+    with pytest.raises(RuntimeError), env_override(FRAUDE_CACHE_TTL_ADRES="0"):
+        raise RuntimeError
+    assert "FRAUDE_CACHE_TTL_ADRES" not in os.environ
@@ -0,0 +1,78 @@
+"""
+Biblioteca de plantillas (forensics/templates.py) con PDFs generados: anclas a partir de
+las etiquetas de los campos, sin desviaciones antes de consolidar la plantilla y con el
+bloque desplazado detectado después.
+
+    python -m pytest test/test_templates.py
+"""
+
+import pytest
+
+fitz = pytest.importorskip("fitz")
+
+from fraude_incapacidades.forensics.templates import TemplateLibrary, extract_layout
+
+DOCUMENTOS = [
+    ("Ana Pérez", "1012345", 5),
+    ("Luis Gómez", "2034567", 3),
+    ("Marta Ruiz", "3045678", 7),
+]
+
+
+def _pdf(nombre, cedula, dias, desplazamiento=0):
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_text((50, 80), "EPS SURA - Certificado de incapacidad")
+    page.insert_text((50, 120), f"Paciente: {nombre}")
+    page.insert_text((50, 140), f"Documento: {cedula}")
+    page.insert_text((50, 160 + desplazamiento), f"Días de incapacidad: {dias}")
+    page.insert_text((50, 200), f"Expedido a {nombre}")
+    page.insert_text((50, 220), "Dirección: Calle 45 # 5-10")
+    return doc
+
+
+def _datos(nombre, cedula, dias):
+    return {"paciente_nombre": nombre, "paciente_cedula": cedula, "dias_incapacidad": str(dias), "eps_o_ips": "SURA"}
+
+
+@pytest.fixture
+def biblioteca(tmp_path):
+    return TemplateLibrary(tmp_path / "plantillas.json")
+
+
+def test_etiquetas_de_campos_son_anclas(biblioteca):
+    for nombre, cedula, dias in DOCUMENTOS:
+        tpl = biblioteca.learn(extract_layout(_pdf(nombre, cedula, dias)), "SURA", _datos(nombre, cedula, dias))
+    anclas = {a["texto"] for a in tpl.anchors}
+    assert {"paciente:", "documento:", "dias de incapacidad:"} <= anclas
+    assert "eps sura - certificado de incapacidad" in anclas  # la EPS no se ubica en el título
+    assert not any(a["texto"].startswith("expedido") for a in tpl.anchors)  # texto variable
+
+
+def test_sin_desviaciones_antes_de_consolidar(biblioteca, monkeypatch):
+    monkeypatch.setenv("FRAUDE_TEMPLATE_MIN_DOCS", "3")
+    nombre, cedula, dias = DOCUMENTOS[0]
+    biblioteca.learn(extract_layout(_pdf(nombre, cedula, dias)), "SURA", _datos(nombre, cedula, dias))
+    doc = _pdf(*DOCUMENTOS[1])
+    match = biblioteca.match(extract_layout(doc), doc)
+    assert match is not None and match.desviaciones == []
+
+
+def test_bloque_desplazado_tras_consolidar(biblioteca, monkeypatch):
+    monkeypatch.setenv("FRAUDE_TEMPLATE_MIN_DOCS", "3")
+    for nombre, cedula, dias in DOCUMENTOS:
+        biblioteca.learn(extract_layout(_pdf(nombre, cedula, dias)), "SURA", _datos(nombre, cedula, dias))
+    doc = _pdf("Pedro Díaz", "4056789", 2)
+    match = biblioteca.match(extract_layout(doc), doc)
+    assert match.confianza == 1.0 and match.desviaciones == []
+    assert match.campos["paciente_cedula"] == "4056789" and match.campos["eps_o_ips"] == "SURA"
+
+    doc = _pdf("Rosa León", "5067890", 4, desplazamiento=40)
+    match = biblioteca.match(extract_layout(doc), doc)
+    assert len(match.desviaciones) == 1 and "desplazado" in match.desviaciones[0]
+
+
+def test_valor_corto_sin_etiqueta_no_se_ubica():
+    doc = _pdf("Ana Pérez", "1012345", 7)
+    regiones = TemplateLibrary._locate_fields(extract_layout(doc), {"codigo_cie10": "5"})
+    assert regiones == {}